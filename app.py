@@ -1,93 +1,363 @@
-from flask import Flask, request, abort
-from linebot.v3 import WebhookHandler
-from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
-    MessagingApiBlob,
-    ReplyMessageRequest,
-    PushMessageRequest,
-    TextMessage,
-    FlexMessage,
-    FlexContainer
+import hmac
+import json
+import queue
+import threading
+import time
+from flask import Flask, Response, request, abort, jsonify
+from config import (
+    LINE_CHANNEL_SECRET, LINE_CHANNEL_ACCESS_TOKEN,
+    JOB_QUEUE_BACKEND, JOB_QUEUE_MAXSIZE, JOB_QUEUE_DB_PATH, RECOGNITION_WORKERS,
+    BATCH_WINDOW_SECONDS, BATCH_MAX_WAIT_SECONDS, BATCH_MAX_IMAGES,
+    LINE_POOL_SIZE, LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT, LINE_BLOB_READ_TIMEOUT, LINE_API_HOST,
+    DOWNLOAD_MAX_BYTES, WARMUP_ON_START
 )
-from linebot.v3.webhooks import (
-    MessageEvent,
-    TextMessageContent,
-    ImageMessageContent,
-    StickerMessageContent
+from utils.bot import (
+    sign_body, split_events, processed_events, admission, ADMISSION_NOTICES, ADMISSION_BUSY_NOTICE,
+    DOWNLOAD_REJECTED_NOTICE, PREFILTER_NOTICE, reply_scheduler, USE_PREVIEW, use_preview, batch_key,
+    build_bubble, build_result_message, record_delivery, delivery_stats,
+    WEBHOOK_REQUESTS, WEBHOOK_EVENTS, IMAGE_REQUESTS, IMAGE_REQUEST_SECONDS
+)
+from utils.gemini import (
+    recognize_restaurant, recognize_restaurants, recognition_cache, model_cascade, prompt_cache, usage_stats,
+    stream_stats, parse_stats, single_flight, usage_ledger, shop_index, prefilter, key_pool,
+    resilience
 )
-import requests
-from config import LINE_CHANNEL_SECRET, LINE_CHANNEL_ACCESS_TOKEN, GEMINI_API_KEY
-from utils.gemini import recognize_restaurant
 from utils.validator import validate_result
-from utils.maps import generate_maps_url
+from utils.jobs import WorkerPool, create_job_queue
+from utils.batcher import ImageBatcher
+from utils.admission import ADMITTED, QUEUED, DEFERRED, REJECTED_GLOBAL
+from utils.merge import normalize_key
+from utils.line_client import LineClients
+from utils.download import DownloadRejected
+from utils.delivery import text_message
+from utils.gazetteer import get_gazetteer
+from utils.genai_client import warm_up as warm_up_genai
+from utils.warmup import Warmup, preload_modules
+from utils.log import get_logger
+from utils import metrics
 
 app = Flask(__name__)
 
-# LINE Bot API 設定
-print(f"=== 環境變數檢查 ===")
-print(f"LINE_CHANNEL_ACCESS_TOKEN 長度: {len(LINE_CHANNEL_ACCESS_TOKEN) if LINE_CHANNEL_ACCESS_TOKEN else 'None'}")
-print(f"LINE_CHANNEL_ACCESS_TOKEN 前10碼: {LINE_CHANNEL_ACCESS_TOKEN[:10] if LINE_CHANNEL_ACCESS_TOKEN else 'None'}")
-print(f"LINE_CHANNEL_SECRET 長度: {len(LINE_CHANNEL_SECRET) if LINE_CHANNEL_SECRET else 'None'}")
-print(f"GEMINI_API_KEY 長度: {len(GEMINI_API_KEY) if GEMINI_API_KEY else 'None'}")
+log = get_logger('app')
+
+# 指標（GET /metrics；兩種模式共用的 webhook / 圖片指標在 utils/bot.py）
+FIRST_CARD_SECONDS = metrics.histogram('maps_first_card_seconds', '串流模式第一張卡片送出的時間（秒）')
+
+# 每個行程共用的 LINE API client（訊息 / 下載圖片各自的 keep-alive 連線池）
+line_clients = LineClients(
+    LINE_CHANNEL_ACCESS_TOKEN,
+    pool_size=LINE_POOL_SIZE,
+    connect_timeout=LINE_CONNECT_TIMEOUT,
+    read_timeout=LINE_READ_TIMEOUT,
+    blob_read_timeout=LINE_BLOB_READ_TIMEOUT,
+    host=LINE_API_HOST
+)
+
+# WebhookHandler 會載入全部 webhook model，第一次分派事件（或預熱）時才建立
+_handler = None
+_handler_lock = threading.Lock()
+
+def get_handler():
+    """取得註冊好各訊息 handler 的 WebhookHandler"""
+    global _handler
+    if _handler is None:
+        with _handler_lock:
+            if _handler is None:
+                from linebot.v3 import WebhookHandler
+                from linebot.v3.webhooks import (
+                    MessageEvent,
+                    TextMessageContent,
+                    ImageMessageContent,
+                    StickerMessageContent
+                )
+                handler = WebhookHandler(LINE_CHANNEL_SECRET)
+                handler.add(MessageEvent, message=ImageMessageContent)(handle_image_message)
+                handler.add(MessageEvent, message=StickerMessageContent)(handle_sticker_message)
+                handler.add(MessageEvent, message=TextMessageContent)(handle_text_message)
+                _handler = handler
+    return _handler
 
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+def process_webhook_job(payload):
+    """背景 worker：實際分派 webhook 事件給各個 handler（圖片先過流量控制）"""
+    if not admit_job(payload):
+        return
+    # 原始 body 已在 webhook 驗證過簽名；拆開後的 body 重新簽章，沿用 WebhookHandler 的分派
+    body = payload['body']
+    get_handler().handle(body, sign_body(body))
+
+# 背景辨識 worker（gunicorn 每個 worker 行程各自一組執行緒）
+job_pool = WorkerPool(
+    create_job_queue(JOB_QUEUE_BACKEND, JOB_QUEUE_MAXSIZE, JOB_QUEUE_DB_PATH),
+    process_webhook_job,
+    RECOGNITION_WORKERS
+)
+
+# 同一位使用者連續傳的圖片合併成一批（視窗設為 0 表示不合併）
+image_batcher = ImageBatcher(
+    window=BATCH_WINDOW_SECONDS,
+    max_wait=BATCH_MAX_WAIT_SECONDS,
+    max_items=BATCH_MAX_IMAGES
+) if BATCH_WINDOW_SECONDS > 0 else None
+
+# 冷啟動預熱（每個 worker 行程各跑一次，依序執行）
+warmup = Warmup()
+warmup.add('modules', preload_modules)
+warmup.add('gemini', warm_up_genai)
+warmup.add('webhook', get_handler)
+warmup.add('gazetteer', get_gazetteer)
+warmup.add('line', line_clients.warm_up)
+
+def start_background():
+    """啟動本行程的辨識 worker 與背景預熱（gunicorn post_fork 會呼叫；重複呼叫沒有影響）"""
+    job_pool.start()
+    if WARMUP_ON_START:
+        warmup.start()
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """存活檢查：立即回應，不等預熱完成（順便觸發背景預熱）"""
+    start_background()
+    return jsonify({'status': 'ok', 'warmup': warmup.status()['state']})
+
+@app.route('/warmup', methods=['GET', 'POST'])
+def warmup_endpoint():
+    """同步跑完預熱步驟再回應（平台喚醒容器後可以先呼叫這裡）"""
+    job_pool.start()
+    status = warmup.run()
+    return jsonify(status), 200 if status['state'] == 'warm' else 503
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    """LINE Bot webhook endpoint"""
+    """LINE Bot webhook endpoint（只驗證簽名並排入佇列，立即回 200）"""
     # 取得 X-Line-Signature header
-    signature = request.headers['X-Line-Signature']
+    signature = request.headers.get('X-Line-Signature', '')
 
     # 取得 request body
     body = request.get_data(as_text=True)
-    print(f"收到 webhook 請求，body: {body[:200]}...")  # 只印前 200 字元
 
-    # 處理 webhook
+    # 先驗證簽名，不合法的請求不進佇列
+    if not hmac.compare_digest(sign_body(body), signature):
+        WEBHOOK_REQUESTS.inc(status='bad_signature')
+        log.warning('webhook_bad_signature', bytes=len(body))
+        abort(400)
+
     try:
-        handler.handle(body, signature)
-    except InvalidSignatureError as e:
-        print(f"簽名驗證失敗: {e}")
+        event_bodies = split_events(body)
+    except (ValueError, AttributeError) as e:
+        WEBHOOK_REQUESTS.inc(status='bad_body')
+        log.warning('webhook_bad_body', bytes=len(body), error=str(e))
         abort(400)
-    except Exception as e:
-        print(f"處理 webhook 錯誤: {e}")
-        import traceback
-        traceback.print_exc()
+    log.sampled('webhook_received', events=len(event_bodies), bytes=len(body))
+
+    # 每個事件各自排入背景佇列，由辨識 worker 處理（已受理過的事件直接略過）
+    start_background()
+    queued = []
+    try:
+        for event, event_body in event_bodies:
+            if not processed_events.claim(event):
+                log.info('duplicate_event_skipped', event_id=event.get('webhookEventId'),
+                         redelivery=bool((event.get('deliveryContext') or {}).get('isRedelivery')))
+                continue
+            try:
+                job_pool.submit({'body': event_body})
+            except queue.Full:
+                processed_events.release(event)
+                raise
+            queued.append(event)
+    except queue.Full:
+        # 還沒排入的事件會由 LINE 重送；已排入的會照常處理，重送時會被略過
+        WEBHOOK_REQUESTS.inc(status='queue_full')
+        log.warning('job_queue_full', maxsize=JOB_QUEUE_MAXSIZE, queued=len(queued))
+        abort(503)
 
+    WEBHOOK_REQUESTS.inc(status='ok')
+    WEBHOOK_EVENTS.inc(len(queued))
     return 'OK'
 
-@handler.add(MessageEvent, message=ImageMessageContent)
-def handle_image_message(event):
-    """處理圖片訊息"""
-    print("=== 觸發圖片訊息處理器 ===")
-    try:
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
+@app.route('/stats', methods=['GET'])
+def stats():
+    """背景佇列、辨識快取、模型分層與 token 用量統計"""
+    result = {
+        'queue': job_pool.stats(),
+        'events': processed_events.stats(),
+        'cascade': model_cascade.stats(),
+        'prompt_cache': prompt_cache.stats(),
+        'keys': key_pool.stats(),
+        'resilience': resilience.stats(),
+        'usage': usage_stats(),
+        'parse': parse_stats(),
+        'line': line_clients.stats(),
+        'delivery': delivery_stats(),
+        'reply': reply_scheduler.stats(),
+        'stream': stream_stats(),
+        'warmup': warmup.status(),
+        'single_flight': single_flight.stats(),
+        'ledger': usage_ledger.summary(),
+    }
+    if recognition_cache:
+        result['cache'] = recognition_cache.stats()
+    if image_batcher:
+        result['batch'] = image_batcher.stats()
+    if admission:
+        result['admission'] = admission.stats()
+    if shop_index:
+        result['shops'] = shop_index.stats()
+    if prefilter:
+        result['prefilter'] = prefilter.stats()
+    return jsonify(result)
+
+metrics.gauge('maps_job_queue_depth', '佇列中等待處理的工作數').set_function(lambda: job_pool.stats()['depth'])
+metrics.gauge('maps_job_workers_busy', '正在處理工作的 worker 執行緒數').set_function(lambda: job_pool.stats()['busy'])
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 格式的指標（以本行程為準，每筆帶 pid 標籤）"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def admit_job(payload):
+    """
+    流量控制：圖片事件要不要處理（在分派、下載之前）
 
-            # 先回「辨識中...」
-            line_bot_api.reply_message(
+    全域太忙時不在辨識 worker 執行緒裡等：工作延後放回佇列（not_before），
+    執行緒先去處理其他工作（例如命中快取、不用呼叫 Gemini 的圖）。
+    婉拒時用這張圖的 reply token 回一則說明（同一位使用者一段時間內只回一次）。
+
+    回傳:
+        bool: True 表示繼續分派這個事件
+    """
+    if not admission:
+        return True
+    event = json.loads(payload['body'])['events'][0]
+    message = event.get('message') or {}
+    if event.get('type') != 'message' or message.get('type') != 'image':
+        return True
+
+    user_id = (event.get('source') or {}).get('userId')
+    now = time.time()
+    since = payload.get('admission_since', now)
+    decision, seconds = admission.admit(user_id, waited=now - since)
+    if decision == DEFERRED:
+        try:
+            job_pool.submit(dict(payload, admission_since=since), not_before=now + seconds)
+            log.sampled('image_admission_deferred', message_id=message.get('id'), retry_ms=round(seconds * 1000, 1))
+            return False
+        except queue.Full:
+            decision = REJECTED_GLOBAL
+    if decision in (ADMITTED, QUEUED):
+        if decision == QUEUED:
+            log.sampled('image_admission_queued', waited_ms=round(seconds * 1000, 1))
+        return True
+
+    log.info('image_rejected', decision=decision, message_id=message.get('id'))
+    if admission.should_notify(user_id):
+        from linebot.v3.messaging import ReplyMessageRequest, TextMessage
+        try:
+            line_clients.messaging().reply_message(
                 ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text='🔍 辨識中...')]
+                    reply_token=event.get('replyToken'),
+                    messages=[TextMessage(text=ADMISSION_NOTICES.get(decision, ADMISSION_BUSY_NOTICE))]
                 )
             )
+        except Exception:
+            log.exception('admission_notice_failed')
+    return False
+
+def download_image(message_id):
+    """
+    下載一張圖片（超過 DOWNLOAD_MAX_BYTES 或不是支援的格式時中途放棄）
 
-            # 下載圖片（使用 MessagingApiBlob）
-            message_id = event.message.id
-            print(f"開始下載圖片，message_id: {message_id}")
+    USE_PREVIEW 時先下載預覽圖，解析度不夠或失敗才改下載原圖。
 
-            # LINE Bot SDK v3 使用 MessagingApiBlob 下載圖片
-            blob_api = MessagingApiBlob(api_client)
-            image_data = blob_api.get_message_content(message_id)
-            print(f"圖片下載完成，大小: {len(image_data)} bytes")
+    回傳:
+        bytes: 圖片內容
 
-            # 辨識店家資訊
-            print("開始辨識店家資訊...")
-            result = recognize_restaurant(image_data)
-            print(f"辨識結果: {result}")
+    例外:
+        DownloadRejected: 原圖太大或格式不支援
+    """
+    if USE_PREVIEW:
+        try:
+            image_data = line_clients.download(message_id, DOWNLOAD_MAX_BYTES, preview=True)
+            if use_preview(image_data):
+                log.sampled('image_preview_used', message_id=message_id, bytes=len(image_data))
+                return image_data
+        except Exception as e:
+            log.sampled('image_preview_failed', message_id=message_id, error=str(e))
+    return line_clients.download(message_id, DOWNLOAD_MAX_BYTES)
+
+def handle_image_message(event):
+    """處理圖片訊息（同一位使用者連續傳的圖片會合併成一批辨識；流量控制已在 admit_job 做過）"""
+    if not image_batcher:
+        process_image_events([event])
+        return
+
+    image_set = getattr(event.message, 'image_set', None)
+    events = image_batcher.submit(
+        batch_key(event), event,
+        expected_total=image_set.total if image_set else None
+    )
+    if events is None:
+        # 已併入同一批，由第一張圖的 worker 合併辨識
+        log.sampled('image_batched', message_id=event.message.id)
+        return
+
+    # 依傳送順序排列（同一個圖片集的時間戳相同，再依圖片編號）
+    events.sort(key=lambda e: (
+        e.timestamp,
+        (e.message.image_set.index or 0) if e.message.image_set else 0
+    ))
+    process_image_events(events)
+
+def process_image_events(events):
+    """辨識一批圖片（1 張以上），結果優先用第一張圖的 reply token 送出，來不及才回「辨識中」再推送"""
+    event = events[0]
+    start = time.perf_counter()
+    early = {'restaurant': None, 'at': None}  # 串流模式下先送出的第一家店
+    summary = {'images': len(events), 'outcome': 'error', 'restaurants': 0}
+    with metrics.trace() as timings:
+        # 期限內有結果就用 reply 送出；期限到了會在背景回「辨識中」（同一批只用第一張圖的 reply token）
+        slot = reply_scheduler.open(
+            event.reply_token, event.source.user_id, line_clients.reply, line_clients.push, timestamp=event.timestamp
+        )
+        try:
+            # 下載圖片（邊下載邊檢查大小與格式，太大 / 不支援的圖片略過）
+            images_data = []
+            for image_event in events:
+                message_id = image_event.message.id
+                try:
+                    with metrics.span('download'):
+                        image_data = download_image(message_id)
+                except DownloadRejected as e:
+                    log.warning('image_download_rejected', message_id=message_id, reason=e.reason, detail=str(e))
+                    continue
+                log.sampled('image_downloaded', message_id=message_id, bytes=len(image_data))
+                images_data.append(image_data)
+            summary['bytes'] = sum(len(image_data) for image_data in images_data)
+
+            if not images_data:
+                summary['outcome'] = 'rejected'
+                summary['delivery'] = slot.send([text_message(DOWNLOAD_REJECTED_NOTICE)])
+                return
+
+            def send_first_card(restaurant):
+                # 串流模式：第一家店解析完成就先送出，其餘等整份結果出來再送
+                if early['restaurant'] is not None:
+                    return
+                with metrics.span('flex'):
+                    message = build_result_message([build_bubble(restaurant, 0, None)], 1, restaurant['name'])
+                summary['delivery'] = slot.send([message])
+                early['restaurant'] = restaurant
+                early['at'] = time.perf_counter() - start
+
+            # 辨識店家資訊（多張圖一次送給 Gemini）
+            with metrics.span('recognize'):
+                if len(images_data) == 1:
+                    result = recognize_restaurant(
+                        images_data[0], on_restaurant=send_first_card, user_id=event.source.user_id
+                    )
+                else:
+                    result = recognize_restaurants(
+                        images_data, on_restaurant=send_first_card, user_id=event.source.user_id
+                    )
 
             # 驗證結果
             if validate_result(result):
@@ -104,159 +374,79 @@ def handle_image_message(event):
                     }]
                     count = 1
 
-                print(f"辨識到 {count} 個店家")
-                if food_keywords:
-                    print(f"食物關鍵字: {food_keywords}")
-
-                # 建立卡片
-                bubbles = []
-                for idx, restaurant in enumerate(restaurants[:10]):  # 最多 10 個
-                    name = restaurant.get('name', 'unknown')
-                    address = restaurant.get('address', 'unknown')
-                    original_handle = restaurant.get('original_handle', '')
-
-                    # 生成 Google Maps URL（加入原始帳號 + 食物關鍵字提高搜尋精確度）
-                    maps_url = generate_maps_url(name, address, food_keywords, original_handle)
-
-                    # 建立卡片內容
-                    card_contents = [
-                        {
-                            "type": "text",
-                            "text": f"🏪 店家 {idx + 1}/{count}" if count > 1 else "🏪 找到店家！",
-                            "weight": "bold",
-                            "size": "md",
-                            "color": "#1DB446"
-                        },
-                        {
-                            "type": "text",
-                            "text": name,
-                            "weight": "bold",
-                            "size": "xl",
-                            "margin": "md",
-                            "wrap": True
-                        }
+                summary.update(outcome='found', restaurants=count, food_keywords=food_keywords,
+                               names=[restaurant.get('name') for restaurant in restaurants[:10]])
+
+                # 建立卡片（已先送出的那一家不再重送）
+                sent_key = normalize_key(early['restaurant']['name']) if early['restaurant'] else None
+                with metrics.span('flex'):
+                    bubbles = [
+                        build_bubble(restaurant, idx, count, food_keywords)
+                        for idx, restaurant in enumerate(restaurants[:10])  # 最多 10 個
+                        if normalize_key(restaurant.get('name')) != sent_key
                     ]
+                    message = build_result_message(bubbles, count, restaurants[0]['name']) if bubbles else None
 
-                    # 如果有地址，才顯示地址
-                    if address and address != 'unknown' and address.strip():
-                        card_contents.append({
-                            "type": "text",
-                            "text": address,
-                            "size": "sm",
-                            "color": "#999999",
-                            "margin": "md",
-                            "wrap": True
-                        })
-                    else:
-                        card_contents.append({
-                            "type": "text",
-                            "text": "📍 地址未提供",
-                            "size": "sm",
-                            "color": "#AAAAAA",
-                            "margin": "md"
-                        })
-
-                    # 建立單張卡片
-                    bubble = {
-                        "type": "bubble",
-                        "body": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": card_contents
-                        },
-                        "footer": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "button",
-                                    "style": "primary",
-                                    "color": "#1DB446",
-                                    "action": {
-                                        "type": "uri",
-                                        "label": "🗺️ 開啟地圖",
-                                        "uri": maps_url
-                                    }
-                                }
-                            ]
-                        }
-                    }
-                    bubbles.append(bubble)
-
-                # 根據店家數量決定訊息類型
-                if count == 1:
-                    # 單個店家：單張卡片
-                    flex_message_json = bubbles[0]
-                    alt_text = f"{restaurants[0]['name']}"
-                else:
-                    # 多個店家：Carousel 輪播
-                    flex_message_json = {
-                        "type": "carousel",
-                        "contents": bubbles
-                    }
-                    alt_text = f"找到 {count} 家店，滑動查看"
-
-                flex_message = FlexMessage(
-                    alt_text=alt_text,
-                    contents=FlexContainer.from_dict(flex_message_json)
-                )
+                # 送出訊息（第一則結果沒先送出過的話走 reply）
+                if message:
+                    delivery = slot.send([message])
+                    summary.setdefault('delivery', delivery)
 
-                # 推送訊息
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=event.source.user_id,
-                        messages=[flex_message]
-                    )
-                )
+            elif early['restaurant'] is None:
+                # 辨識失敗（或預篩判定沒有店名，沒有呼叫 Gemini）
+                skipped = result.get('skipped') == 'prefilter'
+                summary['outcome'] = 'skipped' if skipped else 'empty'
+                summary['delivery'] = slot.send([text_message(PREFILTER_NOTICE if skipped else '😅 抱歉辨識不出來')])
+            else:
+                summary['outcome'] = 'found'
 
+            record_delivery(early['at'], time.perf_counter() - start)
+
+        except Exception:
+            log.exception('image_processing_failed', images=len(events))
+            if early['restaurant'] is not None:
+                # 已經有卡片送到使用者手上，不再補一則失敗訊息
+                summary['outcome'] = 'found'
             else:
-                # 辨識失敗
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=event.source.user_id,
-                        messages=[TextMessage(text='😅 抱歉辨識不出來')]
-                    )
-                )
+                try:
+                    summary['delivery'] = slot.send([text_message('😅 抱歉辨識不出來')])
+                except Exception:
+                    log.exception('failure_notice_failed')
 
-    except Exception as e:
-        print(f"處理圖片錯誤: {e}")
-        try:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=event.source.user_id,
-                        messages=[TextMessage(text='😅 抱歉辨識不出來')]
-                    )
-                )
-        except:
-            pass
+        finally:
+            slot.close()
+            total = time.perf_counter() - start
+            IMAGE_REQUESTS.inc(outcome=summary['outcome'])
+            IMAGE_REQUEST_SECONDS.observe(total)
+            if early['at'] is not None:
+                FIRST_CARD_SECONDS.observe(early['at'])
+                summary['first_card_ms'] = round(early['at'] * 1000, 1)
+            log.info('image_processed', total_ms=round(total * 1000, 1), stages=dict(timings), **summary)
 
-@handler.add(MessageEvent, message=StickerMessageContent)
 def handle_sticker_message(event):
     """處理貼圖訊息"""
-    print("=== 觸發貼圖訊息處理器 ===")
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text='貼圖很可愛！但我需要美食截圖才能幫你找店家喔 📸')]
-            )
+    from linebot.v3.messaging import ReplyMessageRequest, TextMessage
+
+    line_bot_api = line_clients.messaging()
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text='貼圖很可愛！但我需要美食截圖才能幫你找店家喔 📸')]
         )
+    )
 
-@handler.add(MessageEvent, message=TextMessageContent)
 def handle_text_message(event):
     """處理文字訊息"""
-    print("=== 觸發文字訊息處理器 ===")
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text='請傳截圖給我！📸')]
-            )
+    from linebot.v3.messaging import ReplyMessageRequest, TextMessage
+
+    line_bot_api = line_clients.messaging()
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text='請傳截圖給我！📸')]
         )
+    )
 
 if __name__ == '__main__':
+    start_background()
     app.run(host='0.0.0.0', port=8080)
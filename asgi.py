@@ -0,0 +1,472 @@
+import asyncio
+import hmac
+import json
+import time
+from config import (
+    LINE_CHANNEL_SECRET, LINE_CHANNEL_ACCESS_TOKEN, LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT, LINE_BLOB_READ_TIMEOUT,
+    LINE_API_HOST, DOWNLOAD_MAX_BYTES, JOB_QUEUE_MAXSIZE, BATCH_WINDOW_SECONDS, BATCH_MAX_WAIT_SECONDS,
+    BATCH_MAX_IMAGES, WARMUP_ON_START,
+    ASYNC_MAX_CONCURRENCY, ASYNC_LINE_POOL_SIZE, ASYNC_REPLY_TIMEOUT, ASYNC_DOWNLOAD_TIMEOUT, ASYNC_GEMINI_TIMEOUT,
+    ASYNC_PUSH_TIMEOUT, ASYNC_REQUEST_TIMEOUT, ASYNC_SHUTDOWN_GRACE_SECONDS
+)
+from utils.bot import (
+    sign_body, split_events, processed_events, admission, ADMISSION_NOTICES, ADMISSION_BUSY_NOTICE,
+    DOWNLOAD_REJECTED_NOTICE, PREFILTER_NOTICE, reply_scheduler, USE_PREVIEW, use_preview, batch_key,
+    build_bubble, build_result_message, record_delivery, delivery_stats,
+    WEBHOOK_REQUESTS, WEBHOOK_EVENTS, IMAGE_REQUESTS, IMAGE_REQUEST_SECONDS
+)
+from utils.gemini import (
+    recognize_restaurants_async, recognition_cache, model_cascade, prompt_cache, usage_stats,
+    parse_stats, async_single_flight, usage_ledger, shop_index, prefilter, key_pool,
+    resilience
+)
+from utils.validator import validate_result
+from utils.batcher import AsyncImageBatcher
+from utils.admission import ADMITTED, QUEUED, DEFERRED
+from utils.download import DownloadRejected
+from utils.delivery import text_message
+from utils.line_client import AsyncLineClients
+from utils.gazetteer import get_gazetteer
+from utils.genai_client import warm_up as warm_up_genai
+from utils.warmup import Warmup, preload_modules
+from utils.log import get_logger
+from utils import metrics
+
+# ASGI 模式（APP_MODE=async，gunicorn 改用 uvicorn worker 載入 asgi:app）
+#
+# 同步模式每個 worker 行程只有 RECOGNITION_WORKERS 條辨識執行緒，而每張圖幾乎都在等網路
+# （LINE 下載、Gemini）。這裡改用 asyncio：LINE 用 AsyncMessagingApi / AsyncMessagingApiBlob，
+# Gemini 用 generate_content_async，一個行程可以同時處理數百張圖，
+# CPU 工作（解碼、前處理、SQLite）才丟到執行緒裡跑。
+#
+# 行為與同步模式相同（驗簽名、去重、流量控制、合併多張圖、reply 優先送出卡片 / 來不及才回「辨識中」、失敗通知），
+# 簽名驗證、去重、流量控制、卡片與統計和 app.py 共用 utils/bot.py（不會載入 Flask app 與同步模式的
+# LINE 連線池、背景 worker、圖片聚合）；差別：
+#   - 每個階段各自逾時（ASYNC_*_TIMEOUT），整批也有上限，超過就取消並通知辨識失敗
+#   - 關機時先等進行中的辨識最多 ASYNC_SHUTDOWN_GRACE_SECONDS 秒，之後取消
+#   - 不支援串流先推第一家店（GEMINI_STREAMING 只用在同步模式）
+
+log = get_logger('asgi')
+
+ASYNC_TASKS = metrics.gauge('maps_async_tasks_in_flight', 'ASGI 模式進行中的事件處理 task 數')
+ASYNC_TIMEOUTS = metrics.counter('maps_async_timeouts_total', 'ASGI 模式各階段逾時次數', ['stage'])
+
+# LINE SDK v3 沒有 asyncio 版的 webhook parser；解析只花 CPU，沿用同步的 WebhookParser
+_parser = None
+
+def get_parser():
+    """取得 WebhookParser（第一次呼叫時才載入全部 webhook model）"""
+    global _parser
+    if _parser is None:
+        from linebot.v3 import WebhookParser
+        _parser = WebhookParser(LINE_CHANNEL_SECRET)
+    return _parser
+
+line_clients = AsyncLineClients(
+    LINE_CHANNEL_ACCESS_TOKEN,
+    pool_size=ASYNC_LINE_POOL_SIZE,
+    connect_timeout=LINE_CONNECT_TIMEOUT,
+    read_timeout=LINE_READ_TIMEOUT,
+    blob_read_timeout=LINE_BLOB_READ_TIMEOUT,
+    host=LINE_API_HOST
+)
+
+# 同一位使用者連續傳的圖片合併成一批（視窗設為 0 表示不合併）
+image_batcher = AsyncImageBatcher(
+    window=BATCH_WINDOW_SECONDS,
+    max_wait=BATCH_MAX_WAIT_SECONDS,
+    max_items=BATCH_MAX_IMAGES
+) if BATCH_WINDOW_SECONDS > 0 else None
+
+# 進行中的事件處理 task；同時辨識的數量由 semaphore 限制，等待中的 task 數等同同步模式的佇列長度
+_tasks = set()
+_slots = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+ASYNC_TASKS.set_function(lambda: len(_tasks))
+
+# 冷啟動預熱（lifespan startup 時在背景執行緒跑）
+warmup = Warmup()
+warmup.add('modules', preload_modules)
+warmup.add('gemini', warm_up_genai)
+warmup.add('webhook', get_parser)
+warmup.add('gazetteer', get_gazetteer)
+
+
+async def with_timeout(stage, awaitable, timeout):
+    """
+    等待一個階段，超過 timeout 秒就取消並丟出 TimeoutError（記到 maps_async_timeouts_total）
+
+    參數:
+        stage: str - 階段名稱（reply / download / push / request）
+        awaitable: 要等待的 coroutine
+        timeout: float - 秒數（None 或 0 表示不限制）
+    """
+    try:
+        return await asyncio.wait_for(awaitable, timeout or None)
+    except asyncio.TimeoutError:
+        ASYNC_TIMEOUTS.inc(stage=stage)
+        log.warning('stage_timeout', stage=stage, timeout=timeout)
+        raise
+
+
+async def reply_text(reply_token, text):
+    """用 reply token 回一則文字訊息"""
+    from linebot.v3.messaging import ReplyMessageRequest, TextMessage
+
+    await with_timeout('reply', line_clients.messaging().reply_message(
+        ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=text)])
+    ), ASYNC_REPLY_TIMEOUT)
+
+
+async def reply_messages(reply_token, messages):
+    """用 reply token 回覆 JSON 格式的訊息（reply_scheduler 用）"""
+    await with_timeout('reply', line_clients.reply(reply_token, messages), ASYNC_REPLY_TIMEOUT)
+
+
+async def push_messages(to, messages):
+    """推播 JSON 格式的訊息（reply_scheduler 用）"""
+    await with_timeout('push', line_clients.push(to, messages), ASYNC_PUSH_TIMEOUT)
+
+
+async def download_image(message_id):
+    """下載一張圖片（同 app.download_image；每次下載各自逾時）"""
+    if USE_PREVIEW:
+        try:
+            image_data = await with_timeout(
+                'download', line_clients.download(message_id, DOWNLOAD_MAX_BYTES, preview=True), ASYNC_DOWNLOAD_TIMEOUT
+            )
+            if use_preview(image_data):
+                log.sampled('image_preview_used', message_id=message_id, bytes=len(image_data))
+                return image_data
+        except Exception as e:
+            log.sampled('image_preview_failed', message_id=message_id, error=str(e))
+    return await with_timeout(
+        'download', line_clients.download(message_id, DOWNLOAD_MAX_BYTES), ASYNC_DOWNLOAD_TIMEOUT
+    )
+
+
+async def admit_image(event):
+    """流量控制（同 app.admit_job；全域太忙時用 asyncio.sleep 排隊，不佔用執行緒）"""
+    if not admission:
+        return True
+    user_id = event.source.user_id
+    start = time.monotonic()
+    while True:
+        # SQLite 交易在執行緒裡跑
+        decision, seconds = await asyncio.to_thread(admission.admit, user_id, time.monotonic() - start)
+        if decision != DEFERRED:
+            break
+        await asyncio.sleep(seconds)
+    if decision in (ADMITTED, QUEUED):
+        if decision == QUEUED:
+            log.sampled('image_admission_queued', waited_ms=round(seconds * 1000, 1))
+        return True
+
+    log.info('image_rejected', decision=decision, message_id=event.message.id)
+    if admission.should_notify(user_id):
+        try:
+            await reply_text(event.reply_token, ADMISSION_NOTICES.get(decision, ADMISSION_BUSY_NOTICE))
+        except Exception:
+            log.exception('admission_notice_failed')
+    return False
+
+
+async def handle_image_message(event):
+    """處理圖片訊息（同 app.handle_image_message）"""
+    if not await admit_image(event):
+        return
+
+    events = [event]
+    if image_batcher:
+        image_set = getattr(event.message, 'image_set', None)
+        events = await image_batcher.submit(
+            batch_key(event), event,
+            expected_total=image_set.total if image_set else None
+        )
+        if events is None:
+            # 已併入同一批，由第一張圖的 task 合併辨識
+            log.sampled('image_batched', message_id=event.message.id)
+            return
+
+        # 依傳送順序排列（同一個圖片集的時間戳相同，再依圖片編號）
+        events.sort(key=lambda e: (
+            e.timestamp,
+            (e.message.image_set.index or 0) if e.message.image_set else 0
+        ))
+
+    async with _slots:
+        await process_image_events(events)
+
+
+async def process_image_events(events):
+    """辨識一批圖片（1 張以上），結果優先用 reply 送出（同 app.process_image_events）；整批最多 ASYNC_REQUEST_TIMEOUT 秒"""
+    event = events[0]
+    start = time.perf_counter()
+    summary = {'images': len(events), 'outcome': 'error', 'restaurants': 0}
+    with metrics.trace() as timings:
+        # 期限內有結果就用 reply 送出；期限到了由背景 task 回「辨識中」（同一批只用第一張圖的 reply token）
+        slot = reply_scheduler.open_async(
+            event.reply_token, event.source.user_id, reply_messages, push_messages, timestamp=event.timestamp
+        )
+        try:
+            await with_timeout('request', _recognize_and_send(events, slot, summary), ASYNC_REQUEST_TIMEOUT)
+            record_delivery(None, time.perf_counter() - start)
+
+        except asyncio.CancelledError:
+            # 關機：已回過「辨識中」的使用者收不到結果，但不再發任何請求
+            summary['outcome'] = 'cancelled'
+            log.warning('image_processing_cancelled', images=len(events))
+            raise
+
+        except Exception:
+            log.exception('image_processing_failed', images=len(events))
+            try:
+                summary['delivery'] = await slot.send([text_message('😅 抱歉辨識不出來')])
+            except Exception:
+                log.exception('failure_notice_failed')
+
+        finally:
+            slot.close()
+            total = time.perf_counter() - start
+            IMAGE_REQUESTS.inc(outcome=summary['outcome'])
+            IMAGE_REQUEST_SECONDS.observe(total)
+            log.info('image_processed', total_ms=round(total * 1000, 1), stages=dict(timings), **summary)
+
+
+async def _recognize_and_send(events, slot, summary):
+    event = events[0]
+
+    # 下載圖片（同一批的圖片同時下載；太大 / 不支援的圖片略過）
+    async def download(message_id):
+        try:
+            image_data = await download_image(message_id)
+        except DownloadRejected as e:
+            log.warning('image_download_rejected', message_id=message_id, reason=e.reason, detail=str(e))
+            return None
+        log.sampled('image_downloaded', message_id=message_id, bytes=len(image_data))
+        return image_data
+
+    with metrics.span('download'):
+        downloaded = await asyncio.gather(*(download(image_event.message.id) for image_event in events))
+    images_data = [image_data for image_data in downloaded if image_data is not None]
+    summary['bytes'] = sum(len(image_data) for image_data in images_data)
+
+    if not images_data:
+        summary['outcome'] = 'rejected'
+        summary['delivery'] = await slot.send([text_message(DOWNLOAD_REJECTED_NOTICE)])
+        return
+
+    # 辨識店家資訊（多張圖一次送給 Gemini；每次 Gemini 呼叫各自逾時）
+    with metrics.span('recognize'):
+        result = await recognize_restaurants_async(
+            images_data, user_id=event.source.user_id, timeout=ASYNC_GEMINI_TIMEOUT
+        )
+
+    if not validate_result(result):
+        # 辨識失敗（或預篩判定沒有店名，沒有呼叫 Gemini）
+        skipped = result.get('skipped') == 'prefilter'
+        summary['outcome'] = 'skipped' if skipped else 'empty'
+        summary['delivery'] = await slot.send([text_message(PREFILTER_NOTICE if skipped else '😅 抱歉辨識不出來')])
+        return
+
+    restaurants = result.get('restaurants', [])
+    count = result.get('count', 0)
+    food_keywords = result.get('food_keywords', '')
+    summary.update(outcome='found', restaurants=count, food_keywords=food_keywords,
+                   names=[restaurant.get('name') for restaurant in restaurants[:10]])
+
+    with metrics.span('flex'):
+        # 地圖連結會查已知店家索引（SQLite），在執行緒裡產生
+        bubbles = await asyncio.to_thread(lambda: [
+            build_bubble(restaurant, idx, count, food_keywords)
+            for idx, restaurant in enumerate(restaurants[:10])  # 最多 10 個
+        ])
+        message = build_result_message(bubbles, count, restaurants[0]['name'])
+
+    summary['delivery'] = await slot.send([message])
+
+
+async def dispatch(event):
+    """把一個事件交給對應的 handler（同 app.get_handler 註冊的三種訊息，其他事件略過）"""
+    from linebot.v3.webhooks import MessageEvent, ImageMessageContent, StickerMessageContent, TextMessageContent
+
+    if not isinstance(event, MessageEvent):
+        return
+    try:
+        if isinstance(event.message, ImageMessageContent):
+            await handle_image_message(event)
+        elif isinstance(event.message, StickerMessageContent):
+            await reply_text(event.reply_token, '貼圖很可愛！但我需要美食截圖才能幫你找店家喔 📸')
+        elif isinstance(event.message, TextMessageContent):
+            await reply_text(event.reply_token, '請傳截圖給我！📸')
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        log.exception('event_handler_failed', message_type=getattr(event.message, 'type', None))
+
+
+def start_task(coroutine):
+    """建立事件處理 task（保留參照直到完成，避免被回收）"""
+    task = asyncio.get_running_loop().create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def webhook(headers, body):
+    """LINE Bot webhook endpoint（驗證簽名、去重後建立 task，立即回 200）"""
+    signature = headers.get('x-line-signature', '')
+    body = body.decode('utf-8')
+
+    # 先驗證簽名，不合法的請求不處理
+    if not hmac.compare_digest(sign_body(body), signature):
+        WEBHOOK_REQUESTS.inc(status='bad_signature')
+        log.warning('webhook_bad_signature', bytes=len(body))
+        return 400, 'Bad Request'
+
+    try:
+        raw_events = [event for event, _ in split_events(body)]
+        events = get_parser().parse(body, signature)
+    except Exception as e:
+        WEBHOOK_REQUESTS.inc(status='bad_body')
+        log.warning('webhook_bad_body', bytes=len(body), error=str(e))
+        return 400, 'Bad Request'
+    log.sampled('webhook_received', events=len(events), bytes=len(body))
+
+    # 每個事件各自一個 task（已受理過的事件直接略過；進行中的 task 太多時回 503 讓 LINE 重送）
+    queued = 0
+    for raw_event, event in zip(raw_events, events):
+        if not await asyncio.to_thread(processed_events.claim, raw_event):
+            log.info('duplicate_event_skipped', event_id=raw_event.get('webhookEventId'),
+                     redelivery=bool((raw_event.get('deliveryContext') or {}).get('isRedelivery')))
+            continue
+        if len(_tasks) >= ASYNC_MAX_CONCURRENCY + JOB_QUEUE_MAXSIZE:
+            await asyncio.to_thread(processed_events.release, raw_event)
+            WEBHOOK_REQUESTS.inc(status='queue_full')
+            log.warning('async_tasks_full', tasks=len(_tasks), queued=queued)
+            return 503, 'Service Unavailable'
+        start_task(dispatch(event))
+        queued += 1
+
+    WEBHOOK_REQUESTS.inc(status='ok')
+    WEBHOOK_EVENTS.inc(queued)
+    return 200, 'OK'
+
+
+def stats():
+    """同 app 的 /stats，佇列改為進行中的 task 數"""
+    result = {
+        'mode': 'async',
+        'tasks': {'in_flight': len(_tasks), 'max_concurrency': ASYNC_MAX_CONCURRENCY},
+        'events': processed_events.stats(),
+        'cascade': model_cascade.stats(),
+        'prompt_cache': prompt_cache.stats(),
+        'keys': key_pool.stats(),
+        'resilience': resilience.stats(),
+        'usage': usage_stats(),
+        'parse': parse_stats(),
+        'line': line_clients.stats(),
+        'delivery': delivery_stats(),
+        'reply': reply_scheduler.stats(),
+        'warmup': warmup.status(),
+        'single_flight': async_single_flight.stats(),
+        'ledger': usage_ledger.summary(),
+    }
+    if recognition_cache:
+        result['cache'] = recognition_cache.stats()
+    if image_batcher:
+        result['batch'] = image_batcher.stats()
+    if admission:
+        result['admission'] = admission.stats()
+    if shop_index:
+        result['shops'] = shop_index.stats()
+    if prefilter:
+        result['prefilter'] = prefilter.stats()
+    return result
+
+
+async def shutdown():
+    """等進行中的 task 最多 ASYNC_SHUTDOWN_GRACE_SECONDS 秒，之後取消，再關閉 LINE 連線池"""
+    if _tasks:
+        log.info('shutdown_waiting', tasks=len(_tasks))
+        _, pending = await asyncio.wait(set(_tasks), timeout=ASYNC_SHUTDOWN_GRACE_SECONDS)
+        for task in pending:
+            task.cancel()
+        if pending:
+            log.warning('shutdown_cancelled', tasks=len(pending))
+            await asyncio.gather(*pending, return_exceptions=True)
+    await line_clients.close()
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _respond(send, status, body, content_type='text/plain; charset=utf-8'):
+    if isinstance(body, dict):
+        body, content_type = json.dumps(body, ensure_ascii=False), 'application/json'
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if WARMUP_ON_START:
+                warmup.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI 入口：/webhook、/healthz、/warmup、/stats、/metrics"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path, method = scope['path'], scope['method']
+    routes = {
+        '/webhook': ('POST',),
+        '/healthz': ('GET',),
+        '/warmup': ('GET', 'POST'),
+        '/stats': ('GET',),
+        '/metrics': ('GET',),
+    }
+    if path not in routes:
+        await _respond(send, 404, 'Not Found')
+        return
+    if method not in routes[path]:
+        await _respond(send, 405, 'Method Not Allowed')
+        return
+
+    if path == '/webhook':
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        status, text = await webhook(headers, await _read_body(receive))
+        await _respond(send, status, text)
+    elif path == '/healthz':
+        # 存活檢查：立即回應，不等預熱完成（順便觸發背景預熱）
+        warmup.start()
+        await _respond(send, 200, {'status': 'ok', 'warmup': warmup.status()['state']})
+    elif path == '/warmup':
+        status = await asyncio.to_thread(warmup.run)
+        await _respond(send, 200 if status['state'] == 'warm' else 503, status)
+    elif path == '/stats':
+        await _respond(send, 200, await asyncio.to_thread(stats))
+    else:
+        await _respond(send, 200, metrics.render(), metrics.CONTENT_TYPE)
@@ -0,0 +1,428 @@
+"""
+辨識品質評估：準確度 vs 延遲 vs 花費
+
+用一組標好答案的截圖（預設 新增資料夾/ground_truth.json），對每種設定（模型 / Prompt 版本 / 前處理 / JSON mode）
+各辨識一次，並排輸出：
+  店名        召回（標準答案的店家有幾成被辨識出來）與精確（辨識出來的店家有幾成是對的）
+  帳號 / 地區  對到的店家中，社群帳號、行政區（extract_area）正確的比例
+  查詢相符    用 --query 的查詢策略產生的 Google Maps 查詢字串與標準答案完全相同的比例
+  延遲        每張圖 Gemini 呼叫的 p50 / p95
+  花費        每張圖的 token 數與每千張的估算美元（GEMINI_PRICES）
+另外列出每種設定在各查詢策略下的查詢相符率（不用重新呼叫 Gemini）。
+
+Gemini 的回應會錄製在 --recordings（以設定 + 圖片內容為 key，一個 JSON 檔）：
+同樣的設定重跑直接重播，不花錢、不需要網路；--offline 完全不呼叫 Gemini（沒有錄製的略過並標出來），
+--rerecord 忽略舊的錄製重新呼叫。延遲與 token 用量取自錄製當時的數字。
+
+設定的寫法：model=gemini-2.5-flash,prompt=v7,preprocess=1600,json=on
+  preprocess  長邊上限（同 PREPROCESS_MAX_EDGE），off 表示不前處理（直接交給 SDK）
+  json        on / off（同 GEMINI_JSON_MODE）
+沒寫的欄位用預設值；--config 可以重複指定多種設定。
+
+標準答案的格式見 新增資料夾/ground_truth.json 的 description。
+
+用法:
+    python benchmarks/eval_benchmark.py                      # 預設的幾種設定（需要 GEMINI_API_KEY，錄製過的直接重播）
+    python benchmarks/eval_benchmark.py --offline            # 只用錄製的回應
+    python benchmarks/eval_benchmark.py --config model=gemini-2.5-flash,preprocess=1024 --config model=gemini-2.5-pro
+    python benchmarks/eval_benchmark.py --dataset labels/ground_truth.json --save results.json
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from urllib.parse import unquote
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.jsonparse import parse_tolerant  # noqa: E402
+from utils.maps import extract_area, generate_maps_url  # noqa: E402
+from utils.merge import normalize_key  # noqa: E402
+from utils.prompts import get_prompt, RESPONSE_SCHEMA  # noqa: E402
+from utils.ledger import estimate_cost  # noqa: E402
+from utils.log import configure  # noqa: E402
+
+DEFAULT_DATASET = os.path.join(ROOT, '新增資料夾', 'ground_truth.json')
+DEFAULT_RECORDINGS = os.path.join(ROOT, 'benchmarks', 'recordings')
+DEFAULT_CONFIG = {'model': 'gemini-2.5-flash', 'prompt': 'v7', 'preprocess': '1600', 'json': 'on'}
+DEFAULT_CONFIGS = [
+    'model=gemini-2.5-flash',
+    'model=gemini-2.5-flash,preprocess=off',
+    'model=gemini-2.5-flash,json=off',
+    'model=gemini-2.5-pro',
+]
+
+
+def _query(url):
+    return unquote(url.split('query=', 1)[1])
+
+
+# 查詢策略：辨識出的一家店 → Google Maps 查詢字串
+QUERY_STRATEGIES = {
+    # 目前的 generate_maps_url（店名 + 帳號 + 行政區，菜市場名才加關鍵字；不查已知店家索引）
+    'golden': lambda shop, keywords: _query(generate_maps_url(
+        shop.get('name', ''), shop.get('address', 'unknown'), keywords, shop.get('original_handle') or ''
+    )),
+    # 店名 + 行政區（不加帳號）
+    'name_area': lambda shop, keywords: ' '.join(
+        part for part in (shop.get('name', ''), extract_area(shop.get('address', ''))) if part
+    ),
+    # 只有店名
+    'name': lambda shop, keywords: shop.get('name', ''),
+}
+
+
+def parse_config(spec):
+    """'model=...,prompt=...' → dict（沒寫的欄位用預設值）"""
+    config = dict(DEFAULT_CONFIG)
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        key, _, value = item.partition('=')
+        if key not in DEFAULT_CONFIG:
+            raise ValueError(f"❌ 不認得的設定欄位: {key}（可用: {', '.join(DEFAULT_CONFIG)}）")
+        config[key] = value.strip()
+    get_prompt(config['prompt'])  # 版本不存在時提早報錯
+    return config
+
+
+def config_label(config):
+    model = config['model'].replace('gemini-', '')
+    return f"{model}/{config['prompt']}/{config['preprocess']}/{'json' if config['json'] == 'on' else 'text'}"
+
+
+def load_dataset(path):
+    """
+    讀取標準答案
+
+    回傳:
+        list[tuple(str, bytes, list[dict])]: (檔名, 圖片內容, 標準答案的店家)
+    """
+    with open(path, encoding='utf-8') as f:
+        dataset = json.load(f)
+    directory = os.path.dirname(os.path.abspath(path))
+    samples = []
+    for filename, entry in dataset['images'].items():
+        with open(os.path.join(directory, filename), 'rb') as f:
+            samples.append((filename, f.read(), entry['restaurants']))
+    return samples
+
+
+def recording_key(config, data):
+    """錄製的 key：會影響模型輸出的設定（含 Prompt 全文）+ 圖片內容"""
+    prompt = get_prompt(config['prompt'])
+    material = json.dumps({
+        'model': config['model'],
+        'prompt': [prompt.system_instruction, prompt.user_instruction],
+        'preprocess': config['preprocess'],
+        'json': config['json'],
+        'image': hashlib.sha256(data).hexdigest(),
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class Recorder:
+    """Gemini 回應的錄製 / 重播（一個回應一個 JSON 檔）"""
+
+    def __init__(self, directory, offline=False, rerecord=False):
+        self.directory = directory
+        self.offline = offline
+        self.rerecord = rerecord
+        self.recorded = 0
+        self.replayed = 0
+        self.missing = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, config, filename, data):
+        """
+        取得一張圖在這個設定下的回應（有錄製就重播，否則呼叫 Gemini 並錄下來）
+
+        回傳:
+            dict 或 None: {"text", "usage", "latency_s", ...}；--offline 且沒有錄製時為 None
+        """
+        key = recording_key(config, data)
+        path = self._path(key)
+        if not self.rerecord and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.replayed += 1
+                return json.load(f)
+        if self.offline:
+            self.missing += 1
+            return None
+        recording = dict(call_gemini(config, data), key=key, image=filename, config=config,
+                         recorded_at=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(recording, f, ensure_ascii=False, indent=2)
+        self.recorded += 1
+        return recording
+
+
+_models = {}
+
+
+def call_gemini(config, data):
+    """實際呼叫 Gemini（同 utils.gemini.generate，但 Prompt / 前處理 / JSON mode 依這個設定）"""
+    from PIL import Image
+    from utils.genai_client import get_genai
+    from utils.preprocess import preprocess_image
+
+    genai = get_genai()
+    prompt = get_prompt(config['prompt'])
+    model_key = (config['model'], config['prompt'])
+    if model_key not in _models:
+        _models[model_key] = genai.GenerativeModel(config['model'], system_instruction=prompt.system_instruction)
+
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if config['preprocess'] == 'off':
+        part, uploaded = image, None
+    else:
+        prepared = preprocess_image(image, max_edge=int(config['preprocess']), original_bytes=len(data))
+        part, uploaded = prepared.to_part(), len(prepared.data)
+    generation_config = {
+        'response_mime_type': 'application/json', 'response_schema': RESPONSE_SCHEMA
+    } if config['json'] == 'on' else None
+
+    start = time.perf_counter()
+    response = _models[model_key].generate_content(
+        [prompt.user_instruction, part], generation_config=generation_config, request_options={'timeout': 120}
+    )
+    text = response.text
+    latency = time.perf_counter() - start
+    metadata = response.usage_metadata
+    usage = {
+        'prompt': getattr(metadata, 'prompt_token_count', 0) or 0,
+        'cached': getattr(metadata, 'cached_content_token_count', 0) or 0,
+        'output': getattr(metadata, 'candidates_token_count', 0) or 0,
+        'total': getattr(metadata, 'total_token_count', 0) or 0,
+    }
+    return {'text': text, 'usage': usage, 'latency_s': round(latency, 3), 'uploaded_bytes': uploaded}
+
+
+def parse_restaurants(text):
+    """
+    回應文字 → (店家 list, food_keywords)；同 utils.gemini.parse_response 去掉沒有店名 / unknown 的店家
+
+    例外:
+        ValueError: 回應裡找不到可用的 JSON
+    """
+    result, _ = parse_tolerant(text.strip())
+    restaurants = [
+        r for r in result.get('restaurants', [])
+        if isinstance(r, dict) and isinstance(r.get('name'), str) and r['name'].strip() and r['name'] != 'unknown'
+    ]
+    return restaurants, result.get('food_keywords') or ''
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def match_shops(labels, predicted):
+    """
+    依店名（含 aliases，正規化後完全相同）把標準答案對到辨識結果，每家辨識結果只能對到一次
+
+    回傳:
+        list: 與 labels 同順序，對到的辨識結果（沒對到為 None）
+    """
+    used = set()
+    matches = []
+    for label in labels:
+        names = {normalize_key(name) for name in [label['name']] + label.get('aliases', [])}
+        match = None
+        for index, shop in enumerate(predicted):
+            if index not in used and normalize_key(shop['name']) in names:
+                used.add(index)
+                match = shop
+                break
+        matches.append(match)
+    return matches
+
+
+def score_image(labels, predicted, keywords):
+    """
+    一張圖的各項計數
+
+    回傳:
+        dict: 各項的 [對的數量, 總數]，以及各查詢策略的 [相符數, 總數]
+    """
+    matches = match_shops(labels, predicted)
+    matched = sum(1 for match in matches if match is not None)
+    counts = {
+        'name_recall': [matched, len(labels)],
+        'name_precision': [matched, len(predicted)],
+        'handle': [0, 0],
+        'area': [0, 0],
+        'query': {name: [0, 0] for name in QUERY_STRATEGIES},
+    }
+    for label, match in zip(labels, matches):
+        if match is not None and 'handle' in label:
+            counts['handle'][1] += 1
+            counts['handle'][0] += normalize_key(match.get('original_handle') or '') == normalize_key(label['handle'] or '')
+        if match is not None and 'area' in label:
+            counts['area'][1] += 1
+            counts['area'][0] += extract_area(match.get('address') or '') == label['area']
+        if 'query' in label:
+            expected = {normalize_key(query) for query in _as_list(label['query'])}
+            for name, strategy in QUERY_STRATEGIES.items():
+                counts['query'][name][1] += 1
+                counts['query'][name][0] += match is not None and normalize_key(strategy(match, keywords)) in expected
+    return counts
+
+
+def _add(total, counts):
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            _add(total.setdefault(key, {}), value)
+        else:
+            pair = total.setdefault(key, [0, 0])
+            pair[0] += value[0]
+            pair[1] += value[1]
+
+
+def _rate(pair):
+    return pair[0] / pair[1] if pair[1] else None
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def evaluate(config, samples, recorder, prices):
+    """
+    跑一種設定
+
+    回傳:
+        dict: 各項比例、延遲、token 與花費，以及每張圖的明細
+    """
+    totals = {}
+    latencies, tokens, costs = [], [], []
+    failures, missing, details = 0, 0, []
+    for filename, data, labels in samples:
+        recording = recorder.get(config, filename, data)
+        if recording is None:
+            missing += 1
+            continue
+        latencies.append(recording['latency_s'])
+        tokens.append(recording['usage']['total'])
+        costs.append(estimate_cost(prices, config['model'], recording['usage'])[1])
+        try:
+            predicted, keywords = parse_restaurants(recording['text'])
+        except ValueError:
+            failures += 1
+            predicted, keywords = [], ''
+        counts = score_image(labels, predicted, keywords)
+        _add(totals, counts)
+        details.append({
+            'image': filename,
+            'predicted': [shop['name'] for shop in predicted],
+            'queries': [QUERY_STRATEGIES['golden'](shop, keywords) for shop in predicted],
+            'missed': [label['name'] for label, match in zip(labels, match_shops(labels, predicted)) if match is None],
+        })
+    evaluated = len(samples) - missing
+    return {
+        'config': config,
+        'label': config_label(config),
+        'images': evaluated,
+        'missing': missing,
+        'parse_failures': failures,
+        'name_recall': _rate(totals.get('name_recall', [0, 0])),
+        'name_precision': _rate(totals.get('name_precision', [0, 0])),
+        'handle': _rate(totals.get('handle', [0, 0])),
+        'area': _rate(totals.get('area', [0, 0])),
+        'query': {name: _rate(pair) for name, pair in totals.get('query', {}).items()},
+        'latency_p50_ms': round(percentile(latencies, 0.5) * 1000),
+        'latency_p95_ms': round(percentile(latencies, 0.95) * 1000),
+        'tokens_per_image': round(sum(tokens) / evaluated) if evaluated else 0,
+        'usd_per_1k_images': round(sum(costs) / evaluated * 1000, 3) if evaluated else 0.0,
+        'details': details,
+    }
+
+
+def _fmt(rate):
+    return '—' if rate is None else f'{rate:.0%}'
+
+
+def print_report(results, query_strategy):
+    print(f"{'設定':<28}{'圖':>4}{'店名召回':>10}{'店名精確':>10}{'帳號':>7}{'地區':>7}{'查詢相符':>10}{'解析失敗':>10}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'tokens/張':>11}{'美元/千張':>11}")
+    for row in results:
+        print(f"{row['label']:<28}{row['images']:>4}{_fmt(row['name_recall']):>10}{_fmt(row['name_precision']):>10}"
+              f"{_fmt(row['handle']):>7}{_fmt(row['area']):>7}{_fmt(row['query'].get(query_strategy)):>10}"
+              f"{row['parse_failures']:>10}{row['latency_p50_ms']:>9}{row['latency_p95_ms']:>9}"
+              f"{row['tokens_per_image']:>11}{row['usd_per_1k_images']:>11.3f}"
+              + (f"  （{row['missing']} 張沒有錄製）" if row['missing'] else ''))
+
+    print(f"\n查詢策略的查詢相符率: {', '.join(QUERY_STRATEGIES)}")
+    for row in results:
+        print(f"{row['label']:<28}" + ''.join(f"{_fmt(row['query'].get(name)):>12}" for name in QUERY_STRATEGIES))
+
+    # 準確度（店名召回 → 查詢相符）不低於最好的設定時，最便宜的那個
+    scored = [row for row in results if row['images']]
+    if scored:
+        def accuracy(row):
+            return (row['name_recall'] or 0, row['query'].get(query_strategy) or 0)
+        best = max(accuracy(row) for row in scored)
+        cheapest = min((row for row in scored if accuracy(row) >= best), key=lambda row: row['usd_per_1k_images'])
+        print(f"\n準確度最高的設定中最便宜的: {cheapest['label']}（每千張約 ${cheapest['usd_per_1k_images']:.3f}）")
+
+
+def load_config(offline):
+    """讀取 config（價格、Gemini endpoint）；評估用不到 LINE，離線重播也不需要 Gemini key"""
+    from dotenv import load_dotenv
+    load_dotenv()
+    os.environ.setdefault('LINE_CHANNEL_SECRET', 'eval')
+    os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'eval')
+    if offline:
+        os.environ.setdefault('GEMINI_API_KEY', 'offline')
+    import config
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='辨識品質評估：準確度 vs 延遲 vs 花費')
+    parser.add_argument('--dataset', default=DEFAULT_DATASET, help='標準答案 JSON（圖片路徑相對於這個檔案）')
+    parser.add_argument('--config', action='append', help='設定，例如 model=gemini-2.5-pro,preprocess=off（可重複）')
+    parser.add_argument('--query', default='golden', choices=list(QUERY_STRATEGIES), help='主表的查詢策略')
+    parser.add_argument('--recordings', default=DEFAULT_RECORDINGS, help='錄製的回應目錄')
+    parser.add_argument('--offline', action='store_true', help='不呼叫 Gemini，只用錄製的回應')
+    parser.add_argument('--rerecord', action='store_true', help='忽略錄製的回應，重新呼叫 Gemini')
+    parser.add_argument('--details', action='store_true', help='列出每張圖辨識出的店家、查詢字串與漏掉的店家')
+    parser.add_argument('--save', help='把結果存成 JSON')
+    args = parser.parse_args()
+    configure('warning')
+
+    config = load_config(args.offline)
+    configs = [parse_config(spec) for spec in (args.config or DEFAULT_CONFIGS)]
+    samples = load_dataset(args.dataset)
+    recorder = Recorder(args.recordings, offline=args.offline, rerecord=args.rerecord)
+    labels = sum(len(entry) for _, _, entry in samples)
+    print(f"資料集: {len(samples)} 張圖、{labels} 家店（{os.path.relpath(args.dataset, ROOT)}）；{len(configs)} 種設定\n")
+
+    results = [evaluate(item, samples, recorder, config.GEMINI_PRICES) for item in configs]
+    print_report(results, args.query)
+    print(f"\n錄製: 重播 {recorder.replayed}、新錄製 {recorder.recorded}、沒有錄製 {recorder.missing}"
+          f"（{os.path.relpath(args.recordings, ROOT)}）")
+
+    if args.details:
+        for row in results:
+            print(f"\n=== {row['label']} ===")
+            for detail in row['details']:
+                print(f"{detail['image']}: {json.dumps(detail['queries'], ensure_ascii=False)}"
+                      + (f"  漏掉 {json.dumps(detail['missed'], ensure_ascii=False)}" if detail['missed'] else ''))
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
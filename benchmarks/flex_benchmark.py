@@ -0,0 +1,143 @@
+"""
+店家卡片（Flex Message）產生 micro-benchmark
+
+比較舊版寫法（每張卡片重建整個 dict → FlexContainer.from_dict → FlexMessage
+→ PushMessageRequest.to_dict()）與 utils/flex.py 直接產生 JSON 的耗時，
+並確認兩者送到 LINE 的訊息 JSON 完全相同。
+
+用法:
+    python benchmarks/flex_benchmark.py
+    python benchmarks/flex_benchmark.py --number 1000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from linebot.v3.messaging import FlexContainer, FlexMessage, PushMessageRequest  # noqa: E402
+
+from utils import flex  # noqa: E402
+
+RESTAURANTS = [
+    ('NO.5 CAFE', '甘肅二街5號'),
+    ('Minimalism Cafe 巴斯克專賣店', '新富一街203號'),
+    ('No.5 CheeseCake 5號起司蛋糕專門店', '縣民大道二段7號板橋車站B1'),
+    ('Mountain', 'unknown'),
+    ('食。光機', '桃園市中壢區大華路93號'),
+]
+
+
+def legacy_bubble(name, address, maps_url, index, count):
+    # 舊版 build_bubble（照原樣保留，只用來比較）
+    card_contents = [
+        {
+            "type": "text",
+            "text": f"🏪 店家 {index + 1}/{count}" if count and count > 1 else "🏪 找到店家！",
+            "weight": "bold",
+            "size": "md",
+            "color": "#1DB446"
+        },
+        {
+            "type": "text",
+            "text": name,
+            "weight": "bold",
+            "size": "xl",
+            "margin": "md",
+            "wrap": True
+        }
+    ]
+    if address and address != 'unknown' and address.strip():
+        card_contents.append({
+            "type": "text",
+            "text": address,
+            "size": "sm",
+            "color": "#999999",
+            "margin": "md",
+            "wrap": True
+        })
+    else:
+        card_contents.append({
+            "type": "text",
+            "text": "📍 地址未提供",
+            "size": "sm",
+            "color": "#AAAAAA",
+            "margin": "md"
+        })
+    return {
+        "type": "bubble",
+        "body": {"type": "box", "layout": "vertical", "contents": card_contents},
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [{
+                "type": "button",
+                "style": "primary",
+                "color": "#1DB446",
+                "action": {"type": "uri", "label": "🗺️ 開啟地圖", "uri": maps_url}
+            }]
+        }
+    }
+
+
+def legacy_push_body(restaurants):
+    # 舊版：dict → pydantic 模型 → 送出前再轉回 dict
+    count = len(restaurants)
+    bubbles = [legacy_bubble(name, address, f'https://maps.example/{i}', i, count)
+               for i, (name, address) in enumerate(restaurants)]
+    contents = bubbles[0] if count == 1 else {"type": "carousel", "contents": bubbles}
+    message = FlexMessage(alt_text=f"找到 {count} 家店", contents=FlexContainer.from_dict(contents))
+    return PushMessageRequest(to='U1', messages=[message]).to_dict()
+
+
+def flex_push_body(restaurants):
+    count = len(restaurants)
+    bubbles = [flex.bubble(name, address, f'https://maps.example/{i}', i, count)
+               for i, (name, address) in enumerate(restaurants)]
+    return {'to': 'U1', 'messages': [flex.flex_message(bubbles, f"找到 {count} 家店")]}
+
+
+def wire(body):
+    return json.dumps(body, ensure_ascii=False, sort_keys=True)
+
+
+def per_call_us(func, restaurants, number, repeat=3):
+    # 取多次量測的最小值，降低其他行程干擾；包含序列化成 JSON 的時間
+    elapsed = min(timeit.repeat(lambda: wire(func(restaurants)), number=number, repeat=repeat))
+    return elapsed / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='店家卡片產生 micro-benchmark')
+    parser.add_argument('--number', type=int, default=200, help='每組重複次數')
+    args = parser.parse_args()
+
+    cases = [
+        ('1 家店', RESTAURANTS[:1]),
+        ('5 家店', RESTAURANTS),
+        ('10 家店', (RESTAURANTS * 2)[:flex.MAX_BUBBLES]),
+    ]
+
+    for label, restaurants in cases:
+        # 舊版多帶一個預設值 notificationDisabled: false，只比較訊息本身
+        if wire(legacy_push_body(restaurants)['messages']) != wire(flex_push_body(restaurants)['messages']):
+            raise SystemExit(f"❌ {label}: 兩種寫法產生的 JSON 不同")
+        flex.validate(flex_push_body(restaurants)['messages'][0])
+    print("兩種寫法產生的訊息 JSON 相同，且通過 SDK 模型驗證")
+    print()
+
+    print(f"{'卡片數':<10}{'舊版 µs':>10}{'新版 µs':>10}{'strict µs':>12}{'加速':>8}")
+    for label, restaurants in cases:
+        before = per_call_us(legacy_push_body, restaurants, args.number)
+        after = per_call_us(flex_push_body, restaurants, args.number)
+        flex.set_strict(True)
+        strict = per_call_us(flex_push_body, restaurants, args.number)
+        flex.set_strict(False)
+        print(f"{label:<10}{before:>10.1f}{after:>10.1f}{strict:>12.1f}{before / after:>7.1f}×")
+
+
+if __name__ == '__main__':
+    main()
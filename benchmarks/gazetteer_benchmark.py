@@ -0,0 +1,147 @@
+"""
+地名索引 micro-benchmark
+
+比較舊版 extract_area / is_generic_name（逐一 `in` 比對手寫清單）
+與 utils/gazetteer.py 的 Aho-Corasick 索引：涵蓋名稱數、載入時間、
+每次查詢耗時，並列出兩者結果不同的地址。
+「線性掃描」欄是用舊寫法逐一比對整份新地名清單的耗時，作為對照。
+
+用法:
+    python benchmarks/gazetteer_benchmark.py
+    python benchmarks/gazetteer_benchmark.py --number 50000
+"""
+import argparse
+import os
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.gazetteer import Gazetteer  # noqa: E402
+from utils.maps import extract_area, is_generic_name  # noqa: E402
+
+# 舊版清單與掃描（照原樣保留，只用來比較）
+LEGACY_GENERIC_NAMES = [
+    '麵包店', '咖啡廳', '咖啡店', '小吃店', '早餐店',
+    '麵店', '火鍋店', '便當店', '餐廳', '飲料店',
+    '茶飲', '手搖', '烘焙坊', '甜點店', '蛋糕店'
+]
+LEGACY_TAIWAN_AREAS = [
+    '中壢', '內壢', '平鎮', '桃園', '龜山', '八德', '蘆竹', '大園', '楊梅', '新屋', '觀音', '龍潭',
+    '台北', '信義', '大安', '中正', '松山', '萬華', '大同', '中山', '文山', '南港', '內湖', '士林', '北投',
+    '新北', '板橋', '新莊', '三重', '永和', '中和', '土城', '樹林', '鶯歌', '三峽', '淡水', '汐止',
+    '台中', '北區', '西區', '南區', '東區', '中區', '西屯', '南屯', '北屯', '豐原', '大里', '太平',
+    '台南', '東區', '南區', '北區', '中西區', '安平', '安南', '永康', '新營', '佳里',
+    '高雄', '前金', '新興', '苓雅', '鹽埕', '鼓山', '前鎮', '三民', '左營', '楠梓', '小港'
+]
+
+
+def legacy_extract_area(address):
+    if not address or address == 'unknown':
+        return ''
+    for area in LEGACY_TAIWAN_AREAS:
+        if area in address:
+            return area
+    return ''
+
+
+def legacy_is_generic_name(name):
+    if not name:
+        return False
+    for generic in LEGACY_GENERIC_NAMES:
+        if generic in name:
+            return True
+    if len(name) < 3:
+        return True
+    return False
+
+
+# 模型實際會回傳的地址樣態：完整地址、只有區域、車站地下街、沒有地名的路名、unknown
+ADDRESSES = [
+    '桃園市中壢區大華路93號',
+    '甘肅二街5號',
+    '新富一街203號',
+    '縣民大道二段7號板橋車站B1',
+    'unknown',
+    '台北市大安區忠孝東路四段181巷',
+    '高雄市前鎮區中華五路789號',
+    '台中市西屯區台灣大道三段301號',
+    '宜蘭縣羅東鎮興東路',
+    '屏東縣恆春鎮墾丁路',
+    '新北市永和區永和路二段',
+    '基隆市中正區中正路',
+    '臺南市中西區國華街三段',
+    '中山北路二段',
+    '內壢',
+    '新竹市東區光復路二段',
+    '花蓮縣花蓮市中華路',
+    '嘉義市西區文化路',
+    '台中市北區一中街',
+    '彰化縣員林市',
+]
+
+NAMES = [
+    'NO.5 CAFE', 'Minimalism Cafe 巴斯克專賣店', 'No.5 CheeseCake 5號起司蛋糕專門店',
+    'Mountain', '食。光機', '阿明麵包店', '老街咖啡廳', '巷口早餐店', '好食光餐廳', '茶',
+]
+
+
+def per_call_us(func, items, number, repeat=5):
+    # 取多次量測的最小值，降低其他行程干擾
+    elapsed = min(timeit.repeat(lambda: [func(item) for item in items], number=number, repeat=repeat))
+    return elapsed / number / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='地名索引 micro-benchmark')
+    parser.add_argument('--number', type=int, default=20000, help='每組重複次數')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    gazetteer = Gazetteer.load()
+    load_ms = (time.perf_counter() - start) * 1000
+
+    legacy_names = len(set(LEGACY_TAIWAN_AREAS))
+    print(f"舊清單: {legacy_names} 個地名（原始清單 {len(LEGACY_TAIWAN_AREAS)} 筆，含重複）")
+    print(f"地名索引: {gazetteer.place_count} 個地名，{len(gazetteer)} 個可比對名稱"
+          f"（{len(gazetteer) / legacy_names:.0f}×），載入 {load_ms:.1f} ms")
+    print()
+
+    # 預熱：讓 lazy DFA 補上這批文字會用到的轉移
+    for address in ADDRESSES:
+        extract_area(address)
+
+    # 舊寫法套用在整份新清單上（最長的名稱先比）
+    all_names = sorted(gazetteer.names(), key=len, reverse=True)
+
+    def linear_extract_area(address):
+        if not address or address == 'unknown':
+            return ''
+        for name in all_names:
+            if name in address:
+                return name
+        return ''
+
+    rows = [
+        ('extract_area', legacy_extract_area, extract_area, linear_extract_area, ADDRESSES),
+        ('is_generic_name', legacy_is_generic_name, is_generic_name, None, NAMES),
+    ]
+    print(f"{'函式':<18}{'舊版 µs':>10}{'新版 µs':>10}{'比值':>8}{'線性掃描 µs':>14}")
+    for label, legacy, current, linear, items in rows:
+        before = per_call_us(legacy, items, args.number)
+        after = per_call_us(current, items, args.number)
+        scan = f"{per_call_us(linear, items, max(args.number // 20, 1)):>14.2f}" if linear else f"{'-':>14}"
+        print(f"{label:<18}{before:>10.2f}{after:>10.2f}{after / before:>8.2f}{scan}")
+    print()
+
+    print("結果不同的地址：")
+    for address in ADDRESSES:
+        before, after = legacy_extract_area(address), extract_area(address)
+        if before != after:
+            print(f"  {address:<28} {before or '（無）':<8} → {after or '（無）'}")
+
+
+if __name__ == '__main__':
+    main()
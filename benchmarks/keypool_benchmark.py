@@ -0,0 +1,178 @@
+"""
+Gemini API key 池 benchmark
+
+用 Gemini 替身（benchmarks/stubs.py）模擬每把 key 的配額（每分鐘 --rate-limit 個請求，超過回 429），
+以不同的 key 數量、固定的並行數持續呼叫 utils.gemini.generate --duration 秒，輸出：
+  成功數、每秒成功數、替身回的 429 次數、key 池在本地擋下（沒有送出）的次數、各把 key 送出的請求數
+兩種設定：
+  limits   GEMINI_RATE_LIMITS 設成替身的配額：用量滿了就換專案，全部用完時在本地擋下（不送出），幾乎不會收到 429
+  429-only 不設定配額（GEMINI_RATE_LIMITS 留空）：只靠收到 429 後的冷卻避開用完的 key
+吞吐量應該大致隨 key 數（專案數）線性增加。每種設定在新的子行程裡跑（config 在 import 時讀取）。
+最後檢查 ASGI 模式的 generate_async 在拿 key 途中被取消時，key 有沒有還回去（進行中的請求數要回到 0），
+沒有的話以非 0 結束。
+
+用法:
+    python benchmarks/keypool_benchmark.py
+    python benchmarks/keypool_benchmark.py --keys 1,2,4,8 --rate-limit 60 --duration 20
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stubs import GeminiStub  # noqa: E402
+
+MODEL = 'gemini-2.5-flash'
+
+
+def run_worker(threads, duration):
+    """子行程：threads 條執行緒持續呼叫 generate，回傳成功 / 429 / 其他錯誤數"""
+    from PIL import Image
+    from utils import gemini
+    from utils.keypool import is_throttled
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (255, 255, 255)).save(buffer, 'JPEG')
+    part = {'mime_type': 'image/jpeg', 'data': buffer.getvalue()}
+    counts = {'ok': 0, 'throttled': 0, 'error': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def loop():
+        while time.monotonic() < deadline:
+            try:
+                gemini.generate(MODEL, [part])
+                outcome = 'ok'
+            except Exception as e:
+                outcome = 'throttled' if is_throttled(e) else 'error'
+                if outcome == 'throttled':
+                    # 呼叫端收到 429 時稍等再送（同使用者重傳）
+                    time.sleep(0.2)
+            with lock:
+                counts[outcome] += 1
+
+    workers = [threading.Thread(target=loop) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    counts['exhausted'] = gemini.key_pool.stats()['exhausted']
+    return counts
+
+
+def run_cancel_worker(calls):
+    """子行程：generate_async 在拿 key（_lease_model）途中被取消 calls 次，回傳之後各把 key 進行中的請求數"""
+    from utils import gemini
+    from utils.genai_client import get_genai
+
+    get_genai()  # 第一次 import SDK 要 1 秒以上，先載入
+    lease_model = gemini._lease_model
+
+    def slow_lease(model_name):
+        time.sleep(0.2)  # 模擬建立 context cache 等較慢的拿 key 過程
+        return lease_model(model_name)
+
+    gemini._lease_model = slow_lease
+    gemini.NATIVE_ASYNC = True  # 取消處理只在原生 async 傳輸的路徑上
+
+    async def cancel_all():
+        for _ in range(calls):
+            try:
+                await asyncio.wait_for(gemini.generate_async(MODEL, []), 0.05)
+            except asyncio.TimeoutError:
+                pass
+        await asyncio.sleep(1.0)  # 等執行緒拿到 key、callback 還回去
+
+    asyncio.run(cancel_all())
+    return {label: counts['in_flight'] for label, counts in gemini.key_pool.stats()['keys'].items()}
+
+
+def _env(stub, keys, limits, args, data_dir):
+    env = dict(
+        os.environ,
+        LINE_CHANNEL_SECRET='bench-secret',
+        LINE_CHANNEL_ACCESS_TOKEN='bench-token',
+        GEMINI_API_KEYS=','.join(f'AIza-bench-key-{index:04d}' for index in range(keys)),
+        GEMINI_API_ENDPOINT=stub.url,
+        GEMINI_TRANSPORT='rest',
+        GEMINI_RATE_LIMITS=f'{MODEL}={args.rate_limit}/0' if limits else '',
+        PROMPT_CACHE_ENABLED='false',
+        DATA_DIR=data_dir,
+        LOG_LEVEL='error',
+    )
+    env.pop('GEMINI_API_KEY', None)
+    return env
+
+
+def run_cancel_check(stub, args):
+    with tempfile.TemporaryDirectory() as data_dir:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--cancel-worker'],
+            env=_env(stub, 2, False, args, data_dir), cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+def run_config(stub, keys, limits, args):
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = _env(stub, keys, limits, args, data_dir)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', '--threads', str(args.threads),
+             '--duration', str(args.duration)],
+            env=env, cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gemini API key 池 benchmark')
+    parser.add_argument('--keys', default='1,2,4', help='key 數量，逗號分隔')
+    parser.add_argument('--rate-limit', type=int, default=30, help='替身每把 key 每分鐘接受幾個請求')
+    parser.add_argument('--duration', type=float, default=15.0, help='每種設定呼叫幾秒（需小於 60）')
+    parser.add_argument('--threads', type=int, default=8, help='並行呼叫數')
+    parser.add_argument('--latency', type=float, default=0.2, help='替身每次呼叫的延遲（秒）')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--cancel-worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker or args.cancel_worker:
+        from utils.log import configure
+        configure('error')
+        print(json.dumps(run_worker(args.threads, args.duration) if args.worker else run_cancel_worker(5)))
+        return
+
+    print(f"替身配額: 每把 key 每分鐘 {args.rate_limit} 個請求；並行 {args.threads}，每種設定 {args.duration:g} 秒\n")
+    print(f"{'設定':<10}{'keys':>6}{'成功':>8}{'成功/秒':>10}{'收到 429':>10}{'本地擋下':>10}  各把 key 送出的請求數")
+    for limits in (True, False):
+        for keys in [int(value) for value in args.keys.split(',')]:
+            stub = GeminiStub(latency=args.latency, rate_limit=args.rate_limit, rate_window=60.0).start()
+            try:
+                counts = run_config(stub, keys, limits, args)
+            finally:
+                stub.stop()
+            per_key = [count for kind, count in sorted(stub.requests.items()) if kind.startswith('key ')]
+            print(f"{'limits' if limits else '429-only':<10}{keys:>6}{counts['ok']:>8}"
+                  f"{counts['ok'] / args.duration:>10.2f}{stub.throttled:>10}{counts['exhausted']:>10}  {per_key}")
+
+    stub = GeminiStub(latency=args.latency).start()
+    try:
+        in_flight = run_cancel_check(stub, args)
+    finally:
+        stub.stop()
+    leaked = sum(in_flight.values())
+    print(f"\n拿 key 途中取消 5 次後，進行中的請求數: {in_flight}（{'OK' if leaked == 0 else '沒有還回去'}）")
+    if leaked:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
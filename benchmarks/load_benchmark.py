@@ -0,0 +1,359 @@
+"""
+端對端壓力測試（本地 LINE / Gemini 替身）
+
+用目前的 gunicorn.conf.py 啟動 app，LINE 與 Gemini 都換成本地替身（benchmarks/stubs.py），
+再用 新增資料夾 的截圖組出簽好名的圖片訊息 webhook，以遞增的並行數重播：
+
+  webhook     POST /webhook 到回 200 的時間
+  端對端      送出 webhook 到替身收到結果（卡片或失敗訊息，reply 或 push 都算；不算「辨識中」）的時間
+  吞吐量      每秒完成（收到結果）的請求數
+  逾時        --timeout 秒內沒收到結果
+  reply       結果直接用 reply token 送出（省下一次 push）的比例
+
+不需要 LINE / Gemini 金鑰，也不會連到外部網路。app 的設定（WEB_CONCURRENCY、
+RECOGNITION_WORKERS、BATCH_WINDOW_SECONDS、GEMINI_STREAMING…）沿用目前的環境變數；
+辨識結果快取預設關閉（同一組截圖重播時每次都會命中），加上 --cache 才開啟；
+流量控制（admission）預設也關閉（否則量到的是限流的速率），加上 --admission 才開啟。
+--mode async 改用 ASGI 模式（APP_MODE=async）；Gemini 替身只支援 rest 傳輸，
+所以這時 Gemini 呼叫走執行緒（正式環境的 grpc_asyncio 才是真正的 asyncio 呼叫）。
+
+每次改效能相關的程式，先存一份基準，之後用 --baseline 比較：
+    python benchmarks/load_benchmark.py --save baseline.json
+    python benchmarks/load_benchmark.py --baseline baseline.json
+
+用法:
+    python benchmarks/load_benchmark.py
+    python benchmarks/load_benchmark.py --concurrency 1,4,16 --requests 40
+    python benchmarks/load_benchmark.py --gemini-latency 3 --gemini-error-rate 0.05 --line-latency 0.05
+    BATCH_WINDOW_SECONDS=0 WEB_CONCURRENCY=4 python benchmarks/load_benchmark.py
+    python benchmarks/load_benchmark.py --mode async --concurrency 8,32,64
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import runpy
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from stubs import GeminiStub, LineStub
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.delivery import PROGRESS_TEXT  # noqa: E402
+
+SAMPLE_DIR = os.path.join(ROOT, '新增資料夾')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+CHANNEL_SECRET = 'bench-secret'
+
+# 印出（與存檔）的 app 設定；沒設定的用 app 的預設值
+APP_SETTINGS = ('APP_MODE', 'RECOGNITION_WORKERS', 'ASYNC_MAX_CONCURRENCY', 'JOB_QUEUE_BACKEND',
+                'BATCH_WINDOW_SECONDS', 'GEMINI_STREAMING', 'GEMINI_MODEL_TIERS', 'PREPROCESS_ENABLED', 'LINE_POOL_SIZE',
+                'REPLY_BUDGET_SECONDS')
+
+
+def load_images(directory):
+    images = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(directory, filename), 'rb') as f:
+                images.append(f.read())
+    return images
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q):
+    """最近排名法的百分位數（values 已排序）"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(q / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def image_event(n):
+    """第 n 個請求的圖片訊息事件（每個請求一位使用者，推播 / 回覆才對得回來）"""
+    return {
+        'type': 'message', 'mode': 'active', 'timestamp': int(time.time() * 1000),
+        'webhookEventId': f'BENCH{n:08d}', 'deliveryContext': {'isRedelivery': False},
+        'source': {'type': 'user', 'userId': f'Ubench{n:08d}'}, 'replyToken': f'reply{n:08d}',
+        'message': {'type': 'image', 'id': str(n), 'quoteToken': f'q{n}', 'contentProvider': {'type': 'line'}},
+    }
+
+
+def reply_recipient(reply_token):
+    """reply token（image_event 的 reply{n}）→ 同一個請求的 userId"""
+    return 'Ubench' + reply_token[len('reply'):]
+
+
+def is_result(kind, messages):
+    """結果（卡片或失敗訊息）；「辨識中」不算"""
+    return not (kind == 'reply' and [message.get('text') for message in messages] == [PROGRESS_TEXT])
+
+
+def signed_body(events):
+    body = json.dumps({'destination': 'Ubench', 'events': events}).encode('utf-8')
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()).decode()
+    return body, signature
+
+
+class AppServer:
+    """用 gunicorn.conf.py 啟動的 app（stdout / stderr 寫到 log 檔）"""
+
+    def __init__(self, env, log_path):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.log_path = log_path
+        self._log = open(log_path, 'w')
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'],
+            cwd=ROOT, env=dict(env, PORT=str(self.port)), stdout=self._log, stderr=subprocess.STDOUT
+        )
+
+    def wait_ready(self, timeout):
+        """等到 /healthz 回報預熱完成（沒網路也不影響：LINE 與 Gemini 都指向本地替身）"""
+        deadline = time.monotonic() + timeout
+        state = None
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                break
+            try:
+                with urllib.request.urlopen(self.url + '/healthz', timeout=2) as response:
+                    state = json.loads(response.read())['warmup']
+                if state == 'warm':
+                    return state
+            except (urllib.error.URLError, ConnectionError, socket.timeout):
+                pass
+            time.sleep(0.2)
+        if self._process.poll() is not None or state is None:
+            with open(self.log_path) as f:
+                tail = f.read()[-2000:]
+            raise RuntimeError(f"app 沒有啟動成功:\n{tail}")
+        return state
+
+    def stop(self):
+        self._process.terminate()
+        try:
+            self._process.wait(15)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+        self._log.close()
+
+
+def run_level(app_url, line, concurrency, requests, start_index, timeout):
+    """
+    以固定並行數（closed loop：每條執行緒送出後等到推播才送下一個）送出 requests 個請求
+
+    回傳:
+        dict: 這一輪的統計
+    """
+    results = []
+    results_lock = threading.Lock()
+
+    def one(n):
+        body, signature = signed_body([image_event(n)])
+        request = urllib.request.Request(
+            app_url + '/webhook', data=body, method='POST',
+            headers={'Content-Type': 'application/json', 'X-Line-Signature': signature}
+        )
+        sent = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            status = None
+        acked = time.perf_counter()
+
+        record = {'ack_ms': (acked - sent) * 1000}
+        if status != 200:
+            record['outcome'] = 'rejected' if status else 'timeout'
+        else:
+            delivery = line.wait_delivery(f'Ubench{n:08d}', max(timeout - (acked - sent), 0), accept=is_result)
+            if delivery is None:
+                record['outcome'] = 'timeout'
+            else:
+                received, record['method'], kinds = delivery
+                record['e2e_ms'] = (received - sent) * 1000
+                record['outcome'] = 'ok' if 'flex' in kinds else 'failed'
+        with results_lock:
+            results.append(record)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(start_index, start_index + requests)))
+    elapsed = time.perf_counter() - started
+
+    outcomes = {name: sum(1 for r in results if r['outcome'] == name)
+                for name in ('ok', 'failed', 'rejected', 'timeout')}
+    ack = sorted(r['ack_ms'] for r in results)
+    e2e = sorted(r['e2e_ms'] for r in results if 'e2e_ms' in r)
+    level = {
+        'concurrency': concurrency,
+        'requests': requests,
+        'elapsed_s': round(elapsed, 2),
+        'throughput_rps': round((outcomes['ok'] + outcomes['failed']) / elapsed, 2) if elapsed else 0.0,
+        **outcomes,
+    }
+    delivered = [r for r in results if 'method' in r]
+    level['reply_rate'] = round(sum(r['method'] == 'reply' for r in delivered) / len(delivered), 3) if delivered else None
+    for q in (50, 95, 99):
+        level[f'ack_p{q}_ms'] = round(percentile(ack, q), 1) if ack else None
+        level[f'e2e_p{q}_ms'] = round(percentile(e2e, q), 1) if e2e else None
+    return level
+
+
+def fmt(value, width, digits=0):
+    return f"{'-':>{width}}" if value is None else f"{value:>{width}.{digits}f}"
+
+
+def print_levels(levels):
+    print(f"{'並行':>4}{'請求':>6}{'成功':>6}{'失敗':>6}{'拒絕':>6}{'逾時':>6}{'req/s':>8}"
+          f"{'ack p50':>9}{'p95':>7}{'p99':>7}{'端對端 p50':>12}{'p95':>8}{'p99':>8}{'reply':>8}   (ms)")
+    for level in levels:
+        print(f"{level['concurrency']:>4}{level['requests']:>6}{level['ok']:>6}{level['failed']:>6}"
+              f"{level['rejected']:>6}{level['timeout']:>6}{fmt(level['throughput_rps'], 8, 2)}"
+              f"{fmt(level['ack_p50_ms'], 9, 1)}{fmt(level['ack_p95_ms'], 7, 1)}{fmt(level['ack_p99_ms'], 7, 1)}"
+              f"{fmt(level['e2e_p50_ms'], 12)}{fmt(level['e2e_p95_ms'], 8)}{fmt(level['e2e_p99_ms'], 8)}"
+              f"{fmt(None if level.get('reply_rate') is None else level['reply_rate'] * 100, 7)}%")
+
+
+def print_comparison(levels, baseline):
+    """和基準比較吞吐量與端對端 p50 / p95 / p99（同樣的並行數才比）"""
+    previous = {level['concurrency']: level for level in baseline['levels']}
+    print()
+    print(f"與基準比較（{baseline.get('saved_at', '?')}）:")
+    print(f"{'並行':>4}{'req/s':>16}{'端對端 p50':>22}{'p95':>20}{'p99':>20}")
+
+    def delta(key, current, old, digits):
+        if current.get(key) is None or old.get(key) is None:
+            return f"{'-':>20}"
+        change = (current[key] - old[key]) / old[key] if old[key] else 0.0
+        return f"{old[key]:>8.{digits}f}→{current[key]:<8.{digits}f}{change:+.0%}"
+
+    for level in levels:
+        old = previous.get(level['concurrency'])
+        if old is None:
+            continue
+        print(f"{level['concurrency']:>4}" + delta('throughput_rps', level, old, 2)
+              + delta('e2e_p50_ms', level, old, 0) + delta('e2e_p95_ms', level, old, 0)
+              + delta('e2e_p99_ms', level, old, 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端對端壓力測試（本地 LINE / Gemini 替身）')
+    parser.add_argument('--concurrency', default='1,2,4,8,16', help='逗號分隔的並行數（依序遞增）')
+    parser.add_argument('--requests', type=int, default=0, help='每種並行數送出的請求數（預設為並行數 × 4，至少 8）')
+    parser.add_argument('--timeout', type=float, default=60, help='單一請求等待結果的秒數')
+    parser.add_argument('--line-latency', type=float, default=0.03, help='LINE API 替身的延遲（秒）')
+    parser.add_argument('--line-error-rate', type=float, default=0.0, help='LINE API 替身回 500 的機率')
+    parser.add_argument('--gemini-latency', type=float, default=1.5, help='Gemini 替身的延遲（秒）')
+    parser.add_argument('--gemini-error-rate', type=float, default=0.0, help='Gemini 替身回 500 的機率')
+    parser.add_argument('--jitter', type=float, default=0.2, help='替身延遲的隨機抖動比例')
+    parser.add_argument('--responses', help='Gemini 替身的回應（JSON 檔，內容為回應物件或文字的陣列）')
+    parser.add_argument('--images', default=SAMPLE_DIR, help='截圖目錄')
+    parser.add_argument('--cache', action='store_true', help='開啟辨識結果快取（預設關閉）')
+    parser.add_argument('--admission', action='store_true', help='開啟流量控制（預設關閉）')
+    parser.add_argument('--mode', choices=('sync', 'async'), help='APP_MODE（預設沿用環境變數，未設定為 sync）')
+    parser.add_argument('--seed', type=int, default=1, help='替身的亂數種子')
+    parser.add_argument('--save', help='把結果存成 JSON（之後當作 --baseline）')
+    parser.add_argument('--baseline', help='和之前 --save 的結果比較')
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if not images:
+        parser.error(f'{args.images} 裡沒有圖片')
+    responses = None
+    if args.responses:
+        with open(args.responses, encoding='utf-8') as f:
+            responses = json.load(f)
+    levels_to_run = [int(value) for value in args.concurrency.split(',') if value.strip()]
+
+    line = LineStub(images, reply_recipient=reply_recipient, latency=args.line_latency, jitter=args.jitter,
+                    error_rate=args.line_error_rate, seed=args.seed).start()
+    gemini = GeminiStub(responses, latency=args.gemini_latency, jitter=args.jitter,
+                        error_rate=args.gemini_error_rate, seed=args.seed).start()
+
+    if args.mode:
+        os.environ['APP_MODE'] = args.mode
+    gunicorn_conf = runpy.run_path(os.path.join(ROOT, 'gunicorn.conf.py'))
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(os.environ)
+        env.setdefault('LOG_LEVEL', 'warning')
+        env.update(
+            LINE_CHANNEL_SECRET=CHANNEL_SECRET,
+            LINE_CHANNEL_ACCESS_TOKEN='bench-token',
+            GEMINI_API_KEY='bench-key',
+            LINE_API_HOST=line.url,
+            GEMINI_API_ENDPOINT=gemini.url,
+            GEMINI_TRANSPORT='rest',
+            DATA_DIR=data_dir,
+            RECOGNITION_CACHE_ENABLED='true' if args.cache else 'false',
+            ADMISSION_ENABLED='true' if args.admission else 'false',
+            PYTHONDONTWRITEBYTECODE='1',
+        )
+        settings = {
+            'gunicorn_workers': gunicorn_conf['workers'],
+            'gunicorn_timeout': gunicorn_conf['timeout'],
+            **{name: env[name] for name in APP_SETTINGS if name in env},
+            'recognition_cache': args.cache,
+            'admission': args.admission,
+            'line_latency_s': args.line_latency,
+            'line_error_rate': args.line_error_rate,
+            'gemini_latency_s': args.gemini_latency,
+            'gemini_error_rate': args.gemini_error_rate,
+        }
+        print('設定: ' + ', '.join(f'{key}={value}' for key, value in settings.items()))
+
+        server = AppServer(env, os.path.join(data_dir, 'server.log'))
+        try:
+            state = server.wait_ready(60)
+            if state != 'warm':
+                print(f"⚠️ 預熱沒有完成（{state}），第一輪會包含冷啟動時間")
+
+            levels = []
+            next_index = 1
+            for concurrency in levels_to_run:
+                requests = args.requests or max(concurrency * 4, 8)
+                levels.append(run_level(server.url, line, concurrency, requests, next_index, args.timeout))
+                next_index += requests
+        finally:
+            server.stop()
+            line.stop()
+            gemini.stop()
+
+    print()
+    print_levels(levels)
+    print()
+    print(f"替身請求數: LINE {line.requests}（500: {line.errors}）, Gemini {gemini.requests}（500: {gemini.errors}）")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            print_comparison(levels, json.load(f))
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'saved_at': time.strftime('%Y-%m-%d %H:%M:%S'), 'settings': settings, 'levels': levels},
+                      f, ensure_ascii=False, indent=2)
+        print(f"結果已存到 {args.save}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Gemini 回應解析 benchmark
+
+離線比較舊版解析（三次 re.sub 去掉 markdown 標記 → json.loads）與
+utils/jsonparse.py 的容錯解析：在一組常見的「不乾淨」模型輸出上，
+各自的解析失敗率、救回的店家數與每次解析耗時。
+加上 --live 會實際呼叫 Gemini，比較 JSON mode 開 / 關時的輸出 token、延遲與解析方式
+（需要設定 GEMINI_API_KEY 等環境變數）。
+
+用法:
+    python benchmarks/parse_benchmark.py
+    python benchmarks/parse_benchmark.py --live
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.jsonparse import parse_tolerant  # noqa: E402
+
+SAMPLE_DIR = os.path.join(ROOT, '新增資料夾')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+RESULT = {
+    'restaurants': [
+        {'name': 'NO.5 CAFE', 'address': '甘肅二街5號'},
+        {'name': 'Minimalism Cafe 巴斯克專賣店', 'address': '新富一街203號'},
+        {'name': 'No.5 CheeseCake 5號起司蛋糕專門店', 'address': '縣民大道二段7號板橋車站B1'},
+    ],
+    'count': 3,
+    'food_keywords': '巴斯克 起司蛋糕 咖啡',
+}
+CLEAN = json.dumps(RESULT, ensure_ascii=False, indent=2)
+
+# (說明, 模型輸出)
+CASES = [
+    ('純 JSON', CLEAN),
+    ('```json 標記', f'```json\n{CLEAN}\n```'),
+    ('前面多一句話', f'以下是辨識結果：\n{CLEAN}'),
+    ('前後都有說明', f'好的！\n```json\n{CLEAN}\n```\n如果需要更多資訊請告訴我。'),
+    ('結尾逗號', CLEAN.replace('"甘肅二街5號"\n', '"甘肅二街5號",\n')[:-2] + ',\n}'),
+    ('字串內換行', CLEAN.replace('巴斯克專賣店', '巴斯克\n專賣店')),
+    ('截斷（第三家店）', CLEAN[:CLEAN.index('No.5 CheeseCake') + 10]),
+    ('截斷（陣列後）', CLEAN[:CLEAN.index('"count"') + 5]),
+    ('不是 JSON', '抱歉，這張圖片裡看不出店家名稱。'),
+]
+
+
+def legacy_parse(text):
+    # 舊版 parse_response_text 的前半段（照原樣保留，只用來比較）
+    text = text.strip()
+    text = re.sub(r'^```json\s*', '', text)
+    text = re.sub(r'^```\s*', '', text)
+    text = re.sub(r'\s*```$', '', text)
+    return json.loads(text.strip())
+
+
+def tolerant_parse(text):
+    return parse_tolerant(text.strip())[0]
+
+
+def outcome(func, text):
+    try:
+        result = func(text)
+    except ValueError:
+        return None
+    return len(result.get('restaurants', []))
+
+
+def per_call_us(func, text, number):
+    def call():
+        try:
+            func(text)
+        except ValueError:
+            pass
+    return min(timeit.repeat(call, number=number, repeat=3)) / number * 1e6
+
+
+def run_offline(number):
+    print(f"{'輸出':<18}{'舊版':>8}{'容錯':>8}{'方式':>10}{'舊版 µs':>10}{'容錯 µs':>10}")
+    legacy_failed = tolerant_failed = 0
+    for label, text in CASES:
+        before = outcome(legacy_parse, text)
+        after = outcome(tolerant_parse, text)
+        try:
+            method = parse_tolerant(text.strip())[1]
+        except ValueError:
+            method = 'failed'
+        legacy_failed += before is None
+        tolerant_failed += after is None
+        print(f"{label:<18}{'失敗' if before is None else f'{before} 家':>8}{'失敗' if after is None else f'{after} 家':>8}"
+              f"{method:>10}{per_call_us(legacy_parse, text, number):>10.1f}{per_call_us(tolerant_parse, text, number):>10.1f}")
+    print(f"\n解析失敗率: 舊版 {legacy_failed}/{len(CASES)}，容錯 {tolerant_failed}/{len(CASES)}")
+
+
+def run_live():
+    from PIL import Image
+    from utils import gemini
+
+    samples = sorted(name for name in os.listdir(SAMPLE_DIR) if name.lower().endswith(IMAGE_EXTENSIONS))
+    model_name = gemini.model_cascade.model_names[0]
+    json_config = {'response_mime_type': 'application/json', 'response_schema': gemini.RESPONSE_SCHEMA}
+    for filename in samples:
+        print(f"\n=== {filename} ===")
+        with open(os.path.join(SAMPLE_DIR, filename), 'rb') as f:
+            data = f.read()
+        image_parts = [gemini.prepare_image(Image.open(os.path.join(SAMPLE_DIR, filename)), len(data))]
+        for label, config in (('text', None), ('json', json_config)):
+            gemini.GENERATION_CONFIG = config
+            before = gemini.usage_stats().get(model_name, {}).get('output', 0)
+            start = time.perf_counter()
+            text = gemini.generate(model_name, image_parts)
+            elapsed = time.perf_counter() - start
+            output_tokens = gemini.usage_stats()[model_name]['output'] - before
+            try:
+                result, method = gemini.parse_response(text)
+                names = [r['name'] for r in result['restaurants']]
+            except ValueError:
+                method, names = 'failed', []
+            print(f"{label:<5} {elapsed:6.2f}s  輸出 {output_tokens:>4} tokens  {method:<9}"
+                  f"{json.dumps(names, ensure_ascii=False)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gemini 回應解析 benchmark')
+    parser.add_argument('--number', type=int, default=2000, help='每種輸出重複解析次數')
+    parser.add_argument('--live', action='store_true', help='實際呼叫 Gemini 比較 JSON mode 開 / 關')
+    args = parser.parse_args()
+
+    run_offline(args.number)
+    if args.live:
+        run_live()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+本地預篩 benchmark
+
+用一組有標記的圖片評估 utils/prefilter.py：
+- 正例（有店家資訊，必須送辨識）：新增資料夾 裡的截圖 + 程式產生的文字截圖
+- 反例（不可能有店名，應該擋下）：程式產生的失焦人像、食物特寫、純色 / 漸層圖
+輸出每張圖的文字分數、底色比例與判斷，以及誤擋率（正例被擋下的比例）、
+反例擋下率（= 省下的 Gemini 呼叫）與平均耗時；--sweep 會列出不同門檻的結果。
+真實的反例可以用 --labels 加入（JSON：{"圖片路徑": true / false}，true 表示有店家資訊）。
+
+用法:
+    python benchmarks/prefilter_benchmark.py
+    python benchmarks/prefilter_benchmark.py --sweep
+    python benchmarks/prefilter_benchmark.py --labels labels.json --threshold 0.4
+"""
+import argparse
+import json
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image, ImageDraw, ImageFilter  # noqa: E402
+from utils.prefilter import PreFilter  # noqa: E402
+
+SAMPLE_DIR = os.path.join(ROOT, '新增資料夾')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def load_samples(directory, labels_path=None):
+    samples = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            samples.append((filename, True, Image.open(os.path.join(directory, filename))))
+    if labels_path:
+        with open(labels_path, encoding='utf-8') as f:
+            for path, label in json.load(f).items():
+                samples.append((os.path.basename(path), bool(label), Image.open(path)))
+    return samples
+
+
+def _noise(image, rng, amount=0.12):
+    # 感光元件雜訊，避免產生的圖比真實照片還乾淨
+    noise = Image.effect_noise(image.size, 10 + rng.random() * 10).convert(image.mode)
+    return Image.blend(image, noise, amount)
+
+
+def fake_portrait(rng, size=(1080, 1440)):
+    # 失焦背景 + 膚色橢圓（自拍）
+    image = Image.new('RGB', size, tuple(rng.randint(60, 200) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y, r = rng.randint(0, size[0]), rng.randint(0, size[1]), rng.randint(80, 400)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randint(0, 255) for _ in range(3)))
+    image = image.filter(ImageFilter.GaussianBlur(30))
+    draw = ImageDraw.Draw(image)
+    w, h = size
+    draw.ellipse((w * 0.25, h * 0.2, w * 0.75, h * 0.75), fill=(224, 172, 140))
+    return _noise(image.filter(ImageFilter.GaussianBlur(6)), rng)
+
+
+def fake_food(rng, size=(1200, 1200)):
+    # 淺景深的食物特寫：盤子 + 幾塊顏色
+    image = Image.new('RGB', size, tuple(rng.randint(90, 160) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    w, h = size
+    draw.ellipse((w * 0.1, h * 0.1, w * 0.9, h * 0.9), fill=(240, 240, 235))
+    for _ in range(25):
+        x, y, r = rng.randint(w // 4, w * 3 // 4), rng.randint(h // 4, h * 3 // 4), rng.randint(30, 160)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=(rng.randint(150, 255), rng.randint(60, 180), rng.randint(0, 90)))
+    return _noise(image.filter(ImageFilter.GaussianBlur(rng.choice((4, 8, 14)))), rng)
+
+
+def fake_plain(rng, size=(1080, 1080)):
+    # 純色 / 漸層背景（沒有文字的迷因底圖、桌布）
+    top, bottom = [tuple(rng.randint(0, 255) for _ in range(3)) for _ in range(2)]
+    image = Image.new('RGB', size)
+    draw = ImageDraw.Draw(image)
+    for y in range(size[1]):
+        t = y / size[1]
+        draw.line((0, y, size[0], y), fill=tuple(int(a + (b - a) * t) for a, b in zip(top, bottom)))
+    return _noise(image, rng, 0.05)
+
+
+def fake_screenshot(rng, size=(1080, 2340)):
+    # 白底的貼文截圖：幾行文字 + 一張圖
+    image = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    words = ['cafe', 'Mountain', 'brunch', 'No.5', '@shop_official', 'Taoyuan', 'open 11:00', 'menu']
+    y = 120
+    while y < size[1] - 100:
+        if rng.random() < 0.15:
+            draw.rectangle((40, y, size[0] - 40, y + 600), fill=tuple(rng.randint(0, 255) for _ in range(3)))
+            y += 640
+            continue
+        line = ' '.join(rng.choice(words) for _ in range(rng.randint(2, 6)))
+        draw.text((60, y), line, fill=(20, 20, 20), font_size=rng.choice((36, 44, 56)))
+        y += 90
+    return image
+
+
+def generated_samples(rng, count):
+    samples = []
+    for i in range(count):
+        samples.append((f'screenshot-{i}', True, fake_screenshot(rng)))
+        samples.append((f'portrait-{i}', False, fake_portrait(rng)))
+        samples.append((f'food-{i}', False, fake_food(rng)))
+        samples.append((f'plain-{i}', False, fake_plain(rng)))
+    return samples
+
+
+def evaluate(samples, threshold, background, verbose):
+    prefilter = PreFilter(threshold=threshold, screenshot_background=background)
+    false_rejects = positives = negatives_rejected = negatives = 0
+    if verbose:
+        print(f"{'圖片':<24}{'標記':>6}{'文字分數':>10}{'底色':>8}{'截圖':>6}{'判斷':>6}")
+    for name, label, image in samples:
+        accepted, features = prefilter.decide(image)
+        if label:
+            positives += 1
+            false_rejects += not accepted
+        else:
+            negatives += 1
+            negatives_rejected += not accepted
+        if verbose:
+            print(f"{name[:22]:<24}{'有' if label else '無':>6}{features['text_score']:>10.3f}"
+                  f"{features['background_ratio']:>8.2f}{'是' if features['screenshot'] else '':>6}"
+                  f"{'送' if accepted else '擋':>6}")
+    return {
+        'false_reject_rate': false_rejects / positives if positives else 0.0,
+        'negative_reject_rate': negatives_rejected / negatives if negatives else 0.0,
+        'false_rejects': false_rejects,
+        'positives': positives,
+        'negatives_rejected': negatives_rejected,
+        'negatives': negatives,
+        'avg_ms': prefilter.stats()['avg_ms'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地預篩 benchmark')
+    parser.add_argument('--dir', default=SAMPLE_DIR, help='正例截圖目錄')
+    parser.add_argument('--labels', help='額外的標記圖片（JSON：{"路徑": true / false}）')
+    parser.add_argument('--generated', type=int, default=10, help='每種產生的圖片張數（0 = 不產生）')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--background', type=float, default=0.45, help='截圖版面的底色比例門檻')
+    parser.add_argument('--sweep', action='store_true', help='列出不同門檻的誤擋率與擋下率')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    samples = load_samples(args.dir, args.labels) + generated_samples(random.Random(args.seed), args.generated)
+    for _, _, image in samples:
+        image.load()
+
+    result = evaluate(samples, args.threshold, args.background, verbose=True)
+    print(f"\n門檻 {args.threshold}: 誤擋 {result['false_rejects']}/{result['positives']}"
+          f"（{result['false_reject_rate']:.1%}），反例擋下 {result['negatives_rejected']}/{result['negatives']}"
+          f"（{result['negative_reject_rate']:.1%}，省下的 Gemini 呼叫），平均 {result['avg_ms']} ms/張")
+
+    if args.sweep:
+        print(f"\n{'門檻':>6}{'誤擋率':>10}{'反例擋下率':>12}")
+        for threshold in (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9):
+            swept = evaluate(samples, threshold, args.background, verbose=False)
+            print(f"{threshold:>6.1f}{swept['false_reject_rate']:>10.1%}{swept['negative_reject_rate']:>12.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+圖片前處理 benchmark
+
+比較「原始送法」（SDK 把 PIL Image 轉成無損 WebP）與前處理後的
+像素數、上傳大小、處理時間；加上 --live 會實際呼叫 Gemini，
+比較兩種送法的延遲與辨識結果（需要設定 GEMINI_API_KEY 等環境變數）。
+
+用法:
+    python benchmarks/preprocess_benchmark.py
+    python benchmarks/preprocess_benchmark.py --live
+    python benchmarks/preprocess_benchmark.py --max-edge 1280 --format WEBP --quality 80
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image  # noqa: E402
+from utils.preprocess import preprocess_image  # noqa: E402
+
+SAMPLE_DIR = os.path.join(ROOT, '新增資料夾')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def load_samples(directory):
+    samples = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(directory, filename), 'rb') as f:
+                samples.append((filename, f.read()))
+    return samples
+
+
+def sdk_upload_size(image):
+    """SDK 對記憶體中的 PIL Image 的預設處理：轉成無損 WebP"""
+    buffer = io.BytesIO()
+    image.save(buffer, format='webp', lossless=True)
+    return len(buffer.getvalue())
+
+
+def run_offline(samples, args):
+    print(f"{'檔案':<24}{'原始像素':>12}{'處理後像素':>12}{'SDK 上傳':>12}{'處理後':>10}{'縮減':>8}{'耗時ms':>9}")
+    total_before = total_after = 0
+    for filename, data in samples:
+        image = Image.open(io.BytesIO(data))
+        before = sdk_upload_size(image)
+        prepared = preprocess_image(
+            image, max_edge=args.max_edge, image_format=args.format, quality=args.quality,
+            grayscale=args.grayscale, crop_chrome=not args.no_crop, original_bytes=len(data)
+        )
+        stats = prepared.stats
+        total_before += before
+        total_after += stats['bytes']
+        print(f"{filename[:22]:<24}{stats['original_pixels']:>12}{stats['pixels']:>12}"
+              f"{before:>12}{stats['bytes']:>10}{1 - stats['bytes'] / before:>8.0%}{stats['elapsed_ms']:>9}")
+    if total_before:
+        print(f"\n合計: {total_before} → {total_after} bytes（縮減 {1 - total_after / total_before:.0%}）")
+
+
+def run_live(samples):
+    # 關閉快取，確保每次都真的呼叫 Gemini
+    os.environ['RECOGNITION_CACHE_ENABLED'] = 'false'
+    from utils.gemini import recognize_restaurant
+
+    for filename, data in samples:
+        print(f"\n=== {filename} ===")
+        for label, preprocess in (('原始', False), ('前處理', True)):
+            start = time.perf_counter()
+            result = recognize_restaurant(data, preprocess=preprocess)
+            elapsed = time.perf_counter() - start
+            names = [r.get('name') for r in result.get('restaurants', [])]
+            print(f"{label:<6} {elapsed:6.2f}s  {json.dumps(names, ensure_ascii=False)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='圖片前處理 benchmark')
+    parser.add_argument('--dir', default=SAMPLE_DIR, help='樣本圖片目錄')
+    parser.add_argument('--max-edge', type=int, default=1600)
+    parser.add_argument('--format', default='JPEG', choices=['JPEG', 'WEBP'])
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--grayscale', default='auto', choices=['auto', 'always', 'never'])
+    parser.add_argument('--no-crop', action='store_true', help='不裁切狀態列 / 導覽列')
+    parser.add_argument('--live', action='store_true', help='實際呼叫 Gemini 比較延遲與辨識結果')
+    args = parser.parse_args()
+
+    samples = load_samples(args.dir)
+    if not samples:
+        print(f"找不到樣本圖片: {args.dir}")
+        return
+
+    run_offline(samples, args)
+    if args.live:
+        run_live(samples)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+Gemini 呼叫的重試 / 對沖 / 斷路器 benchmark
+
+用 Gemini 替身（benchmarks/stubs.py）模擬不穩定的上游，固定並行數持續呼叫 utils.gemini.call --duration 秒：
+  錯誤 + 長尾  --error-rate 的請求回 500、--slow-rate 的請求延遲變成 --slow-factor 倍，比較
+               none（舊做法：不重試、沒有期限）、retry（期限 + 重試）、retry+hedge（再加上對沖）
+               的成功率、延遲 p50 / p95 / p99 / 最大值與實際送出的請求數（對沖會多花請求）
+  上游故障     第 --outage-start 秒起替身一律回 503，持續 --outage 秒，比較有 / 沒有斷路器時
+               失敗的呼叫要等多久、故障期間送到上游的請求數，與故障結束後多久才有第一個成功的呼叫
+每種設定在新的子行程裡跑（config 在 import 時讀取）。
+
+用法:
+    python benchmarks/resilience_benchmark.py
+    python benchmarks/resilience_benchmark.py --error-rate 0.1 --slow-rate 0.05 --duration 20
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stubs import GeminiStub  # noqa: E402
+
+MODEL = 'gemini-2.5-flash'
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def run_worker(threads, duration, start_at):
+    """子行程：threads 條執行緒持續呼叫 gemini.call，回傳每次呼叫的 (開始時間, 耗時, 是否成功)"""
+    from PIL import Image
+    from utils import gemini
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (255, 255, 255)).save(buffer, 'JPEG')
+    part = {'mime_type': 'image/jpeg', 'data': buffer.getvalue()}
+    gemini.call(MODEL, [part])  # 建立 client（不計入結果）
+
+    calls = []
+    lock = threading.Lock()
+    time.sleep(max(start_at - time.time(), 0))
+    deadline = start_at + duration
+
+    def loop():
+        while time.time() < deadline:
+            began = time.time()
+            try:
+                gemini.call(MODEL, [part])
+                ok = True
+            except Exception:
+                ok = False
+                time.sleep(0.05)  # 呼叫端失敗時不要空轉
+            with lock:
+                calls.append((began - start_at, time.time() - began, ok))
+
+    workers = [threading.Thread(target=loop) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return {'calls': calls, 'resilience': gemini.resilience.stats()['models'].get(MODEL, {})}
+
+
+def run_config(stub, settings, args, outage=None):
+    """在子行程裡跑一種設定；outage=(開始秒數, 持續秒數) 時由這裡切換替身的故障狀態"""
+    with tempfile.TemporaryDirectory() as data_dir:
+        env = dict(
+            os.environ,
+            LINE_CHANNEL_SECRET='bench-secret',
+            LINE_CHANNEL_ACCESS_TOKEN='bench-token',
+            GEMINI_API_KEY='AIza-bench-key-0000',
+            GEMINI_API_ENDPOINT=stub.url,
+            GEMINI_TRANSPORT='rest',
+            GEMINI_RATE_LIMITS='',
+            PROMPT_CACHE_ENABLED='false',
+            DATA_DIR=data_dir,
+            LOG_LEVEL='error',
+            **settings,
+        )
+        env.pop('GEMINI_API_KEYS', None)
+        start_at = time.time() + 3  # 留時間給子行程 import
+        worker = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker', '--threads', str(args.threads),
+             '--duration', str(args.duration), '--start-at', str(start_at)],
+            env=env, cwd=ROOT, stdout=subprocess.PIPE, text=True
+        )
+        requests_at = {}
+        if outage:
+            begin, length = outage
+            time.sleep(max(start_at + begin - time.time(), 0))
+            requests_at['before'] = stub.requests.get('generate', 0)
+            stub.outage = True
+            time.sleep(length)
+            stub.outage = False
+            requests_at['after'] = stub.requests.get('generate', 0)
+        output, _ = worker.communicate()
+        if worker.returncode:
+            raise RuntimeError(f'worker 失敗（{worker.returncode}）')
+        result = json.loads(output.strip().splitlines()[-1])
+        result['upstream_during_outage'] = requests_at.get('after', 0) - requests_at.get('before', 0)
+        return result
+
+
+def summarize(result, stub):
+    calls = result['calls']
+    latencies = [elapsed for _, elapsed, _ in calls]
+    ok = sum(1 for _, _, success in calls if success)
+    return {
+        'calls': len(calls),
+        'ok_rate': ok / len(calls) if calls else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'max': max(latencies, default=0.0),
+        'upstream': stub.requests.get('generate', 0),
+    }
+
+
+# 各設定（環境變數）
+NONE = {'GEMINI_RETRY_ATTEMPTS': '1', 'GEMINI_ATTEMPT_TIMEOUT': '600', 'GEMINI_CIRCUIT_FAILURES': '1000000'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gemini 呼叫的重試 / 對沖 / 斷路器 benchmark')
+    parser.add_argument('--threads', type=int, default=8, help='並行呼叫數')
+    parser.add_argument('--duration', type=float, default=15.0, help='每種設定呼叫幾秒')
+    parser.add_argument('--latency', type=float, default=0.3, help='替身每次呼叫的平均延遲（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.05, help='回 500 的機率')
+    parser.add_argument('--slow-rate', type=float, default=0.03, help='延遲變成 --slow-factor 倍的機率')
+    parser.add_argument('--slow-factor', type=float, default=20.0)
+    parser.add_argument('--attempt-timeout', type=float, default=2.0, help='每次嘗試的期限（GEMINI_ATTEMPT_TIMEOUT）')
+    parser.add_argument('--outage-start', type=float, default=3.0, help='上游故障從第幾秒開始')
+    parser.add_argument('--outage', type=float, default=6.0, help='上游故障持續幾秒')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--start-at', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        from utils.log import configure
+        configure('error')
+        print(json.dumps(run_worker(args.threads, args.duration, args.start_at)))
+        return
+
+    retry = {
+        'GEMINI_RETRY_ATTEMPTS': '3', 'GEMINI_ATTEMPT_TIMEOUT': str(args.attempt_timeout),
+        'GEMINI_RETRY_BUDGET_SECONDS': str(args.attempt_timeout * 3), 'GEMINI_RETRY_BACKOFF': '0.1',
+        'GEMINI_RETRY_MAX_BACKOFF': '1', 'GEMINI_CIRCUIT_FAILURES': '1000000',
+    }
+    hedge = dict(retry, GEMINI_HEDGE_ENABLED='true', GEMINI_HEDGE_MIN_DELAY='0')
+
+    print(f"替身: 延遲 {args.latency:g}s，{args.error_rate:.0%} 回 500，{args.slow_rate:.0%} 延遲 ×{args.slow_factor:g}；"
+          f"並行 {args.threads}，每種設定 {args.duration:g} 秒\n")
+    print(f"{'設定':<13}{'呼叫':>6}{'成功率':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'最大 ms':>10}"
+          f"{'上游請求':>10}{'重試':>6}{'對沖':>6}{'對沖勝':>8}")
+    for label, settings in (('none', NONE), ('retry', retry), ('retry+hedge', hedge)):
+        stub = GeminiStub(latency=args.latency, error_rate=args.error_rate, slow_rate=args.slow_rate,
+                          slow_factor=args.slow_factor, seed=args.seed).start()
+        try:
+            result = run_config(stub, settings, args)
+            row = summarize(result, stub)
+        finally:
+            stub.stop()
+        counts = result['resilience']
+        print(f"{label:<13}{row['calls']:>6}{row['ok_rate']:>9.1%}{row['p50'] * 1000:>9.0f}{row['p95'] * 1000:>9.0f}"
+              f"{row['p99'] * 1000:>9.0f}{row['max'] * 1000:>10.0f}{row['upstream']:>10}"
+              f"{counts.get('retries', 0):>6}{counts.get('hedges', 0):>6}{counts.get('hedges_won', 0):>8}")
+
+    print(f"\n上游故障：第 {args.outage_start:g} 秒起一律回 503，持續 {args.outage:g} 秒")
+    print(f"{'設定':<13}{'呼叫':>6}{'失敗':>6}{'失敗平均 ms':>13}{'故障期間上游請求':>18}{'斷路器打開':>12}{'直接拒絕':>10}"
+          f"{'恢復 ms':>10}")
+    breaker = dict(retry, GEMINI_CIRCUIT_FAILURES='5', GEMINI_CIRCUIT_RESET_SECONDS='2')
+    for label, settings in (('no breaker', retry), ('breaker', breaker)):
+        stub = GeminiStub(latency=args.latency, seed=args.seed).start()
+        try:
+            result = run_config(stub, settings, args, outage=(args.outage_start, args.outage))
+        finally:
+            stub.stop()
+        calls = result['calls']
+        failed = [elapsed for _, elapsed, ok in calls if not ok]
+        # 故障結束後第一個成功的呼叫（斷路器要等 reset 時間過後的試探請求成功才關閉）
+        end = args.outage_start + args.outage
+        recovered = min((began + elapsed for began, elapsed, ok in calls if ok and began + elapsed > end), default=None)
+        counts = result['resilience']
+        print(f"{label:<13}{len(calls):>6}{len(failed):>6}{sum(failed) / len(failed) * 1000 if failed else 0:>13.0f}"
+              f"{result['upstream_during_outage']:>18}{counts.get('trips', 0):>12}{counts.get('rejected', 0):>10}"
+              f"{(recovered - end) * 1000 if recovered is not None else float('nan'):>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
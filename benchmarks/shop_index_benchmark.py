@@ -0,0 +1,97 @@
+"""
+已知店家索引 benchmark
+
+在暫存的 SQLite 檔建立 N 家假店家（utils/shops.py 的 ShopIndex），量測：
+寫入速度、精確查詢（帳號 / 店名）、模糊查詢（店名差一個字）、
+查不到的店名，以及模型分層用的 trusts() 每次耗時。
+
+用法:
+    python benchmarks/shop_index_benchmark.py
+    python benchmarks/shop_index_benchmark.py --shops 500000 --number 2000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.shops import ShopIndex  # noqa: E402
+
+# 假店名：隨機音節組成的字 + 常見類別字（類別字重複率高，測得到模糊查詢的候選過多）
+SYLLABLES = ['ka', 'mo', 'ri', 'to', 'na', 'su', 'le', 'po', 'chi', 'ya', 'ben', 'lin', 'wa', 'xi', 'do', 'ru',
+             'mi', 'ta', 'ko', 'shan', 'yu', 'fei', 'ho', 'an', 'zen', 'bo', 'ki', 'ma', 'no', 'sa']
+CATEGORIES = ['cafe', 'coffee', 'bakery', 'brunch', 'kitchen', 'bistro', 'tea', 'dessert',
+              '咖啡', '甜點', '食堂', '麵屋', '烘焙', '小館', '茶室', '餐酒館']
+AREAS = ['中壢區', '桃園區', '板橋區', '大安區', '信義區', '西屯區', '前鎮區', '新莊區']
+
+
+def fake_word(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+
+
+def fake_shop(rng):
+    word = fake_word(rng)
+    name = f"{word.title()} {fake_word(rng) + ' ' if rng.random() < 0.5 else ''}{rng.choice(CATEGORIES)}"
+    handle = f"{word}.{rng.choice(CATEGORIES[:8])}{rng.randint(0, 99)}" if rng.random() < 0.6 else ''
+    address = f"{rng.choice(AREAS)}{rng.randint(1, 300)}號" if rng.random() < 0.5 else 'unknown'
+    return {'name': name, 'original_handle': handle, 'address': address}
+
+
+def typo(text, rng):
+    pos = rng.randrange(len(text))
+    return text[:pos] + text[pos + 1:]
+
+
+def per_call_us(func, items):
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - start) / len(items) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='已知店家索引 benchmark')
+    parser.add_argument('--shops', type=int, default=200000, help='索引中的店家數')
+    parser.add_argument('--number', type=int, default=1000, help='每種查詢的次數')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    shops = [fake_shop(rng) for _ in range(args.shops)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = ShopIndex(os.path.join(directory, 'shops.db'))
+        start = time.perf_counter()
+        for offset in range(0, len(shops), 500):
+            index.record(shops[offset:offset + 500])
+        elapsed = time.perf_counter() - start
+        print(f"寫入 {args.shops} 家: {elapsed:.1f}s（{args.shops / elapsed:.0f} 家/s），"
+              f"檔案 {os.path.getsize(os.path.join(directory, 'shops.db')) / 1e6:.1f} MB")
+
+        sample = rng.sample(shops, min(args.number, len(shops)))
+        # 同名的店合併時只留第一個帳號，帳號查詢從索引裡實際存的帳號抽樣
+        handles = [row[0] for row in index._db.execute(
+            "SELECT handle FROM shops WHERE handle != '' ORDER BY random() LIMIT ?", (len(sample),)
+        )]
+        cases = [
+            ('精確（帳號）', lambda handle: index.lookup('', handle), handles),
+            ('精確（店名）', lambda shop: index.lookup(shop['name']), sample),
+            ('模糊（少一個字）', lambda shop: index.lookup(typo(shop['name'], rng)), sample),
+            ('查不到', lambda shop: index.lookup(f"Unknown Place {rng.random()}"), sample),
+            ('trusts()', lambda shop: index.trusts({'restaurants': [shop]}), sample),
+        ]
+        print(f"\n{'查詢':<14}{'µs/次':>10}")
+        for label, func, items in cases:
+            print(f"{label:<14}{per_call_us(func, items):>10.1f}")
+
+        stats = index.stats()
+        print(f"\n店家數 {stats['shops']}（同名的假店家會合併）；模糊 + 查不到共 {2 * len(sample)} 次查詢："
+              f"模糊命中 {stats['fuzzy']}、查不到 {stats['miss']}")
+
+
+if __name__ == '__main__':
+    main()
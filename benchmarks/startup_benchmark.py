@@ -0,0 +1,128 @@
+"""
+冷啟動 benchmark
+
+每次都開一個全新的 Python 行程，量測：
+  import app 的時間、第一個 /healthz 與 /webhook 的回應時間，
+  以及從收到第一則訊息到送出回覆（reply）的時間。
+
+三種情境：
+  eager  舊版行為：一開始就 import google.generativeai / linebot.v3 / PIL
+  lazy   重量級模組用到才 import，沒有預熱（第一則訊息自己付 import 的時間）
+  warm   import 後先跑完預熱（等同 gunicorn worker 啟動後背景預熱完成）
+
+回覆不會真的送出（以假的 MessagingApi 取代），不需要 LINE / Gemini 金鑰。
+沒有網路時，預熱的 line 步驟（先開連線）會失敗，不影響其他數字。
+
+用法:
+    python benchmarks/startup_benchmark.py
+    python benchmarks/startup_benchmark.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 在子行程執行：印出一行 JSON 結果
+CHILD = r'''
+import base64, hashlib, hmac, json, sys, threading, time, uuid
+mode = sys.argv[1]
+start = time.perf_counter()
+if mode == 'eager':
+    import google.generativeai, linebot.v3.messaging, linebot.v3.webhooks, PIL.Image
+import app
+result = {'import_ms': (time.perf_counter() - start) * 1000}
+
+if mode == 'warm':
+    start = time.perf_counter()
+    result['warmup'] = app.warmup.run()
+    result['warmup_ms'] = (time.perf_counter() - start) * 1000
+
+replied = threading.Event()
+
+class FakeMessagingApi:
+    def reply_message(self, *args, **kwargs):
+        replied.set()
+
+app.line_clients.messaging = lambda: FakeMessagingApi()
+client = app.app.test_client()
+
+start = time.perf_counter()
+client.get('/healthz')
+result['healthz_ms'] = (time.perf_counter() - start) * 1000
+
+# 每次都用新的事件 / 訊息 ID：所有子行程共用同一個 DATA_DIR，重複的 ID 會被當成 LINE 重送而略過
+event_id = uuid.uuid4().hex
+body = json.dumps({'destination': 'bench', 'events': [{
+    'type': 'message', 'mode': 'active', 'timestamp': int(time.time() * 1000), 'webhookEventId': event_id,
+    'deliveryContext': {'isRedelivery': False}, 'source': {'type': 'user', 'userId': 'U1'},
+    'replyToken': 'R1', 'message': {'type': 'text', 'id': event_id, 'text': 'hi', 'quoteToken': 'q'}
+}]})
+signature = base64.b64encode(hmac.new(b'bench-secret', body.encode(), hashlib.sha256).digest()).decode()
+start = time.perf_counter()
+status = client.post('/webhook', data=body, headers={'X-Line-Signature': signature}).status_code
+result['webhook_ms'] = (time.perf_counter() - start) * 1000
+result['reply_ms'] = (time.perf_counter() - start) * 1000 if replied.wait(30) else None
+result['status'] = status
+print('RESULT ' + json.dumps(result))
+'''
+
+
+def run_once(mode, data_dir):
+    env = dict(
+        os.environ,
+        LINE_CHANNEL_SECRET='bench-secret',
+        LINE_CHANNEL_ACCESS_TOKEN='bench-token',
+        GEMINI_API_KEY='bench-key',
+        DATA_DIR=data_dir,
+        WARMUP_ON_START='false',
+        PYTHONDONTWRITEBYTECODE='1',
+    )
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, mode], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    for line in output.splitlines():
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+    raise RuntimeError(f"子行程沒有輸出結果: {output[-500:]}")
+
+
+def median(results, key):
+    values = [r[key] for r in results if r.get(key) is not None]
+    return statistics.median(values) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='冷啟動 benchmark')
+    parser.add_argument('--runs', type=int, default=3, help='每種情境重複幾次（取中位數）')
+    args = parser.parse_args()
+
+    columns = [('import_ms', 'import app'), ('warmup_ms', '預熱'), ('healthz_ms', '/healthz'),
+               ('webhook_ms', '/webhook'), ('reply_ms', '第一則回覆')]
+    print(f"{'情境':<8}" + ''.join(f"{label:>14}" for _, label in columns) + '   (ms，中位數)')
+
+    last_warmup = None
+    with tempfile.TemporaryDirectory() as data_dir:
+        for mode in ('eager', 'lazy', 'warm'):
+            results = [run_once(mode, data_dir) for _ in range(args.runs)]
+            cells = []
+            for key, _ in columns:
+                value = median(results, key)
+                cells.append(f"{value:>14.1f}" if value is not None else f"{'-':>14}")
+            print(f"{mode:<8}" + ''.join(cells))
+            if mode == 'warm':
+                last_warmup = results[-1]['warmup']
+
+    if last_warmup:
+        print()
+        print(f"預熱步驟（ms）: {last_warmup['steps']}")
+        if last_warmup['errors']:
+            print(f"預熱失敗的步驟: {list(last_warmup['errors'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+"""
+本地 LINE / Gemini API 替身（給 benchmark 用）
+
+兩個都是跑在背景執行緒的 HTTP server，延遲、錯誤率、回應內容都可以設定：
+
+  LineStub    LINE Messaging API（reply / push）與 Blob API（下載圖片）。
+              LineClients 設定 host 後兩種 API 都送到同一個 host，所以一個 server 就夠了。
+              每則推播 / 回覆都會記錄下來，benchmark 用收件者（userId；回覆用 reply_recipient
+              從 reply token 換算）對應到哪一個請求。
+  GeminiStub  Gemini REST API（generateContent / streamGenerateContent）。
+              app 需設定 GEMINI_TRANSPORT=rest 與 GEMINI_API_ENDPOINT 指向這裡；
+              context caching 一律回 400，prompt_cache 會退回 inline 系統指示。
+              rate_limit 可以模擬每把 API key 的配額（超過就回 429 RESOURCE_EXHAUSTED）；
+              slow_rate 模擬長尾延遲，outage = True 時一律回 503（模擬上游故障）。
+
+用法:
+    line = LineStub(images, latency=0.03).start()
+    gemini = GeminiStub(latency=1.5, error_rate=0.02).start()
+    ... LINE_API_HOST=line.url、GEMINI_API_ENDPOINT=gemini.url ...
+    line.wait_delivery('U1', timeout=30)
+    line.stop(); gemini.stop()
+"""
+import io
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 預設的 Gemini 回應（新增資料夾 截圖裡的店家；有帳號或地址，flash 層就會採用）
+DEFAULT_RESPONSES = [
+    {
+        'restaurants': [
+            {'name': 'Mountain', 'original_handle': 'mountain.coffee2025', 'address': '中壢 內壢'},
+            {'name': '食。光機', 'address': '桃園市中壢區大華路93號'},
+        ],
+        'count': 2,
+        'food_keywords': '咖啡 甜點',
+    },
+    {
+        'restaurants': [
+            {'name': 'NO.5 CAFE', 'address': '甘肅二街5號'},
+            {'name': 'Minimalism Cafe 巴斯克專賣店', 'address': '新富一街203號'},
+            {'name': 'No.5 CheeseCake 5號起司蛋糕專門店', 'address': '縣民大道二段7號板橋車站B1'},
+        ],
+        'count': 3,
+        'food_keywords': '起司蛋糕',
+    },
+    {
+        'restaurants': [{'name': 'No.5 Cafe', 'address': 'unknown'}],
+        'count': 1,
+        'food_keywords': '咖啡',
+    },
+]
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # app 結束時會直接關掉 keep-alive 連線，不算錯誤
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stub = None  # 子類別設定
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, body, content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Stub:
+    """背景執行緒裡的 HTTP server；latency 加上 ±jitter 比例的隨機抖動"""
+
+    handler = _StubHandler
+
+    def __init__(self, latency=0.0, jitter=0.2, error_rate=0.0, seed=None):
+        """
+        參數:
+            latency: float - 每個請求的平均延遲（秒）
+            jitter: float - 延遲的隨機抖動比例（0.2 表示 ±20%）
+            error_rate: float - 回 500 的機率（0 ~ 1）
+            seed: int - 亂數種子（固定後每次執行的錯誤分佈相同）
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.requests = {}  # 路徑種類 → 次數
+        self.errors = 0
+        self._server = None
+
+    def start(self):
+        handler = type(self.handler.__name__, (self.handler,), {'stub': self})
+        self._server = _Server(('127.0.0.1', 0), handler)
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def delay(self, scale=1.0):
+        with self._random_lock:
+            factor = 1 + self._random.uniform(-self.jitter, self.jitter)
+        seconds = max(self.latency * factor * scale, 0.0)
+        if seconds:
+            time.sleep(seconds)
+
+    def should_fail(self):
+        with self._random_lock:
+            failed = self._random.random() < self.error_rate
+        if failed:
+            with self._lock:
+                self.errors += 1
+        return failed
+
+    def count(self, kind):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+
+_CONTENT_PATH = re.compile(r'^/v2/bot/message/([^/]+)/content(/preview)?$')
+
+
+class _LineHandler(_StubHandler):
+    def do_HEAD(self):
+        # LineClients.warm_up() 先開連線用
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        stub = self.stub
+        match = _CONTENT_PATH.match(self.path.split('?')[0])
+        if not match:
+            self._send(404, {'message': 'Not found'})
+            return
+        preview = bool(match.group(2))
+        stub.count('preview' if preview else 'content')
+        stub.delay()
+        if stub.should_fail():
+            self._send(500, {'message': 'stub error'})
+            return
+        image = stub.preview_for(match.group(1)) if preview else stub.image_for(match.group(1))
+        self._send(200, image, content_type='image/jpeg')
+
+    def do_POST(self):
+        stub = self.stub
+        path = self.path.split('?')[0]
+        body = self._body()
+        if path not in ('/v2/bot/message/reply', '/v2/bot/message/push'):
+            self._send(404, {'message': 'Not found'})
+            return
+        kind = path.rsplit('/', 1)[-1]
+        stub.count(kind)
+        stub.delay()
+        if stub.should_fail():
+            self._send(500, {'message': 'stub error'})
+            return
+        payload = json.loads(body or b'{}')
+        stub.record_delivery(kind, payload)
+        self._send(200, {'sentMessages': [
+            {'id': str(index + 1), 'quoteToken': 'stub'} for index in range(len(payload.get('messages', [])))
+        ]})
+
+
+class LineStub(_Stub):
+    """LINE Messaging / Blob API 替身"""
+
+    handler = _LineHandler
+
+    def __init__(self, images, preview_edge=240, reply_recipient=None, **kwargs):
+        """
+        參數:
+            images: list[bytes] - 下載圖片時回傳的內容（訊息 ID 取餘數挑選）
+            preview_edge: int - 預覽圖（/content/preview）的長邊
+            reply_recipient: callable(reply_token) -> userId - 回覆要記在哪位使用者名下（None = 不記錄回覆）
+            其餘參數同 _Stub
+        """
+        super().__init__(**kwargs)
+        self.images = list(images)
+        self.preview_edge = preview_edge
+        self.reply_recipient = reply_recipient
+        self._previews = {}
+        self._deliveries = {}  # userId → [(時間, 'reply' / 'push', [訊息]), ...]
+        self._conditions = {}
+
+    def image_for(self, message_id):
+        digits = re.sub(r'\D', '', message_id) or '0'
+        return self.images[int(digits) % len(self.images)]
+
+    def preview_for(self, message_id):
+        image = self.image_for(message_id)
+        with self._lock:
+            preview = self._previews.get(image)
+        if preview is None:
+            from PIL import Image
+
+            thumbnail = Image.open(io.BytesIO(image)).convert('RGB')
+            thumbnail.thumbnail((self.preview_edge, self.preview_edge))
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, 'JPEG', quality=80)
+            preview = buffer.getvalue()
+            with self._lock:
+                self._previews[image] = preview
+        return preview
+
+    def _condition(self, to):
+        # 呼叫端需持有 self._lock
+        condition = self._conditions.get(to)
+        if condition is None:
+            condition = self._conditions[to] = threading.Condition(self._lock)
+        return condition
+
+    def record_delivery(self, kind, payload):
+        if kind == 'push':
+            to = payload.get('to')
+        elif self.reply_recipient:
+            to = self.reply_recipient(payload.get('replyToken'))
+        else:
+            return
+        with self._lock:
+            self._deliveries.setdefault(to, []).append((time.perf_counter(), kind, payload.get('messages', [])))
+            self._condition(to).notify_all()
+
+    def wait_delivery(self, to, timeout, accept=None):
+        """
+        等待送給 to 的第一則訊息（推播或回覆）
+
+        參數:
+            to: str - userId
+            timeout: float - 最多等幾秒
+            accept: callable(kind, messages) -> bool - 只算符合條件的訊息（例如略過「辨識中」）
+
+        回傳:
+            tuple(float, str, list[str]) 或 None: (收到的時間 perf_counter, 'reply' / 'push', 訊息種類)，逾時回傳 None
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            condition = self._condition(to)
+            while True:
+                for received, kind, messages in self._deliveries.get(to, []):
+                    if accept is None or accept(kind, messages):
+                        return received, kind, [message.get('type') for message in messages]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                condition.wait(remaining)
+
+
+class _GeminiHandler(_StubHandler):
+    def do_GET(self):
+        self._send(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+
+    def do_POST(self):
+        stub = self.stub
+        path = self.path.split('?')[0]
+        self._body()
+        if path.endswith('/cachedContents'):
+            stub.count('cached_contents')
+            self._send(400, {'error': {
+                'code': 400, 'message': 'stub: context caching is not supported', 'status': 'INVALID_ARGUMENT'
+            }})
+            return
+
+        stream = path.endswith(':streamGenerateContent')
+        if not (stream or path.endswith(':generateContent')):
+            self._send(404, {'error': {'code': 404, 'message': 'Not found', 'status': 'NOT_FOUND'}})
+            return
+
+        stub.count('stream' if stream else 'generate')
+        if not stub.admit(self.headers.get('x-goog-api-key') or ''):
+            self._send(429, {'error': {
+                'code': 429, 'message': 'stub: quota exceeded', 'status': 'RESOURCE_EXHAUSTED'
+            }})
+            return
+        if stub.outage:
+            with stub._lock:
+                stub.unavailable += 1
+            self._send(503, {'error': {'code': 503, 'message': 'stub: unavailable', 'status': 'UNAVAILABLE'}})
+            return
+        if stub.should_fail():
+            stub.delay(0.2)
+            self._send(500, {'error': {'code': 500, 'message': 'stub error', 'status': 'INTERNAL'}})
+            return
+
+        text = stub.next_response()
+        if not stream:
+            stub.response_delay()
+            self._send(200, stub.chunk(text, final=True))
+            return
+
+        # 串流：REST 傳輸收到的是逐步送出的 JSON 陣列，每個元素是一段回應
+        pieces = [text[i:i + stub.stream_chunk_chars] for i in range(0, len(text), stub.stream_chunk_chars)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for index, piece in enumerate(pieces):
+            stub.delay(1 / len(pieces))
+            data = ('[' if index == 0 else ',\n') + json.dumps(stub.chunk(piece, index == len(pieces) - 1))
+            if index == len(pieces) - 1:
+                data += ']'
+            self._write_chunk(data.encode('utf-8'))
+        self._write_chunk(b'')
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+
+class GeminiStub(_Stub):
+    """Gemini generateContent 替身，依序輪流回傳 responses 中的回應"""
+
+    handler = _GeminiHandler
+
+    def __init__(self, responses=None, stream_chunk_chars=40, rate_limit=0, rate_window=60.0,
+                 slow_rate=0.0, slow_factor=20.0, **kwargs):
+        """
+        參數:
+            responses: list[dict 或 str] - 回應內容（dict 會轉成 JSON 文字），None 用 DEFAULT_RESPONSES
+            stream_chunk_chars: int - 串流模式每段的字元數
+            rate_limit: int - 每把 API key 在 rate_window 秒內最多幾個請求（0 = 不限），超過回 429
+            rate_window: float - 配額的滑動視窗（秒）
+            slow_rate: float - 延遲變成 slow_factor 倍的機率（模擬長尾 / 卡住的請求）
+            slow_factor: float - 慢請求的延遲倍數
+            其餘參數同 _Stub
+        """
+        super().__init__(**kwargs)
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.outage = False  # True 時所有 generateContent 都回 503（模擬上游故障）
+        self.unavailable = 0
+        self.throttled = 0
+        self._admitted = {}  # API key → 視窗內已接受的請求時間
+        self.responses = [
+            response if isinstance(response, str) else json.dumps(response, ensure_ascii=False)
+            for response in (responses or DEFAULT_RESPONSES)
+        ]
+        self.stream_chunk_chars = stream_chunk_chars
+        self._next = 0
+
+    def admit(self, api_key):
+        """這把 key 的配額還夠不夠（夠就記一次；同時記錄每把 key 的請求數）"""
+        self.count(f'key …{api_key[-4:]}')
+        if not self.rate_limit:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            recent = [at for at in self._admitted.get(api_key, []) if now - at < self.rate_window]
+            if len(recent) >= self.rate_limit:
+                self._admitted[api_key] = recent
+                self.throttled += 1
+                return False
+            recent.append(now)
+            self._admitted[api_key] = recent
+            return True
+
+    def response_delay(self):
+        """一般回應的延遲（slow_rate 的機率變成 slow_factor 倍）"""
+        with self._random_lock:
+            slow = self._random.random() < self.slow_rate
+        self.delay(self.slow_factor if slow else 1.0)
+
+    def next_response(self):
+        with self._lock:
+            text = self.responses[self._next % len(self.responses)]
+            self._next += 1
+        return text
+
+    @staticmethod
+    def chunk(text, final):
+        chunk = {'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}, 'index': 0}]}
+        if final:
+            chunk['candidates'][0]['finishReason'] = 'STOP'
+            chunk['usageMetadata'] = {'promptTokenCount': 1290, 'candidatesTokenCount': 80, 'totalTokenCount': 1370}
+        return chunk
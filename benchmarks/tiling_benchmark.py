@@ -0,0 +1,228 @@
+"""
+長截圖切塊 benchmark
+
+產生一張 10 家店的推薦清單長截圖（寬 1080，高約一萬像素），比較整張送出與切塊（utils/tiling.py）：
+  字高        前處理縮圖後，店名文字的高度（像素）；太小模型就讀不出來
+  CPU         切塊規劃 + 裁切 + 前處理的耗時
+  記憶體      各自在新的子行程裡跑，解碼 + 前處理的 RSS 峰值
+  合併        模擬每個區塊「看得到」的店家（切在交界處的店名只讀到一半），
+              檢查合併後的店家數、順序與重疊處的重複是否去掉
+加上 --live 會實際呼叫 Gemini（需要設定 GEMINI_API_KEY 等環境變數），比較兩種做法的延遲、店家數與 token。
+
+用法:
+    python benchmarks/tiling_benchmark.py
+    python benchmarks/tiling_benchmark.py --shops 12 --max-tiles 4
+    python benchmarks/tiling_benchmark.py --live
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image, ImageDraw  # noqa: E402
+from utils.preprocess import preprocess_image, crop_phone_chrome  # noqa: E402
+from utils.tiling import plan_tiles, merge_tiles  # noqa: E402
+from utils.log import configure  # noqa: E402
+
+WIDTH = 1080
+FONT_SIZE = 44
+NAMES = ['山角咖啡 Mountain', '食。光機', 'NO.5 CAFE', 'Minimalism Cafe 巴斯克專賣店', 'No.5 CheeseCake 起司蛋糕',
+         '小巷子早午餐', 'Kaffee Haus 德式咖啡', '阿嬤的滷肉飯', 'Bistro 43 義式餐酒館', '森林裡甜點工作室',
+         '老街豆花', 'Hoshi 星空拉麵']
+AREAS = ['中壢區大華路93號', '板橋區縣民大道二段7號', '新莊區新富一街203號', '桃園區甘肅二街5號', '大安區忠孝東路四段1號']
+
+
+def make_list_screenshot(shops, seed=1):
+    """
+    產生一張推薦清單長截圖
+
+    回傳:
+        tuple(bytes, list[dict]): (JPEG, 每家店的 {"name", "original_handle", "address", "top", "bottom"})
+    """
+    rng = random.Random(seed)
+    entries = []
+    y = 180
+    for index in range(shops):
+        name = NAMES[index % len(NAMES)] + ('' if index < len(NAMES) else f' {index}')
+        entry = {'name': name, 'original_handle': f'shop_{index:02d}', 'address': rng.choice(AREAS), 'top': y}
+        # 店名、帳號、地址、一張照片、幾行介紹
+        y += 70 * 3 + rng.randint(500, 700) + 60 * rng.randint(2, 5) + 120
+        entry['bottom'] = y
+        entries.append(entry)
+    image = Image.new('RGB', (WIDTH, y + 200), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    for entry in entries:
+        top = entry['top']
+        draw.text((60, top), f"{entries.index(entry) + 1}. {entry['name']}", fill=(20, 20, 20), font_size=FONT_SIZE)
+        draw.text((60, top + 70), '@' + entry['original_handle'], fill=(60, 90, 160), font_size=FONT_SIZE - 8)
+        draw.text((60, top + 140), '📍 ' + entry['address'], fill=(60, 60, 60), font_size=FONT_SIZE - 8)
+        photo_top = top + 220
+        photo_bottom = entry['bottom'] - 60 * 4 - 120
+        draw.rectangle((60, photo_top, WIDTH - 60, photo_bottom), fill=tuple(rng.randint(80, 220) for _ in range(3)))
+        for line in range(3):
+            draw.text((60, photo_bottom + 30 + line * 60), '招牌必點 口感 推薦 營業時間 11:00-20:00',
+                      fill=(90, 90, 90), font_size=FONT_SIZE - 12)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue(), entries
+
+
+def visible_result(entries, box):
+    """模擬一個區塊的辨識結果：店名那一列在區塊內的店家；店名被切到時只讀到前半段、沒有帳號與地址"""
+    _, top, _, bottom = box
+    restaurants = []
+    for entry in entries:
+        name_top, name_bottom = entry['top'], entry['top'] + FONT_SIZE
+        if name_bottom <= top or name_top >= bottom:
+            continue
+        if entry['top'] + 200 <= bottom and name_top >= top:
+            restaurants.append({k: entry[k] for k in ('name', 'original_handle', 'address')})
+        else:
+            restaurants.append({'name': entry['name'][:max(3, len(entry['name']) * 2 // 3)], 'address': 'unknown'})
+    return {'restaurants': restaurants, 'count': len(restaurants), 'food_keywords': ''}
+
+
+def text_height(scale):
+    return round(FONT_SIZE * scale, 1)
+
+
+def run_single(data, max_edge):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    start = time.perf_counter()
+    prepared = preprocess_image(image, max_edge=max_edge)
+    elapsed = time.perf_counter() - start
+    scale = prepared.image.width / image.width
+    return {'parts': 1, 'bytes': len(prepared.data), 'text_px': text_height(scale), 'cpu_ms': round(elapsed * 1000, 1)}
+
+
+def run_tiled(data, max_edge, max_tiles, overlap):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    start = time.perf_counter()
+    # 同 gemini._plan_tiles：整張圖先裁狀態列 / 導覽列，區塊不再裁
+    image = crop_phone_chrome(image)
+    boxes = plan_tiles(image, overlap=overlap, max_tiles=max_tiles)
+    plan_ms = (time.perf_counter() - start) * 1000
+    sizes = []
+    scale = 1.0
+    for box in boxes:
+        prepared = preprocess_image(image.crop(box), max_edge=max_edge, crop_chrome=False)
+        scale = min(scale, prepared.image.width / image.width)
+        sizes.append(len(prepared.data))
+    elapsed = time.perf_counter() - start
+    return {'parts': len(boxes), 'bytes': sum(sizes), 'text_px': text_height(scale),
+            'cpu_ms': round(elapsed * 1000, 1), 'plan_ms': round(plan_ms, 1), 'boxes': boxes}
+
+
+def high_water_mark():
+    """目前行程的 RSS 峰值（KB）；ru_maxrss 會沿用父行程的值，所以優先讀 /proc 的 VmHWM"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def peak_rss(mode, path, args):
+    """在新的子行程裡跑一種做法，回傳 (RSS 峰值, 比跑之前增加多少)（MB）"""
+    code = (
+        'import sys, json; sys.path.insert(0, {root!r}); sys.path.insert(0, {bench!r});'
+        'import tiling_benchmark as b; data = open({path!r}, "rb").read();'
+        'base = b.high_water_mark(); b.run_{mode}(data, *{args!r});'
+        'print(json.dumps([base, b.high_water_mark()]))'
+    ).format(root=ROOT, bench=os.path.dirname(os.path.abspath(__file__)), path=path, mode=mode, args=args)
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    base, peak = json.loads(output.strip().splitlines()[-1])
+    return round(peak / 1024, 1), round((peak - base) / 1024, 1)
+
+
+def check_merge(entries, boxes):
+    merged = merge_tiles([visible_result(entries, box) for box in boxes], max_restaurants=len(entries) + 5)
+    names = [restaurant['name'] for restaurant in merged['restaurants']]
+    expected = [entry['name'] for entry in entries]
+    raw = sum(len(visible_result(entries, box)['restaurants']) for box in boxes)
+    return {
+        'raw': raw,
+        'merged': merged['count'],
+        'expected': len(expected),
+        'in_order': names == expected,
+        'missing': [name for name in expected if name not in names],
+        'extra': [name for name in names if name not in expected],
+    }
+
+
+def run_live(data):
+    from utils import gemini
+
+    results = {}
+    for label, enabled in (('整張', False), ('切塊', True)):
+        gemini.TILING_ENABLED = enabled
+        before = {name: dict(usage) for name, usage in gemini.usage_stats().items()}
+        start = time.perf_counter()
+        result = gemini.recognize_restaurant(data + label.encode())  # 不同的 key，避開快取與 single flight
+        elapsed = time.perf_counter() - start
+        tokens = sum(usage['total'] - before.get(name, {}).get('total', 0) for name, usage in gemini.usage_stats().items())
+        results[label] = result
+        print(f"{label}: {elapsed:6.2f}s  {result['count']:>2} 家  {tokens:>6} tokens  "
+              f"{json.dumps([r['name'] for r in result['restaurants']], ensure_ascii=False)}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='長截圖切塊 benchmark')
+    parser.add_argument('--shops', type=int, default=10, help='清單裡有幾家店')
+    parser.add_argument('--max-edge', type=int, default=1600, help='前處理的長邊上限（同 PREPROCESS_MAX_EDGE）')
+    parser.add_argument('--max-tiles', type=int, default=6)
+    parser.add_argument('--overlap', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--live', action='store_true', help='實際呼叫 Gemini 比較整張 / 切塊')
+    args = parser.parse_args()
+    configure('warning')
+
+    data, entries = make_list_screenshot(args.shops, args.seed)
+    image = Image.open(io.BytesIO(data))
+    print(f"長截圖: {image.width}x{image.height}，{len(data) / 1024:.0f} KB，{len(entries)} 家店\n")
+
+    single = run_single(data, args.max_edge)
+    tiled = run_tiled(data, args.max_edge, args.max_tiles, args.overlap)
+
+    path = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'tiling_benchmark.jpg')
+    with open(path, 'wb') as f:
+        f.write(data)
+    try:
+        single['rss_mb'], single['rss_delta_mb'] = peak_rss('single', path, (args.max_edge,))
+        tiled['rss_mb'], tiled['rss_delta_mb'] = peak_rss('tiled', path, (args.max_edge, args.max_tiles, args.overlap))
+    finally:
+        os.remove(path)
+
+    print(f"{'做法':<6}{'張數':>6}{'上傳 KB':>10}{'字高 px':>10}{'CPU ms':>10}{'RSS 峰值 MB':>14}{'增加 MB':>10}")
+    for label, row in (('整張', single), ('切塊', tiled)):
+        print(f"{label:<6}{row['parts']:>6}{row['bytes'] / 1024:>10.0f}{row['text_px']:>10}{row['cpu_ms']:>10}"
+              f"{row['rss_mb']:>14}{row['rss_delta_mb']:>10}")
+    print(f"\n切點規劃 {tiled['plan_ms']} ms，區塊: {[(box[1], box[3]) for box in tiled['boxes']]}")
+
+    merge = check_merge(entries, tiled['boxes'])
+    print(f"合併: 各區塊共 {merge['raw']} 筆 → {merge['merged']} 家（應為 {merge['expected']}），"
+          f"順序{'正確' if merge['in_order'] else '不對'}"
+          + (f"，缺 {merge['missing']}" if merge['missing'] else '')
+          + (f"，多 {merge['extra']}" if merge['extra'] else ''))
+
+    if args.live:
+        print()
+        run_live(data)
+
+
+if __name__ == '__main__':
+    main()
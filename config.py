@@ -9,10 +9,196 @@ LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
+# Gemini API key 池：逗號分隔，每個可以寫成「專案:key」標示所屬的 Google Cloud 專案
+# （配額以專案計，同專案的 key 共用配額；沒標示的 key 各自算一個專案）。沒設定時只用 GEMINI_API_KEY
+GEMINI_API_KEYS = [
+    tuple(item.strip().split(':', 1)) if ':' in item else (None, item.strip())
+    for item in os.getenv('GEMINI_API_KEYS', GEMINI_API_KEY or '').split(',')
+    if item.strip()
+]
+if GEMINI_API_KEYS and not GEMINI_API_KEY:
+    GEMINI_API_KEY = GEMINI_API_KEYS[0][1]
+
 # 確認必要的環境變數
 if not LINE_CHANNEL_SECRET:
     raise ValueError("❌ LINE_CHANNEL_SECRET 環境變數未設定！")
 if not LINE_CHANNEL_ACCESS_TOKEN:
     raise ValueError("❌ LINE_CHANNEL_ACCESS_TOKEN 環境變數未設定！")
 if not GEMINI_API_KEY:
-    raise ValueError("❌ GEMINI_API_KEY 環境變數未設定！")
+    raise ValueError("❌ GEMINI_API_KEY（或 GEMINI_API_KEYS）環境變數未設定！")
+
+# 本地資料目錄（SQLite 檔案放這裡，兩個 gunicorn worker 共用）
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+# 背景辨識工作佇列
+# memory: 行程內佇列（最快，worker 重啟會遺失未處理的工作）
+# sqlite: 存在 SQLite，worker 重啟後由其他 worker 接手
+JOB_QUEUE_BACKEND = os.getenv('JOB_QUEUE_BACKEND', 'memory')
+JOB_QUEUE_MAXSIZE = int(os.getenv('JOB_QUEUE_MAXSIZE', '100'))
+JOB_QUEUE_DB_PATH = os.getenv('JOB_QUEUE_DB_PATH', os.path.join(DATA_DIR, 'jobs.db'))
+RECOGNITION_WORKERS = int(os.getenv('RECOGNITION_WORKERS', '4'))
+
+# webhook 事件去重（webhookEventId / 訊息 ID；LINE 重送的事件不再處理）
+IDEMPOTENCY_DB_PATH = os.getenv('IDEMPOTENCY_DB_PATH', os.path.join(DATA_DIR, 'events.db'))
+IDEMPOTENCY_MEMORY_SIZE = int(os.getenv('IDEMPOTENCY_MEMORY_SIZE', '4096'))
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', '86400'))
+
+# 辨識結果快取（SHA-256 精確比對 + dHash 感知雜湊比對）
+RECOGNITION_CACHE_ENABLED = os.getenv('RECOGNITION_CACHE_ENABLED', 'true').lower() == 'true'
+RECOGNITION_CACHE_DB_PATH = os.getenv('RECOGNITION_CACHE_DB_PATH', os.path.join(DATA_DIR, 'cache.db'))
+RECOGNITION_CACHE_MEMORY_SIZE = int(os.getenv('RECOGNITION_CACHE_MEMORY_SIZE', '256'))
+RECOGNITION_CACHE_TTL = int(os.getenv('RECOGNITION_CACHE_TTL', str(7 * 86400)))
+RECOGNITION_CACHE_MAX_DISTANCE = int(os.getenv('RECOGNITION_CACHE_MAX_DISTANCE', '4'))
+
+# 已知店家索引：記下辨識過的店名 / 帳號 / 行政區，補進地圖查詢；
+# flash 辨識出的店家都被辨識過 KNOWN_SHOPS_MIN_SEEN 次以上時，不升級到 Pro
+KNOWN_SHOPS_ENABLED = os.getenv('KNOWN_SHOPS_ENABLED', 'true').lower() == 'true'
+KNOWN_SHOPS_DB_PATH = os.getenv('KNOWN_SHOPS_DB_PATH', os.path.join(DATA_DIR, 'shops.db'))
+KNOWN_SHOPS_MIN_SEEN = int(os.getenv('KNOWN_SHOPS_MIN_SEEN', '2'))
+
+# 圖片前處理（送給 Gemini 前先縮圖、裁切、重新壓縮）
+PREPROCESS_ENABLED = os.getenv('PREPROCESS_ENABLED', 'true').lower() == 'true'
+PREPROCESS_MAX_EDGE = int(os.getenv('PREPROCESS_MAX_EDGE', '1600'))
+PREPROCESS_FORMAT = os.getenv('PREPROCESS_FORMAT', 'JPEG')  # JPEG 或 WEBP
+PREPROCESS_QUALITY = int(os.getenv('PREPROCESS_QUALITY', '85'))
+PREPROCESS_GRAYSCALE = os.getenv('PREPROCESS_GRAYSCALE', 'auto')  # auto / always / never
+PREPROCESS_CROP_CHROME = os.getenv('PREPROCESS_CROP_CHROME', 'true').lower() == 'true'
+
+# 長截圖切塊：高 / 寬超過 TILING_MIN_ASPECT 的單張圖切成每塊約 TILING_TILE_ASPECT 個寬度高、
+# 相鄰重疊 TILING_OVERLAP 的區塊，同時辨識後依順序合併（最多 TILING_MAX_TILES 塊）
+TILING_ENABLED = os.getenv('TILING_ENABLED', 'true').lower() == 'true'
+TILING_MIN_ASPECT = float(os.getenv('TILING_MIN_ASPECT', '3'))
+TILING_TILE_ASPECT = float(os.getenv('TILING_TILE_ASPECT', '2'))
+TILING_OVERLAP = float(os.getenv('TILING_OVERLAP', '0.1'))
+TILING_MAX_TILES = int(os.getenv('TILING_MAX_TILES', '6'))
+TILING_WORKERS = int(os.getenv('TILING_WORKERS', '4'))  # 每個行程同時辨識的區塊數（所有請求共用）
+# 解碼的像素上限：超過的 JPEG 直接以 1/2、1/4… 的解析度解碼（限制長截圖的記憶體尖峰，0 = 不限）
+DECODE_MAX_PIXELS = int(os.getenv('DECODE_MAX_PIXELS', str(40_000_000)))
+
+# 本地預篩：文字量（邊緣比例）太低、又不是截圖版面的圖（自拍、食物特寫）不呼叫 Gemini，直接回覆
+PREFILTER_ENABLED = os.getenv('PREFILTER_ENABLED', 'true').lower() == 'true'
+PREFILTER_THRESHOLD = float(os.getenv('PREFILTER_THRESHOLD', '0.5'))  # 文字分數 0 ~ 1，低於這個值不送辨識
+PREFILTER_SCREENSHOT_BACKGROUND = float(os.getenv('PREFILTER_SCREENSHOT_BACKGROUND', '0.45'))  # 單一底色比例
+
+# 模型分層：由便宜到昂貴，逗號分隔；只有一個模型時等同不分層
+GEMINI_MODEL_TIERS = [
+    name.strip() for name in os.getenv('GEMINI_MODEL_TIERS', 'gemini-2.5-flash,gemini-2.5-pro').split(',')
+    if name.strip()
+]
+# 除了「解析失敗 / 空結果」一定升級外，額外啟用的信心度啟發式
+CASCADE_ESCALATE_ON = [
+    reason.strip() for reason in os.getenv('CASCADE_ESCALATE_ON', 'generic_name,missing_handle').split(',')
+    if reason.strip()
+]
+
+# Gemini API endpoint 與傳輸方式（預設 SDK 的 grpc；本地替身只支援 rest，例如 http://127.0.0.1:9002）
+GEMINI_API_ENDPOINT = os.getenv('GEMINI_API_ENDPOINT') or None
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT') or None
+
+# 每個專案、每個模型的配額（每分鐘請求數 / 每分鐘 token 數，模型=RPM/TPM，逗號分隔；沒列出的模型不限制）
+# key 池把每次呼叫分給配額用量最低、沒有在冷卻中的專案；收到 429 的專案冷卻一段時間（連續 429 時加倍）
+GEMINI_RATE_LIMITS = {
+    name.strip(): tuple(int(limit) for limit in limits.split('/'))
+    for name, limits in (
+        item.split('=', 1)
+        for item in os.getenv('GEMINI_RATE_LIMITS', 'gemini-2.5-flash=1000/1000000,gemini-2.5-pro=150/2000000').split(',')
+        if '=' in item
+    )
+}
+GEMINI_KEY_COOLDOWN_SECONDS = float(os.getenv('GEMINI_KEY_COOLDOWN_SECONDS', '30'))
+GEMINI_KEY_MAX_COOLDOWN_SECONDS = float(os.getenv('GEMINI_KEY_MAX_COOLDOWN_SECONDS', '300'))
+KEY_POOL_DB_PATH = os.getenv('KEY_POOL_DB_PATH', os.path.join(DATA_DIR, 'keys.db'))
+
+# Gemini 呼叫的期限、重試、對沖與斷路器（每一層模型各自計算，見 utils/resilience.py）
+GEMINI_ATTEMPT_TIMEOUT = float(os.getenv('GEMINI_ATTEMPT_TIMEOUT', '25'))  # 每次嘗試的期限（秒）
+GEMINI_RETRY_ATTEMPTS = int(os.getenv('GEMINI_RETRY_ATTEMPTS', '3'))  # 含第一次；1 = 不重試
+GEMINI_RETRY_BUDGET_SECONDS = float(os.getenv('GEMINI_RETRY_BUDGET_SECONDS', '40'))  # 每層含重試的總期限
+GEMINI_RETRY_BACKOFF = float(os.getenv('GEMINI_RETRY_BACKOFF', '0.5'))
+GEMINI_RETRY_MAX_BACKOFF = float(os.getenv('GEMINI_RETRY_MAX_BACKOFF', '8'))
+GEMINI_HEDGE_ENABLED = os.getenv('GEMINI_HEDGE_ENABLED', 'false').lower() == 'true'
+GEMINI_HEDGE_QUANTILE = float(os.getenv('GEMINI_HEDGE_QUANTILE', '0.95'))
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv('GEMINI_HEDGE_MIN_DELAY', '2'))
+GEMINI_CIRCUIT_FAILURES = int(os.getenv('GEMINI_CIRCUIT_FAILURES', '5'))  # 連續幾次上游故障打開斷路器
+GEMINI_CIRCUIT_RESET_SECONDS = float(os.getenv('GEMINI_CIRCUIT_RESET_SECONDS', '30'))
+
+# 辨識 Prompt 版本與 Gemini context caching
+GEMINI_PROMPT_VERSION = os.getenv('GEMINI_PROMPT_VERSION', 'v7')
+PROMPT_CACHE_ENABLED = os.getenv('PROMPT_CACHE_ENABLED', 'true').lower() == 'true'
+PROMPT_CACHE_TTL = int(os.getenv('PROMPT_CACHE_TTL', '3600'))
+PROMPT_CACHE_TIMEOUT = float(os.getenv('PROMPT_CACHE_TIMEOUT', '10'))  # 查詢 / 建立 CachedContent 的期限（秒）
+PROMPT_CACHE_DB_PATH = os.getenv('PROMPT_CACHE_DB_PATH', os.path.join(DATA_DIR, 'prompt_cache.db'))
+
+# 同一位使用者連續傳的多張圖片合併成一次辨識
+BATCH_WINDOW_SECONDS = float(os.getenv('BATCH_WINDOW_SECONDS', '2'))  # 0 表示不合併
+BATCH_MAX_WAIT_SECONDS = float(os.getenv('BATCH_MAX_WAIT_SECONDS', '6'))
+BATCH_MAX_IMAGES = int(os.getenv('BATCH_MAX_IMAGES', '5'))
+
+# 圖片流量控制：下載前先依每位使用者 / 全域的 token bucket 決定要不要處理（速率以每分鐘幾張圖計）
+ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+ADMISSION_USER_PER_MINUTE = float(os.getenv('ADMISSION_USER_PER_MINUTE', '10'))
+ADMISSION_USER_BURST = int(os.getenv('ADMISSION_USER_BURST', '5'))
+ADMISSION_GLOBAL_PER_MINUTE = float(os.getenv('ADMISSION_GLOBAL_PER_MINUTE', '60'))
+ADMISSION_GLOBAL_BURST = int(os.getenv('ADMISSION_GLOBAL_BURST', '20'))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv('ADMISSION_MAX_WAIT_SECONDS', '10'))  # 全域太忙時最多排隊幾秒
+ADMISSION_USER_DAILY_TOKENS = int(os.getenv('ADMISSION_USER_DAILY_TOKENS', '0'))  # 每人每日 token 額度，0 = 不限
+ADMISSION_DB_PATH = os.getenv('ADMISSION_DB_PATH', os.path.join(DATA_DIR, 'admission.db'))
+
+# 每位使用者每天的 Gemini token 用量與估算花費
+USAGE_LEDGER_DB_PATH = os.getenv('USAGE_LEDGER_DB_PATH', os.path.join(DATA_DIR, 'usage.db'))
+# 價格（美元 / 百萬 token）：模型=輸入/快取的輸入/輸出，逗號分隔
+GEMINI_PRICES = {
+    name.strip(): tuple(float(price) for price in prices.split('/'))
+    for name, prices in (
+        item.split('=', 1)
+        for item in os.getenv('GEMINI_PRICES', 'gemini-2.5-flash=0.30/0.075/2.50,gemini-2.5-pro=1.25/0.31/10').split(',')
+        if '=' in item
+    )
+}
+
+# 結構化輸出：要求 Gemini 直接回傳符合 response_schema 的 JSON（不再有 markdown 標記與說明文字）
+GEMINI_JSON_MODE = os.getenv('GEMINI_JSON_MODE', 'true').lower() == 'true'
+
+# 串流模式：多店家清單時，第一家店解析完成就先推送卡片
+GEMINI_STREAMING = os.getenv('GEMINI_STREAMING', 'false').lower() == 'true'
+
+# LINE API 連線池（每個行程共用，訊息與下載圖片各一個池）
+LINE_POOL_SIZE = int(os.getenv('LINE_POOL_SIZE', '8'))
+LINE_CONNECT_TIMEOUT = float(os.getenv('LINE_CONNECT_TIMEOUT', '5'))
+LINE_READ_TIMEOUT = float(os.getenv('LINE_READ_TIMEOUT', '15'))
+LINE_BLOB_READ_TIMEOUT = float(os.getenv('LINE_BLOB_READ_TIMEOUT', '30'))
+# 下載圖片：大小上限（超過就中斷下載，0 = 不限），以及 LINE 預覽圖的長邊（像素）
+# 前處理的 PREPROCESS_MAX_EDGE 不超過預覽圖的長邊時，改下載預覽圖（預設 1600 > 240，不會用到）
+DOWNLOAD_MAX_BYTES = int(os.getenv('DOWNLOAD_MAX_BYTES', str(10 * 1024 * 1024)))
+LINE_PREVIEW_EDGE = int(os.getenv('LINE_PREVIEW_EDGE', '240'))
+# 指定時訊息與下載圖片的 API 都改送到這個 host（壓力測試的本地替身用，正式環境不要設定）
+LINE_API_HOST = os.getenv('LINE_API_HOST') or None
+
+# 結果送達：reply token 最多保留幾秒等結果，期限內辨識完就直接用 reply 送出卡片（不佔 push 額度）；
+# 超過才回「辨識中」、結果改用 push（0 = 一律先回「辨識中」，同以前）
+REPLY_BUDGET_SECONDS = float(os.getenv('REPLY_BUDGET_SECONDS', '3'))
+# reply token 的有效時間（秒，從 LINE 送出事件起算，LINE 約一分鐘）；事件等太久時保留的期限會跟著提前
+REPLY_TOKEN_TTL = float(os.getenv('REPLY_TOKEN_TTL', '50'))
+
+# 執行模式：sync = Flask + gunicorn 同步 worker（app:app）；async = ASGI + uvicorn worker（asgi:app）
+APP_MODE = os.getenv('APP_MODE', 'sync').lower()
+# ASGI 模式：每個行程同時辨識的上限、aiohttp 連線池大小，以及各階段的逾時（秒）
+ASYNC_MAX_CONCURRENCY = int(os.getenv('ASYNC_MAX_CONCURRENCY', '200'))
+ASYNC_LINE_POOL_SIZE = int(os.getenv('ASYNC_LINE_POOL_SIZE', '100'))
+ASYNC_REPLY_TIMEOUT = float(os.getenv('ASYNC_REPLY_TIMEOUT', '10'))
+ASYNC_DOWNLOAD_TIMEOUT = float(os.getenv('ASYNC_DOWNLOAD_TIMEOUT', '30'))
+ASYNC_GEMINI_TIMEOUT = float(os.getenv('ASYNC_GEMINI_TIMEOUT', '60'))  # 每一層模型的 Gemini 呼叫（含重試，逾時會升級到下一層）
+ASYNC_PUSH_TIMEOUT = float(os.getenv('ASYNC_PUSH_TIMEOUT', '15'))
+ASYNC_REQUEST_TIMEOUT = float(os.getenv('ASYNC_REQUEST_TIMEOUT', '150'))  # 一批圖片從回覆到推送的總上限
+ASYNC_SHUTDOWN_GRACE_SECONDS = float(os.getenv('ASYNC_SHUTDOWN_GRACE_SECONDS', '20'))
+
+# 店家卡片：true 時每則 Flex 訊息都再用 SDK 模型驗證一次（測試 / 除錯用）
+FLEX_STRICT = os.getenv('FLEX_STRICT', 'false').lower() == 'true'
+
+# 冷啟動預熱：worker 啟動後在背景先 import 重量級模組、建立 Gemini client 與 LINE 連線池
+WARMUP_ON_START = os.getenv('WARMUP_ON_START', 'true').lower() == 'true'
+# true 時 gunicorn master 在開 port、fork worker 前就先 import 重量級模組（worker 共用，但開 port 較慢）
+WARMUP_PRELOAD_MODULES = os.getenv('WARMUP_PRELOAD_MODULES', 'false').lower() == 'true'
+
+# 結構化 log：等級，以及高頻率細節（收到 webhook、下載完成…）的抽樣率（摘要與錯誤一律輸出）
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'info')
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1'))
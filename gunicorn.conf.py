@@ -0,0 +1,38 @@
+import os
+
+# gunicorn 設定（啟動指令：gunicorn -c gunicorn.conf.py）
+#
+# preload_app：master 先 import app 一次，fork 出來的 worker 共用已載入的程式碼。
+# app 本身只載入輕量模組；辨識 worker 執行緒、Gemini client、LINE 連線池
+# 都不能跨 fork 共用，在 post_fork 裡由各 worker 自己建立（並在背景預熱）。
+#
+# APP_MODE=async 時改用 uvicorn worker 載入 asgi:app（asyncio，一個行程同時處理數百張圖），
+# 預熱與連線池改由 ASGI lifespan 在各 worker 的 event loop 裡建立。
+
+APP_MODE = os.getenv('APP_MODE', 'sync').lower()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+timeout = 120
+preload_app = True
+
+if APP_MODE == 'async':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    wsgi_app = 'app:app'
+
+
+def on_starting(server):
+    # 在開 port、fork worker 之前執行：選擇讓 master 先載入重量級模組
+    from config import WARMUP_PRELOAD_MODULES
+    if WARMUP_PRELOAD_MODULES:
+        from utils.warmup import preload_modules
+        server.log.info("預先載入模組: %s", preload_modules())
+
+
+def post_fork(server, worker):
+    if APP_MODE == 'async':
+        return
+    import app
+    app.start_background()
@@ -0,0 +1,176 @@
+import threading
+import time
+from utils.db import ThreadLocalSqlite
+from utils import metrics
+
+# 圖片辨識的流量控制（admission control）
+#
+# 在下載圖片之前先決定這張圖要不要處理：
+#   - 每位使用者一個 token bucket：連續狂傳時，超過的圖片直接婉拒（不下載、不呼叫 Gemini）
+#   - 全域一個 token bucket：整體太忙時先排隊等一下（最多 max_wait 秒），等不到再婉拒；
+#     這裡不睡：回傳 DEFERRED 與要等的秒數，由呼叫端延後再問（同步模式把工作延後放回佇列，
+#     辨識 worker 執行緒先去做別的工作；ASGI 模式 await asyncio.sleep）
+#   - 可選的每日 token 額度：依 UsageLedger 的帳，今天用超過就婉拒
+# bucket 狀態存在 SQLite，兩個 gunicorn worker 共用同一份限制。
+
+ADMITTED = 'admitted'                # 直接通過
+QUEUED = 'queued'                    # 等了一下全域 bucket 後通過
+DEFERRED = 'deferred'                # 全域 bucket 空了，過幾秒再問一次
+REJECTED_USER = 'rejected_user'      # 這位使用者傳太快
+REJECTED_GLOBAL = 'rejected_global'  # 整體太忙，排隊也等不到
+REJECTED_BUDGET = 'rejected_budget'  # 今天的額度用完了
+
+GLOBAL_KEY = '*'
+
+DECISIONS = metrics.counter(
+    'maps_admission_decisions_total', '圖片流量控制的結果（admitted / queued / deferred / rejected_*）', ['decision']
+)
+WAIT_SECONDS = metrics.histogram('maps_admission_wait_seconds', '等待全域 token bucket 的時間（秒）')
+
+
+class AdmissionController:
+    """每位使用者 + 全域的 token bucket（速率以「每分鐘幾張圖」計）"""
+
+    def __init__(self, db_path, user_per_minute=10, user_burst=5, global_per_minute=60, global_burst=20,
+                 max_wait=10.0, daily_tokens=0, usage_today=None, notice_interval=60.0):
+        """
+        參數:
+            db_path: str - SQLite 檔案路徑
+            user_per_minute: float - 每位使用者每分鐘補充幾張
+            user_burst: int - 每位使用者最多可以連續傳幾張
+            global_per_minute: float - 全部使用者合計每分鐘補充幾張
+            global_burst: int - 全域最多可以同時累積幾張
+            max_wait: float - 全域 bucket 空了時最多排隊幾秒（從第一次 admit 起算）
+            daily_tokens: int - 每位使用者每天的 Gemini token 額度（0 表示不限制）
+            usage_today: callable(user_id) -> int - 使用者今天已用的 token 數（UsageLedger.tokens_today）
+            notice_interval: float - 同一位使用者多久內只提醒一次（避免狂傳時每張都回一則婉拒訊息）
+        """
+        self.user_rate = user_per_minute / 60
+        self.user_burst = user_burst
+        self.global_rate = global_per_minute / 60
+        self.global_burst = global_burst
+        self.max_wait = max_wait
+        self.daily_tokens = daily_tokens
+        self.usage_today = usage_today
+        self.notice_interval = notice_interval
+        self._lock = threading.Lock()
+        self._notified = {}  # user_id → 上次提醒的時間
+        self._decisions = {}
+        self._calls = 0
+        self._db = ThreadLocalSqlite(db_path, [
+            'CREATE TABLE IF NOT EXISTS admission_buckets ('
+            ' key TEXT PRIMARY KEY,'
+            ' tokens REAL NOT NULL,'
+            ' updated_at REAL NOT NULL)'
+        ])
+
+    def _take(self, user_key, now):
+        """
+        同一個交易裡檢查兩個 bucket，都有 token 才一起扣
+
+        回傳:
+            tuple(str 或 None, float): (婉拒原因, 需要再等幾秒)；(None, 0) 表示已扣到
+        """
+        conn = self._db.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            levels = {}
+            for key, rate, burst in ((user_key, self.user_rate, self.user_burst),
+                                     (GLOBAL_KEY, self.global_rate, self.global_burst)):
+                row = conn.execute(
+                    'SELECT tokens, updated_at FROM admission_buckets WHERE key = ?', (key,)
+                ).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + max(now - row[1], 0) * rate)
+                levels[key] = tokens
+
+            if levels[user_key] < 1:
+                outcome = (REJECTED_USER, 0.0)
+            elif levels[GLOBAL_KEY] < 1:
+                wait = (1 - levels[GLOBAL_KEY]) / self.global_rate if self.global_rate > 0 else float('inf')
+                outcome = (REJECTED_GLOBAL, wait)
+            else:
+                levels[user_key] -= 1
+                levels[GLOBAL_KEY] -= 1
+                outcome = (None, 0.0)
+
+            conn.executemany(
+                'INSERT OR REPLACE INTO admission_buckets (key, tokens, updated_at) VALUES (?, ?, ?)',
+                [(key, tokens, now) for key, tokens in levels.items()]
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return outcome
+
+    def admit(self, user_id, waited=0.0):
+        """
+        決定這張圖片要不要處理（不會等待）
+
+        全域 bucket 空了、但 max_wait 內補得到 token 時回傳 DEFERRED：呼叫端過 retry_after 秒再呼叫一次，
+        並把已經等了多久傳進來（超過 max_wait 就婉拒）。
+
+        參數:
+            user_id: str - 使用者 ID
+            waited: float - 這張圖已經排隊等了幾秒（第一次呼叫為 0）
+
+        回傳:
+            tuple(str, float): (ADMITTED / QUEUED / REJECTED_*, 排隊等了幾秒) 或 (DEFERRED, 幾秒後再問)
+        """
+        user_key = f'user:{user_id or "unknown"}'
+        seconds = waited
+
+        if self.daily_tokens and self.usage_today and self.usage_today(user_id) >= self.daily_tokens:
+            decision = REJECTED_BUDGET
+        else:
+            reason, wait = self._take(user_key, time.time())
+            if reason is None:
+                decision = QUEUED if waited > 0 else ADMITTED
+            elif reason == REJECTED_USER or waited + wait > self.max_wait:
+                decision = reason
+            else:
+                decision, seconds = DEFERRED, wait
+
+        if decision == QUEUED:
+            WAIT_SECONDS.observe(waited)
+        DECISIONS.inc(decision=decision)
+        with self._lock:
+            self._decisions[decision] = self._decisions.get(decision, 0) + 1
+            self._calls += 1
+            purge = self._calls % 1000 == 0
+        if purge:
+            self.purge_idle()
+        return decision, seconds
+
+    def should_notify(self, user_id):
+        """這次婉拒要不要回訊息提醒（同一位使用者 notice_interval 秒內只提醒一次）"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._notified.get(user_id, float('-inf')) < self.notice_interval:
+                return False
+            self._notified[user_id] = now
+            # 順手清掉很久以前的提醒紀錄
+            if len(self._notified) > 1000:
+                self._notified = {
+                    key: at for key, at in self._notified.items() if now - at < self.notice_interval
+                }
+            return True
+
+    def purge_idle(self):
+        """刪除已經補滿（閒置夠久）的使用者 bucket，回傳刪除筆數"""
+        idle = self.user_burst / self.user_rate if self.user_rate > 0 else 86400
+        return self._db.execute(
+            'DELETE FROM admission_buckets WHERE key != ? AND updated_at < ?', (GLOBAL_KEY, time.time() - idle)
+        ).rowcount
+
+    def stats(self):
+        """各種結果的次數（以本行程為準）"""
+        with self._lock:
+            return {
+                'decisions': dict(self._decisions),
+                'user_per_minute': round(self.user_rate * 60, 2),
+                'user_burst': self.user_burst,
+                'global_per_minute': round(self.global_rate * 60, 2),
+                'global_burst': self.global_burst,
+                'daily_tokens': self.daily_tokens,
+            }
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+
+# 同一位使用者連續傳的多張圖片合併成一批
+#
+# 使用者常一次傳 3-5 張同一則貼文的截圖（輪播、內文、留言），
+# LINE 會拆成多個 ImageMessageContent 事件。第一張圖的 worker 當「leader」，
+# 在聚合視窗內等待同一批的其他圖片，時間到（或湊滿）後由 leader 一次處理整批；
+# 其他圖片的 worker 把圖交給 leader 後就直接返回。
+# AsyncImageBatcher 是 ASGI 模式（asyncio）用的版本：leader 是 task，等待時不佔用執行緒。
+
+
+class _Batch:
+    def __init__(self, item, expected_total, created_at):
+        self.items = [item]
+        self.expected_total = expected_total
+        self.created_at = created_at
+        self.updated_at = created_at
+        self.changed = threading.Event()
+
+
+class ImageBatcher:
+    """依 key（圖片集 ID 或使用者 ID）聚合圖片"""
+
+    def __init__(self, window=2.0, max_wait=6.0, max_items=5):
+        """
+        參數:
+            window: float - 最後一張圖之後再等幾秒（滑動視窗）
+            max_wait: float - 從第一張圖開始最多等幾秒
+            max_items: int - 一批最多幾張
+        """
+        self.window = window
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._open = {}
+        self._batches = 0
+        self._images = 0
+
+    def submit(self, key, item, expected_total=None):
+        """
+        加入一張圖片
+
+        參數:
+            key: str - 聚合 key
+            item: 任意物件（通常是 LINE 事件）
+            expected_total: int - 已知整批張數（LINE imageSet.total），湊滿就不再等
+
+        回傳:
+            list 或 None: leader 回傳整批項目（依加入順序），其他呼叫者回傳 None
+        """
+        now = time.monotonic()
+        with self._lock:
+            batch = self._open.get(key)
+            if batch is not None and not self._is_complete(batch):
+                batch.items.append(item)
+                batch.updated_at = now
+                batch.changed.set()
+                return None
+            batch = _Batch(item, expected_total, now)
+            self._open[key] = batch
+
+        # leader：等到視窗結束、湊滿或超過最長等待時間
+        while True:
+            with self._lock:
+                if self._is_complete(batch):
+                    break
+                deadline = min(batch.updated_at + self.window, batch.created_at + self.max_wait)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                batch.changed.clear()
+            batch.changed.wait(remaining)
+
+        with self._lock:
+            if self._open.get(key) is batch:
+                del self._open[key]
+            self._batches += 1
+            self._images += len(batch.items)
+            return list(batch.items)
+
+    def _is_complete(self, batch):
+        if len(batch.items) >= self.max_items:
+            return True
+        return bool(batch.expected_total) and len(batch.items) >= batch.expected_total
+
+    def stats(self):
+        """批次數、圖片數、省下的模型呼叫 / 推播次數（以本行程為準）"""
+        with self._lock:
+            return {
+                'batches': self._batches,
+                'images': self._images,
+                'calls_saved': self._images - self._batches,
+                'open': len(self._open),
+            }
+
+
+class AsyncImageBatcher(ImageBatcher):
+    """ImageBatcher 的 asyncio 版本（同一個 event loop 內聚合）"""
+
+    async def submit(self, key, item, expected_total=None):
+        """
+        加入一張圖片
+
+        參數 / 回傳:
+            同 ImageBatcher.submit()
+        """
+        now = time.monotonic()
+        batch = self._open.get(key)
+        if batch is not None and not self._is_complete(batch):
+            batch.items.append(item)
+            batch.updated_at = now
+            batch.changed.set()
+            return None
+        batch = _Batch(item, expected_total, now)
+        batch.changed = asyncio.Event()
+        self._open[key] = batch
+
+        try:
+            while not self._is_complete(batch):
+                deadline = min(batch.updated_at + self.window, batch.created_at + self.max_wait)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                batch.changed.clear()
+                try:
+                    await asyncio.wait_for(batch.changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self._open.get(key) is batch:
+                del self._open[key]
+
+        with self._lock:
+            self._batches += 1
+            self._images += len(batch.items)
+        return list(batch.items)
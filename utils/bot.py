@@ -0,0 +1,182 @@
+import base64
+import hashlib
+import hmac
+import json
+import threading
+from config import (
+    LINE_CHANNEL_SECRET, LINE_CHANNEL_ACCESS_TOKEN, GEMINI_API_KEY, GEMINI_API_KEYS,
+    IDEMPOTENCY_DB_PATH, IDEMPOTENCY_MEMORY_SIZE, IDEMPOTENCY_TTL,
+    FLEX_STRICT, LINE_PREVIEW_EDGE, PREPROCESS_ENABLED, PREPROCESS_MAX_EDGE, LOG_LEVEL, LOG_SAMPLE_RATE,
+    ADMISSION_ENABLED, ADMISSION_USER_PER_MINUTE, ADMISSION_USER_BURST, ADMISSION_GLOBAL_PER_MINUTE,
+    ADMISSION_GLOBAL_BURST, ADMISSION_MAX_WAIT_SECONDS, ADMISSION_USER_DAILY_TOKENS, ADMISSION_DB_PATH,
+    REPLY_BUDGET_SECONDS, REPLY_TOKEN_TTL
+)
+from utils.gemini import usage_ledger, shop_index
+from utils.maps import generate_maps_url
+from utils.idempotency import IdempotencyStore
+from utils.admission import AdmissionController, REJECTED_USER, REJECTED_BUDGET
+from utils.download import long_edge
+from utils.delivery import ReplyScheduler
+from utils.log import configure as configure_logging, get_logger
+from utils import flex, metrics
+
+# 同步模式（app.py）與 ASGI 模式（asgi.py）共用的部分
+#
+# 簽名驗證與拆事件、已受理事件、流量控制、reply token 保留、店家卡片、婉拒訊息與 webhook / 圖片指標。
+# 只放兩種模式都會用到、建立時不碰網路的東西：Flask app、同步的 LINE 連線池、背景 worker 與
+# 圖片聚合各自留在 app.py / asgi.py，ASGI 模式載入時不會建立同步模式的元件。
+
+configure_logging(LOG_LEVEL, LOG_SAMPLE_RATE)
+log = get_logger('bot')
+
+# 環境變數檢查（只記長度，不輸出金鑰內容）
+log.info(
+    'config_loaded',
+    line_access_token_length=len(LINE_CHANNEL_ACCESS_TOKEN),
+    line_channel_secret_length=len(LINE_CHANNEL_SECRET),
+    gemini_api_key_length=len(GEMINI_API_KEY) if GEMINI_API_KEY else 0,
+    gemini_api_keys=len(GEMINI_API_KEYS),
+)
+
+# 指標（GET /metrics）
+WEBHOOK_REQUESTS = metrics.counter(
+    'maps_webhook_requests_total', 'webhook 請求數（ok / bad_signature / bad_body / queue_full）', ['status']
+)
+WEBHOOK_EVENTS = metrics.counter('maps_webhook_events_total', '排入佇列的 webhook 事件數')
+IMAGE_REQUESTS = metrics.counter(
+    'maps_image_requests_total', '圖片辨識請求數（found / empty / skipped / rejected / cancelled / error）', ['outcome']
+)
+IMAGE_REQUEST_SECONDS = metrics.histogram('maps_image_request_seconds', '一批圖片從開始處理到送出結果的時間（秒）')
+
+flex.set_strict(FLEX_STRICT)
+
+
+def sign_body(body):
+    """用 channel secret 計算 X-Line-Signature"""
+    digest = hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def split_events(body):
+    """
+    把 webhook body 拆成「一個事件一個 body」
+
+    同一個 body 裡的多個事件（例如一次傳的多張圖）要能被不同 worker 同時處理，
+    圖片才有辦法在聚合視窗內合併成一批。
+
+    回傳:
+        list[tuple(dict, str)]: (事件, 只含這個事件的 body)
+    """
+    data = json.loads(body)
+    return [
+        (event, json.dumps({'destination': data.get('destination'), 'events': [event]}, ensure_ascii=False))
+        for event in data.get('events', [])
+    ]
+
+
+# 已受理的 webhook 事件（LINE 重送 / 重複的事件在排入佇列前就略過）
+processed_events = IdempotencyStore(IDEMPOTENCY_DB_PATH, memory_size=IDEMPOTENCY_MEMORY_SIZE, ttl=IDEMPOTENCY_TTL)
+
+# 圖片流量控制：下載前先檢查每位使用者 / 全域的速率與每日額度
+admission = AdmissionController(
+    ADMISSION_DB_PATH,
+    user_per_minute=ADMISSION_USER_PER_MINUTE,
+    user_burst=ADMISSION_USER_BURST,
+    global_per_minute=ADMISSION_GLOBAL_PER_MINUTE,
+    global_burst=ADMISSION_GLOBAL_BURST,
+    max_wait=ADMISSION_MAX_WAIT_SECONDS,
+    daily_tokens=ADMISSION_USER_DAILY_TOKENS,
+    usage_today=usage_ledger.tokens_today
+) if ADMISSION_ENABLED else None
+
+# 婉拒時回覆的訊息
+ADMISSION_NOTICES = {
+    REJECTED_USER: '⏳ 圖片有點多，我先處理前面幾張，這張請過一下再傳給我喔',
+    REJECTED_BUDGET: '🙏 今天的辨識次數用完了，明天再傳給我吧',
+}
+ADMISSION_BUSY_NOTICE = '😵 現在有點忙，這張請過一會兒再傳一次'
+# 一批圖片全部因為太大 / 格式不支援而放棄下載時回覆的訊息
+DOWNLOAD_REJECTED_NOTICE = '📦 這張圖片太大或不是支援的格式（JPEG / PNG / WebP / GIF），換一張截圖試試'
+# 本地預篩判定圖片裡不可能有店名（自拍、食物特寫）時回覆的訊息
+PREFILTER_NOTICE = '🤔 這張圖看起來沒有店名或文字，傳有店名、IG 帳號或地址的貼文截圖給我試試'
+
+# 結果送達：reply token 保留一小段時間，期限內有結果就直接 reply，否則先回「辨識中」、結果改 push
+reply_scheduler = ReplyScheduler(budget=REPLY_BUDGET_SECONDS, token_ttl=REPLY_TOKEN_TTL)
+
+# 前處理本來就會把圖縮到 LINE 預覽圖的大小以下時，直接下載預覽圖（省頻寬與解碼時間）
+USE_PREVIEW = PREPROCESS_ENABLED and PREPROCESS_MAX_EDGE <= LINE_PREVIEW_EDGE
+
+
+def use_preview(image_data):
+    """預覽圖的解析度夠前處理用（長邊不小於 PREPROCESS_MAX_EDGE）才採用"""
+    try:
+        return long_edge(image_data) >= PREPROCESS_MAX_EDGE
+    except Exception:
+        return False
+
+
+def batch_key(event):
+    """圖片聚合 key：LINE 有提供圖片集 ID 就用它，否則以使用者為單位"""
+    image_set = getattr(event.message, 'image_set', None)
+    if image_set and image_set.id:
+        return f'set:{image_set.id}'
+    return f'user:{event.source.user_id}'
+
+
+def build_bubble(restaurant, index, count, food_keywords=''):
+    """
+    建立單一店家的卡片
+
+    參數:
+        restaurant: dict - 店家資訊
+        index: int - 第幾家（從 0 開始）
+        count: int - 總店家數（1 或未知時顯示「找到店家！」）
+        food_keywords: str - 食物關鍵字
+
+    回傳:
+        dict: Flex bubble
+    """
+    name = restaurant.get('name', 'unknown')
+    address = restaurant.get('address', 'unknown')
+    original_handle = restaurant.get('original_handle', '')
+
+    # 生成 Google Maps URL（加入原始帳號 + 食物關鍵字提高搜尋精確度；已知店家補上帳號 / 行政區）
+    maps_url = generate_maps_url(name, address, food_keywords, original_handle, known_shops=shop_index)
+
+    return flex.bubble(name, address, maps_url, index, count)
+
+
+def build_result_message(bubbles, count, first_name):
+    """單個店家用單張卡片，多個店家用 Carousel 輪播（回傳 LINE API 的 JSON 格式）"""
+    if len(bubbles) == 1:
+        alt_text = first_name if count == 1 else f"找到 {count} 家店"
+    else:
+        alt_text = f"找到 {count} 家店，滑動查看"
+    return flex.flex_message(bubbles, alt_text)
+
+
+# 卡片送達時間：第一張卡片 vs 全部卡片（從開始處理這批圖片起算）
+_delivery_lock = threading.Lock()
+_delivery = {'requests': 0, 'early': 0, 'first_card_total': 0.0, 'total_total': 0.0}
+
+
+def record_delivery(first_card, total):
+    with _delivery_lock:
+        _delivery['requests'] += 1
+        _delivery['total_total'] += total
+        if first_card is not None:
+            _delivery['early'] += 1
+            _delivery['first_card_total'] += first_card
+
+
+def delivery_stats():
+    """平均第一張卡片時間 / 全部完成時間（以本行程為準）"""
+    with _delivery_lock:
+        requests_count, early = _delivery['requests'], _delivery['early']
+        first_card_total = _delivery['first_card_total']
+        return {
+            'requests': requests_count,
+            'early_first_card': early,
+            'first_card_avg_ms': round(first_card_total / early * 1000, 1) if early else 0.0,
+            'total_avg_ms': round(_delivery['total_total'] / requests_count * 1000, 1) if requests_count else 0.0,
+        }
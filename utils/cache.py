@@ -0,0 +1,292 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from utils.db import ThreadLocalSqlite
+
+# 辨識結果快取（以圖片內容為 key）
+#
+# 同一張爆紅的 IG/Threads 截圖會被很多人轉傳給 Bot，
+# 用 SHA-256 做精確比對，再用 dHash 感知雜湊找「重新壓縮 / 稍微裁切」過的同一張圖，
+# 命中時直接回傳先前的辨識結果，完全不呼叫 Gemini。
+#
+# 快取依 namespace（Prompt 版本、模型分層、JSON mode）分開：換了 Prompt 或模型之後，
+# 舊設定的結果不再命中，轉傳的截圖會用新設定重新辨識。
+
+HASH_BITS = 64
+
+
+def sha256_hex(image_data):
+    """圖片原始 bytes 的 SHA-256"""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def dhash(image, hash_size=8):
+    """
+    計算 dHash（差異雜湊）
+
+    把圖縮成 (hash_size + 1) x hash_size 的灰階圖，比較每列相鄰像素的亮度，
+    對重新壓縮、縮放、輕微裁切都很穩定。
+
+    參數:
+        image: PIL.Image - 圖片
+        hash_size: int - 邊長（8 → 64 bits）
+
+    回傳:
+        int: 64-bit 雜湊值
+    """
+    from PIL import Image
+
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a, b):
+    """兩個雜湊值的漢明距離"""
+    return bin(a ^ b).count('1')
+
+
+def _to_signed(value):
+    # SQLite INTEGER 是有號 64-bit
+    return value - (1 << HASH_BITS) if value >= (1 << (HASH_BITS - 1)) else value
+
+
+def _to_unsigned(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+def _bands(value, count):
+    """
+    把雜湊切成 count 段
+
+    鴿籠原理：距離 <= count - 1 的兩個雜湊，至少有一段完全相同，
+    所以 SQLite 只要用索引查「任一段相同」的候選，再逐一算漢明距離。
+    """
+    width = HASH_BITS // count
+    bands = []
+    for i in range(count):
+        bits = width if i < count - 1 else HASH_BITS - width * (count - 1)
+        bands.append((value >> (width * i)) & ((1 << bits) - 1))
+    return bands
+
+
+class RecognitionCache:
+    """
+    兩層辨識快取
+
+    - 記憶體層：LRU + TTL，只在本行程
+    - SQLite 層：兩個 gunicorn worker 共用
+    """
+
+    def __init__(self, db_path, memory_size=256, ttl=7 * 86400, max_distance=4, namespace=''):
+        """
+        參數:
+            db_path: str - SQLite 檔案路徑
+            memory_size: int - 記憶體層最多幾筆
+            ttl: int - 快取有效秒數
+            max_distance: int - 感知雜湊的漢明距離門檻（<= 此值視為同一張圖）
+            namespace: str - 產生結果的設定（例如 Prompt 版本 + 模型），只查得到同一個 namespace 寫入的結果
+        """
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.namespace = namespace
+        self.band_count = max_distance + 1
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # sha256 -> (expires_at, phash, result_json)
+
+        self._hits = 0
+        self._near_hits = 0
+        self._misses = 0
+        self._puts = 0
+
+        self._db = ThreadLocalSqlite(db_path, [
+            # 舊版沒有 namespace 的表（不知道是哪個 Prompt 產生的結果），直接丟掉
+            'DROP TABLE IF EXISTS recognition_cache',
+            'DROP TABLE IF EXISTS recognition_cache_bands',
+            'CREATE TABLE IF NOT EXISTS recognition_results ('
+            ' namespace TEXT NOT NULL,'
+            ' sha256 TEXT NOT NULL,'
+            ' phash INTEGER NOT NULL,'
+            ' result TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' PRIMARY KEY (namespace, sha256))',
+            'CREATE TABLE IF NOT EXISTS recognition_result_bands ('
+            ' namespace TEXT NOT NULL,'
+            ' band INTEGER NOT NULL,'
+            ' value INTEGER NOT NULL,'
+            ' sha256 TEXT NOT NULL)',
+            'CREATE INDEX IF NOT EXISTS idx_recognition_result_bands'
+            ' ON recognition_result_bands (namespace, band, value)',
+        ])
+
+    def get(self, sha256, phash):
+        """
+        查快取
+
+        參數:
+            sha256: str - 圖片 SHA-256
+            phash: int - 圖片 dHash（None 表示只做精確比對，例如多張圖的合併 key）
+
+        回傳:
+            dict 或 None: 辨識結果（每次回傳新的副本）
+        """
+        now = time.time()
+
+        # 1. 記憶體層：精確比對 → 感知雜湊比對
+        with self._lock:
+            entry = self._memory.get(sha256)
+            if entry and entry[0] > now:
+                self._memory.move_to_end(sha256)
+                self._hits += 1
+                return json.loads(entry[2])
+
+            for key, (expires_at, other, result_json) in self._memory.items():
+                if phash is None or other is None:
+                    continue
+                if expires_at > now and hamming(phash, other) <= self.max_distance:
+                    self._memory.move_to_end(key)
+                    self._near_hits += 1
+                    return json.loads(result_json)
+
+        # 2. SQLite 層
+        found = self._lookup_db(sha256, phash, now)
+        if found is None:
+            with self._lock:
+                self._misses += 1
+            return None
+
+        near, stored_phash, result_json = found
+        with self._lock:
+            if near:
+                self._near_hits += 1
+            else:
+                self._hits += 1
+            self._remember(sha256, stored_phash, result_json, now)
+        return json.loads(result_json)
+
+    def _lookup_db(self, sha256, phash, now):
+        conn = self._db.conn()
+        oldest = now - self.ttl
+
+        row = conn.execute(
+            'SELECT phash, result FROM recognition_results WHERE namespace = ? AND sha256 = ? AND created_at > ?',
+            (self.namespace, sha256, oldest)
+        ).fetchone()
+        if row:
+            return False, (None if phash is None else _to_unsigned(row[0])), row[1]
+        if phash is None:
+            return None
+
+        clauses = ' OR '.join(['(b.band = ? AND b.value = ?)'] * self.band_count)
+        params = [self.namespace]
+        for i, value in enumerate(_bands(phash, self.band_count)):
+            params.extend([i, value])
+        params.append(oldest)
+
+        rows = conn.execute(
+            'SELECT DISTINCT c.phash, c.result FROM recognition_result_bands b'
+            ' JOIN recognition_results c ON c.namespace = b.namespace AND c.sha256 = b.sha256'
+            f' WHERE b.namespace = ? AND ({clauses}) AND c.created_at > ?',
+            params
+        ).fetchall()
+
+        best = None
+        for stored, result_json in rows:
+            stored = _to_unsigned(stored)
+            distance = hamming(phash, stored)
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, stored, result_json)
+
+        if best is None:
+            return None
+        return True, best[1], best[2]
+
+    def put(self, sha256, phash, result):
+        """
+        寫入快取
+
+        參數:
+            sha256: str - 圖片 SHA-256
+            phash: int - 圖片 dHash（None 表示只供精確比對）
+            result: dict - 辨識結果
+        """
+        now = time.time()
+        result_json = json.dumps(result, ensure_ascii=False)
+
+        with self._lock:
+            self._remember(sha256, phash, result_json, now)
+            self._puts += 1
+            purge = self._puts % 256 == 0
+
+        conn = self._db.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'DELETE FROM recognition_result_bands WHERE namespace = ? AND sha256 = ?', (self.namespace, sha256)
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO recognition_results (namespace, sha256, phash, result, created_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (self.namespace, sha256, _to_signed(phash or 0), result_json, now)
+            )
+            if phash is not None:
+                conn.executemany(
+                    'INSERT INTO recognition_result_bands (namespace, band, value, sha256) VALUES (?, ?, ?, ?)',
+                    [(self.namespace, i, value, sha256) for i, value in enumerate(_bands(phash, self.band_count))]
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        # 偶爾順手清掉過期資料，避免檔案無限長大
+        if purge:
+            self.purge_expired()
+
+    def _remember(self, sha256, phash, result_json, now):
+        # 呼叫端需持有 self._lock
+        self._memory[sha256] = (now + self.ttl, phash, result_json)
+        self._memory.move_to_end(sha256)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def purge_expired(self):
+        """刪除 SQLite 中過期的資料（所有 namespace），回傳刪除筆數"""
+        oldest = time.time() - self.ttl
+        conn = self._db.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'DELETE FROM recognition_result_bands WHERE (namespace, sha256) IN'
+                ' (SELECT namespace, sha256 FROM recognition_results WHERE created_at <= ?)',
+                (oldest,)
+            )
+            deleted = conn.execute(
+                'DELETE FROM recognition_results WHERE created_at <= ?', (oldest,)
+            ).rowcount
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return deleted
+
+    def stats(self):
+        """命中 / 近似命中 / 未命中次數（以本行程為準）"""
+        with self._lock:
+            lookups = self._hits + self._near_hits + self._misses
+            return {
+                'namespace': self.namespace,
+                'hits': self._hits,
+                'near_hits': self._near_hits,
+                'misses': self._misses,
+                'hit_rate': round((self._hits + self._near_hits) / lookups, 3) if lookups else 0.0,
+                'memory_entries': len(self._memory),
+            }
@@ -0,0 +1,239 @@
+import re
+import threading
+import time
+from utils.validator import validate_result
+from utils.maps import is_generic_name
+from utils.log import get_logger
+from utils import metrics
+
+# 模型分層（cascade）
+#
+# 大部分截圖有清楚的招牌或 IG 帳號，flash 等級的模型就能讀對，
+# 先用便宜的模型跑，只有結果可疑時才升級到 Pro。
+
+# 升級原因
+REASON_ERROR = 'error'                # 呼叫失敗
+REASON_PARSE_ERROR = 'parse_error'    # 回應不是合法 JSON
+REASON_EMPTY = 'empty'                # 沒辨識到店家（validate_result 不通過）
+REASON_GENERIC_NAME = 'generic_name'  # 店名太普通（菜市場名）
+REASON_MISSING_HANDLE = 'missing_handle'  # 看起來是帳號還原的店名，卻沒有帳號也沒有地點
+
+_CJK = re.compile(r'[㐀-鿿]')
+
+log = get_logger('cascade')
+
+ESCALATIONS = metrics.counter('maps_cascade_escalations_total', '模型分層升級次數（依原因）', ['model', 'reason'])
+TRUSTED = metrics.counter(
+    'maps_cascade_trusted_total', '結果可疑、但店家都是已知店家而不升級的次數（依原因）', ['model', 'reason']
+)
+
+
+def escalation_reason(result, escalate_on):
+    """
+    判斷這個結果是否需要交給下一層模型
+
+    參數:
+        result: dict - 已整理過的辨識結果
+        escalate_on: set[str] - 啟用的信心度啟發式（generic_name / missing_handle）
+
+    回傳:
+        str 或 None: 升級原因，None 表示結果可以直接用
+    """
+    if not validate_result(result):
+        return REASON_EMPTY
+
+    for restaurant in result.get('restaurants', []):
+        name = restaurant.get('name', '')
+        if REASON_GENERIC_NAME in escalate_on and is_generic_name(name):
+            return REASON_GENERIC_NAME
+
+        if REASON_MISSING_HANDLE in escalate_on:
+            handle = (restaurant.get('original_handle') or '').strip()
+            address = (restaurant.get('address') or '').strip()
+            if not _CJK.search(name) and not handle and address in ('', 'unknown'):
+                return REASON_MISSING_HANDLE
+
+    return None
+
+
+class ModelCascade:
+    """
+    依序嘗試多個模型，結果可疑時才往下一層升級
+
+    每一層的呼叫次數、延遲與升級原因都會記錄下來，方便調整分層策略。
+    """
+
+    def __init__(self, model_names, escalate_on=(REASON_GENERIC_NAME, REASON_MISSING_HANDLE), trusts=None):
+        """
+        參數:
+            model_names: list[str] - 由便宜到昂貴的模型名稱
+            escalate_on: list[str] - 啟用的信心度啟發式
+            trusts: callable(dict) -> bool - 可選；信心度啟發式判定可疑、但這個函式認可的結果不升級
+                    （例如店家都是已知店家，見 utils/shops.py）
+        """
+        if not model_names:
+            raise ValueError("❌ 至少需要一個模型")
+        self.model_names = list(model_names)
+        self.escalate_on = set(escalate_on)
+        self.trusts = trusts
+        self._trusted = 0
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._escalated = 0
+        self._tiers = {
+            name: {'calls': 0, 'accepted': 0, 'latency_total': 0.0, 'latency_max': 0.0, 'escalations': {}}
+            for name in self.model_names
+        }
+
+    def run(self, attempt, allow_empty=False):
+        """
+        執行分層辨識
+
+        參數:
+            attempt: callable(model_name) -> dict - 用指定模型辨識並回傳整理過的結果；
+                     回應無法解析時應丟出 ValueError（json.JSONDecodeError）
+            allow_empty: bool - 空結果不升級（長截圖的區塊本來就可能沒有店家）
+
+        回傳:
+            tuple(dict, str): (結果, 最後採用的模型名稱)
+
+        例外:
+            所有層都失敗且沒有任何可用結果時，丟出最後一個例外
+        """
+        # fallback: 前面層級「可用但可疑」的結果
+        state = {'fallback': None, 'last_error': None, 'allow_empty': allow_empty}
+
+        with self._lock:
+            self._requests += 1
+
+        for index, model_name in enumerate(self.model_names):
+            start = time.perf_counter()
+            result = error = None
+            try:
+                result = attempt(model_name)
+            except Exception as e:
+                error = e
+            done, outcome = self._settle(state, index, model_name, result, error, time.perf_counter() - start)
+            if done:
+                return outcome
+
+    async def run_async(self, attempt, allow_empty=False):
+        """
+        run() 的 asyncio 版本（ASGI 模式用）
+
+        參數:
+            attempt: async callable(model_name) -> dict - 同 run()
+            allow_empty: bool - 同 run()
+
+        回傳 / 例外:
+            同 run()；取消（asyncio.CancelledError）不算失敗，直接往外傳
+        """
+        state = {'fallback': None, 'last_error': None, 'allow_empty': allow_empty}
+
+        with self._lock:
+            self._requests += 1
+
+        for index, model_name in enumerate(self.model_names):
+            start = time.perf_counter()
+            result = error = None
+            try:
+                result = await attempt(model_name)
+            except Exception as e:
+                error = e
+            done, outcome = self._settle(state, index, model_name, result, error, time.perf_counter() - start)
+            if done:
+                return outcome
+
+    def _settle(self, state, index, model_name, result, error, elapsed):
+        """
+        判斷一層的結果：採用、升級到下一層，或（最後一層）決定最終結果
+
+        回傳:
+            tuple(bool, tuple 或 None): (是否結束, (結果, 模型名稱))
+
+        例外:
+            所有層都失敗且沒有任何可用結果時，丟出最後一個例外
+        """
+        is_last = index == len(self.model_names) - 1
+        if isinstance(error, ValueError):
+            reason, state['last_error'] = REASON_PARSE_ERROR, error
+        elif error is not None:
+            reason, state['last_error'] = REASON_ERROR, error
+        else:
+            reason = escalation_reason(result, self.escalate_on)
+            if reason == REASON_EMPTY and state['allow_empty']:
+                reason = None
+            elif reason in (REASON_GENERIC_NAME, REASON_MISSING_HANDLE) and not is_last and self._trust(result):
+                log.sampled('cascade_trusted', model=model_name, reason=reason)
+                TRUSTED.inc(model=model_name, reason=reason)
+                reason = None
+
+        self._record(model_name, elapsed, reason, is_last)
+
+        if reason is None:
+            return True, (result, model_name)
+
+        if result is not None and validate_result(result):
+            state['fallback'] = (result, model_name)
+
+        if not is_last:
+            ESCALATIONS.inc(model=model_name, reason=reason)
+            log.info('cascade_escalated', model=model_name, reason=reason, next=self.model_names[index + 1])
+            return False, None
+
+        # 最後一層也不理想：有可用結果就用（最後一層優先），否則沿用前面層級的結果
+        fallback = state['fallback']
+        if result is not None and reason not in (REASON_ERROR, REASON_PARSE_ERROR):
+            if reason == REASON_EMPTY and fallback:
+                return True, fallback
+            return True, (result, model_name)
+        if fallback:
+            return True, fallback
+        raise state['last_error']
+
+    def _trust(self, result):
+        if self.trusts is None:
+            return False
+        try:
+            trusted = self.trusts(result)
+        except Exception:
+            log.exception('cascade_trust_failed')
+            return False
+        if trusted:
+            with self._lock:
+                self._trusted += 1
+        return trusted
+
+    def _record(self, model_name, elapsed, reason, is_last):
+        with self._lock:
+            tier = self._tiers[model_name]
+            tier['calls'] += 1
+            tier['latency_total'] += elapsed
+            tier['latency_max'] = max(tier['latency_max'], elapsed)
+            if reason is None:
+                tier['accepted'] += 1
+            elif not is_last:
+                tier['escalations'][reason] = tier['escalations'].get(reason, 0) + 1
+                if model_name == self.model_names[0]:
+                    self._escalated += 1
+
+    def stats(self):
+        """每層呼叫次數、平均 / 最大延遲、升級率（以本行程為準）"""
+        with self._lock:
+            tiers = {}
+            for name, tier in self._tiers.items():
+                calls = tier['calls']
+                tiers[name] = {
+                    'calls': calls,
+                    'accepted': tier['accepted'],
+                    'latency_avg_ms': round(tier['latency_total'] / calls * 1000, 1) if calls else 0.0,
+                    'latency_max_ms': round(tier['latency_max'] * 1000, 1),
+                    'escalations': dict(tier['escalations']),
+                }
+            return {
+                'requests': self._requests,
+                'escalated': self._escalated,
+                'escalation_rate': round(self._escalated / self._requests, 3) if self._requests else 0.0,
+                'trusted': self._trusted,
+                'tiers': tiers,
+            }
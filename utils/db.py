@@ -0,0 +1,43 @@
+import os
+import sqlite3
+import threading
+
+
+class ThreadLocalSqlite:
+    """
+    SQLite 連線包裝：每個執行緒（以及 fork 出來的每個行程）各自一條連線
+
+    sqlite3 連線不能跨執行緒共用，而兩個 gunicorn worker 透過同一個檔案
+    共享資料，所以統一開啟 WAL 模式讓讀寫不互相阻塞。
+    """
+
+    def __init__(self, path, schema=()):
+        """
+        參數:
+            path: str - SQLite 檔案路徑
+            schema: list[str] - 建表 / 建索引的 SQL（需可重複執行）
+        """
+        self.path = path
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = self.conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        for statement in schema:
+            conn.execute(statement)
+
+    def conn(self):
+        """取得目前執行緒的連線（autocommit 模式，需要交易時自行 BEGIN）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.conn().execute(sql, params)
@@ -0,0 +1,281 @@
+import asyncio
+import threading
+import time
+from utils.log import get_logger
+from utils import metrics
+
+# 結果送達：reply 優先、push 備援
+#
+# 以前每批圖片都先用免費的 reply 回「🔍 辨識中...」，結果再用 push 推送：
+# push 會佔每月的訊息額度，而且每次辨識都多一次 API 來回。快取命中、預篩擋下、
+# flash 很快就辨識完的圖，其實幾秒內就有結果。這裡先把 reply token 留著（budget 秒）：
+#   - 期限內有結果（卡片或失敗通知）：直接用 reply 送出，不回「辨識中」、也不推播
+#   - 期限到了還沒有結果：用 reply 回「辨識中」，之後的結果改用 push
+# reply token 從 LINE 送出事件起大約一分鐘內有效；事件在佇列 / 聚合視窗等得久的話，期限會跟著提前，
+# 已經過期就不再嘗試 reply。reply 失敗（token 失效、LINE 錯誤）時改用 push，結果一定送得到。
+#
+# ReplySlot 給同步模式（期限由 threading.Timer 觸發），AsyncReplySlot 給 ASGI 模式（asyncio task）。
+
+PROGRESS_TEXT = '🔍 辨識中...'
+
+DELIVERIES = metrics.counter('maps_deliveries_total', '結果 / 通知的送出方式（reply / push）', ['method'])
+PROGRESS_REPLIES = metrics.counter('maps_delivery_progress_total', '期限內沒有結果、先回「辨識中」的次數')
+PUSH_SAVED = metrics.counter('maps_push_saved_total', '結果直接用 reply 送出、省下的 push 次數')
+REPLY_FAILURES = metrics.counter(
+    'maps_reply_failures_total', 'reply 沒有送出的次數（failed = LINE 回錯誤、expired = token 已過期）', ['reason']
+)
+HELD_SECONDS = metrics.histogram('maps_reply_held_seconds', 'reply token 保留到送出結果或「辨識中」的時間（秒）')
+
+log = get_logger('delivery')
+
+# reply token 的狀態
+HELD = 'held'          # 還沒用，等結果
+PROGRESS = 'progress'  # 已回「辨識中」（或 token 過期 / reply 失敗），之後都用 push
+USED = 'used'          # 結果已經用 reply 送出，之後的訊息用 push
+
+
+def text_message(text):
+    """文字訊息（LINE API 的 JSON 格式）"""
+    return {'type': 'text', 'text': text}
+
+
+class ReplyScheduler:
+    """決定每批圖片的 reply token 要保留多久，並統計 reply / push 的比例"""
+
+    def __init__(self, budget=3.0, token_ttl=50.0, progress_text=PROGRESS_TEXT):
+        """
+        參數:
+            budget: float - reply token 最多保留幾秒等結果（0 = 一律先回「辨識中」）
+            token_ttl: float - reply token 的有效時間（秒，從事件的 timestamp 起算，留一點安全餘裕）
+            progress_text: str - 期限到了還沒有結果時回覆的文字
+        """
+        self.budget = budget
+        self.token_ttl = token_ttl
+        self.progress_text = progress_text
+        self._lock = threading.Lock()
+        self._counts = {'requests': 0, 'reply': 0, 'push': 0, 'progress': 0, 'reply_failed': 0, 'expired': 0}
+
+    def deadline(self, timestamp=None):
+        """
+        reply token 還能保留幾秒
+
+        參數:
+            timestamp: int - 事件的 timestamp（毫秒），None 表示不檢查 token 的剩餘時間
+
+        回傳:
+            float: 秒數；token 已經（或快要）過期時回傳負數
+        """
+        if timestamp is None:
+            return self.budget
+        remaining = self.token_ttl - (time.time() - timestamp / 1000)
+        return min(self.budget, remaining)
+
+    def open(self, reply_token, to, reply, push, timestamp=None):
+        """
+        開始保留一個 reply token（同步模式）
+
+        參數:
+            reply_token: str - 事件的 reply token
+            to: str - 推播的對象（使用者 ID）
+            reply: callable(reply_token, messages) - 用 reply 送出 JSON 格式的訊息
+            push: callable(to, messages) - 用 push 送出 JSON 格式的訊息
+            timestamp: int - 事件的 timestamp（毫秒）
+
+        回傳:
+            ReplySlot
+        """
+        self._count('requests')
+        return ReplySlot(self, reply_token, to, reply, push, self.deadline(timestamp))
+
+    def open_async(self, reply_token, to, reply, push, timestamp=None):
+        """同 open，給 ASGI 模式用（reply / push 是 coroutine function；需在 event loop 裡呼叫）"""
+        self._count('requests')
+        return AsyncReplySlot(self, reply_token, to, reply, push, self.deadline(timestamp))
+
+    def _count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def _delivered(self, method):
+        DELIVERIES.inc(method=method)
+        self._count(method)
+        if method == 'reply':
+            PUSH_SAVED.inc()
+
+    def _progress(self, held):
+        HELD_SECONDS.observe(held)
+        PROGRESS_REPLIES.inc()
+        self._count('progress')
+
+    def _reply_failed(self, reason):
+        REPLY_FAILURES.inc(reason=reason)
+        self._count('reply_failed' if reason == 'failed' else 'expired')
+
+    def stats(self):
+        """結果用 reply / push 送出的次數與比例、「辨識中」次數、省下的 push 次數（以本行程為準）"""
+        with self._lock:
+            counts = dict(self._counts)
+        sent = counts['reply'] + counts['push']
+        counts['reply_rate'] = round(counts['reply'] / sent, 3) if sent else 0.0
+        counts['push_saved'] = counts['reply']
+        counts['budget_s'] = self.budget
+        return counts
+
+
+class ReplySlot:
+    """一批圖片的 reply token（同步模式）：期限內送出的第一則結果用 reply，其餘用 push"""
+
+    def __init__(self, scheduler, reply_token, to, reply, push, deadline):
+        self._scheduler = scheduler
+        self._reply_token = reply_token
+        self._to = to
+        self._reply = reply
+        self._push = push
+        self._opened = time.perf_counter()
+        self._lock = threading.Lock()
+        self._state = HELD
+        self._timer = None
+        if deadline <= 0 and scheduler.budget > 0:
+            # 在佇列裡等太久，token 已經過期：不再嘗試 reply
+            self._state = PROGRESS
+            scheduler._reply_failed('expired')
+            log.sampled('reply_token_expired', to=to)
+        elif deadline <= 0:
+            self._send_progress()
+        else:
+            self._timer = threading.Timer(deadline, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    @property
+    def state(self):
+        return self._state
+
+    def _expire(self):
+        with self._lock:
+            if self._state == HELD:
+                self._send_progress()
+
+    def _send_progress(self):
+        # 呼叫端需持有 self._lock（或還在 __init__ 裡）
+        self._state = PROGRESS
+        self._scheduler._progress(time.perf_counter() - self._opened)
+        try:
+            with metrics.span('reply'):
+                self._reply(self._reply_token, [text_message(self._scheduler.progress_text)])
+        except Exception:
+            self._scheduler._reply_failed('failed')
+            log.exception('progress_reply_failed')
+
+    def send(self, messages):
+        """
+        送出結果：reply token 還留著就用 reply，否則（或 reply 失敗時）用 push
+
+        參數:
+            messages: list[dict] - 訊息（LINE API 的 JSON 格式）
+
+        回傳:
+            str: 'reply' 或 'push'
+        """
+        with self._lock:
+            if self._state == HELD:
+                self._state = USED
+                if self._timer:
+                    self._timer.cancel()
+                HELD_SECONDS.observe(time.perf_counter() - self._opened)
+                try:
+                    with metrics.span('reply'):
+                        self._reply(self._reply_token, messages)
+                except Exception as e:
+                    self._scheduler._reply_failed('failed')
+                    log.warning('result_reply_failed', to=self._to, error=str(e))
+                else:
+                    self._scheduler._delivered('reply')
+                    return 'reply'
+        with metrics.span('push'):
+            self._push(self._to, messages)
+        self._scheduler._delivered('push')
+        return 'push'
+
+    def close(self):
+        """不再送出任何訊息（停止計時；還沒用的 token 就放著過期）"""
+        if self._timer:
+            self._timer.cancel()
+
+
+class AsyncReplySlot:
+    """同 ReplySlot，給 ASGI 模式用（期限由 asyncio task 觸發）"""
+
+    def __init__(self, scheduler, reply_token, to, reply, push, deadline):
+        self._scheduler = scheduler
+        self._reply_token = reply_token
+        self._to = to
+        self._reply = reply
+        self._push = push
+        self._opened = time.perf_counter()
+        self._lock = asyncio.Lock()
+        self._state = HELD
+        self._timer = None
+        loop = asyncio.get_running_loop()
+        if deadline <= 0 and scheduler.budget > 0:
+            self._state = PROGRESS
+            scheduler._reply_failed('expired')
+            log.sampled('reply_token_expired', to=to)
+        elif deadline <= 0:
+            # budget 為 0：立刻回「辨識中」（同以前），但不擋住下載
+            self._state = PROGRESS
+            self._timer = loop.create_task(self._send_progress())
+        else:
+            self._timer = loop.create_task(self._expire(deadline))
+
+    @property
+    def state(self):
+        return self._state
+
+    async def _expire(self, delay):
+        await asyncio.sleep(delay)
+        async with self._lock:
+            if self._state == HELD:
+                self._state = PROGRESS
+                await self._send_progress()
+
+    async def _send_progress(self):
+        self._scheduler._progress(time.perf_counter() - self._opened)
+        try:
+            with metrics.span('reply'):
+                await self._reply(self._reply_token, [text_message(self._scheduler.progress_text)])
+        except Exception:
+            self._scheduler._reply_failed('failed')
+            log.exception('progress_reply_failed')
+
+    async def send(self, messages):
+        """同 ReplySlot.send"""
+        async with self._lock:
+            if self._state == HELD:
+                self._state = USED
+                if self._timer:
+                    self._timer.cancel()
+                HELD_SECONDS.observe(time.perf_counter() - self._opened)
+                try:
+                    with metrics.span('reply'):
+                        await self._reply(self._reply_token, messages)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._scheduler._reply_failed('failed')
+                    log.warning('result_reply_failed', to=self._to, error=str(e))
+                else:
+                    self._scheduler._delivered('reply')
+                    return 'reply'
+        if self._timer and not self._timer.done():
+            # 「辨識中」還在送出：等它送完，訊息的順序才不會顛倒
+            await asyncio.wait({self._timer})
+        with metrics.span('push'):
+            await self._push(self._to, messages)
+        self._scheduler._delivered('push')
+        return 'push'
+
+    def close(self):
+        """同 ReplySlot.close（取消還沒觸發的計時 task）"""
+        if self._timer and not self._timer.done():
+            self._timer.cancel()
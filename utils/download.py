@@ -0,0 +1,120 @@
+import io
+from utils import metrics
+
+# 圖片下載的大小上限與格式檢查
+#
+# SDK 的 get_message_content() 會把整個回應讀進記憶體後才交給我們，
+# 一批超大的 PNG（或根本不是圖片的內容）會讓 worker 記憶體暴增、白白下載完整檔案。
+# 這裡邊下載邊檢查：Content-Length 超過上限直接放棄；第一個區塊就依檔頭判斷格式，
+# 不支援的格式立刻中斷；累計超過上限也立刻中斷。
+
+CHUNK_SIZE = 64 * 1024
+
+# 檔頭 → 格式（PIL 與 Gemini 都支援的格式）
+SUPPORTED_FORMATS = ('jpeg', 'png', 'webp', 'gif')
+
+REASON_TOO_LARGE = 'too_large'
+REASON_UNSUPPORTED = 'unsupported_format'
+
+DOWNLOAD_BYTES = metrics.counter('maps_download_bytes_total', '下載的圖片位元組數（content / preview）', ['source'])
+DOWNLOAD_REJECTED = metrics.counter(
+    'maps_download_rejected_total', '下載途中放棄的圖片數（too_large / unsupported_format）', ['reason']
+)
+
+
+class DownloadRejected(ValueError):
+    """下載的內容超過大小上限或不是支援的圖片格式"""
+
+    def __init__(self, reason, detail=''):
+        super().__init__(f'{reason}: {detail}' if detail else reason)
+        self.reason = reason
+
+
+def sniff_format(head):
+    """
+    依檔頭判斷圖片格式
+
+    參數:
+        head: bytes - 檔案開頭（至少 12 bytes 才能判斷 WebP）
+
+    回傳:
+        str 或 None: jpeg / png / webp / gif / heic / bmp，認不出來為 None
+    """
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[4:8] == b'ftyp' and head[8:12] in (b'heic', b'heix', b'mif1', b'msf1'):
+        return 'heic'
+    if head.startswith(b'BM'):
+        return 'bmp'
+    return None
+
+
+class BoundedReader:
+    """累積下載的區塊；超過上限或格式不支援時丟出 DownloadRejected"""
+
+    def __init__(self, max_bytes, source='content', content_length=None):
+        """
+        參數:
+            max_bytes: int - 大小上限（0 表示不限制）
+            source: str - content（原圖）/ preview（預覽圖），只用於指標
+            content_length: int - 回應的 Content-Length（有的話先檢查）
+
+        例外:
+            DownloadRejected: Content-Length 已超過上限
+        """
+        self.max_bytes = max_bytes
+        self.source = source
+        self.format = None
+        self._buffer = bytearray()
+        if max_bytes and content_length and content_length > max_bytes:
+            self._reject(REASON_TOO_LARGE, f'Content-Length {content_length} > {max_bytes}')
+
+    def _reject(self, reason, detail):
+        DOWNLOAD_REJECTED.inc(reason=reason)
+        raise DownloadRejected(reason, detail)
+
+    def feed(self, chunk):
+        """
+        加入一個區塊
+
+        例外:
+            DownloadRejected: 累計超過上限，或檔頭不是支援的格式
+        """
+        if not chunk:
+            return
+        self._buffer += chunk
+        if self.max_bytes and len(self._buffer) > self.max_bytes:
+            self._reject(REASON_TOO_LARGE, f'> {self.max_bytes} bytes')
+        if self.format is None and len(self._buffer) >= 12:
+            self._check_format()
+
+    def _check_format(self):
+        image_format = sniff_format(bytes(self._buffer[:12]))
+        if image_format not in SUPPORTED_FORMATS:
+            self._reject(REASON_UNSUPPORTED, image_format or bytes(self._buffer[:8]).hex())
+        self.format = image_format
+
+    def finish(self):
+        """
+        下載完成，回傳完整內容
+
+        例外:
+            DownloadRejected: 內容太短或格式不支援
+        """
+        if self.format is None:
+            self._check_format()
+        DOWNLOAD_BYTES.inc(len(self._buffer), source=self.source)
+        return bytes(self._buffer)
+
+
+def long_edge(image_data):
+    """圖片的長邊（像素；只讀檔頭，不解碼）"""
+    from PIL import Image
+    with Image.open(io.BytesIO(image_data)) as image:
+        return max(image.size)
@@ -0,0 +1,140 @@
+# 店家卡片（Flex Message）產生器
+#
+# 卡片的固定部分（樣式、按鈕、「地址未提供」等）只建一次，
+# 每家店只填入店名、地址、編號與地圖連結，直接產生 LINE 要的 JSON 結構，
+# 不經過 FlexContainer.from_dict 的 pydantic 模型建構與驗證。
+#
+# 測試或除錯時可開啟 strict 模式（FLEX_STRICT=true），
+# 每則訊息都會再用 SDK 的 FlexMessage 模型驗證一次。
+
+MAX_BUBBLES = 10  # LINE carousel 上限
+
+# 固定不變的元件（所有卡片共用同一個物件，只會被序列化，不可修改）
+_FOUND_LABEL = {
+    "type": "text",
+    "text": "🏪 找到店家！",
+    "weight": "bold",
+    "size": "md",
+    "color": "#1DB446"
+}
+_NO_ADDRESS = {
+    "type": "text",
+    "text": "📍 地址未提供",
+    "size": "sm",
+    "color": "#AAAAAA",
+    "margin": "md"
+}
+
+# 每家店要填值的元件骨架
+_NAME = {
+    "type": "text",
+    "weight": "bold",
+    "size": "xl",
+    "margin": "md",
+    "wrap": True
+}
+_ADDRESS = {
+    "type": "text",
+    "size": "sm",
+    "color": "#999999",
+    "margin": "md",
+    "wrap": True
+}
+_ACTION = {
+    "type": "uri",
+    "label": "🗺️ 開啟地圖"
+}
+_BUTTON = {
+    "type": "button",
+    "style": "primary",
+    "color": "#1DB446"
+}
+
+_strict = False
+
+
+def set_strict(enabled):
+    """開啟 / 關閉 strict 模式（每則訊息都用 SDK 模型驗證）"""
+    global _strict
+    _strict = bool(enabled)
+
+
+def _has_address(address):
+    return bool(address) and address != 'unknown' and bool(address.strip())
+
+
+def bubble(name, address, maps_url, index=0, count=1):
+    """
+    建立單一店家的卡片
+
+    參數:
+        name: str - 店名
+        address: str - 地址（unknown 或空白時顯示「地址未提供」）
+        maps_url: str - Google Maps 連結
+        index: int - 第幾家（從 0 開始）
+        count: int - 總店家數（1 或 None 時顯示「找到店家！」）
+
+    回傳:
+        dict: Flex bubble（LINE API 的 JSON 格式）
+    """
+    if count and count > 1:
+        label = {**_FOUND_LABEL, "text": f"🏪 店家 {index + 1}/{count}"}
+    else:
+        label = _FOUND_LABEL
+
+    return {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                label,
+                {**_NAME, "text": name},
+                {**_ADDRESS, "text": address} if _has_address(address) else _NO_ADDRESS,
+            ]
+        },
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {**_BUTTON, "action": {**_ACTION, "uri": maps_url}}
+            ]
+        }
+    }
+
+
+def flex_message(bubbles, alt_text):
+    """
+    把卡片包成 Flex 訊息（一張用 bubble，多張用 carousel）
+
+    參數:
+        bubbles: list[dict] - bubble() 的結果
+        alt_text: str - 通知與聊天列表顯示的文字
+
+    回傳:
+        dict: 可直接放進 messages 的 Flex 訊息
+    """
+    if len(bubbles) == 1:
+        contents = bubbles[0]
+    else:
+        contents = {"type": "carousel", "contents": list(bubbles[:MAX_BUBBLES])}
+
+    message = {"type": "flex", "altText": alt_text, "contents": contents}
+    if _strict:
+        validate(message)
+    return message
+
+
+def validate(message):
+    """
+    用 SDK 的 FlexMessage 模型驗證訊息格式
+
+    例外:
+        ValueError（pydantic ValidationError）: 格式不符合 LINE 規格
+    """
+    from linebot.v3.messaging import FlexMessage
+
+    parsed = FlexMessage.from_dict(message)
+    if parsed.to_dict() != message:
+        raise ValueError("❌ Flex 訊息含有 SDK 模型不認得的欄位")
+    return parsed
@@ -0,0 +1,376 @@
+import os
+import threading
+from collections import deque, namedtuple
+
+# 台灣地名索引（縣市、鄉鎮市區、車站、地標）
+#
+# 地名資料放在 utils/data/taiwan_places.txt，第一次查詢時載入並編譯成
+# Aho-Corasick 自動機，一次掃過文字就能找出所有出現的地名，
+# 再挑「最具體、最長」的一個（地標 > 車站 > 行政區 > 縣市）。
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data', 'taiwan_places.txt')
+
+KIND_COUNTY = 'county'
+KIND_DISTRICT = 'district'
+KIND_STATION = 'station'
+KIND_LANDMARK = 'landmark'
+
+# 越具體分數越高
+_SPECIFICITY = {KIND_COUNTY: 1, KIND_DISTRICT: 2, KIND_STATION: 3, KIND_LANDMARK: 4}
+
+_DATA_KINDS = {'區': KIND_DISTRICT, '站': KIND_STATION, '地': KIND_LANDMARK}
+
+# 簡稱後面接這些字時是路名（中山路、信義東路），不算地名
+_ROAD_CHARS = set('路街道巷弄里村')
+_DIRECTION_CHARS = set('東西南北中')
+
+Place = namedtuple('Place', ['name', 'kind', 'county', 'label'])
+Place.__doc__ = """
+地名
+
+欄位:
+    name: str - 正式名稱（例如 中壢區、板橋車站）
+    kind: str - county / district / station / landmark
+    county: str - 所屬縣市
+    label: str - 放進 Google Maps 查詢的字串（例如 中壢、板橋車站）
+"""
+
+
+class AhoCorasick:
+    """
+    多字串比對自動機
+
+    轉移表在查詢時才依需要補上失敗轉移（lazy DFA），
+    之後同一個狀態遇到同一個字只要一次 dict 查表。
+    """
+
+    def __init__(self, words, weights=None):
+        """
+        參數:
+            words: iterable[str] - 要比對的字串
+            weights: dict[str, int] - 字串權重（正整數），best() 用來挑最好的命中
+        """
+        goto = [{}]
+        output = [()]
+        for word in words:
+            if not word:
+                continue
+            state = 0
+            for char in word:
+                nxt = goto[state].get(char)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto.append({})
+                    output.append(())
+                    goto[state][char] = nxt
+                state = nxt
+            if word not in output[state]:
+                output[state] = output[state] + (word,)
+
+        # BFS 建失敗連結，輸出合併失敗連結上的字串（後綴也算命中）
+        fail = [0] * len(goto)
+        pending = deque(goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, nxt in goto[state].items():
+                pending.append(nxt)
+                back = fail[state]
+                while back and char not in goto[back]:
+                    back = fail[back]
+                target = goto[back].get(char, 0)
+                fail[nxt] = target if target != nxt else 0
+                output[nxt] = output[nxt] + output[fail[nxt]]
+
+        # 每個狀態命中的字串中權重最高者，best() 掃描時只需比較整數
+        weights = weights or {}
+        self._weight = [0] * len(goto)
+        self._top = [None] * len(goto)
+        for state, words_here in enumerate(output):
+            for word in words_here:
+                weight = weights.get(word, 1)
+                if weight > self._weight[state]:
+                    self._weight[state], self._top[state] = weight, word
+
+        self._goto = goto
+        self._fail = fail
+        self._output = output
+        self._delta = [_Transitions(self, state, edges) for state, edges in enumerate(goto)]
+
+    def _resolve(self, state, char):
+        # 沿失敗連結找到能接受 char 的狀態
+        goto, fail = self._goto, self._fail
+        while state and char not in goto[state]:
+            state = fail[state]
+        return goto[state].get(char, 0)
+
+    def findall(self, text):
+        """
+        回傳文字中出現的所有字串（依結束位置排序，可能重疊）
+
+        參數:
+            text: str - 要搜尋的文字
+
+        回傳:
+            list[str]
+        """
+        delta = self._delta
+        output = self._output
+        state = 0
+        found = []
+        for char in text:
+            state = delta[state][char]
+            if output[state]:
+                found.extend(output[state])
+        return found
+
+    def best(self, text):
+        """
+        一次掃描找出權重最高的命中字串（同權重取先出現者）
+
+        參數:
+            text: str - 要搜尋的文字
+
+        回傳:
+            str 或 None
+        """
+        delta = self._delta
+        weight = self._weight
+        state = 0
+        best_state = 0
+        best_weight = 0
+        for char in text:
+            state = delta[state][char]
+            if weight[state] > best_weight:
+                best_weight = weight[state]
+                best_state = state
+        return self._top[best_state]
+
+
+class _Transitions(dict):
+    """單一狀態的轉移表：沒看過的字才走失敗連結，結果記下來"""
+
+    __slots__ = ('_automaton', '_state')
+
+    def __init__(self, automaton, state, edges):
+        super().__init__(edges)
+        self._automaton = automaton
+        self._state = state
+
+    def __missing__(self, char):
+        nxt = self._automaton._resolve(self._state, char)
+        self[char] = nxt  # 多執行緒同時補上同一格也只是寫入相同的值
+        return nxt
+
+
+def _short_name(name):
+    # 中壢區 → 中壢、竹北市 → 竹北；兩個字的（東區）不縮
+    if len(name) >= 3 and name[-1] in '區鄉鎮市':
+        return name[:-1]
+    return name
+
+
+def _weight(place, alias):
+    # 先比具體程度，同級再比名稱長度；同一個地方正式名稱優先於簡稱
+    return (_SPECIFICITY[place.kind] * 100 + len(place.name)) * 2 + (0 if alias else 1)
+
+
+class Gazetteer:
+    """地名索引"""
+
+    def __init__(self, places, county_aliases=None):
+        """
+        參數:
+            places: iterable[Place] - 地名
+            county_aliases: dict[str, list[str]] - 縣市正式名稱 → 別名（台北、北市…）
+        """
+        self._places = {}          # 比對字串 → Place
+        self._aliases = set()      # 簡稱 / 別名（要檢查是否其實是路名）
+        self._ambiguous = {}       # 不只一個縣市有的行政區（東區、中正區…）→ [(縣市, 縣市名稱與別名)]
+        counties = {}
+        seen_districts = {}
+        count = 0
+
+        for place in places:
+            count += 1
+            if place.kind == KIND_STATION and not place.name.endswith('站'):
+                # 車站只比對「X站 / X車站」，單獨的站名通常是行政區
+                for word in (place.name + '站', place.name + '車站'):
+                    self._add(word, place._replace(label=word), alias=False)
+                continue
+
+            self._add(place.name, place, alias=False)
+            if place.kind == KIND_COUNTY:
+                aliases = (county_aliases or {}).get(place.name, [])
+                for alias in aliases:
+                    self._add(alias, place, alias=True)
+                counties[place.name] = (place, [place.name] + list(aliases))
+            elif place.kind == KIND_DISTRICT:
+                self._add(_short_name(place.name), place, alias=True)
+                seen_districts.setdefault(place.name, set()).add(place.county)
+
+        self._ambiguous = {
+            name: [counties[county] for county in sorted(in_counties) if county in counties]
+            for name, in_counties in seen_districts.items() if len(in_counties) > 1
+        }
+        self.place_count = count
+        self._matcher = AhoCorasick(self._places, {
+            word: _weight(place, word in self._aliases) for word, place in self._places.items()
+        })
+
+    def _add(self, text, place, alias):
+        # 正式名稱優先於別名；同樣是別名時先登記的優先（縣市先於行政區）
+        existing = self._places.get(text)
+        if existing is None or (text in self._aliases and not alias):
+            self._places[text] = place
+            if alias:
+                self._aliases.add(text)
+            else:
+                self._aliases.discard(text)
+
+    def __len__(self):
+        """可比對的名稱數（含別名）"""
+        return len(self._places)
+
+    def names(self):
+        """所有可比對的名稱（含別名）"""
+        return list(self._places)
+
+    @classmethod
+    def load(cls, path=DATA_PATH):
+        """
+        從資料檔載入
+
+        參數:
+            path: str - 資料檔路徑（格式見檔案開頭說明）
+
+        回傳:
+            Gazetteer
+        """
+        places = []
+        county_aliases = {}
+        county = None
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                tag, names = fields[0], fields[1:]
+                if tag == '=':
+                    county = names[0]
+                    county_aliases[county] = names[1:]
+                    label = names[1] if len(names) > 1 else county
+                    places.append(Place(county, KIND_COUNTY, county, label))
+                    continue
+
+                kind = _DATA_KINDS.get(tag)
+                if kind is None or county is None:
+                    raise ValueError(f"❌ 地名資料格式錯誤: {line.strip()}")
+                for name in names:
+                    if kind == KIND_DISTRICT:
+                        label = _short_name(name)
+                    else:
+                        label = name
+                    places.append(Place(name, kind, county, label))
+        return cls(places, county_aliases)
+
+    def _is_road(self, text, word):
+        # 簡稱後面接「路 / 街 / 東路 / 北路…」就是路名，不是地名
+        start = text.find(word)
+        while start != -1:
+            after = text[start + len(word):start + len(word) + 2]
+            if not after or after[0] not in _ROAD_CHARS and not (
+                after[0] in _DIRECTION_CHARS and after[1:2] in _ROAD_CHARS
+            ):
+                return False
+            start = text.find(word, start + 1)
+        return True
+
+    def find_all(self, text):
+        """
+        找出文字中所有地名
+
+        參數:
+            text: str - 地址或任意文字
+
+        回傳:
+            list[Place]: 依出現順序（同一地名只出現一次）
+        """
+        if not text:
+            return []
+        if '臺' in text:
+            text = text.replace('臺', '台')
+        return self._find_all(text)
+
+    def _find_all(self, text):
+        places = []
+        for word in self._matcher.findall(text):
+            if word in self._aliases and self._is_road(text, word):
+                continue
+            place = self._places[word]
+            if place not in places:
+                places.append(place)
+        return places
+
+    def _best(self, text):
+        # 一次掃描取權重最高者；勝出的簡稱其實是路名時，把它遮掉再掃一次
+        word = self._matcher.best(text)
+        while word is not None and word in self._aliases and self._is_road(text, word):
+            text = text.replace(word, '\0' * len(word))
+            word = self._matcher.best(text)
+        return self._places[word] if word is not None else None
+
+    def best_match(self, text):
+        """
+        最具體的地名（地標 > 車站 > 行政區 > 縣市，同級取名稱較長者）
+
+        參數:
+            text: str - 地址或任意文字
+
+        回傳:
+            Place 或 None
+        """
+        if not text:
+            return None
+        if '臺' in text:
+            text = text.replace('臺', '台')
+        return self._best(text)
+
+    def area(self, text):
+        """
+        地址中最適合放進地圖搜尋的地名
+
+        多個縣市都有的行政區（東區、中正區…）若地址裡也有縣市，會一起帶上。
+
+        參數:
+            text: str - 地址
+
+        回傳:
+            str: 地名，找不到時回傳空字串
+        """
+        if not text:
+            return ''
+        if '臺' in text:
+            text = text.replace('臺', '台')
+        best = self._best(text)
+        if best is None:
+            return ''
+        counties = self._ambiguous.get(best.name) if best.kind == KIND_DISTRICT else None
+        if counties:
+            for county, names in counties:
+                if any(name in text for name in names):
+                    return f'{county.label} {best.name}'
+        return best.label
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    """取得共用的地名索引（第一次呼叫時才載入）"""
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer.load()
+    return _gazetteer
@@ -1,20 +1,437 @@
-import google.generativeai as genai
-import json
-import re
-from config import GEMINI_API_KEY
-from PIL import Image
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    RECOGNITION_CACHE_ENABLED, RECOGNITION_CACHE_DB_PATH, RECOGNITION_CACHE_MEMORY_SIZE,
+    RECOGNITION_CACHE_TTL, RECOGNITION_CACHE_MAX_DISTANCE,
+    PREPROCESS_ENABLED, PREPROCESS_MAX_EDGE, PREPROCESS_FORMAT, PREPROCESS_QUALITY,
+    PREPROCESS_GRAYSCALE, PREPROCESS_CROP_CHROME,
+    GEMINI_MODEL_TIERS, CASCADE_ESCALATE_ON,
+    GEMINI_PROMPT_VERSION, PROMPT_CACHE_ENABLED, PROMPT_CACHE_TTL, PROMPT_CACHE_TIMEOUT, PROMPT_CACHE_DB_PATH,
+    GEMINI_STREAMING, USAGE_LEDGER_DB_PATH, GEMINI_PRICES, GEMINI_TRANSPORT, GEMINI_JSON_MODE,
+    KNOWN_SHOPS_ENABLED, KNOWN_SHOPS_DB_PATH, KNOWN_SHOPS_MIN_SEEN,
+    PREFILTER_ENABLED, PREFILTER_THRESHOLD, PREFILTER_SCREENSHOT_BACKGROUND,
+    TILING_ENABLED, TILING_MIN_ASPECT, TILING_TILE_ASPECT, TILING_OVERLAP, TILING_MAX_TILES, TILING_WORKERS,
+    DECODE_MAX_PIXELS, GEMINI_API_KEYS, GEMINI_RATE_LIMITS, GEMINI_KEY_COOLDOWN_SECONDS,
+    GEMINI_KEY_MAX_COOLDOWN_SECONDS, KEY_POOL_DB_PATH,
+    GEMINI_ATTEMPT_TIMEOUT, GEMINI_RETRY_ATTEMPTS, GEMINI_RETRY_BUDGET_SECONDS, GEMINI_RETRY_BACKOFF,
+    GEMINI_RETRY_MAX_BACKOFF, GEMINI_HEDGE_ENABLED, GEMINI_HEDGE_QUANTILE, GEMINI_HEDGE_MIN_DELAY,
+    GEMINI_CIRCUIT_FAILURES, GEMINI_CIRCUIT_RESET_SECONDS
+)
 import io
+from utils.cache import RecognitionCache, sha256_hex, dhash
+from utils.cascade import ModelCascade
+from utils.prompts import get_prompt, RESPONSE_SCHEMA
+from utils.prompt_cache import PromptCache
+from utils.merge import merge_results
+from utils.shops import ShopIndex
+from utils.prefilter import PreFilter
+from utils.tiling import limit_decode, plan_tiles, merge_tiles, TILED_IMAGES, TILES
+from utils.jsonparse import RestaurantStreamParser, parse_tolerant
+from utils.singleflight import SingleFlight, AsyncSingleFlight
+from utils.ledger import UsageLedger
+from utils.keypool import KeyPool
+from utils.resilience import Resilience
+from utils.genai_client import bind
+from utils.log import get_logger
+from utils import metrics
+
+# google.generativeai 與 PIL 都在第一次辨識時才 import（見 utils/genai_client.py、utils/warmup.py）
+
+# 已知店家索引（辨識過的店名 / 帳號 / 行政區）
+shop_index = ShopIndex(KNOWN_SHOPS_DB_PATH, min_seen=KNOWN_SHOPS_MIN_SEEN) if KNOWN_SHOPS_ENABLED else None
+
+# 模型分層：先用便宜的 flash，結果可疑才升級到 Pro（店家都是已知店家就不升級）
+model_cascade = ModelCascade(
+    GEMINI_MODEL_TIERS, escalate_on=CASCADE_ESCALATE_ON, trusts=shop_index.trusts if shop_index else None
+)
+
+# 辨識 Prompt（固定的系統指示用 context caching 只上傳一次）
+recognition_prompt = get_prompt(GEMINI_PROMPT_VERSION)
+prompt_cache = PromptCache(
+    PROMPT_CACHE_DB_PATH, ttl=PROMPT_CACHE_TTL, timeout=PROMPT_CACHE_TIMEOUT, enabled=PROMPT_CACHE_ENABLED
+)
+
+# API key 池：每次呼叫分給配額用量最低、沒有被 429 冷卻中的專案
+key_pool = KeyPool(
+    GEMINI_API_KEYS, KEY_POOL_DB_PATH, limits=GEMINI_RATE_LIMITS,
+    cooldown=GEMINI_KEY_COOLDOWN_SECONDS, max_cooldown=GEMINI_KEY_MAX_COOLDOWN_SECONDS
+)
+
+# 每一層模型的呼叫：每次嘗試的期限、暫時性錯誤重試（429 會換專案）、對沖與斷路器
+resilience = Resilience(
+    attempts=GEMINI_RETRY_ATTEMPTS, attempt_timeout=GEMINI_ATTEMPT_TIMEOUT, budget=GEMINI_RETRY_BUDGET_SECONDS,
+    backoff=GEMINI_RETRY_BACKOFF, max_backoff=GEMINI_RETRY_MAX_BACKOFF, hedge=GEMINI_HEDGE_ENABLED,
+    hedge_quantile=GEMINI_HEDGE_QUANTILE, hedge_min_delay=GEMINI_HEDGE_MIN_DELAY,
+    failure_threshold=GEMINI_CIRCUIT_FAILURES, reset_timeout=GEMINI_CIRCUIT_RESET_SECONDS
+)
+
+# 結構化輸出：每次呼叫都帶上（inline 與 context cache 的模型都適用）
+GENERATION_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': RESPONSE_SCHEMA,
+} if GEMINI_JSON_MODE else None
+
+log = get_logger('gemini')
+
+RECOGNITIONS = metrics.counter('maps_recognitions_total', '辨識次數（found / empty / skipped / error）', ['outcome'])
+CACHE_LOOKUPS = metrics.counter('maps_recognition_cache_lookups_total', '辨識快取查詢次數（hit / miss）', ['result'])
+PARSE_FAILURES = metrics.counter('maps_parse_failures_total', 'Gemini 回應無法解析成 JSON 的次數', ['model'])
+PARSE_RESULTS = metrics.counter(
+    'maps_parse_results_total', 'Gemini 回應的解析方式（strict / tolerant / salvaged / failed；mode: json / text）',
+    ['model', 'mode', 'result']
+)
+GEMINI_REQUESTS = metrics.counter('maps_gemini_requests_total', 'Gemini 呼叫次數（ok / error）', ['model', 'status'])
+GEMINI_SECONDS = metrics.histogram('maps_gemini_request_seconds', 'Gemini 單次呼叫耗時（秒）', ['model'])
+GEMINI_TOKENS = metrics.counter(
+    'maps_gemini_tokens_total', 'Gemini token 用量（prompt / cached / output / total）', ['model', 'kind']
+)
+
+# 同一張圖同時只辨識一次；每位使用者每天的 token 用量與花費
+single_flight = SingleFlight()
+async_single_flight = AsyncSingleFlight()  # ASGI 模式（同一個 event loop 內合併）
+usage_ledger = UsageLedger(USAGE_LEDGER_DB_PATH, GEMINI_PRICES)
+
+# token 用量統計
+_usage_lock = threading.Lock()
+_usage = {}
+
+
+def record_usage(model_name, response, user_id=None):
+    """
+    記錄單次呼叫的 token 用量（usage_metadata），並記到使用者的每日帳本
+
+    參數:
+        model_name: str - 模型名稱
+        response: GenerateContentResponse - Gemini 回應
+        user_id: str - 觸發這次呼叫的使用者（None 記在 unknown）
+
+    回傳:
+        dict: {"prompt": int, "cached": int, "output": int, "total": int}
+    """
+    metadata = getattr(response, 'usage_metadata', None)
+    usage = {
+        'prompt': getattr(metadata, 'prompt_token_count', 0) or 0,
+        'cached': getattr(metadata, 'cached_content_token_count', 0) or 0,
+        'output': getattr(metadata, 'candidates_token_count', 0) or 0,
+        'total': getattr(metadata, 'total_token_count', 0) or 0,
+    }
+    log.sampled('gemini_usage', model=model_name, **usage)
+    for kind, value in usage.items():
+        GEMINI_TOKENS.inc(value, model=model_name, kind=kind)
+
+    with _usage_lock:
+        totals = _usage.setdefault(model_name, {'calls': 0, 'prompt': 0, 'cached': 0, 'output': 0, 'total': 0})
+        totals['calls'] += 1
+        for key, value in usage.items():
+            totals[key] += value
+
+    try:
+        usage_ledger.record(user_id, model_name, usage)
+    except Exception:
+        # 記帳失敗不影響辨識結果
+        log.exception('usage_ledger_failed', model=model_name)
+    return usage
+
+
+def usage_stats():
+    """各模型累計 token 用量（以本行程為準）"""
+    with _usage_lock:
+        return {name: dict(totals) for name, totals in _usage.items()}
+
+
+def build_contents(image_parts):
+    """組出送給模型的內容：短指示 + 圖片（多張圖時改用合併辨識的指示）"""
+    if len(image_parts) == 1:
+        instruction = recognition_prompt.user_instruction
+    else:
+        instruction = recognition_prompt.multi_image_instruction.format(count=len(image_parts))
+    return [instruction] + list(image_parts)
 
-# 初始化 Gemini 2.5 Pro 模型
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-pro')
 
-def recognize_restaurant(image_data):
+def _request_options(timeout):
+    # SDK 預設對 503 自己重試、期限 600 秒；重試與期限改由 resilience 處理，SDK 的重試關掉
+    options = {'retry': None}
+    if timeout:
+        options['timeout'] = timeout
+    return options
+
+
+def generate(model_name, image_parts, user_id=None, timeout=None):
+    """
+    用指定模型辨識圖片，回傳回應文字（單次呼叫，不重試；重試見 call()）
+
+    參數:
+        model_name: str - 模型名稱
+        image_parts: list - 圖片（PIL Image 或 inline blob dict）
+        user_id: str - 記帳用的使用者 ID
+        timeout: float - 這次呼叫的期限（秒，傳給 SDK；None 表示 SDK 預設）
+
+    回傳:
+        str: 模型回應文字
+    """
+    lease, model = _lease_model(model_name)
+    start = time.perf_counter()
+    try:
+        bind(model, lease.key.key)
+        with metrics.span('gemini'):
+            response = model.generate_content(
+                build_contents(image_parts), generation_config=GENERATION_CONFIG,
+                request_options=_request_options(timeout)
+            )
+            text = response.text
+    except BaseException as e:
+        key_pool.release(lease, error=e)
+        GEMINI_REQUESTS.inc(model=model_name, status='error')
+        raise
+    GEMINI_REQUESTS.inc(model=model_name, status='ok')
+    GEMINI_SECONDS.observe(time.perf_counter() - start, model=model_name)
+    _finish(lease, response, user_id)
+    return text
+
+
+def call(model_name, image_parts, user_id=None):
+    """
+    generate() 加上每次嘗試的期限、重試、對沖與斷路器（見 utils/resilience.py）
+
+    例外:
+        CircuitOpen: 這個模型的斷路器打開中
+        其他: 不能重試、次數或期限用完時，最後一次的例外
+    """
+    return resilience.call(model_name, lambda timeout: generate(model_name, image_parts, user_id, timeout))
+
+
+async def call_async(model_name, image_parts, user_id=None, timeout=None):
+    """
+    call() 的 asyncio 版本
+
+    參數:
+        timeout: float - 這一層含重試的總期限（None 表示 GEMINI_RETRY_BUDGET_SECONDS）
+    """
+    return await resilience.call_async(
+        model_name, lambda attempt_timeout: generate_async(model_name, image_parts, user_id, attempt_timeout),
+        budget=timeout
+    )
+
+
+def _lease_model(model_name):
+    """向 key 池要一把 key，並取得用那把 key 呼叫的模型"""
+    lease = key_pool.acquire(model_name)
+    try:
+        model, _ = prompt_cache.model_for(model_name, recognition_prompt, lease.key)
+    except BaseException as e:
+        key_pool.release(lease, error=e)
+        raise
+    return lease, model
+
+
+def _finish(lease, response, user_id):
+    """呼叫成功：記錄 token 用量，並把實際用量回報給 key 池"""
+    usage = record_usage(lease.model_name, response, user_id)
+    key_pool.release(lease, tokens=usage['total'] or None)
+
+
+# 只有 grpc_asyncio（SDK 預設）有真正的 asyncio 版本；rest / grpc 傳輸的 async client 無法使用
+NATIVE_ASYNC = GEMINI_TRANSPORT in (None, 'grpc_asyncio')
+
+
+async def generate_async(model_name, image_parts, user_id=None, timeout=None):
+    """
+    generate() 的 asyncio 版本（ASGI 模式用）
+
+    grpc_asyncio 傳輸用 generate_content_async，逾時或取消時連同 RPC 一起取消；
+    其他傳輸沒有 asyncio 版本，改在執行緒裡跑 generate()（逾時只會放棄等待，呼叫仍會跑完）。
+
+    參數:
+        model_name: str - 模型名稱
+        image_parts: list - 圖片
+        user_id: str - 記帳用的使用者 ID
+        timeout: float - 這次呼叫最多等幾秒（None 表示不限制）
+
+    回傳:
+        str: 模型回應文字
+
+    例外:
+        TimeoutError: 超過 timeout
+    """
+    if not NATIVE_ASYNC:
+        return await asyncio.wait_for(asyncio.to_thread(generate, model_name, image_parts, user_id), timeout)
+
+    # key 池與建立 / 查詢 context cache 都是同步的 SQLite / 網路呼叫（cache 通常只有第一次）
+    leasing = asyncio.ensure_future(asyncio.to_thread(_lease_model, model_name))
+    try:
+        lease, model = await asyncio.shield(leasing)
+    except asyncio.CancelledError:
+        # 執行緒還是會拿到 key：拿到後馬上還回去
+        # （except 區塊結束時 as 的名稱會被刪掉，callback 要用自己的例外物件）
+        error = asyncio.CancelledError()
+
+        def give_back(done):
+            if not done.cancelled() and done.exception() is None:
+                key_pool.release(done.result()[0], error=error)
+
+        leasing.add_done_callback(give_back)
+        raise
+    start = time.perf_counter()
+    try:
+        bind(model, lease.key.key, asynchronous=True)
+        with metrics.span('gemini'):
+            response = await asyncio.wait_for(
+                model.generate_content_async(
+                    build_contents(image_parts), generation_config=GENERATION_CONFIG,
+                    request_options=_request_options(timeout)
+                ),
+                timeout
+            )
+            text = response.text
+    except BaseException as e:
+        # 只有 429 會寫 SQLite（冷卻），其餘只更新記憶體裡的計數
+        key_pool.release(lease, error=e)
+        GEMINI_REQUESTS.inc(model=model_name, status='error')
+        raise
+    GEMINI_REQUESTS.inc(model=model_name, status='ok')
+    GEMINI_SECONDS.observe(time.perf_counter() - start, model=model_name)
+    # 記帳會寫 SQLite，不佔用 event loop
+    await asyncio.to_thread(_finish, lease, response, user_id)
+    return text
+
+
+# 串流統計：第一家店解析出來的時間 vs 整個回應完成的時間
+_stream_lock = threading.Lock()
+_stream = {'streams': 0, 'with_first': 0, 'first_total': 0.0, 'total_total': 0.0}
+
+
+def generate_stream(model_name, image_parts, on_restaurant, user_id=None, timeout=None):
+    """
+    串流模式呼叫模型：restaurants[] 每完成一個元素就呼叫 on_restaurant
+
+    參數:
+        model_name: str - 模型名稱
+        image_parts: list - 圖片
+        on_restaurant: callable(dict) - 每解析出一家店就呼叫一次
+        user_id: str - 記帳用的使用者 ID
+        timeout: float - 這次呼叫的期限（秒，傳給 SDK）
+
+    回傳:
+        str: 完整的模型回應文字
+    """
+    start = time.perf_counter()
+    first_at = None
+    parser = RestaurantStreamParser()
+
+    lease, model = _lease_model(model_name)
+    try:
+        bind(model, lease.key.key)
+        with metrics.span('gemini'):
+            response = model.generate_content(
+                build_contents(image_parts), generation_config=GENERATION_CONFIG, stream=True,
+                request_options=_request_options(timeout)
+            )
+            for chunk in response:
+                for restaurant in parser.feed(chunk.text):
+                    name = (restaurant.get('name') or '').strip()
+                    if not name or name == 'unknown':
+                        continue
+                    if first_at is None:
+                        first_at = time.perf_counter() - start
+                        log.sampled('stream_first_restaurant', model=model_name, ms=round(first_at * 1000, 1))
+                    on_restaurant(restaurant)
+    except BaseException as e:
+        key_pool.release(lease, error=e)
+        GEMINI_REQUESTS.inc(model=model_name, status='error')
+        raise
+
+    total = time.perf_counter() - start
+    GEMINI_REQUESTS.inc(model=model_name, status='ok')
+    GEMINI_SECONDS.observe(total, model=model_name)
+    _finish(lease, response, user_id)
+    with _stream_lock:
+        _stream['streams'] += 1
+        _stream['total_total'] += total
+        if first_at is not None:
+            _stream['with_first'] += 1
+            _stream['first_total'] += first_at
+    return parser.buffer
+
+
+def call_stream(model_name, image_parts, on_restaurant, user_id=None):
+    """generate_stream() 加上期限、重試與斷路器；已經送出店家後不再重試（也不對沖）"""
+    sent = []
+
+    def forward(restaurant):
+        sent.append(True)
+        on_restaurant(restaurant)
+
+    return resilience.call(
+        model_name, lambda timeout: generate_stream(model_name, image_parts, forward, user_id, timeout),
+        hedge=False, can_retry=lambda: not sent
+    )
+
+
+def stream_stats():
+    """串流模式的平均「第一家店」時間與總時間（以本行程為準）"""
+    with _stream_lock:
+        streams, with_first = _stream['streams'], _stream['with_first']
+        return {
+            'streams': streams,
+            'first_restaurant_avg_ms': round(_stream['first_total'] / with_first * 1000, 1) if with_first else 0.0,
+            'total_avg_ms': round(_stream['total_total'] / streams * 1000, 1) if streams else 0.0,
+        }
+
+
+def prepare_image(image, original_bytes=None, preprocess=None, crop_chrome=None):
+    """
+    依設定前處理圖片，回傳可以放進 generate_content 的圖片
+
+    參數:
+        image: PIL.Image - 原始圖片
+        original_bytes: int - 原始檔案大小（僅用於 log）
+        preprocess: bool - 是否前處理（None 表示依 PREPROCESS_ENABLED 設定）
+        crop_chrome: bool - 是否裁掉手機狀態列 / 導覽列（None 表示依 PREPROCESS_CROP_CHROME 設定）
+    """
+    if preprocess is None:
+        preprocess = PREPROCESS_ENABLED
+    if not preprocess:
+        return image
+    from utils.preprocess import preprocess_image
+    with metrics.span('preprocess'):
+        return preprocess_image(
+            image,
+            max_edge=PREPROCESS_MAX_EDGE,
+            image_format=PREPROCESS_FORMAT,
+            quality=PREPROCESS_QUALITY,
+            grayscale=PREPROCESS_GRAYSCALE,
+            crop_chrome=PREPROCESS_CROP_CHROME if crop_chrome is None else crop_chrome,
+            original_bytes=original_bytes
+        ).to_part()
+
+# 辨識結果快取（同一張截圖被轉傳時不用再問 Gemini）
+# 依 Prompt 版本、模型分層與 JSON mode 分開存：換了其中任何一個，舊結果就不再命中
+recognition_cache = RecognitionCache(
+    RECOGNITION_CACHE_DB_PATH,
+    memory_size=RECOGNITION_CACHE_MEMORY_SIZE,
+    ttl=RECOGNITION_CACHE_TTL,
+    max_distance=RECOGNITION_CACHE_MAX_DISTANCE,
+    namespace=f"{recognition_prompt.version}/{','.join(GEMINI_MODEL_TIERS)}/{'json' if GEMINI_JSON_MODE else 'text'}"
+) if RECOGNITION_CACHE_ENABLED else None
+
+# 本地預篩（不可能有店名的圖直接回覆）
+prefilter = PreFilter(
+    threshold=PREFILTER_THRESHOLD, screenshot_background=PREFILTER_SCREENSHOT_BACKGROUND
+) if PREFILTER_ENABLED else None
+
+def recognize_restaurant(image_data, preprocess=None, on_restaurant=None, user_id=None):
     """
     辨識圖片中的店家資訊（支援單個或多個店家）
 
     參數:
         image_data: 圖片的 bytes 資料
+        preprocess: bool - 是否先做圖片前處理（None 表示依 PREPROCESS_ENABLED 設定）
+        on_restaurant: callable(dict) - 串流模式下，每解析出一家店就先呼叫一次（可選）
+        user_id: str - 傳圖的使用者（token 用量記在他的帳上）
 
     回傳:
         dict: {
@@ -25,244 +442,417 @@ def recognize_restaurant(image_data):
             "count": int
         }
     """
+    return recognize_restaurants([image_data], preprocess=preprocess, on_restaurant=on_restaurant, user_id=user_id)
+
+def recognize_restaurants(images_data, preprocess=None, on_restaurant=None, user_id=None):
+    """
+    一次辨識多張圖片（同一則貼文的多張截圖），回傳合併、去重後的結果
+
+    同一組圖片已經在辨識中時（例如群組裡好幾個人同時轉傳），直接等那一次的結果，
+    不再另外呼叫 Gemini；等待者拿到完整結果，不會收到串流的 on_restaurant。
+
+    參數:
+        images_data: list[bytes] - 圖片的 bytes 資料
+        preprocess: bool - 是否先做圖片前處理（None 表示依 PREPROCESS_ENABLED 設定）
+        on_restaurant: callable(dict) - 串流模式下，每解析出一家店就先呼叫一次（可選）
+        user_id: str - 傳圖的使用者（token 用量記在他的帳上）
+
+    回傳:
+        dict: 同 recognize_restaurant
+    """
+    image_key = _image_key(images_data)
+    result, shared = single_flight.do(
+        (image_key, preprocess),
+        lambda: _recognize(images_data, image_key, preprocess, on_restaurant, user_id)
+    )
+    if shared:
+        log.sampled('recognition_shared', key=image_key[:12])
+    return result
+
+async def recognize_restaurants_async(images_data, preprocess=None, user_id=None, timeout=None):
+    """
+    recognize_restaurants() 的 asyncio 版本（ASGI 模式用）
+
+    解碼、查快取、前處理這些 CPU 工作在執行緒裡跑，Gemini 呼叫用 generate_async()；
+    不支援串流（GEMINI_STREAMING 只用在同步模式）。
+
+    參數:
+        images_data: list[bytes] - 圖片的 bytes 資料
+        preprocess: bool - 是否先做圖片前處理（None 表示依 PREPROCESS_ENABLED 設定）
+        user_id: str - 傳圖的使用者（token 用量記在他的帳上）
+        timeout: float - 每一層模型的 Gemini 呼叫（含重試）最多等幾秒（逾時視同呼叫失敗，會升級到下一層）
+
+    回傳:
+        dict: 同 recognize_restaurant
+    """
+    image_key = _image_key(images_data)
+    result, shared = await async_single_flight.do(
+        (image_key, preprocess),
+        lambda: _recognize_async(images_data, image_key, preprocess, user_id, timeout)
+    )
+    if shared:
+        log.sampled('recognition_shared', key=image_key[:12])
+    return result
+
+def _image_key(images_data):
+    # 圖片內容的 key（單張：SHA-256；多張：每張 SHA-256 串起來再算一次），也是快取的精確比對 key
+    if len(images_data) == 1:
+        return sha256_hex(images_data[0])
+    return sha256_hex(''.join(sha256_hex(d) for d in images_data).encode())
+
+def _lookup(images_data, image_key):
+    """
+    解碼圖片、查辨識快取，再做本地預篩
+
+    回傳:
+        tuple(list, str 或 None, dict 或 None): (PIL 圖片, dHash, 快取的結果或預篩擋下的空結果)
+    """
+    from PIL import Image
+
+    # 將 bytes 轉換為 PIL Image（Image.open 只讀檔頭，load() 才真正解碼；太大的 JPEG 縮小解碼）
+    with metrics.span('decode'):
+        images = [Image.open(io.BytesIO(image_data)) for image_data in images_data]
+        for image in images:
+            if limit_decode(image, DECODE_MAX_PIXELS):
+                log.info('image_decode_reduced', size=f'{image.width}x{image.height}', max_pixels=DECODE_MAX_PIXELS)
+            image.load()
+
+    # 先查快取：完全相同（SHA-256）或看起來相同（dHash）的圖直接回傳
+    # 多張圖時只做精確比對
+    cache_phash = None
+    if recognition_cache:
+        with metrics.span('cache_lookup'):
+            cache_phash = dhash(images[0]) if len(images) == 1 else None
+            cached = recognition_cache.get(image_key, cache_phash)
+        CACHE_LOOKUPS.inc(result='hit' if cached is not None else 'miss')
+        if cached is not None:
+            log.sampled('recognition_cache_hit', key=image_key[:12])
+            RECOGNITIONS.inc(outcome='found' if cached['count'] > 0 else 'empty')
+            return images, cache_phash, cached
+
+    # 自拍、純食物特寫這類不可能有店名的圖，不呼叫 Gemini
+    if prefilter:
+        with metrics.span('prefilter'):
+            accepted, features = prefilter.accept(images)
+        if not accepted:
+            log.info('prefilter_rejected', images=len(images), features=features)
+            RECOGNITIONS.inc(outcome='skipped')
+            return images, cache_phash, {'restaurants': [], 'count': 0, 'food_keywords': '', 'skipped': 'prefilter'}
+    return images, cache_phash, None
+
+def _prepare_parts(images, images_data, preprocess):
+    # 圖片前處理：縮圖 + 重新壓縮，減少上傳量與圖片 token
+    return [
+        prepare_image(image, len(image_data), preprocess)
+        for image, image_data in zip(images, images_data)
+    ]
+
+# 長截圖區塊的辨識執行緒（每個行程一組、所有請求共用，同時在辨識的區塊數不超過 TILING_WORKERS）
+_tile_pool = None
+_tile_pool_pid = None
+_tile_pool_lock = threading.Lock()
+
+
+def _tile_executor():
+    global _tile_pool, _tile_pool_pid
+    pid = os.getpid()
+    if _tile_pool_pid != pid:
+        with _tile_pool_lock:
+            if _tile_pool_pid != pid:
+                # gunicorn fork 後的 worker 不沿用父行程的執行緒
+                _tile_pool = ThreadPoolExecutor(max_workers=TILING_WORKERS, thread_name_prefix='tile')
+                _tile_pool_pid = pid
+    return _tile_pool
+
+
+def _plan_tiles(images):
+    """
+    長截圖的切塊規劃（只切單張的長截圖，多張圖的貼文本來就一起送出）
+
+    回傳:
+        tuple(PIL.Image, list): (要切的圖, 區塊)；不需要切時區塊為空 list
+    """
+    if not TILING_ENABLED or len(images) != 1:
+        return None, []
+    from utils.preprocess import crop_phone_chrome
+    with metrics.span('tile_plan'):
+        image = images[0]
+        if PREPROCESS_CROP_CHROME:
+            # 狀態列 / 導覽列在整張圖的頭尾，先裁掉；區塊本身不再裁（區塊的頭尾是內容）
+            image = crop_phone_chrome(image)
+        return image, plan_tiles(image, TILING_MIN_ASPECT, TILING_TILE_ASPECT, TILING_OVERLAP, TILING_MAX_TILES)
+
+
+def _prepare_tile(image, box, preprocess):
+    # 區塊在辨識時才裁切，前處理完（壓成 JPEG）就丟掉裁出來的像素
+    return prepare_image(image.crop(box), None, preprocess, crop_chrome=False)
+
+
+def _recognize_tile(image, box, preprocess, user_id):
+    part = _prepare_tile(image, box, preprocess)
+    # 區塊本來就可能沒有店家（清單的頭尾、留言），空結果不升級
+    return model_cascade.run(lambda tier: _parse(tier, call(tier, [part], user_id)), allow_empty=True)
+
+
+def _merge_tile_outcomes(outcomes):
+    """
+    合併各區塊的 (結果, 模型) 或例外；有任一區塊成功就回傳合併結果（失敗的區塊略過）
+
+    回傳:
+        tuple(dict, str): (合併後的結果, 用到的最高一層模型)
+
+    例外:
+        所有區塊都失敗時丟出最後一個例外
+    """
+    results, tiers, error = [], [], None
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, BaseException):
+            log.warning('tile_failed', tile=index, tiles=len(outcomes), error=repr(outcome))
+            TILES.inc(outcome='error')
+            results.append(None)
+            error = outcome
+            continue
+        result, model_name = outcome
+        TILES.inc(outcome='ok' if result['count'] else 'empty')
+        results.append(result)
+        tiers.append(model_cascade.model_names.index(model_name))
+    if not tiers:
+        raise error
+
+    merged = merge_tiles(results)
+    log.info('image_tiled', tiles=len(outcomes), failed=len(outcomes) - len(tiers), restaurants=merged['count'])
+    return merged, model_cascade.model_names[max(tiers)]
+
+
+def _recognize_tiles(image, boxes, preprocess, user_id):
+    """長截圖：各區塊同時辨識（區塊執行緒），依順序合併"""
+    TILED_IMAGES.inc()
+    executor = _tile_executor()
+    # 帶著目前的 trace()，區塊裡的 gemini / parse 耗時也記到這批圖片的 stages
+    futures = [
+        executor.submit(contextvars.copy_context().run, _recognize_tile, image, box, preprocess, user_id)
+        for box in boxes
+    ]
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append(future.result())
+        except Exception as e:
+            outcomes.append(e)
+    return _merge_tile_outcomes(outcomes)
+
+
+async def _recognize_tiles_async(image, boxes, preprocess, user_id, timeout):
+    """_recognize_tiles 的 asyncio 版本（同時最多 TILING_WORKERS 塊）"""
+    TILED_IMAGES.inc()
+    slots = asyncio.Semaphore(TILING_WORKERS)
+
+    async def tile(box):
+        async with slots:
+            part = await asyncio.to_thread(_prepare_tile, image, box, preprocess)
+
+            async def attempt(tier):
+                return _parse(tier, await call_async(tier, [part], user_id, timeout))
+
+            return await model_cascade.run_async(attempt, allow_empty=True)
+
+    outcomes = await asyncio.gather(*(tile(box) for box in boxes), return_exceptions=True)
+    for outcome in outcomes:
+        if isinstance(outcome, asyncio.CancelledError):
+            raise outcome
+    return _merge_tile_outcomes(outcomes)
+
+# 解析方式統計：比較 JSON mode 開 / 關的解析失敗率
+PARSE_MODE = 'json' if GEMINI_JSON_MODE else 'text'
+_parse_lock = threading.Lock()
+_parse_counts = {}
+
+
+def _count_parse(tier, result):
+    PARSE_RESULTS.inc(model=tier, mode=PARSE_MODE, result=result)
+    with _parse_lock:
+        counts = _parse_counts.setdefault(tier, {'strict': 0, 'tolerant': 0, 'salvaged': 0, 'failed': 0})
+        counts[result] += 1
+
+
+def parse_stats():
+    """各模型回應的解析方式次數與失敗率（以本行程為準）"""
+    models = {}
+    with _parse_lock:
+        for tier, counts in _parse_counts.items():
+            total = sum(counts.values())
+            models[tier] = dict(counts, failure_rate=round(counts['failed'] / total, 4) if total else 0.0)
+    return {'mode': PARSE_MODE, 'models': models}
+
+def _parse(tier, text):
     try:
-        # 將 bytes 轉換為 PIL Image
-        image = Image.open(io.BytesIO(image_data))
-
-        # 設計 Prompt
-        prompt = """
-# Role & Objective
-你是美食導航助手。從圖片 (OCR) 與貼文文字中，精準提取店家資訊，整理成 JSON 格式，以便生成 Google Maps 搜尋連結。
-
-# CRITICAL: Grounding Rules (絕對遵守 - 防止 AI 幻覺)
-
-**1. Source of Truth is ONLY the Input:**
-- 你只能提取圖片 (Image) 與文字 (Caption) 中「明確出現」的資訊
-- **嚴禁使用外部知識 (No External Knowledge)**
-- 即使你知道 "No.5 Cafe" 的真實地址在 "甘肅二街"，但如果圖片/文字沒寫，你必須填寫 `address: "unknown"`
-- **禁止補全地址**：不要在地址欄位自行填入你記憶中的資料
-
-**2. Single Post Assumption:**
-- 除非圖片明顯是「多店家清單」(有編號 1. 2. 3. 或不同店名並列)，否則預設這是「單一店家」的貼文
-- 若只看到一個蛋糕和一個帳號，`restaurants` 陣列中只能有 **1 個** 物件
-- **禁止分裂**：不要因為不確定，就列出所有可能的候選店家
-
-**3. Hallucination Check:**
-- 若 `name` 是根據風格猜測的（例如：圖片風格簡約就猜 "Minimalism Cafe"），且圖片中無此文字，直接丟棄該結果
-- 只輸出圖片中「看得到」的店名
-
-# Extraction Logic
-
-## 1. Shop Name (店名 - 帳號權重策略)
-**來源優先級（由清晰度決定）：**
-1. **清晰的實體招牌** → 最優先
-2. **社群帳號（需身份驗證）** → 無招牌時的次選
-3. **貼文文字** → 最後選擇
-
-**社群帳號提取規則（僅當無實體招牌時）：**
-
-**身份驗證（判斷店家 vs 推薦者）：**
-- ❌ 拒絕提取：帳號包含 `foodie`, `blogger`, `eats`, `life`, `diary`, `travel` 等
-- ❌ 拒絕提取：貼文語氣是推薦（「推薦這家」「去吃了XXX」）
-- ✅ 可提取：帳號包含 `cafe`, `official`, `restaurant`, `store` 等
-- ✅ 可提取：貼文語氣是店主（「我們的店」「本店」）
-
-**帳號語意還原（Handle Processing）：**
-提取帳號後，執行以下清洗步驟：
-1. 移除後綴：`_official`, `_store`, `_tw`, `.tw` 等
-2. 移除年份：`2023`, `2024`, `2025` 等
-3. 特殊字元轉空格：`_` 和 `.` 改為空格
-4. 智能合併：`ca_fe` → `Cafe`, `hu_lu_lu` → `Hululu`
-5. Title Case：首字母大寫（例如：`poffee canteen` → `Poffee Canteen`）
-6. 保留數字：`no5` → `No.5`, `101` 保持原樣
-
-**衝突處理：**
-- 模糊招牌 + 清晰帳號 → 使用帳號（還原後的名稱）
-- 清晰招牌 + 帳號 → 使用招牌（`name`），保留帳號（`original_handle`）
-- 推薦清單 → 只提取清單中的店名，忽略推薦者帳號
-
-**多店家清單：**
-- 若圖片是推薦清單，提取所有列出的店名（最多 10 個）
-- 忽略頂部推薦者帳號
-
-## 2. Address/Location (地址資訊)
-**目標：** 提供越詳細越好的地理資訊，提高 Google Maps 搜尋命中率。
-
-**提取策略（堆疊法）：**
-- 有完整地址（如：桃園市中壢區健行路123號）→ 提取完整地址
-- 無完整地址 → 堆疊所有地點資訊（例如：桃園後站 健行路）
-- 從貼文正文或 hashtag 提取區域/路名/地標
-
-**語意分析：**
-- 只提取「店家所在地」，排除「出發地」或「比較對象」
-- 例如：「從台北來桃園吃飯」→ 只提取「桃園」
-- 例如：「後站健行路上的店」→ 提取「後站 健行路」
-
-**無地點資訊：** 填 "unknown"
-
-## 3. Food Keywords (搜尋優化關鍵字)
-**目標：** 提取最能幫助 Google Maps 找到該店家的關鍵搜尋詞。
-
-**來源優先級：**
-1. 貼文強調的招牌菜（例如：「必點肉桂捲」→ 提取「肉桂捲」）
-2. 若貼文未提及，從圖片辨識食物種類（例如：圖是拿鐵 → 提取「咖啡」）
-
-**格式策略：**
-- 採用「具體招牌菜 + 廣泛類別」組合
-- 最多 2-3 個關鍵字，空格分隔
-- 範例：
-  * 貼文「#肉桂捲超好吃」→ "肉桂捲 麵包"
-  * 貼文「咖哩跟漢堡排都讚」→ "咖哩 漢堡排 洋食"
-  * 圖片是咖啡杯，貼文無提及 → "咖啡"
-
-**無食物資訊：** 填空字串 ""
-
-# Output Format (JSON)
-{
-  "restaurants": [
-    {
-      "name": "店名（招牌文字 或 還原後的帳號名）",
-      "original_handle": "原始社群帳號（可選，僅當使用帳號時提供）",
-      "address": "完整地址 或 區域+路名 或 unknown"
+        with metrics.span('parse'):
+            result, method = parse_response(text)
+    except ValueError:
+        _count_parse(tier, 'failed')
+        PARSE_FAILURES.inc(model=tier)
+        log.warning('parse_failed', model=tier, chars=len(text))
+        raise
+    _count_parse(tier, method)
+    if method != 'strict':
+        log.sampled('parse_recovered', model=tier, method=method, chars=len(text))
+    return result
+
+def _store(result, model_name, image_count, image_key, cache_phash):
+    log.sampled('recognition_model', model=model_name, images=image_count)
+
+    # 多張圖可能重複列出同一家店
+    if image_count > 1:
+        result = merge_results([result])
+
+    # 只快取有辨識到店家的結果（空結果可能只是這次沒看清楚）
+    if recognition_cache and result['count'] > 0:
+        recognition_cache.put(image_key, cache_phash, result)
+
+    if shop_index and result['count'] > 0:
+        try:
+            shop_index.record(result['restaurants'])
+        except Exception:
+            # 記錄失敗不影響辨識結果
+            log.exception('shop_record_failed')
+
+    RECOGNITIONS.inc(outcome='found' if result['count'] > 0 else 'empty')
+    return result
+
+def _failed(image_count):
+    log.exception('recognition_failed', images=image_count)
+    RECOGNITIONS.inc(outcome='error')
+    return {
+        'restaurants': [],
+        'count': 0,
+        'food_keywords': ''
     }
-  ],
-  "count": 1,
-  "food_keywords": "關鍵字1 關鍵字2"
-}
-
-**欄位說明：**
-- `name`: 主要顯示名稱（招牌優先，或還原後的帳號名）
-- `original_handle`: 原始社群帳號（例如：no5ca_fe）- 僅當使用帳號作為店名時提供
-- `address`: 地址資訊
-- `food_keywords`: 食物類型關鍵字
-
-# Examples
-
-## Example 1: 單店家，複合地點，視覺推測關鍵字
-**貼文：** "終於來朝聖！這家在桃園後站健行路上的小店，肉桂捲跟美式都超讚"
-**圖片：** 招牌顯示 "Mountain"
-**輸出：**
-{
-  "restaurants": [{"name": "Mountain", "address": "桃園後站 健行路"}],
-  "count": 1,
-  "food_keywords": "肉桂捲 咖啡"
-}
-
-## Example 2: IG 帳號名，錯字容忍
-**貼文：** "後站健行路上的雞湯專賣店 來碗雞湯"
-**圖片：** 招牌顯示 "喝碗雞湯"
-**輸出：**
-{
-  "restaurants": [{"name": "喝碗雞湯", "address": "後站 健行路"}],
-  "count": 1,
-  "food_keywords": "雞湯 滷肉飯"
-}
-
-## Example 3: 社群截圖，帳號語意還原
-**貼文：** "中壢車站走路約10分鐘，有甜有鹹"
-**圖片：** IG 截圖，帳號名 "poffee_canteen"，咖哩飯照片，無實體招牌
-**輸出：**
-{
-  "restaurants": [{"name": "Poffee Canteen", "original_handle": "poffee_canteen", "address": "中壢車站"}],
-  "count": 1,
-  "food_keywords": "咖哩 簡餐"
-}
-
-## Example 3-2: 社群截圖，帳號語意還原（巴斯克案例）
-**貼文：** "柚香蜂蜜巴斯克他來了～這週的巴斯克口味..."
-**圖片：** IG 截圖，帳號名 "no5ca_fe"，巴斯克蛋糕照片，無實體招牌
-**輸出：**
-{
-  "restaurants": [{"name": "No.5 Cafe", "original_handle": "no5ca_fe", "address": "unknown"}],
-  "count": 1,
-  "food_keywords": "巴斯克 蛋糕 甜點"
-}
-
-## Example 4: 多店家清單
-**貼文：** "精選三家！"
-**圖片：** 清單顯示「1. 秋甜（中壢） 2. 日和（樹林四街） 3. Mountain（內壢）」
-**輸出：**
-{
-  "restaurants": [
-    {"name": "秋甜", "address": "中壢"},
-    {"name": "日和", "address": "樹林四街"},
-    {"name": "Mountain", "address": "內壢"}
-  ],
-  "count": 3,
-  "food_keywords": "甜點 麵包 咖啡"
-}
-
-## Example 5: 無店名
-**圖片：** 只有食物特寫，無招牌
-**輸出：**
-{
-  "restaurants": [],
-  "count": 0,
-  "food_keywords": ""
-}
-"""
-
-        # 呼叫 Gemini API
-        response = model.generate_content([prompt, image])
-
-        # 解析回應
-        response_text = response.text.strip()
-
-        # 清理 markdown 標記（可能包含 ```json 或 ```）
-        response_text = re.sub(r'^```json\s*', '', response_text)
-        response_text = re.sub(r'^```\s*', '', response_text)
-        response_text = re.sub(r'\s*```$', '', response_text)
-        response_text = response_text.strip()
-
-        # 解析 JSON
-        result = json.loads(response_text)
-
-        # 確保包含必要的欄位
-        if 'restaurants' not in result:
-            # 向後相容：如果是舊格式，轉換成新格式
-            if 'name' in result:
-                result = {
-                    'restaurants': [
-                        {
-                            'name': result.get('name', 'unknown'),
-                            'address': result.get('address', 'unknown')
-                        }
-                    ],
-                    'count': 1,
-                    'food_keywords': ''
-                }
+
+def _recognize(images_data, image_key, preprocess, on_restaurant, user_id):
+    try:
+        images, cache_phash, cached = _lookup(images_data, image_key)
+        if cached is not None:
+            return cached
+
+        # 長截圖切塊辨識（不串流：區塊的結果要等合併、去重後才確定）
+        source, boxes = _plan_tiles(images)
+        if boxes:
+            result, model_name = _recognize_tiles(source, boxes, preprocess, user_id)
+            return _store(result, model_name, 1, image_key, cache_phash)
+
+        image_parts = _prepare_parts(images, images_data, preprocess)
+
+        # 呼叫 Gemini API（分層：flash → pro）
+        # 串流只用在最後一層：前面層級的結果可能被升級推翻，不能先送出去
+        final_tier = model_cascade.model_names[-1]
+
+        def attempt(tier):
+            if GEMINI_STREAMING and on_restaurant and tier == final_tier:
+                text = call_stream(tier, image_parts, on_restaurant, user_id)
             else:
-                result = {
-                    'restaurants': [],
-                    'count': 0,
-                    'food_keywords': ''
-                }
-
-        # 確保 count 欄位
-        if 'count' not in result:
-            result['count'] = len(result.get('restaurants', []))
-
-        # 確保 food_keywords 欄位
-        if 'food_keywords' not in result:
-            result['food_keywords'] = ''
-
-        # 過濾掉 name 是 unknown 的店家
-        valid_restaurants = [
-            r for r in result.get('restaurants', [])
-            if r.get('name') != 'unknown' and r.get('name', '').strip()
-        ]
-
-        result['restaurants'] = valid_restaurants
-        result['count'] = len(valid_restaurants)
-
-        return result
-
-    except Exception as e:
-        print(f"辨識錯誤: {e}")
-        import traceback
-        traceback.print_exc()
-        return {
-            'restaurants': [],
-            'count': 0,
-            'food_keywords': ''
-        }
+                text = call(tier, image_parts, user_id)
+            return _parse(tier, text)
+
+        result, model_name = model_cascade.run(attempt)
+        return _store(result, model_name, len(image_parts), image_key, cache_phash)
+
+    except Exception:
+        return _failed(len(images_data))
+
+async def _recognize_async(images_data, image_key, preprocess, user_id, timeout):
+    try:
+        images, cache_phash, cached = await asyncio.to_thread(_lookup, images_data, image_key)
+        if cached is not None:
+            return cached
+
+        source, boxes = await asyncio.to_thread(_plan_tiles, images)
+        if boxes:
+            result, model_name = await _recognize_tiles_async(source, boxes, preprocess, user_id, timeout)
+            return await asyncio.to_thread(_store, result, model_name, 1, image_key, cache_phash)
+
+        image_parts = await asyncio.to_thread(_prepare_parts, images, images_data, preprocess)
+
+        async def attempt(tier):
+            return _parse(tier, await call_async(tier, image_parts, user_id, timeout))
+
+        result, model_name = await model_cascade.run_async(attempt)
+        return await asyncio.to_thread(_store, result, model_name, len(image_parts), image_key, cache_phash)
+
+    except Exception:
+        return _failed(len(images_data))
+
+
+def parse_response_text(response_text):
+    """
+    把 Gemini 回應文字解析成標準格式的辨識結果
+
+    參數:
+        response_text: str - 模型回應文字
+
+    回傳:
+        dict: 同 recognize_restaurant 的回傳格式
+
+    例外:
+        ValueError: 回應裡找不到可用的 JSON
+    """
+    return parse_response(response_text)[0]
+
+
+def parse_response(response_text):
+    """
+    同 parse_response_text，另外回傳解析方式
+
+    先照正常 JSON 解析；有多餘的說明文字、markdown 標記或結尾逗號時取出第一個完整的物件；
+    輸出被截斷時救回已經完整的店家（見 utils/jsonparse.py）。
+
+    參數:
+        response_text: str - 模型回應文字
+
+    回傳:
+        tuple(dict, str): (辨識結果, strict / tolerant / salvaged)
+
+    例外:
+        ValueError: 回應裡找不到可用的 JSON
+    """
+    result, method = parse_tolerant(response_text.strip())
+
+    # 確保包含必要的欄位
+    if 'restaurants' not in result:
+        # 向後相容：如果是舊格式，轉換成新格式
+        if 'name' in result:
+            result = {
+                'restaurants': [
+                    {
+                        'name': result.get('name', 'unknown'),
+                        'address': result.get('address', 'unknown')
+                    }
+                ],
+                'count': 1,
+                'food_keywords': ''
+            }
+        else:
+            result = {
+                'restaurants': [],
+                'count': 0,
+                'food_keywords': ''
+            }
+
+    # 確保 count 欄位
+    if 'count' not in result:
+        result['count'] = len(result.get('restaurants', []))
+
+    # 確保 food_keywords 欄位
+    if 'food_keywords' not in result:
+        result['food_keywords'] = ''
+
+    # 過濾掉 name 是 unknown 的店家
+    valid_restaurants = [
+        r for r in result.get('restaurants', [])
+        if isinstance(r, dict) and isinstance(r.get('name'), str)
+        and r['name'] != 'unknown' and r['name'].strip()
+    ]
+
+    result['restaurants'] = valid_restaurants
+    result['count'] = len(valid_restaurants)
+
+    return result, method
@@ -0,0 +1,144 @@
+import datetime
+import threading
+from config import GEMINI_API_KEY, GEMINI_API_KEYS, GEMINI_API_ENDPOINT, GEMINI_TRANSPORT
+
+# google.generativeai 延遲載入
+#
+# import google.generativeai（連同 protobuf / grpc）要 1 秒以上，
+# 放在模組最上層會讓每次冷啟動都先付這筆時間。
+# 這裡第一次真正要用時才 import 並設定 API key；
+# 背景預熱（utils/warmup.py）會在第一則訊息進來前先呼叫。
+# GEMINI_API_ENDPOINT / GEMINI_TRANSPORT 可以把請求改送到本地替身（benchmarks/load_benchmark.py）。
+#
+# SDK 的 genai.configure() 是全域的（只能有一把 key）。key 池（utils/keypool.py）的每把 key
+# 各自一組 client（SDK 的 _ClientManager），GenerativeModel 與 context cache 都用那把 key 的 client。
+
+_genai = None
+_lock = threading.Lock()
+_managers = {}  # API key → 這把 key 的 client 組
+
+
+def _options():
+    options = {}
+    if GEMINI_API_ENDPOINT:
+        options['client_options'] = {'api_endpoint': GEMINI_API_ENDPOINT}
+    if GEMINI_TRANSPORT:
+        options['transport'] = GEMINI_TRANSPORT
+    return options
+
+
+def get_genai():
+    """取得已設定 API key 的 google.generativeai 模組（第一次呼叫時才 import）"""
+    global _genai
+    if _genai is None:
+        with _lock:
+            if _genai is None:
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_API_KEY, **_options())
+                _genai = genai
+    return _genai
+
+
+def client_for(api_key, name):
+    """
+    取得這把 key 的 client（第一次呼叫時才建立）
+
+    參數:
+        api_key: str - API key
+        name: str - 'generative'、'generative_async'、'cache' 等（同 SDK 的 get_default_client）
+
+    回傳:
+        google.ai.generativelanguage 的 *ServiceClient / *ServiceAsyncClient
+    """
+    manager = _managers.get(api_key)
+    if manager is None:
+        get_genai()
+        from google.generativeai import client
+        with _lock:
+            manager = _managers.get(api_key)
+            if manager is None:
+                manager = client._ClientManager()
+                options = _options()
+                if 'client_options' in options:
+                    # configure() 會把 api_key 寫進 client_options，每把 key 各用一份
+                    options['client_options'] = dict(options['client_options'])
+                manager.configure(api_key=api_key, **options)
+                _managers[api_key] = manager
+    with _lock:
+        return manager.get_default_client(name)
+
+
+def bind(model, api_key, asynchronous=False):
+    """
+    讓 GenerativeModel 用這把 key 的 client 呼叫（SDK 預設用 genai.configure 的全域 client）
+
+    async client 要在 event loop 裡第一次用到時才建立，所以同步 / async 分開綁定。
+
+    參數:
+        model: GenerativeModel - 這把 key 專用的模型（PromptCache.model_for 依 key 分開建立）
+        api_key: str - API key
+        asynchronous: bool - 綁定 generate_content_async 用的 client
+    """
+    if asynchronous:
+        if model._async_client is None:
+            model._async_client = client_for(api_key, 'generative_async')
+    elif model._client is None:
+        model._client = client_for(api_key, 'generative')
+
+
+def get_cached_content(api_key, name, timeout):
+    """
+    用這把 key 的 client 取得已建立的 CachedContent
+
+    參數:
+        api_key: str - API key
+        name: str - CachedContent 名稱（cachedContents/...）
+        timeout: float - 請求期限（秒）
+
+    回傳:
+        google.generativeai.caching.CachedContent
+    """
+    genai = get_genai()
+    response = client_for(api_key, 'cache').get_cached_content(
+        genai.protos.GetCachedContentRequest(name=name), timeout=timeout
+    )
+    return _wrap_cached_content(response)
+
+
+def create_cached_content(api_key, model_name, display_name, system_instruction, ttl, timeout):
+    """
+    用這把 key 的 client 建立 CachedContent
+
+    參數:
+        api_key: str - API key
+        model_name: str - 模型名稱（例如 gemini-2.5-flash）
+        display_name: str - 顯示名稱
+        system_instruction: str - 要快取的系統指示
+        ttl: int - 存活秒數
+        timeout: float - 請求期限（秒）
+
+    回傳:
+        google.generativeai.caching.CachedContent
+    """
+    genai = get_genai()
+    # SDK 0.8.3（requirements.txt 固定的版本）的 CachedContent.create 只會用全域 client，
+    # 這裡借用它組請求的私有函式，換成這把 key 的 client 送出；升級 SDK 時要一併確認
+    request = genai.caching.CachedContent._prepare_create_request(
+        model=f'models/{model_name}',
+        display_name=display_name,
+        system_instruction=system_instruction,
+        ttl=datetime.timedelta(seconds=ttl),
+    )
+    return _wrap_cached_content(client_for(api_key, 'cache').create_cached_content(request, timeout=timeout))
+
+
+def _wrap_cached_content(response):
+    # SDK 0.8.3 沒有公開「由 API 回應建立 CachedContent」的方法（CachedContent(name) 會再用全域 client 查一次）
+    return get_genai().caching.CachedContent._from_obj(response)
+
+
+def warm_up():
+    """import 並建立每把 key 的 Gemini client（不會呼叫 API）"""
+    get_genai()
+    for _, api_key in GEMINI_API_KEYS:
+        client_for(api_key, 'generative')
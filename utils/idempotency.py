@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import OrderedDict
+from utils.db import ThreadLocalSqlite
+from utils import metrics
+
+# webhook 事件去重
+#
+# webhook 回應太慢（或回 5xx）時 LINE 會重送同一個事件（deliveryContext.isRedelivery = true，
+# webhookEventId 不變），每次重送都會再回一次「辨識中」、再呼叫一次 Gemini、再推一次卡片。
+# 這裡以 webhookEventId 與訊息 ID 當 key 記下已受理的事件：
+#   - 記憶體層：有上限的 LRU，本行程看過的 key 直接判定重複（O(1)）
+#   - SQLite 層：兩個 gunicorn worker 共用，另一個 worker 受理過的事件也擋得下來
+
+SUPPRESSED = metrics.counter(
+    'maps_duplicate_events_suppressed_total', '被略過的重複 webhook 事件數（redelivery: LINE 重送 / 其他重複）',
+    ['redelivery']
+)
+
+
+def event_keys(event):
+    """
+    事件的去重 key
+
+    參數:
+        event: dict - webhook body 裡的單一事件（JSON）
+
+    回傳:
+        list[str]: webhookEventId 與訊息 ID（有的才列）
+    """
+    keys = []
+    if event.get('webhookEventId'):
+        keys.append(f"event:{event['webhookEventId']}")
+    message = event.get('message')
+    if isinstance(message, dict) and message.get('id'):
+        keys.append(f"message:{message['id']}")
+    return keys
+
+
+class IdempotencyStore:
+    """已受理事件的 key（記憶體 LRU + SQLite）"""
+
+    def __init__(self, db_path, memory_size=4096, ttl=86400):
+        """
+        參數:
+            db_path: str - SQLite 檔案路徑
+            memory_size: int - 記憶體層最多記幾個 key
+            ttl: int - 記錄保留秒數（LINE 重送只會在這段時間內發生）
+        """
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> 受理時間
+        self._claimed = 0
+        self._suppressed = 0
+        self._redelivered = 0
+        self._db = ThreadLocalSqlite(db_path, [
+            'CREATE TABLE IF NOT EXISTS processed_events ('
+            ' key TEXT PRIMARY KEY,'
+            ' created_at REAL NOT NULL)'
+        ])
+
+    def _remember(self, keys, now):
+        # 呼叫端需持有 self._lock
+        for key in keys:
+            self._memory[key] = now
+            self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _seen_in_memory(self, keys, now):
+        # 呼叫端需持有 self._lock
+        for key in keys:
+            created_at = self._memory.get(key)
+            if created_at is not None and now - created_at < self.ttl:
+                self._memory.move_to_end(key)
+                return True
+        return False
+
+    def claim(self, event):
+        """
+        受理一個事件：第一次看到回傳 True，重複（包含 LINE 重送）回傳 False
+
+        參數:
+            event: dict - webhook body 裡的單一事件（JSON）
+
+        回傳:
+            bool: True 表示應該處理
+        """
+        keys = event_keys(event)
+        if not keys:
+            return True
+        now = time.time()
+
+        with self._lock:
+            duplicate = in_memory = self._seen_in_memory(keys, now)
+
+        if not in_memory:
+            conn = self._db.conn()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                placeholders = ','.join('?' * len(keys))
+                duplicate = conn.execute(
+                    f'SELECT 1 FROM processed_events WHERE key IN ({placeholders}) AND created_at > ? LIMIT 1',
+                    (*keys, now - self.ttl)
+                ).fetchone() is not None
+                if not duplicate:
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO processed_events (key, created_at) VALUES (?, ?)',
+                        [(key, now) for key in keys]
+                    )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+        redelivery = bool((event.get('deliveryContext') or {}).get('isRedelivery'))
+        purge = False
+        with self._lock:
+            if not in_memory:
+                self._remember(keys, now)
+            if duplicate:
+                self._suppressed += 1
+                self._redelivered += redelivery
+            else:
+                self._claimed += 1
+                purge = self._claimed % 256 == 0
+        if duplicate:
+            SUPPRESSED.inc(redelivery=str(redelivery).lower())
+            return False
+
+        # 偶爾順手清掉過期的 key，避免檔案無限長大
+        if purge:
+            self.purge_expired()
+        return True
+
+    def release(self, event):
+        """
+        取消受理（事件最後沒有排入佇列時呼叫，讓 LINE 的重送可以再被處理）
+
+        參數:
+            event: dict - 之前 claim() 過的事件
+        """
+        keys = event_keys(event)
+        if not keys:
+            return
+        with self._lock:
+            for key in keys:
+                self._memory.pop(key, None)
+            self._claimed -= 1
+        placeholders = ','.join('?' * len(keys))
+        self._db.execute(f'DELETE FROM processed_events WHERE key IN ({placeholders})', keys)
+
+    def purge_expired(self):
+        """刪除 SQLite 中過期的 key，回傳刪除筆數"""
+        return self._db.execute(
+            'DELETE FROM processed_events WHERE created_at <= ?', (time.time() - self.ttl,)
+        ).rowcount
+
+    def stats(self):
+        """受理 / 略過的事件數（以本行程為準）"""
+        with self._lock:
+            return {
+                'claimed': self._claimed,
+                'suppressed': self._suppressed,
+                'suppressed_redeliveries': self._redelivered,
+                'memory_entries': len(self._memory),
+            }
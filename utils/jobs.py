@@ -0,0 +1,307 @@
+import heapq
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from utils.db import ThreadLocalSqlite
+from utils.log import get_logger
+
+# 背景辨識工作佇列
+#
+# webhook 只負責驗證簽名、把工作丟進佇列，然後馬上回 200；
+# 真正的下載圖片 / Gemini 辨識 / 推送訊息由 WorkerPool 的背景執行緒處理。
+# 工作可以指定 not_before（例如流量控制要晚一點再處理的圖片），時間到之前不會被取出，
+# worker 執行緒不用在工作裡睡著等待。
+
+log = get_logger('jobs')
+
+
+class Job:
+    """佇列中的一筆工作"""
+
+    def __init__(self, payload, enqueued_at, job_id=None, not_before=None):
+        self.payload = payload
+        self.enqueued_at = enqueued_at
+        self.job_id = job_id
+        self.not_before = not_before
+
+    @property
+    def ready_at(self):
+        """可以開始處理的時間（計算排隊等待時間用）"""
+        return max(self.enqueued_at, self.not_before or 0.0)
+
+
+class MemoryJobQueue:
+    """行程內的有界佇列（worker 重啟時未處理的工作會遺失）"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._cond = threading.Condition()
+        self._ready = deque()
+        self._delayed = []  # (not_before, 序號, Job) 的 heap
+        self._seq = itertools.count()
+
+    def put(self, payload, not_before=None):
+        """放入工作（not_before 之前不會被取出），佇列已滿時丟出 queue.Full"""
+        now = time.time()
+        with self._cond:
+            if len(self._ready) + len(self._delayed) >= self.maxsize:
+                raise queue.Full()
+            job = Job(payload, now, not_before=not_before)
+            if not_before and not_before > now:
+                heapq.heappush(self._delayed, (not_before, next(self._seq), job))
+            else:
+                self._ready.append(job)
+            self._cond.notify()
+
+    def get(self, timeout):
+        """取出一筆工作，逾時回傳 None"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                while self._delayed and self._delayed[0][0] <= now:
+                    self._ready.append(heapq.heappop(self._delayed)[2])
+                if self._ready:
+                    return self._ready.popleft()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                if self._delayed:
+                    remaining = min(remaining, self._delayed[0][0] - now)
+                self._cond.wait(remaining)
+
+    def done(self, job):
+        pass
+
+    def depth(self):
+        with self._cond:
+            return len(self._ready) + len(self._delayed)
+
+
+class SqliteJobQueue:
+    """
+    存在 SQLite 的有界佇列
+
+    - 兩個 gunicorn worker 共用同一個檔案，誰有空誰就領工作
+    - 工作被領走後要 done() 才會刪除；若 worker 在處理途中被砍掉，
+      超過 stale_after 秒仍未完成的工作會被重新領取
+    """
+
+    def __init__(self, path, maxsize, stale_after=300, poll_interval=0.5):
+        self.path = path
+        self.maxsize = maxsize
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._db = ThreadLocalSqlite(path, [
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' payload TEXT NOT NULL,'
+            ' enqueued_at REAL NOT NULL,'
+            ' claimed_at REAL,'
+            ' not_before REAL NOT NULL DEFAULT 0)'
+        ])
+        # 舊版建立的表沒有 not_before 欄位
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(jobs)')}
+        if 'not_before' not in columns:
+            self._db.execute('ALTER TABLE jobs ADD COLUMN not_before REAL NOT NULL DEFAULT 0')
+
+    def _conn(self):
+        return self._db.conn()
+
+    def put(self, payload, not_before=None):
+        """放入工作（not_before 之前不會被取出），佇列已滿時丟出 queue.Full"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            (pending,) = conn.execute('SELECT COUNT(*) FROM jobs').fetchone()
+            if pending >= self.maxsize:
+                raise queue.Full()
+            conn.execute(
+                'INSERT INTO jobs (payload, enqueued_at, not_before) VALUES (?, ?, ?)',
+                (json.dumps(payload, ensure_ascii=False), time.time(), not_before or 0.0)
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._wakeup.set()
+
+    def _claim(self):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT id, payload, enqueued_at, not_before FROM jobs'
+                ' WHERE (claimed_at IS NULL OR claimed_at < ?) AND not_before <= ?'
+                ' ORDER BY id LIMIT 1',
+                (now - self.stale_after, now)
+            ).fetchone()
+            if row:
+                conn.execute('UPDATE jobs SET claimed_at = ? WHERE id = ?', (now, row[0]))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        if not row:
+            return None
+        job_id, payload, enqueued_at, not_before = row
+        return Job(json.loads(payload), enqueued_at, job_id, not_before or None)
+
+    def get(self, timeout):
+        """取出一筆工作，逾時回傳 None（另一個行程放入的工作靠輪詢發現）"""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._claim()
+            if job:
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._wakeup.wait(min(self.poll_interval, remaining))
+            self._wakeup.clear()
+
+    def done(self, job):
+        self._conn().execute('DELETE FROM jobs WHERE id = ?', (job.job_id,))
+
+    def depth(self):
+        (pending,) = self._conn().execute(
+            'SELECT COUNT(*) FROM jobs WHERE claimed_at IS NULL'
+        ).fetchone()
+        return pending
+
+
+def create_job_queue(backend, maxsize, db_path):
+    """
+    依設定建立工作佇列
+
+    參數:
+        backend: str - 'memory' 或 'sqlite'
+        maxsize: int - 佇列上限
+        db_path: str - SQLite 檔案路徑（backend 為 sqlite 時使用）
+
+    回傳:
+        MemoryJobQueue 或 SqliteJobQueue
+    """
+    if backend == 'sqlite':
+        return SqliteJobQueue(db_path, maxsize)
+    if backend != 'memory':
+        raise ValueError(f"❌ 不支援的 JOB_QUEUE_BACKEND: {backend}")
+    return MemoryJobQueue(maxsize)
+
+
+class WorkerPool:
+    """
+    辨識 worker 執行緒池
+
+    執行緒在第一次 submit() 時才啟動，並且會檢查 pid：
+    gunicorn fork 出來的子行程不會繼承父行程的執行緒，要在子行程重新啟動。
+    """
+
+    def __init__(self, job_queue, process_fn, size):
+        self.job_queue = job_queue
+        self.process_fn = process_fn
+        self.size = size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._threads = []
+
+        # 統計
+        self._busy = 0
+        self._enqueued = 0
+        self._rejected = 0
+        self._started = 0
+        self._processed = 0
+        self._failed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_last = 0.0
+
+    def start(self):
+        """啟動 worker 執行緒（同一個行程只會啟動一次）"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for i in range(self.size):
+                thread = threading.Thread(
+                    target=self._run, name=f'recognition-worker-{i}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            log.info('workers_started', threads=self.size)
+
+    def submit(self, payload, not_before=None):
+        """
+        放入一筆工作
+
+        參數:
+            payload: dict - 可 JSON 序列化的工作內容
+            not_before: float - 這個時間（epoch 秒）之前不處理（None 表示馬上）
+
+        例外:
+            queue.Full - 佇列已滿
+        """
+        self.start()
+        try:
+            self.job_queue.put(payload, not_before)
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise
+        with self._lock:
+            self._enqueued += 1
+
+    def _run(self):
+        while True:
+            job = self.job_queue.get(timeout=1.0)
+            if job is None:
+                continue
+
+            wait = max(0.0, time.time() - job.ready_at)
+            with self._lock:
+                self._busy += 1
+                self._started += 1
+                self._wait_total += wait
+                self._wait_last = wait
+                self._wait_max = max(self._wait_max, wait)
+
+            failed = False
+            try:
+                self.process_fn(job.payload)
+            except Exception:
+                failed = True
+                log.exception('job_failed')
+            finally:
+                self.job_queue.done(job)
+                with self._lock:
+                    self._busy -= 1
+                    self._processed += 1
+                    if failed:
+                        self._failed += 1
+
+    def stats(self):
+        """回傳佇列深度、等待時間等統計（以本行程為準）"""
+        # 佇列深度在鎖外讀：SQLite 佇列要查資料庫，不該卡住 worker 更新計數
+        depth = self.job_queue.depth()
+        with self._lock:
+            started = self._started
+            return {
+                'workers': self.size,
+                'busy': self._busy,
+                'depth': depth,
+                'enqueued': self._enqueued,
+                'rejected': self._rejected,
+                'processed': self._processed,
+                'failed': self._failed,
+                'wait_last_ms': round(self._wait_last * 1000, 1),
+                'wait_avg_ms': round(self._wait_total / started * 1000, 1) if started else 0.0,
+                'wait_max_ms': round(self._wait_max * 1000, 1),
+            }
@@ -0,0 +1,202 @@
+import json
+import re
+
+# 串流 JSON 解析與容錯解析
+#
+# Gemini 串流回傳時，回應是一段一段到的。這裡在文字還沒收完之前，
+# 就把 "restaurants" 陣列裡已經完整的店家物件一個一個解析出來。
+#
+# 模型偶爾會在 JSON 前後多講幾句話、包 markdown 標記、留下結尾逗號，或輸出到一半被截斷；
+# parse_tolerant() 先照正常 JSON 解析，失敗再取出第一個括號平衡的物件，
+# 最後才從截斷的文字裡救回已經完整的店家，不讓整次呼叫白費。
+
+_RESTAURANTS_KEY = re.compile(r'"restaurants"\s*:\s*\[')
+_FOOD_KEYWORDS = re.compile(r'"food_keywords"\s*:\s*("(?:[^"\\]|\\.)*")')
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+# strict=False：字串裡的換行等控制字元也接受
+_DECODER = json.JSONDecoder(strict=False)
+
+# parse_tolerant() 的解析方式
+STRICT = 'strict'        # 整段就是合法 JSON
+TOLERANT = 'tolerant'    # 去掉前後文字 / 結尾逗號後解析成功
+SALVAGED = 'salvaged'    # JSON 不完整，只救回已完整的店家
+
+
+class RestaurantStreamParser:
+    """逐段餵入模型輸出，回傳新解析完成的 restaurants[] 元素"""
+
+    def __init__(self):
+        self.buffer = ''
+        self._pos = None         # 目前掃描到的位置（找到陣列開頭後才有值）
+        self._depth = 0          # 陣列內的巢狀深度（0 = 在陣列第一層）
+        self._in_string = False
+        self._escaped = False
+        self._start = None       # 目前物件的起始位置
+        self._done = False       # 陣列已結束
+
+    def feed(self, chunk):
+        """
+        餵入一段文字
+
+        參數:
+            chunk: str - 新收到的模型輸出
+
+        回傳:
+            list[dict]: 這次新完成的店家物件
+        """
+        self.buffer += chunk
+        if self._done:
+            return []
+
+        if self._pos is None:
+            match = _RESTAURANTS_KEY.search(self.buffer)
+            if not match:
+                return []
+            self._pos = match.end()
+
+        completed = []
+        buffer = self.buffer
+        pos = self._pos
+        while pos < len(buffer):
+            char = buffer[pos]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                if self._depth == 0 and char == '{':
+                    self._start = pos
+                self._depth += 1
+            elif char in '}]':
+                if self._depth == 0:
+                    # restaurants 陣列結束
+                    self._done = True
+                    pos += 1
+                    break
+                self._depth -= 1
+                if self._depth == 0 and self._start is not None:
+                    try:
+                        item = json.loads(buffer[self._start:pos + 1])
+                    except ValueError:
+                        item = None
+                    if isinstance(item, dict):
+                        completed.append(item)
+                    self._start = None
+            pos += 1
+
+        self._pos = pos
+        return completed
+
+
+def extract_json_object(text):
+    """
+    取出第一個括號平衡的 JSON 物件（略過前後的說明文字與 markdown 標記，字串內的括號不算）
+
+    參數:
+        text: str - 模型輸出
+
+    回傳:
+        str 或 None: 物件的原始文字；找不到 { 或物件沒有結束（輸出被截斷）為 None
+    """
+    start = text.find('{')
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for pos in range(start, len(text)):
+        char = text[pos]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:pos + 1]
+    return None
+
+
+def _loads_object(text):
+    try:
+        value = _DECODER.decode(text)
+    except ValueError:
+        value = _DECODER.decode(_TRAILING_COMMA.sub(r'\1', text))
+    if not isinstance(value, dict):
+        raise ValueError('JSON 不是物件')
+    return value
+
+
+def _salvage(text):
+    restaurants = RestaurantStreamParser().feed(text)
+    if not restaurants:
+        return None
+    result = {'restaurants': restaurants}
+    match = _FOOD_KEYWORDS.search(text)
+    if match:
+        try:
+            result['food_keywords'] = _DECODER.decode(match.group(1))
+        except ValueError:
+            pass
+    return result
+
+
+def parse_tolerant(text):
+    """
+    容錯解析模型輸出的 JSON 物件
+
+    參數:
+        text: str - 模型輸出
+
+    回傳:
+        tuple(dict, str): (解析結果, 解析方式 STRICT / TOLERANT / SALVAGED)；
+        SALVAGED 的結果只有 restaurants（與找得到的 food_keywords）
+
+    例外:
+        ValueError: 找不到可用的 JSON，也救不回任何店家
+    """
+    # 快速路徑：JSON mode 的輸出本來就是純 JSON
+    try:
+        value = json.loads(text)
+    except ValueError:
+        pass
+    else:
+        if isinstance(value, dict):
+            return value, STRICT
+
+    # 前後有說明文字 / markdown 標記：從第一個 { 開始解析，忽略物件後面的內容（C 實作，最快）
+    start = text.find('{')
+    if start >= 0:
+        try:
+            value, _ = _DECODER.raw_decode(text, start)
+        except ValueError:
+            pass
+        else:
+            if isinstance(value, dict):
+                return value, TOLERANT
+
+    # 結尾逗號等小錯誤：取出括號平衡的物件再修正
+    candidate = extract_json_object(text)
+    if candidate is not None:
+        try:
+            return _loads_object(candidate), TOLERANT
+        except ValueError:
+            pass
+
+    salvaged = _salvage(text)
+    if salvaged is not None:
+        return salvaged, SALVAGED
+    raise ValueError(f'無法解析模型輸出（{len(text)} 字元）')
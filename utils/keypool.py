@@ -0,0 +1,315 @@
+import itertools
+import threading
+import time
+from utils.db import ThreadLocalSqlite
+from utils.log import get_logger
+from utils import metrics
+
+# Gemini API key 池
+#
+# 只用一把 key 時，整個服務的吞吐量就是那一個專案的 RPM / TPM 配額，尖峰時 Gemini 回 429，
+# 使用者只會看到「辨識不出來」。這裡可以設定多把 key（可以分屬不同專案），每次呼叫前挑一把：
+#   - 配額以（專案, 模型）計：每分鐘的請求數與 token 數存在 SQLite，兩個 gunicorn worker 共用；
+#     用量以「這一分鐘 + 上一分鐘按比例」估計滑動視窗，呼叫前先記一次請求與預估 token，
+#     回應的 usage_metadata 回來後再補成實際 token 數
+#   - 挑用量比例（請求或 token 較高的那個）最低、沒有在冷卻中的專案；同專案的 key 挑進行中最少的
+#   - 收到 429（ResourceExhausted）的（專案, 模型）冷卻 cooldown 秒，連續 429 時加倍（最多 max_cooldown）；
+#     冷卻中或配額用完的專案不再分配；全部都不能用時直接丟出 KeysExhausted（不送出注定 429 的請求，
+#     模型分層會改用下一層模型，它的配額是分開算的）
+# 各專案配額獨立，吞吐量大致隨專案數線性增加（同專案多把 key 只分散連線，不會增加配額）。
+
+REQUESTS = metrics.counter('maps_gemini_key_requests_total', '分配給各把 API key 的 Gemini 呼叫數', ['key'])
+THROTTLED = metrics.counter('maps_gemini_key_throttled_total', '各把 API key 收到 429 的次數', ['key', 'model'])
+EXHAUSTED = metrics.counter(
+    'maps_gemini_key_exhausted_total', '所有專案都在冷卻中或配額用完、沒有送出的呼叫數', ['model']
+)
+
+log = get_logger('keypool')
+
+DEFAULT_TOKEN_ESTIMATE = 1500  # 還沒有實際用量時，每次呼叫預估的 token 數
+
+
+class KeysExhausted(Exception):
+    """所有專案的這個模型都在冷卻中或配額用完（視同 429）"""
+
+    code = 429
+
+    def __init__(self, model_name, retry_after):
+        super().__init__(f'所有 API key 的 {model_name} 配額都用完或在冷卻中（約 {retry_after:.0f} 秒後恢復）')
+        self.model_name = model_name
+        self.retry_after = retry_after
+
+
+def is_throttled(error):
+    """是否為配額 / 速率限制的錯誤（google.api_core 的 ResourceExhausted / TooManyRequests，HTTP 429）"""
+    return getattr(error, 'code', None) == 429 or type(error).__name__ in ('ResourceExhausted', 'TooManyRequests')
+
+
+class ApiKey:
+    """一把 API key 與它所屬的專案"""
+
+    def __init__(self, key, project):
+        self.key = key
+        self.project = project
+        # log / 指標只用專案名稱 + key 的最後 4 碼
+        self.label = f'{project}…{key[-4:]}'
+
+    def __repr__(self):
+        return f'ApiKey({self.label})'
+
+
+class Lease:
+    """一次呼叫用的 key（release 時補上實際 token 數）"""
+
+    def __init__(self, api_key, model_name, minute, estimate):
+        self.key = api_key
+        self.model_name = model_name
+        self.minute = minute
+        self.estimate = estimate
+
+
+class KeyPool:
+    """依各專案的配額用量與 429 冷卻分配 API key"""
+
+    def __init__(self, keys, db_path, limits=None, cooldown=30.0, max_cooldown=300.0):
+        """
+        參數:
+            keys: list[tuple(str 或 None, str)] - (專案, key)；專案為 None 時這把 key 自成一個專案
+            db_path: str - 存放每分鐘用量與冷卻狀態的 SQLite 檔案
+            limits: dict - {模型名稱: (每分鐘請求數, 每分鐘 token 數)}，沒列出的模型不限制
+            cooldown: float - 收到 429 後冷卻幾秒
+            max_cooldown: float - 連續 429 時冷卻時間的上限（秒）
+        """
+        if not keys:
+            raise ValueError('❌ 至少需要一把 Gemini API key')
+        self.keys = [ApiKey(key, project or f'key{index + 1}') for index, (project, key) in enumerate(keys)]
+        self.projects = {}
+        for api_key in self.keys:
+            self.projects.setdefault(api_key.project, []).append(api_key)
+        self.limits = limits or {}
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+        self._in_flight = {api_key.label: 0 for api_key in self.keys}
+        self._counts = {api_key.label: {'requests': 0, 'throttled': 0, 'tokens': 0} for api_key in self.keys}
+        self._strikes = set()        # 曾經被冷卻過（strikes > 0）的 (專案, 模型)，成功時要歸零
+        self._token_average = {}     # 模型 → 每次呼叫的平均 token 數（預估用）
+        self._exhausted = 0
+        self._round_robin = itertools.count()
+        self._calls = 0
+        self._db = ThreadLocalSqlite(db_path, [
+            'CREATE TABLE IF NOT EXISTS key_usage ('
+            ' project TEXT NOT NULL,'
+            ' model TEXT NOT NULL,'
+            ' minute INTEGER NOT NULL,'
+            ' requests INTEGER NOT NULL,'
+            ' tokens INTEGER NOT NULL,'
+            ' PRIMARY KEY (project, model, minute))',
+            'CREATE TABLE IF NOT EXISTS key_cooldowns ('
+            ' project TEXT NOT NULL,'
+            ' model TEXT NOT NULL,'
+            ' until REAL NOT NULL,'
+            ' strikes INTEGER NOT NULL,'
+            ' PRIMARY KEY (project, model))',
+        ])
+
+    def _estimate(self, model_name):
+        with self._lock:
+            return int(self._token_average.get(model_name, DEFAULT_TOKEN_ESTIMATE))
+
+    def _loads(self, conn, model_name, now):
+        """
+        各專案目前的配額用量比例與冷卻狀態
+
+        回傳:
+            tuple(dict, dict): ({專案: 用量比例}, {專案: (冷卻到期時間, 連續 429 次數)})
+        """
+        minute = int(now // 60)
+        weight = 1 - (now % 60) / 60  # 上一分鐘還在滑動視窗裡的比例
+        used = {project: [0.0, 0.0] for project in self.projects}
+        for project, row_minute, requests, tokens in conn.execute(
+            'SELECT project, minute, requests, tokens FROM key_usage WHERE model = ? AND minute >= ?',
+            (model_name, minute - 1)
+        ):
+            if project in used:
+                factor = 1.0 if row_minute == minute else weight
+                used[project][0] += requests * factor
+                used[project][1] += tokens * factor
+
+        rpm, tpm = self.limits.get(model_name, (0, 0))
+        loads = {
+            project: max(requests / rpm if rpm else 0.0, tokens / tpm if tpm else 0.0)
+            for project, (requests, tokens) in used.items()
+        }
+        cooldowns = {
+            project: (until, strikes)
+            for project, until, strikes in conn.execute(
+                'SELECT project, until, strikes FROM key_cooldowns WHERE model = ?', (model_name,)
+            )
+            if project in self.projects
+        }
+        return loads, cooldowns
+
+    def _choose(self, model_name, loads, cooldowns, now):
+        # 呼叫端需持有 self._lock
+        def in_flight(project):
+            return sum(self._in_flight[api_key.label] for api_key in self.projects[project])
+
+        available = [
+            project for project in self.projects
+            if cooldowns.get(project, (0, 0))[0] <= now and loads[project] < 1
+        ]
+        if not available:
+            # 冷卻最早結束的時間；只是配額用完的，最晚在滑動視窗（一分鐘）過後恢復
+            retry_after = min(
+                max(cooldowns.get(name, (0, 0))[0] - now, 0) or (60 - now % 60) for name in self.projects
+            )
+            self._exhausted += 1
+            EXHAUSTED.inc(model=model_name)
+            log.sampled('key_pool_exhausted', model=model_name, retry_after=round(retry_after, 1))
+            raise KeysExhausted(model_name, retry_after)
+
+        project = self._pick(available, lambda name: (round(loads[name], 3), in_flight(name)))
+        return self._pick(self.projects[project], lambda api_key: self._in_flight[api_key.label])
+
+    def _pick(self, candidates, rank):
+        # 排名最前的裡面輪流挑（沒有配額限制的模型、或用量一樣時，不會全部分給第一個）
+        best = min(rank(candidate) for candidate in candidates)
+        candidates = [candidate for candidate in candidates if rank(candidate) == best]
+        return candidates[next(self._round_robin) % len(candidates)]
+
+    def acquire(self, model_name):
+        """
+        挑一把 key 給這次呼叫，並先記下一次請求與預估的 token 數
+
+        參數:
+            model_name: str - 這次呼叫的模型
+
+        回傳:
+            Lease: 呼叫結束後交給 release()
+
+        例外:
+            KeysExhausted: 所有專案都在冷卻中或配額用完
+        """
+        now = time.time()
+        estimate = self._estimate(model_name)
+        conn = self._db.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            loads, cooldowns = self._loads(conn, model_name, now)
+            with self._lock:
+                api_key = self._choose(model_name, loads, cooldowns, now)
+                self._in_flight[api_key.label] += 1
+                self._counts[api_key.label]['requests'] += 1
+                self._strikes.update((project, model_name) for project, (_, strikes) in cooldowns.items() if strikes)
+                self._calls += 1
+                purge = self._calls % 1000 == 0
+            minute = int(now // 60)
+            conn.execute(
+                'INSERT INTO key_usage (project, model, minute, requests, tokens) VALUES (?, ?, ?, 1, ?)'
+                ' ON CONFLICT (project, model, minute) DO UPDATE'
+                ' SET requests = requests + 1, tokens = tokens + excluded.tokens',
+                (api_key.project, model_name, minute, estimate)
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if purge:
+            self.purge()
+        REQUESTS.inc(key=api_key.label)
+        return Lease(api_key, model_name, minute, estimate)
+
+    def release(self, lease, tokens=None, error=None):
+        """
+        呼叫結束：補上實際 token 數；429 時讓這個（專案, 模型）冷卻
+
+        參數:
+            lease: Lease - acquire() 的結果
+            tokens: int - 這次呼叫實際用掉的 token 數（None 表示不知道，沿用預估值）
+            error: Exception - 呼叫失敗的例外（成功時為 None）
+        """
+        api_key, model_name = lease.key, lease.model_name
+        key = (api_key.project, model_name)
+        with self._lock:
+            self._in_flight[api_key.label] -= 1
+            if tokens is not None:
+                self._counts[api_key.label]['tokens'] += tokens
+                average = self._token_average.get(model_name)
+                self._token_average[model_name] = tokens if average is None else average * 0.9 + tokens * 0.1
+            reset = error is None and key in self._strikes
+            if reset:
+                self._strikes.discard(key)
+
+        if error is not None and is_throttled(error):
+            self._throttled(api_key, model_name, error)
+            return
+
+        conn = self._db.conn()
+        if tokens is not None and tokens != lease.estimate:
+            conn.execute(
+                'UPDATE key_usage SET tokens = MAX(tokens + ?, 0) WHERE project = ? AND model = ? AND minute = ?',
+                (tokens - lease.estimate, api_key.project, model_name, lease.minute)
+            )
+        if reset:
+            # 成功了：連續 429 次數歸零（冷卻時間下次從 cooldown 重新算起）
+            conn.execute(
+                'UPDATE key_cooldowns SET strikes = 0 WHERE project = ? AND model = ?', (api_key.project, model_name)
+            )
+
+    def _throttled(self, api_key, model_name, error):
+        now = time.time()
+        conn = self._db.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT until, strikes FROM key_cooldowns WHERE project = ? AND model = ?',
+                (api_key.project, model_name)
+            ).fetchone()
+            if row and row[0] > now:
+                # 冷卻開始前就送出、現在才回來的 429，不再加倍
+                until, strikes = row
+            else:
+                strikes = (row[1] if row else 0) + 1
+                until = now + min(self.max_cooldown, self.cooldown * 2 ** (strikes - 1))
+                conn.execute(
+                    'INSERT OR REPLACE INTO key_cooldowns (project, model, until, strikes) VALUES (?, ?, ?, ?)',
+                    (api_key.project, model_name, until, strikes)
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        with self._lock:
+            self._counts[api_key.label]['throttled'] += 1
+            self._strikes.add((api_key.project, model_name))
+        THROTTLED.inc(key=api_key.label, model=model_name)
+        log.warning(
+            'gemini_key_throttled', key=api_key.label, model=model_name, strikes=strikes,
+            cooldown_s=round(until - now, 1), error=str(error)[:200]
+        )
+
+    def purge(self):
+        """刪除已經滑出視窗的每分鐘用量，回傳刪除筆數"""
+        return self._db.execute('DELETE FROM key_usage WHERE minute < ?', (int(time.time() // 60) - 1,)).rowcount
+
+    def stats(self):
+        """各把 key 的呼叫 / 429 / token 數（以本行程為準）與各專案目前的配額用量（兩個 worker 合計）"""
+        now = time.time()
+        conn = self._db.conn()
+        usage = {}
+        for model_name in self.limits:
+            loads, cooldowns = self._loads(conn, model_name, now)
+            for project, load in loads.items():
+                entry = usage.setdefault(project, {})[model_name] = {'load': round(load, 3)}
+                until = cooldowns.get(project, (0, 0))[0]
+                if until > now:
+                    entry['cooldown_s'] = round(until - now, 1)
+        with self._lock:
+            return {
+                'keys': {
+                    label: dict(counts, in_flight=self._in_flight[label]) for label, counts in self._counts.items()
+                },
+                'projects': usage,
+                'exhausted': self._exhausted,
+            }
@@ -0,0 +1,170 @@
+import datetime
+import threading
+import time
+from utils.db import ThreadLocalSqlite
+from utils import metrics
+
+# 每位使用者每天的 Gemini 用量帳本
+#
+# 每次呼叫 Gemini 後依回應的 usage_metadata 記帳（token 數 + 估算花費），
+# 存在 SQLite，兩個 gunicorn worker 共用；admission 控制可以用它做每日額度。
+# 日期以台灣時間（UTC+8）切換。
+
+COST = metrics.counter('maps_gemini_cost_usd_total', '依 token 用量估算的 Gemini 花費（美元）', ['model'])
+
+
+def estimate_cost(prices, model_name, usage):
+    """
+    估算單次呼叫的花費
+
+    思考模型的 thinking token 不算在 candidates_token_count，但照輸出計費，
+    所以輸出以「total - prompt」與 output 取大者。
+
+    參數:
+        prices: dict - 模型名稱 → (輸入, 快取, 輸出) 每百萬 token 的美元價格
+        model_name: str - 模型名稱
+        usage: dict - {"prompt", "cached", "output", "total"}（utils.gemini.record_usage 的結果）
+
+    回傳:
+        tuple(int, float): (計費的輸出 token 數, 美元；沒有價格的模型為 0)
+    """
+    output = max(usage['output'], usage['total'] - usage['prompt'])
+    price = prices.get(model_name)
+    if not price:
+        return output, 0.0
+    input_price, cached_price, output_price = price
+    uncached = max(usage['prompt'] - usage['cached'], 0)
+    cost = (uncached * input_price + usage['cached'] * cached_price + output * output_price) / 1_000_000
+    return output, cost
+
+
+def _mask(user_id):
+    return user_id[:5] + '…' if len(user_id) > 5 else user_id
+
+
+class UsageLedger:
+    """(日期, 使用者, 模型) → 呼叫次數、token 數、估算花費"""
+
+    def __init__(self, db_path, prices=None, utc_offset_hours=8, retain_days=90):
+        """
+        參數:
+            db_path: str - SQLite 檔案路徑
+            prices: dict - 模型名稱 → (輸入, 快取, 輸出) 每百萬 token 的美元價格（config.GEMINI_PRICES）
+            utc_offset_hours: int - 切換日期用的時區
+            retain_days: int - 保留幾天的帳
+        """
+        self.prices = dict(prices or {})
+        self.timezone = datetime.timezone(datetime.timedelta(hours=utc_offset_hours))
+        self.retain_days = retain_days
+        self._lock = threading.Lock()
+        self._records = 0
+        self._db = ThreadLocalSqlite(db_path, [
+            'CREATE TABLE IF NOT EXISTS usage_ledger ('
+            ' day TEXT NOT NULL,'
+            ' user_id TEXT NOT NULL,'
+            ' model TEXT NOT NULL,'
+            ' calls INTEGER NOT NULL,'
+            ' prompt_tokens INTEGER NOT NULL,'
+            ' cached_tokens INTEGER NOT NULL,'
+            ' output_tokens INTEGER NOT NULL,'
+            ' total_tokens INTEGER NOT NULL,'
+            ' cost_usd REAL NOT NULL,'
+            ' PRIMARY KEY (day, user_id, model))'
+        ])
+
+    def today(self, now=None):
+        """目前的日期（YYYY-MM-DD）"""
+        return datetime.datetime.fromtimestamp(now or time.time(), self.timezone).date().isoformat()
+
+    def record(self, user_id, model_name, usage):
+        """
+        記一筆 Gemini 呼叫
+
+        參數:
+            user_id: str - 使用者 ID（None 記在 unknown）
+            model_name: str - 模型名稱
+            usage: dict - {"prompt", "cached", "output", "total"}
+
+        回傳:
+            float: 這次的估算花費（美元）
+        """
+        output, cost = estimate_cost(self.prices, model_name, usage)
+        total = max(usage['total'], usage['prompt'] + output)
+        COST.inc(cost, model=model_name)
+
+        self._db.execute(
+            'INSERT INTO usage_ledger (day, user_id, model, calls, prompt_tokens, cached_tokens, output_tokens,'
+            ' total_tokens, cost_usd) VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?)'
+            ' ON CONFLICT (day, user_id, model) DO UPDATE SET'
+            ' calls = calls + 1,'
+            ' prompt_tokens = prompt_tokens + excluded.prompt_tokens,'
+            ' cached_tokens = cached_tokens + excluded.cached_tokens,'
+            ' output_tokens = output_tokens + excluded.output_tokens,'
+            ' total_tokens = total_tokens + excluded.total_tokens,'
+            ' cost_usd = cost_usd + excluded.cost_usd',
+            (self.today(), user_id or 'unknown', model_name, usage['prompt'], usage['cached'], output, total, cost)
+        )
+
+        with self._lock:
+            self._records += 1
+            purge = self._records % 500 == 0
+        if purge:
+            self.purge()
+        return cost
+
+    def tokens_today(self, user_id):
+        """使用者今天累計的 token 數（所有模型）"""
+        row = self._db.execute(
+            'SELECT COALESCE(SUM(total_tokens), 0) FROM usage_ledger WHERE day = ? AND user_id = ?',
+            (self.today(), user_id or 'unknown')
+        ).fetchone()
+        return row[0]
+
+    def purge(self):
+        """刪除超過保留天數的帳，回傳刪除筆數"""
+        oldest = self.today(time.time() - self.retain_days * 86400)
+        return self._db.execute('DELETE FROM usage_ledger WHERE day < ?', (oldest,)).rowcount
+
+    def summary(self, day=None, top=5):
+        """
+        某一天的總用量與用量最多的使用者（使用者 ID 只顯示前幾碼）
+
+        參數:
+            day: str - YYYY-MM-DD，None 表示今天
+            top: int - 列出幾位使用者
+
+        回傳:
+            dict: {"day", "users", "calls", "tokens", "cost_usd", "models", "top_users"}
+        """
+        day = day or self.today()
+        conn = self._db.conn()
+        users, calls, tokens, cost = conn.execute(
+            'SELECT COUNT(DISTINCT user_id), COALESCE(SUM(calls), 0), COALESCE(SUM(total_tokens), 0),'
+            ' COALESCE(SUM(cost_usd), 0) FROM usage_ledger WHERE day = ?',
+            (day,)
+        ).fetchone()
+        models = {
+            model: {'calls': model_calls, 'tokens': model_tokens, 'cost_usd': round(model_cost, 4)}
+            for model, model_calls, model_tokens, model_cost in conn.execute(
+                'SELECT model, SUM(calls), SUM(total_tokens), SUM(cost_usd) FROM usage_ledger'
+                ' WHERE day = ? GROUP BY model ORDER BY model',
+                (day,)
+            )
+        }
+        top_users = [
+            {'user': _mask(user_id), 'calls': user_calls, 'tokens': user_tokens, 'cost_usd': round(user_cost, 4)}
+            for user_id, user_calls, user_tokens, user_cost in conn.execute(
+                'SELECT user_id, SUM(calls), SUM(total_tokens), SUM(cost_usd) FROM usage_ledger'
+                ' WHERE day = ? GROUP BY user_id ORDER BY SUM(cost_usd) DESC, SUM(total_tokens) DESC LIMIT ?',
+                (day, top)
+            )
+        ]
+        return {
+            'day': day,
+            'users': users,
+            'calls': calls,
+            'tokens': tokens,
+            'cost_usd': round(cost, 4),
+            'models': models,
+            'top_users': top_users,
+        }
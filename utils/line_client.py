@@ -0,0 +1,417 @@
+import asyncio
+import os
+import threading
+from urllib.parse import quote
+from utils.download import BoundedReader, CHUNK_SIZE
+
+# 共用的 LINE API client
+#
+# 每則訊息都 `with ApiClient(configuration)` 會建立新的 urllib3 PoolManager，
+# 連線用完就丟，api.line.me / api-data.line.me 每次都要重新 TLS 握手。
+# 這裡每個行程只建一次 client，訊息 API 與下載圖片的 blob API 各自一個連線池
+# （keep-alive 重複使用），gunicorn fork 出 worker 後會在 worker 裡重新建立。
+#
+# linebot.v3.messaging 會一次載入全部 model（約 1 秒），第一次建立 client 時才 import。
+# AsyncLineClients 是 ASGI 模式用的版本（AsyncMessagingApi / AsyncMessagingApiBlob，底層是 aiohttp）。
+
+# SDK 預設的 host（Configuration 沒指定 host 時，各 API 用自己的 host）
+MESSAGING_HOST = 'https://api.line.me'
+BLOB_HOST = 'https://api-data.line.me'
+
+_pooled_client_class = None
+
+
+def _pooled_api_client(configuration, timeout):
+    global _pooled_client_class
+    if _pooled_client_class is None:
+        from linebot.v3.messaging import ApiClient
+
+        class _PooledApiClient(ApiClient):
+            """呼叫端沒指定 _request_timeout 時套用預設的 (連線, 讀取) 逾時"""
+
+            def __init__(self, configuration, timeout):
+                super().__init__(configuration)
+                self.default_timeout = timeout
+
+            def request(self, method, url, query_params=None, headers=None, post_params=None, body=None,
+                        _preload_content=True, _request_timeout=None):
+                return super().request(
+                    method, url, query_params=query_params, headers=headers, post_params=post_params, body=body,
+                    _preload_content=_preload_content, _request_timeout=_request_timeout or self.default_timeout
+                )
+
+        _pooled_client_class = _PooledApiClient
+    return _pooled_client_class(configuration, timeout)
+
+
+_async_client_class = None
+
+
+def _async_api_client(configuration, timeout):
+    global _async_client_class
+    if _async_client_class is None:
+        from linebot.v3.messaging import AsyncApiClient
+
+        class _TimeoutAsyncApiClient(AsyncApiClient):
+            """呼叫端沒指定 _request_timeout 時套用預設的 aiohttp.ClientTimeout（SDK 預設是 5 分鐘）"""
+
+            def __init__(self, configuration, timeout):
+                super().__init__(configuration)
+                self.default_timeout = timeout
+
+            async def request(self, method, url, query_params=None, headers=None, post_params=None, body=None,
+                              _preload_content=True, _request_timeout=None):
+                return await super().request(
+                    method, url, query_params=query_params, headers=headers, post_params=post_params, body=body,
+                    _preload_content=_preload_content, _request_timeout=_request_timeout or self.default_timeout
+                )
+
+        _async_client_class = _TimeoutAsyncApiClient
+    return _async_client_class(configuration, timeout)
+
+
+def _content_path(message_id, preview):
+    path = f"/v2/bot/message/{quote(str(message_id), safe='')}/content"
+    return path + '/preview' if preview else path
+
+
+def _api_error(status, reason):
+    from linebot.v3.messaging.exceptions import ApiException
+    return ApiException(status=status, reason=reason)
+
+
+_PUSH_RESPONSE_TYPES = {
+    '200': 'PushMessageResponse',
+    '400': 'ErrorResponse',
+    '403': 'ErrorResponse',
+    '409': 'ErrorResponse',
+    '429': 'ErrorResponse',
+}
+
+_REPLY_RESPONSE_TYPES = {
+    '200': 'ReplyMessageResponse',
+    '400': 'ErrorResponse',
+    '429': 'ErrorResponse',
+}
+
+
+def _pool_counts(api_client):
+    # urllib3 每個 host 一個 connection pool：num_connections = 新開的連線，num_requests = 請求數
+    pools = api_client.rest_client.pool_manager.pools
+    opened = requests = 0
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            opened += pool.num_connections
+            requests += pool.num_requests
+    return opened, requests
+
+
+class LineClients:
+    """每個行程共用的 MessagingApi / MessagingApiBlob"""
+
+    def __init__(self, access_token, pool_size=8, connect_timeout=5.0, read_timeout=15.0, blob_read_timeout=30.0,
+                 host=None):
+        """
+        參數:
+            access_token: str - LINE Channel Access Token
+            pool_size: int - 每個連線池最多保留幾條 keep-alive 連線
+            connect_timeout: float - 連線逾時（秒）
+            read_timeout: float - 訊息 API 讀取逾時（秒）
+            blob_read_timeout: float - 下載圖片讀取逾時（秒）
+            host: str - 指定時訊息與下載圖片都送到這個 host（本地替身用），None 表示 LINE 正式的 host
+        """
+        self.access_token = access_token
+        self.host = host
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.blob_read_timeout = blob_read_timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._clients = {}
+
+    def _client(self, kind):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # 新行程（或 gunicorn fork 後的 worker）：不沿用父行程的 socket
+                    self._clients = {}
+                    self._pid = pid
+
+        client = self._clients.get(kind)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(kind)
+                if client is None:
+                    client = self._create(kind)
+                    self._clients[kind] = client
+        return client
+
+    def _create(self, kind):
+        from linebot.v3.messaging import Configuration
+
+        configuration = Configuration(access_token=self.access_token, host=self.host)
+        configuration.connection_pool_maxsize = self.pool_size
+        read_timeout = self.blob_read_timeout if kind == 'blob' else self.read_timeout
+        return _pooled_api_client(configuration, (self.connect_timeout, read_timeout))
+
+    def messaging(self):
+        """回覆 / 推播用的 MessagingApi"""
+        from linebot.v3.messaging import MessagingApi
+        return MessagingApi(self._client('messaging'))
+
+    def blob(self):
+        """下載圖片用的 MessagingApiBlob"""
+        from linebot.v3.messaging import MessagingApiBlob
+        return MessagingApiBlob(self._client('blob'))
+
+    def download(self, message_id, max_bytes=0, preview=False):
+        """
+        邊下載邊檢查的 get_message_content（utils/download.py）
+
+        SDK 的 get_message_content_with_http_info(_preload_content=False) 最後仍會把整個回應讀進記憶體，
+        這裡直接用同一個連線池串流讀取；中途放棄的連線直接關掉，不放回池裡。
+
+        參數:
+            message_id: str - 訊息 ID
+            max_bytes: int - 大小上限（0 表示不限制）
+            preview: bool - True 時下載 LINE 產生的預覽圖（較小）
+
+        回傳:
+            bytes: 圖片內容
+
+        例外:
+            DownloadRejected: 超過大小上限或不是支援的圖片格式
+            ApiException: LINE API 回應非 2xx
+        """
+        import urllib3
+
+        client = self._client('blob')
+        response = client.rest_client.pool_manager.request(
+            'GET', (self.host or BLOB_HOST) + _content_path(message_id, preview),
+            headers=dict(client.default_headers),
+            preload_content=False,
+            timeout=urllib3.Timeout(connect=self.connect_timeout, read=self.blob_read_timeout)
+        )
+        try:
+            if not 200 <= response.status <= 299:
+                raise _api_error(response.status, response.reason)
+            length = response.headers.get('Content-Length')
+            reader = BoundedReader(max_bytes, 'preview' if preview else 'content', int(length) if length else None)
+            for chunk in response.stream(CHUNK_SIZE):
+                reader.feed(chunk)
+            data = reader.finish()
+        except BaseException:
+            response.close()
+            raise
+        finally:
+            response.release_conn()
+        return data
+
+    def warm_up(self):
+        """
+        建立兩個連線池並各先開一條連線（DNS + TLS 握手），
+        第一則訊息就能直接重用；只送 HEAD /，不會呼叫任何 LINE API
+        """
+        import urllib3
+
+        timeout = urllib3.Timeout(connect=self.connect_timeout, read=self.read_timeout)
+        for kind in ('messaging', 'blob'):
+            client = self._client(kind)
+            host = client.configuration.host or (BLOB_HOST if kind == 'blob' else MESSAGING_HOST)
+            client.rest_client.pool_manager.request('HEAD', host + '/', timeout=timeout, retries=False)
+
+    def push(self, to, messages):
+        """
+        推播已經是 JSON 格式（dict）的訊息
+
+        直接把 dict 交給 SDK 序列化送出，不經過 PushMessageRequest 的 pydantic 模型，
+        給 utils/flex 產生的卡片用。
+
+        參數:
+            to: str - 使用者 / 群組 ID
+            messages: list[dict] - 訊息（LINE API 的 JSON 格式）
+
+        回傳:
+            PushMessageResponse
+        """
+        return self._client('messaging').call_api(
+            '/v2/bot/message/push', 'POST',
+            {}, [], {'Accept': 'application/json', 'Content-Type': 'application/json'},
+            body={'to': to, 'messages': messages},
+            response_types_map=_PUSH_RESPONSE_TYPES,
+            auth_settings=['Bearer'],
+            _host=self.host or MESSAGING_HOST,
+            _return_http_data_only=True
+        )
+
+    def reply(self, reply_token, messages):
+        """
+        用 reply token 回覆已經是 JSON 格式（dict）的訊息（同 push，不經過 pydantic 模型）
+
+        參數:
+            reply_token: str - webhook 事件的 reply token（只能用一次）
+            messages: list[dict] - 訊息（LINE API 的 JSON 格式，最多 5 則）
+
+        回傳:
+            ReplyMessageResponse
+        """
+        return self._client('messaging').call_api(
+            '/v2/bot/message/reply', 'POST',
+            {}, [], {'Accept': 'application/json', 'Content-Type': 'application/json'},
+            body={'replyToken': reply_token, 'messages': messages},
+            response_types_map=_REPLY_RESPONSE_TYPES,
+            auth_settings=['Bearer'],
+            _host=self.host or MESSAGING_HOST,
+            _return_http_data_only=True
+        )
+
+    def stats(self):
+        """各連線池新開 / 重複使用的連線數（以本行程為準）"""
+        result = {}
+        for kind in ('messaging', 'blob'):
+            client = self._clients.get(kind) if self._pid == os.getpid() else None
+            opened, requests = _pool_counts(client) if client else (0, 0)
+            result[kind] = {
+                'requests': requests,
+                'opened': opened,
+                'reused': max(requests - opened, 0),
+                'reuse_rate': round((requests - opened) / requests, 3) if requests else 0.0,
+            }
+        result['pool_size'] = self.pool_size
+        return result
+
+
+class AsyncLineClients:
+    """
+    ASGI 模式共用的 AsyncMessagingApi / AsyncMessagingApiBlob
+
+    aiohttp 的 ClientSession 綁定建立它的 event loop，第一次在 event loop 裡使用時才建立；
+    換了 event loop（例如測試裡多次 asyncio.run）會重新建立。
+    """
+
+    def __init__(self, access_token, pool_size=100, connect_timeout=5.0, read_timeout=15.0, blob_read_timeout=30.0,
+                 host=None):
+        """
+        參數:
+            access_token: str - LINE Channel Access Token
+            pool_size: int - 每個連線池同時最多幾條連線（aiohttp TCPConnector 的 limit）
+            connect_timeout / read_timeout / blob_read_timeout / host: 同 LineClients
+        """
+        self.access_token = access_token
+        self.host = host
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.blob_read_timeout = blob_read_timeout
+        self._loop = None
+        self._clients = {}
+        self._requests = {'messaging': 0, 'blob': 0}
+
+    def _client(self, kind):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._clients = {}
+            self._loop = loop
+
+        client = self._clients.get(kind)
+        if client is None:
+            import aiohttp
+            from linebot.v3.messaging import Configuration
+
+            configuration = Configuration(access_token=self.access_token, host=self.host)
+            configuration.connection_pool_maxsize = self.pool_size
+            read_timeout = self.blob_read_timeout if kind == 'blob' else self.read_timeout
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=read_timeout)
+            client = self._clients[kind] = _async_api_client(configuration, timeout)
+        self._requests[kind] += 1
+        return client
+
+    def messaging(self):
+        """回覆 / 推播用的 AsyncMessagingApi"""
+        from linebot.v3.messaging import AsyncMessagingApi
+        return AsyncMessagingApi(self._client('messaging'))
+
+    def blob(self):
+        """下載圖片用的 AsyncMessagingApiBlob"""
+        from linebot.v3.messaging import AsyncMessagingApiBlob
+        return AsyncMessagingApiBlob(self._client('blob'))
+
+    async def download(self, message_id, max_bytes=0, preview=False):
+        """
+        邊下載邊檢查的 get_message_content（同 LineClients.download）
+
+        參數 / 回傳 / 例外:
+            同 LineClients.download
+        """
+        client = self._client('blob')
+        async with client.rest_client.pool_manager.get(
+            (self.host or BLOB_HOST) + _content_path(message_id, preview),
+            headers=dict(client.default_headers),
+            timeout=client.default_timeout
+        ) as response:
+            try:
+                if not 200 <= response.status <= 299:
+                    raise _api_error(response.status, response.reason)
+                reader = BoundedReader(max_bytes, 'preview' if preview else 'content', response.content_length)
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    reader.feed(chunk)
+                return reader.finish()
+            except BaseException:
+                # 中途放棄：關掉連線，不把讀到一半的連線放回池裡
+                response.close()
+                raise
+
+    async def push(self, to, messages):
+        """
+        推播已經是 JSON 格式（dict）的訊息（同 LineClients.push）
+
+        參數:
+            to: str - 使用者 / 群組 ID
+            messages: list[dict] - 訊息（LINE API 的 JSON 格式）
+
+        回傳:
+            PushMessageResponse
+        """
+        return await self._client('messaging').call_api(
+            '/v2/bot/message/push', 'POST',
+            {}, [], {'Accept': 'application/json', 'Content-Type': 'application/json'},
+            body={'to': to, 'messages': messages},
+            response_types_map=_PUSH_RESPONSE_TYPES,
+            auth_settings=['Bearer'],
+            _host=self.host or MESSAGING_HOST,
+            _return_http_data_only=True
+        )
+
+    async def reply(self, reply_token, messages):
+        """
+        用 reply token 回覆已經是 JSON 格式（dict）的訊息（同 LineClients.reply）
+
+        參數:
+            reply_token: str - webhook 事件的 reply token（只能用一次）
+            messages: list[dict] - 訊息（LINE API 的 JSON 格式，最多 5 則）
+
+        回傳:
+            ReplyMessageResponse
+        """
+        return await self._client('messaging').call_api(
+            '/v2/bot/message/reply', 'POST',
+            {}, [], {'Accept': 'application/json', 'Content-Type': 'application/json'},
+            body={'replyToken': reply_token, 'messages': messages},
+            response_types_map=_REPLY_RESPONSE_TYPES,
+            auth_settings=['Bearer'],
+            _host=self.host or MESSAGING_HOST,
+            _return_http_data_only=True
+        )
+
+    async def close(self):
+        """關閉連線池（ASGI lifespan shutdown 時呼叫）"""
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.close()
+
+    def stats(self):
+        """各 API 的呼叫次數與連線池大小（以本行程為準）"""
+        return {**self._requests, 'pool_size': self.pool_size}
@@ -0,0 +1,111 @@
+import datetime
+import json
+import logging
+import random
+import sys
+import threading
+
+# 結構化 log
+#
+# 每筆 log 是一行 JSON：{"ts", "level", "logger", "event", "pid", ...欄位}，
+# 方便在平台的 log 介面搜尋與彙整。
+# 每則訊息都會出現的細節（收到 webhook、下載完成…）用 sampled() 依抽樣率輸出，
+# 每次辨識的摘要、警告與錯誤一律輸出。
+# 等級與抽樣率由 app.py 依 LOG_LEVEL / LOG_SAMPLE_RATE 呼叫 configure() 設定。
+
+_configure_lock = threading.Lock()
+_handler = None
+_sample_rate = 1.0
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'event': record.getMessage(),
+            'pid': record.process,
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _install_handler():
+    global _handler
+    with _configure_lock:
+        if _handler is None:
+            _handler = logging.StreamHandler(sys.stdout)
+            _handler.setFormatter(_JsonFormatter())
+            root = logging.getLogger('maps')
+            root.addHandler(_handler)
+            root.setLevel(logging.INFO)
+            root.propagate = False
+
+
+def configure(level='info', sample_rate=1.0):
+    """
+    設定 log 等級與抽樣率
+
+    參數:
+        level: str - debug / info / warning / error
+        sample_rate: float - sampled() 的輸出機率（0 ~ 1）
+    """
+    global _sample_rate
+    _install_handler()
+    logging.getLogger('maps').setLevel(level.upper())
+    _sample_rate = max(0.0, min(1.0, sample_rate))
+
+
+class StructuredLogger:
+    """輸出一行 JSON 的 logger：log.info('event_name', 欄位=值, ...)"""
+
+    def __init__(self, name):
+        """
+        參數:
+            name: str - logger 名稱（例如 app、gemini）
+        """
+        _install_handler()
+        self.name = name
+        self._logger = logging.getLogger(f'maps.{name}')
+
+    def _log(self, level, event, fields, exc_info=False):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, event, extra={'fields': fields}, exc_info=exc_info)
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        """error 等級，並附上目前例外的 traceback（在 except 區塊內呼叫）"""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+    def sampled(self, event, **fields):
+        """info 等級，依抽樣率輸出（高頻率的細節用）"""
+        if _sample_rate >= 1 or random.random() < _sample_rate:
+            self._log(logging.INFO, event, fields)
+
+
+def get_logger(name):
+    """
+    取得結構化 logger
+
+    參數:
+        name: str - logger 名稱
+
+    回傳:
+        StructuredLogger
+    """
+    return StructuredLogger(name)
+
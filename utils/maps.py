@@ -1,5 +1,6 @@
 from urllib.parse import quote
 import re
+from utils.gazetteer import get_gazetteer
 
 # 菜市場名清單（店名太普通時才需要加關鍵字）
 GENERIC_NAMES = [
@@ -8,15 +9,8 @@ GENERIC_NAMES = [
     '茶飲', '手搖', '烘焙坊', '甜點店', '蛋糕店'
 ]
 
-# 台灣常見行政區（用於提取）
-TAIWAN_AREAS = [
-    '中壢', '內壢', '平鎮', '桃園', '龜山', '八德', '蘆竹', '大園', '楊梅', '新屋', '觀音', '龍潭',
-    '台北', '信義', '大安', '中正', '松山', '萬華', '大同', '中山', '文山', '南港', '內湖', '士林', '北投',
-    '新北', '板橋', '新莊', '三重', '永和', '中和', '土城', '樹林', '鶯歌', '三峽', '淡水', '汐止',
-    '台中', '北區', '西區', '南區', '東區', '中區', '西屯', '南屯', '北屯', '豐原', '大里', '太平',
-    '台南', '東區', '南區', '北區', '中西區', '安平', '安南', '永康', '新營', '佳里',
-    '高雄', '前金', '新興', '苓雅', '鹽埕', '鼓山', '前鎮', '三民', '左營', '楠梓', '小港'
-]
+# 菜市場名比對（編譯成一個 regex，一次掃過店名）
+_GENERIC_PATTERN = re.compile('|'.join(map(re.escape, GENERIC_NAMES)))
 
 def extract_area(address):
     """
@@ -26,17 +20,12 @@ def extract_area(address):
         address: str - 地址字串
 
     回傳:
-        str - 提取到的行政區，若無則回傳空字串
+        str - 提取到的行政區（有車站或地標時回傳最具體的那一個），若無則回傳空字串
     """
     if not address or address == 'unknown':
         return ''
 
-    # 檢查是否包含行政區關鍵字
-    for area in TAIWAN_AREAS:
-        if area in address:
-            return area
-
-    return ''
+    return get_gazetteer().area(address)
 
 def is_generic_name(name):
     """
@@ -52,9 +41,8 @@ def is_generic_name(name):
         return False
 
     # 檢查是否包含菜市場關鍵字
-    for generic in GENERIC_NAMES:
-        if generic in name:
-            return True
+    if _GENERIC_PATTERN.search(name):
+        return True
 
     # 店名太短（少於 3 個字）也視為普通
     if len(name) < 3:
@@ -62,13 +50,14 @@ def is_generic_name(name):
 
     return False
 
-def generate_maps_url(name, address, keywords='', original_handle=''):
+def generate_maps_url(name, address, keywords='', original_handle='', known_shops=None):
     """
     生成 Google Maps 搜尋連結（Golden Query 優化）
 
     策略：
     - 優先組合：店名 + original_handle + 行政區
     - 只有店名很菜市場才加 keywords
+    - 已知店家（以前的貼文出現過）補上當時看到的帳號與行政區
     - 提高 Google Maps 直接彈出店家頁面的機率
 
     參數:
@@ -76,10 +65,20 @@ def generate_maps_url(name, address, keywords='', original_handle=''):
         address: str - 店家地址（可為 "unknown"）
         keywords: str - 食物類型關鍵字（可選，例如：麵包、咖啡）
         original_handle: str - 原始社群帳號（可選，例如：no5ca_fe）
+        known_shops: ShopIndex - 已知店家索引（可選，見 utils/shops.py）
 
     回傳:
         str: Google Maps 搜尋 URL
     """
+    # 同一家店在別的貼文看過帳號 / 行政區時，補上這次沒出現的部分
+    known_area = ''
+    if known_shops is not None:
+        shop = known_shops.lookup(name, original_handle)
+        if shop:
+            if not (original_handle and original_handle.strip()):
+                original_handle = shop['handle']
+            known_area = shop['area']
+
     # 組合查詢字串
     query_parts = [name]
 
@@ -88,7 +87,7 @@ def generate_maps_url(name, address, keywords='', original_handle=''):
         query_parts.append(original_handle)
 
     # 提取行政區（而非完整地址）- 大範圍定位，容錯率高
-    area = extract_area(address)
+    area = extract_area(address) or known_area
     if area:
         query_parts.append(area)
     elif address and address != 'unknown' and address.strip():
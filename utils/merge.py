@@ -0,0 +1,71 @@
+import re
+
+# 合併多份辨識結果（多張圖片 / 多個區塊），同一家店只留一筆
+
+_NON_WORD = re.compile(r'[\s\W_]+', re.UNICODE)
+
+
+def normalize_key(text):
+    """去掉空白、標點與大小寫差異，用來判斷是不是同一家店"""
+    if not text:
+        return ''
+    return _NON_WORD.sub('', text).casefold()
+
+
+def _has_address(restaurant):
+    address = (restaurant.get('address') or '').strip()
+    return bool(address) and address != 'unknown'
+
+
+def merge_results(results, max_restaurants=10):
+    """
+    合併辨識結果並去除重複店家（保留第一次出現的順序）
+
+    店名或原始帳號正規化後相同即視為同一家店；
+    後出現的資料可以補上先前缺少的地址與帳號。
+
+    參數:
+        results: list[dict] - 多份辨識結果
+        max_restaurants: int - 最多保留幾家
+
+    回傳:
+        dict: {"restaurants": [...], "count": int, "food_keywords": str}
+    """
+    merged = []
+    by_key = {}
+    keywords = []
+
+    for result in results:
+        if not result:
+            continue
+
+        for keyword in (result.get('food_keywords') or '').split():
+            if keyword not in keywords:
+                keywords.append(keyword)
+
+        for restaurant in result.get('restaurants', []):
+            name_key = normalize_key(restaurant.get('name'))
+            handle_key = normalize_key(restaurant.get('original_handle'))
+            if not name_key:
+                continue
+
+            existing = by_key.get(name_key) or (by_key.get(handle_key) if handle_key else None)
+            if existing is None:
+                existing = dict(restaurant)
+                merged.append(existing)
+            else:
+                if not _has_address(existing) and _has_address(restaurant):
+                    existing['address'] = restaurant['address']
+                if not existing.get('original_handle') and restaurant.get('original_handle'):
+                    existing['original_handle'] = restaurant['original_handle']
+
+            by_key[name_key] = existing
+            if handle_key:
+                by_key[handle_key] = existing
+
+    merged = merged[:max_restaurants]
+    return {
+        'restaurants': merged,
+        'count': len(merged),
+        'food_keywords': ' '.join(keywords[:3]),
+    }
@@ -0,0 +1,236 @@
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 輕量的指標收集（Counter / Gauge / Histogram），以 Prometheus 文字格式輸出在 /metrics
+#
+# 不依賴 prometheus_client；每個行程各自累計，輸出時每筆都帶 pid 標籤，
+# gunicorn 多個 worker 被輪流抓取時各自是獨立的時間序列，rate() 不會互相干擾。
+#
+# span('download') 量測一個階段的耗時並記到 maps_stage_seconds{stage="download"}；
+# 在 trace() 裡面執行時，耗時也會累加到這次請求的 timings，用來輸出單筆摘要 log。
+# timings 存在 ContextVar：執行緒各自一份，asyncio 的每個 task 也各自一份（ASGI 模式）。
+
+# 秒：涵蓋 LINE API（幾十毫秒）到 Gemini Pro（數十秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"❌ {self.name} 的標籤應為 {self.labelnames}，收到 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    """只會增加的計數"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def collect(self, pid_label):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self._header() + [
+            f'{self.name}{_format_labels(self.labelnames, key, pid_label)} {_format_value(value)}'
+            for key, value in values
+        ]
+
+
+class Gauge(_Metric):
+    """目前的值；可以用 set() 設定，或用 set_function() 在輸出時才計算"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """
+        參數:
+            function: callable() -> float - 沒有標籤的 gauge 在輸出時呼叫取值
+        """
+        self._function = function
+
+    def collect(self, pid_label):
+        with self._lock:
+            values = sorted(self._values.items())
+        if self._function is not None:
+            values = [((), self._function())]
+        return self._header() + [
+            f'{self.name}{_format_labels(self.labelnames, key, pid_label)} {_format_value(value)}'
+            for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    """分佈（累計的 bucket 計數 + 總和 + 次數）"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[2] if entry else 0
+
+    def collect(self, pid_label):
+        with self._lock:
+            values = sorted((key, (list(entry[0]), entry[1], entry[2])) for key, entry in self._values.items())
+        lines = self._header()
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = (('le', _format_value(float(bound))),)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le + pid_label)} {cumulative}')
+            labels = _format_labels(self.labelnames, key, pid_label)
+            lines.append(f'{self.name}_sum{labels} {_format_value(round(total, 6))}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    """所有指標；同名的指標只會建立一次"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"❌ 指標 {name} 已用不同的類型或標籤註冊過")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        """Prometheus 文字格式（text/plain; version=0.0.4）"""
+        pid_label = (('pid', os.getpid()),)
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for _, metric in metrics:
+            lines.extend(metric.collect(pid_label))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+render = REGISTRY.render
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGE_SECONDS = histogram(
+    'maps_stage_seconds', '每個處理階段的耗時（秒）', ['stage']
+)
+
+_timings = ContextVar('maps_timings', default=None)
+
+
+@contextmanager
+def trace():
+    """
+    收集這個執行緒（或 asyncio task）內各 span 的耗時（同一階段多次會累加）
+
+    用法:
+        with trace() as timings:
+            with span('download'):
+                ...
+        timings → {'download': 12.3}（毫秒）
+    """
+    timings = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+@contextmanager
+def span(stage):
+    """量測一個階段的耗時，記到 maps_stage_seconds 與目前的 trace()"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = _timings.get()
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0.0) + elapsed * 1000, 1)
@@ -0,0 +1,141 @@
+import threading
+import time
+from utils import metrics
+
+# 送 Gemini 前的本地預篩
+#
+# 使用者偶爾會傳自拍、迷因或純食物特寫，每一張都要跑完整的 Gemini 呼叫，
+# 最後才依 Prompt 的「無店名」規則回傳空結果。這裡在 CPU 上用縮小的灰階圖估計：
+#   - 文字量：邊緣（筆畫）像素的比例；對焦模糊的人像、食物特寫、純色圖幾乎沒有細邊緣
+#   - 截圖版面：大面積的單色底（App 介面的白 / 黑底），有這種版面的圖一律送辨識
+# 兩者都不成立才判定「不可能有店名」，直接回覆，不呼叫 Gemini。
+# 判斷寧可放行：有紋理的照片（招牌、街景）邊緣多，一定會送辨識。
+
+EDGE_LEVEL = 40              # FIND_EDGES 後超過這個亮度才算邊緣像素
+EDGE_REFERENCE = 0.05        # 邊緣比例達到這個值時文字分數為 1（截圖樣本約 0.07 ~ 0.15）
+BACKGROUND_BAND = 5          # 幾個相鄰灰階內算「同一個底色」
+
+DECISIONS = metrics.counter('maps_prefilter_decisions_total', '本地預篩結果（pass / reject）', ['decision'])
+SAVED_CALLS = metrics.counter('maps_prefilter_saved_calls_total', '整批圖片被預篩擋下、省下的 Gemini 呼叫數')
+PREFILTER_SECONDS = metrics.histogram('maps_prefilter_seconds', '本地預篩單張圖的耗時（秒）')
+
+# 邊緣像素 → 255，其他 → 0
+_EDGE_LUT = [255 if value > EDGE_LEVEL else 0 for value in range(256)]
+
+
+def analyze(image, max_edge=384):
+    """
+    估計圖片的文字量與是否為截圖版面
+
+    參數:
+        image: PIL.Image - 圖片（任何模式、任何大小）
+        max_edge: int - 分析前縮到的長邊（像素）
+
+    回傳:
+        dict: {"text_score": 0~1, "edge_density", "background_ratio", "size": (寬, 高)}
+    """
+    from PIL import ImageFilter
+
+    if image.mode not in ('L', 'RGB', 'RGBA'):
+        image = image.convert('RGB')
+
+    # reduce 是整數倍縮小，比 thumbnail 快很多；再轉灰階
+    factor = max(1, max(image.size) // max_edge)
+    small = (image.reduce(factor) if factor > 1 else image).convert('L')
+    pixels = small.size[0] * small.size[1]
+    if not pixels:
+        return {'text_score': 0.0, 'edge_density': 0.0, 'background_ratio': 0.0, 'size': small.size}
+
+    edges = small.filter(ImageFilter.FIND_EDGES).point(_EDGE_LUT)
+    edge_density = edges.histogram()[255] / pixels
+
+    histogram = small.histogram()
+    window = sum(histogram[:BACKGROUND_BAND])
+    background = window
+    for value in range(BACKGROUND_BAND, 256):
+        window += histogram[value] - histogram[value - BACKGROUND_BAND]
+        background = max(background, window)
+
+    return {
+        'text_score': round(min(1.0, edge_density / EDGE_REFERENCE), 3),
+        'edge_density': round(edge_density, 4),
+        'background_ratio': round(background / pixels, 3),
+        'size': small.size,
+    }
+
+
+class PreFilter:
+    """判斷圖片是否值得送給 Gemini 辨識"""
+
+    def __init__(self, threshold=0.5, screenshot_background=0.45, max_edge=384):
+        """
+        參數:
+            threshold: float - 文字分數低於這個值（且不是截圖版面）就不送辨識
+            screenshot_background: float - 單一底色佔畫面的比例達到這個值視為截圖版面
+            max_edge: int - 分析前縮到的長邊（像素）
+        """
+        self.threshold = threshold
+        self.screenshot_background = screenshot_background
+        self.max_edge = max_edge
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._rejected = 0
+        self._saved_calls = 0
+        self._elapsed = 0.0
+
+    def decide(self, image):
+        """
+        判斷單張圖片
+
+        參數:
+            image: PIL.Image - 圖片
+
+        回傳:
+            tuple(bool, dict): (是否送辨識, analyze() 的結果加上 screenshot)
+        """
+        start = time.perf_counter()
+        features = analyze(image, self.max_edge)
+        # 截圖版面也要有一點內容（整片純色的圖不算）
+        features['screenshot'] = (
+            features['background_ratio'] >= self.screenshot_background and features['text_score'] >= self.threshold / 2
+        )
+        accepted = features['screenshot'] or features['text_score'] >= self.threshold
+        elapsed = time.perf_counter() - start
+
+        PREFILTER_SECONDS.observe(elapsed)
+        DECISIONS.inc(decision='pass' if accepted else 'reject')
+        with self._lock:
+            self._checked += 1
+            self._rejected += not accepted
+            self._elapsed += elapsed
+        return accepted, features
+
+    def accept(self, images):
+        """
+        一批圖片（同一則貼文）是否值得送辨識：任一張通過就整批送出
+
+        參數:
+            images: list[PIL.Image] - 圖片
+
+        回傳:
+            tuple(bool, list[dict]): (是否送辨識, 每張圖的分析結果)
+        """
+        results = [self.decide(image) for image in images]
+        accepted = any(accepted for accepted, _ in results)
+        if not accepted:
+            SAVED_CALLS.inc()
+            with self._lock:
+                self._saved_calls += 1
+        return accepted, [features for _, features in results]
+
+    def stats(self):
+        """檢查 / 擋下的圖片數、省下的 Gemini 呼叫數與平均耗時（以本行程為準）"""
+        with self._lock:
+            return {
+                'threshold': self.threshold,
+                'checked': self._checked,
+                'rejected': self._rejected,
+                'reject_rate': round(self._rejected / self._checked, 3) if self._checked else 0.0,
+                'saved_calls': self._saved_calls,
+                'avg_ms': round(self._elapsed / self._checked * 1000, 2) if self._checked else 0.0,
+            }
@@ -0,0 +1,174 @@
+import io
+import time
+from PIL import Image, ImageOps, ImageStat
+from utils.log import get_logger
+
+# 圖片前處理：縮小送給 Gemini 的圖片
+#
+# 直接把 PIL Image 交給 SDK 時，SDK 會把整張原始解析度的圖轉成「無損 WebP」上傳，
+# 手機截圖動輒數 MB。這裡先轉正、縮圖、裁掉手機狀態列 / 導覽列、
+# 必要時轉灰階，再重新壓成 JPEG / WebP，以 bytes 形式送出。
+
+log = get_logger('preprocess')
+
+
+class PreparedImage:
+    """前處理完成、準備送給 Gemini 的圖片"""
+
+    def __init__(self, image, data, mime_type, stats):
+        self.image = image
+        self.data = data
+        self.mime_type = mime_type
+        self.stats = stats
+
+    def to_part(self):
+        """轉成 generate_content 接受的 inline blob"""
+        return {'mime_type': self.mime_type, 'data': self.data}
+
+
+def _uniform_ratio(band):
+    """灰階區塊中，接近中位數亮度的像素比例（狀態列 / 導覽列通常是單色底）"""
+    histogram = band.histogram()
+    total = sum(histogram)
+    if not total:
+        return 0.0
+
+    # 找中位數
+    median, seen = 0, 0
+    for value, count in enumerate(histogram):
+        seen += count
+        if seen * 2 >= total:
+            median = value
+            break
+
+    near = sum(histogram[max(0, median - 8):median + 9])
+    return near / total
+
+
+def crop_phone_chrome(image, top_ratio=0.045, bottom_ratio=0.06, min_aspect=1.8, threshold=0.85):
+    """
+    裁掉手機截圖上方狀態列與下方導覽列
+
+    只處理直式、長寬比像手機全螢幕的截圖；區塊必須大致是單色底才裁，
+    避免把內容誤裁掉。
+
+    參數:
+        image: PIL.Image - 圖片
+        top_ratio: float - 狀態列高度佔比
+        bottom_ratio: float - 導覽列高度佔比
+        min_aspect: float - 高 / 寬至少多少才視為手機截圖
+        threshold: float - 單色像素比例門檻
+
+    回傳:
+        PIL.Image: 裁切後的圖片（不符合條件時回傳原圖）
+    """
+    width, height = image.size
+    if height < width * min_aspect:
+        return image
+
+    gray = image.convert('L')
+    top = int(height * top_ratio)
+    bottom = int(height * bottom_ratio)
+
+    crop_top = top if top and _uniform_ratio(gray.crop((0, 0, width, top))) >= threshold else 0
+    crop_bottom = bottom if bottom and _uniform_ratio(gray.crop((0, height - bottom, width, height))) >= threshold else 0
+
+    if not crop_top and not crop_bottom:
+        return image
+    return image.crop((0, crop_top, width, height - crop_bottom))
+
+
+def is_colorless(image, max_saturation=24):
+    """
+    判斷圖片是否幾乎沒有顏色（例如純文字清單、深色 / 淺色模式的文字截圖）
+
+    參數:
+        image: PIL.Image - 圖片
+        max_saturation: int - 平均飽和度上限（0-255）
+
+    回傳:
+        bool
+    """
+    thumbnail = image.convert('RGB')
+    thumbnail.thumbnail((64, 64))
+    saturation = thumbnail.convert('HSV').getchannel('S')
+    return ImageStat.Stat(saturation).mean[0] <= max_saturation
+
+
+def preprocess_image(image, max_edge=1600, image_format='JPEG', quality=85,
+                     grayscale='auto', crop_chrome=True, original_bytes=None):
+    """
+    前處理圖片
+
+    參數:
+        image: PIL.Image - 原始圖片
+        max_edge: int - 長邊上限（像素）
+        image_format: str - 'JPEG' 或 'WEBP'
+        quality: int - 壓縮品質
+        grayscale: str - 'auto'（沒有顏色才轉灰階）、'always'、'never'
+        crop_chrome: bool - 是否裁掉手機狀態列 / 導覽列
+        original_bytes: int - 原始檔案大小（僅用於 log）
+
+    回傳:
+        PreparedImage
+    """
+    start = time.perf_counter()
+    original_size = image.size
+
+    # 1. 依 EXIF 轉正
+    image = ImageOps.exif_transpose(image)
+
+    # 2. 統一色彩模式（RGBA / P / CMYK 都轉成 RGB，透明底補白）
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        image = background
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    # 3. 裁掉手機狀態列 / 導覽列
+    if crop_chrome:
+        image = crop_phone_chrome(image)
+
+    # 4. 縮圖（長邊不超過 max_edge）
+    if max_edge and max(image.size) > max_edge:
+        scale = max_edge / max(image.size)
+        new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(new_size, Image.LANCZOS)
+
+    # 5. 沒有顏色資訊的圖轉灰階
+    if grayscale == 'always' or (grayscale == 'auto' and image.mode != 'L' and is_colorless(image)):
+        image = image.convert('L')
+
+    # 6. 重新壓縮
+    image_format = image_format.upper()
+    buffer = io.BytesIO()
+    if image_format == 'WEBP':
+        image.save(buffer, format='WEBP', quality=quality, method=4)
+        mime_type = 'image/webp'
+    else:
+        image.save(buffer, format='JPEG', quality=quality, optimize=True)
+        mime_type = 'image/jpeg'
+    data = buffer.getvalue()
+
+    stats = {
+        'original_pixels': original_size[0] * original_size[1],
+        'pixels': image.width * image.height,
+        'original_bytes': original_bytes,
+        'bytes': len(data),
+        'size': image.size,
+        'mode': image.mode,
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 1),
+    }
+
+    log.sampled(
+        'image_preprocessed',
+        original_size=f'{original_size[0]}x{original_size[1]}',
+        size=f'{image.width}x{image.height}',
+        original_bytes=original_bytes,
+        bytes=len(data),
+        elapsed_ms=stats['elapsed_ms'],
+    )
+
+    return PreparedImage(image, data, mime_type, stats)
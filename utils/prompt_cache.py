@@ -0,0 +1,152 @@
+import threading
+import time
+from utils.db import ThreadLocalSqlite
+from utils.genai_client import get_genai, get_cached_content, create_cached_content
+from utils.log import get_logger
+from utils.singleflight import SingleFlight
+
+# Prompt 的 Gemini context caching
+#
+# 固定的系統指示只上傳一次建立 CachedContent，之後每次呼叫用 cache 名稱引用，
+# 只送圖片 + 短指示。建立失敗（例如 Prompt 低於模型的最小快取 token 數、
+# 或該模型不支援）時，退回把系統指示直接放在 system_instruction 送出。
+#
+# cache 名稱存在 SQLite，兩個 gunicorn worker 共用同一份 CachedContent。
+# CachedContent 屬於建立它的專案：key 池裡每個專案各建一份，GenerativeModel 則每把 key 各一個
+# （模型綁著那把 key 的 client，見 utils/genai_client.py）。
+
+log = get_logger('prompt_cache')
+
+
+class PromptCache:
+    """依 (模型, Prompt 版本) 管理 CachedContent，並產生對應的 GenerativeModel"""
+
+    def __init__(self, db_path, ttl=3600, refresh_margin=300, retry_after=600, timeout=10, enabled=True):
+        """
+        參數:
+            db_path: str - 存放 cache 名稱的 SQLite 檔案
+            ttl: int - CachedContent 存活秒數
+            refresh_margin: int - 剩不到這麼多秒就重新建立
+            retry_after: int - 建立失敗後，多久內不再嘗試（直接用 inline）
+            timeout: float - 查詢 / 建立 CachedContent 的請求期限（秒）
+            enabled: bool - False 時一律 inline
+        """
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self.timeout = timeout
+        self.enabled = enabled
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._models = {}         # (key 標籤, model_name, version) -> (expires_at, GenerativeModel, 是否用 cache)
+        self._unavailable = {}    # (專案, model_name, version) -> 下次可重試的時間
+        self._created = 0
+        self._reused = 0
+        self._failures = 0
+        self._db = ThreadLocalSqlite(db_path, [
+            'CREATE TABLE IF NOT EXISTS prompt_caches ('
+            ' project TEXT NOT NULL,'
+            ' model TEXT NOT NULL,'
+            ' version TEXT NOT NULL,'
+            ' name TEXT NOT NULL,'
+            ' expires_at REAL NOT NULL,'
+            ' PRIMARY KEY (project, model, version))'
+        ])
+
+    def model_for(self, model_name, prompt, api_key):
+        """
+        取得套用此 Prompt、用這把 key 呼叫的 GenerativeModel
+
+        參數:
+            model_name: str - 模型名稱（例如 gemini-2.5-flash）
+            prompt: Prompt - utils.prompts.get_prompt() 的結果
+            api_key: ApiKey - key 池分配的 key（utils.keypool）
+
+        回傳:
+            tuple(GenerativeModel, bool): (模型, 是否使用 context cache)
+        """
+        key = (api_key.label, model_name, prompt.version)
+        scope = (api_key.project, model_name, prompt.version)
+        now = time.time()
+
+        # 鎖只保護 _models / _unavailable；查詢 / 建立 CachedContent 要呼叫 API，在鎖外進行，
+        # 同一個 (專案, 模型, 版本) 同時只有一個執行緒去查詢 / 建立，其他的等它的結果
+        with self._lock:
+            entry = self._models.get(key)
+            if entry and entry[0] - self.refresh_margin > now:
+                return entry[1], entry[2]
+            use_cache = self.enabled and self._unavailable.get(scope, 0) <= now
+
+        if not use_cache:
+            return self._inline_model(key, model_name, prompt, now), False
+
+        try:
+            (cached, expires_at), _ = self._flight.do(scope, lambda: self._cached_content(api_key, model_name, prompt))
+        except Exception as e:
+            with self._lock:
+                self._failures += 1
+                self._unavailable[scope] = now + self.retry_after
+            log.warning(
+                'prompt_cache_unavailable', key=api_key.label, model=model_name, version=prompt.version,
+                error=str(e)
+            )
+            return self._inline_model(key, model_name, prompt, now), False
+
+        model = get_genai().GenerativeModel.from_cached_content(cached)
+        with self._lock:
+            self._models[key] = (expires_at, model, True)
+        return model, True
+
+    def _inline_model(self, key, model_name, prompt, now):
+        # inline 模型在 retry_after 後才重新嘗試建立 cache
+        model = get_genai().GenerativeModel(model_name, system_instruction=prompt.system_instruction)
+        with self._lock:
+            self._models[key] = (now + self.retry_after + self.refresh_margin, model, False)
+        return model
+
+    def _cached_content(self, api_key, model_name, prompt):
+        """查詢（同專案已建立過）或建立這個專案的 CachedContent，回傳 (CachedContent, 到期時間)"""
+        now = time.time()
+        conn = self._db.conn()
+        row = conn.execute(
+            'SELECT name, expires_at FROM prompt_caches WHERE project = ? AND model = ? AND version = ?',
+            (api_key.project, model_name, prompt.version)
+        ).fetchone()
+
+        # 同專案的另一把 key / 另一個 worker 已經建立過，而且還沒快過期 → 直接引用
+        if row and row[1] - self.refresh_margin > now:
+            cached = get_cached_content(api_key.key, row[0], timeout=self.timeout)
+            with self._lock:
+                self._reused += 1
+            return cached, row[1]
+
+        cached = create_cached_content(
+            api_key.key, model_name, f'maps-prompt-{prompt.version}', prompt.system_instruction,
+            ttl=self.ttl, timeout=self.timeout
+        )
+        expires_at = now + self.ttl
+        conn.execute(
+            'INSERT OR REPLACE INTO prompt_caches (project, model, version, name, expires_at) VALUES (?, ?, ?, ?, ?)',
+            (api_key.project, model_name, prompt.version, cached.name, expires_at)
+        )
+        with self._lock:
+            self._created += 1
+        log.info(
+            'prompt_cache_created', name=cached.name, project=api_key.project, model=model_name,
+            version=prompt.version
+        )
+        return cached, expires_at
+
+    def stats(self):
+        """cache 建立 / 重用 / 失敗次數（以本行程為準）"""
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'created': self._created,
+                'reused': self._reused,
+                'failures': self._failures,
+                'models': {
+                    f'{label}/{model}/{version}': 'cached' if entry[2] else 'inline'
+                    for (label, model, version), entry in self._models.items()
+                },
+            }
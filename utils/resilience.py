@@ -0,0 +1,424 @@
+import asyncio
+import collections
+import contextvars
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.log import get_logger
+from utils import metrics
+
+# Gemini 呼叫的重試、對沖（hedging）與斷路器
+#
+# 以前任何一次逾時、503、429 都直接變成「辨識不出來」，卡住的呼叫還會佔住 sync worker
+# 直到 gunicorn 的 120 秒逾時。每一層模型的呼叫改成：
+#   - 每次嘗試都有期限（attempt_timeout，傳給 SDK 的 request_options），整層有總預算（budget）
+#   - 只重試暫時性的錯誤（429、5xx、逾時、連線錯誤），間隔是加上 full jitter 的指數退避；
+#     429 由 key 池（utils/keypool.py）把那個專案冷卻，重試會換到別的專案；
+#     key 池全部用完（KeysExhausted）時，恢復時間比最長退避還久就不等了
+#   - 對沖（可選）：一次嘗試超過這個模型最近延遲的 p95 還沒回來，就再送一個相同的請求，
+#     先成功的那個勝出（sync 模式另一個跑完後丟掉，async 模式直接取消）
+#   - 斷路器（每個模型一個）：連續 failure_threshold 次 5xx / 逾時 / 連線錯誤就打開，
+#     reset_timeout 秒內直接丟出 CircuitOpen（不送出，模型分層會改用下一層），
+#     之後放一個試探的請求，成功才關閉；429 與 4xx 不算上游故障
+# 狀態都在記憶體裡（每個 worker 各自判斷）。
+
+RETRIES = metrics.counter('maps_gemini_retries_total', 'Gemini 呼叫重試次數（依原因）', ['model', 'reason'])
+HEDGES = metrics.counter('maps_gemini_hedges_total', 'Gemini 對沖請求（launched 送出 / won 比原本的先成功）', ['model', 'outcome'])
+CIRCUIT_TRIPS = metrics.counter('maps_gemini_circuit_trips_total', '斷路器打開的次數', ['model'])
+CIRCUIT_REJECTED = metrics.counter('maps_gemini_circuit_rejected_total', '斷路器打開時直接拒絕、沒有送出的呼叫數', ['model'])
+CIRCUIT_STATE = metrics.gauge('maps_gemini_circuit_state', '斷路器狀態（0 = closed、1 = half_open、2 = open）', ['model'])
+
+log = get_logger('resilience')
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# 錯誤分類
+THROTTLED = 'throttled'      # 429（配額 / 速率限制）
+TIMEOUT = 'timeout'          # 逾時（本地期限或 504 DeadlineExceeded）
+UNAVAILABLE = 'unavailable'  # 5xx、連線錯誤
+
+_TIMEOUT_NAMES = {'DeadlineExceeded', 'GatewayTimeout', 'Timeout', 'ReadTimeout', 'ConnectTimeout'}
+_UNAVAILABLE_NAMES = {
+    'ServiceUnavailable', 'InternalServerError', 'BadGateway', 'ConnectionError', 'ChunkedEncodingError', 'AioRpcError'
+}
+
+
+def classify(error):
+    """
+    判斷錯誤是不是暫時性的
+
+    google.api_core 的例外帶 HTTP 狀態碼（code）；rest 傳輸的網路錯誤是 requests 的例外，
+    只能用類別名稱判斷（不 import requests / google.api_core）。
+
+    回傳:
+        str 或 None: throttled / timeout / unavailable；None 表示重試也沒用（4xx、解析錯誤…）
+    """
+    code = getattr(error, 'code', None)
+    name = type(error).__name__
+    if code == 429 or name in ('ResourceExhausted', 'TooManyRequests'):
+        return THROTTLED
+    if isinstance(error, TimeoutError) or code == 504 or name in _TIMEOUT_NAMES:
+        return TIMEOUT
+    if isinstance(error, ConnectionError) or code in (500, 502, 503) or name in _UNAVAILABLE_NAMES:
+        return UNAVAILABLE
+    return None
+
+
+class CircuitOpen(Exception):
+    """斷路器打開中，這個模型的呼叫直接拒絕（視同 503）"""
+
+    code = 503
+
+    def __init__(self, model_name, retry_after):
+        super().__init__(f'{model_name} 連續失敗，暫停呼叫（約 {retry_after:.0f} 秒後再試）')
+        self.model_name = model_name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """單一模型的斷路器（closed → open → half_open → closed）"""
+
+    def __init__(self, model_name, failure_threshold, reset_timeout):
+        self.model_name = model_name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0      # 連續失敗次數
+        self.trips = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probing = False  # half_open 時已經放出去的試探請求
+        CIRCUIT_STATE.set(0, model=model_name)
+
+    def allow(self):
+        """
+        呼叫前檢查
+
+        例外:
+            CircuitOpen: 斷路器打開中（或 half_open 時已經有試探請求在跑）
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.reset_timeout:
+                self._set(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+            retry_after = max(self._opened_at + self.reset_timeout - now, 0)
+        CIRCUIT_REJECTED.inc(model=self.model_name)
+        raise CircuitOpen(self.model_name, retry_after)
+
+    def record(self, error=None):
+        """
+        回報一次呼叫的結果
+
+        參數:
+            error: Exception - None 表示成功；只有 timeout / unavailable 算上游故障，其他錯誤不影響狀態
+        """
+        failed = error is not None and classify(error) in (TIMEOUT, UNAVAILABLE)
+        with self._lock:
+            probing, self._probing = self._probing, False
+            if error is None:
+                self.failures = 0
+                if self.state != CLOSED:
+                    self._set(CLOSED)
+                    log.info('circuit_closed', model=self.model_name)
+                return
+            if not failed:
+                return
+            self.failures += 1
+            if self.state == CLOSED and self.failures < self.failure_threshold:
+                return
+            if self.state == OPEN and not probing:
+                return
+            # 連續失敗到門檻，或試探請求失敗：（重新）打開
+            self._opened_at = time.monotonic()
+            if self.state != OPEN:
+                self.trips += 1
+                self._set(OPEN)
+            trips = self.trips
+        CIRCUIT_TRIPS.inc(model=self.model_name)
+        log.warning('circuit_opened', model=self.model_name, failures=self.failures, trips=trips,
+                    error=type(error).__name__)
+
+    def _set(self, state):
+        self.state = state
+        CIRCUIT_STATE.set(_STATE_VALUES[state], model=self.model_name)
+
+
+class Resilience:
+    """
+    包住單一模型的呼叫：每次嘗試的期限、暫時性錯誤的重試、對沖與斷路器
+
+    call() / call_async() 的 fn 接受這次嘗試的逾時秒數，例如
+        resilience.call('gemini-2.5-flash', lambda timeout: generate('gemini-2.5-flash', parts, timeout=timeout))
+    """
+
+    def __init__(self, attempts=3, attempt_timeout=25.0, budget=45.0, backoff=0.5, max_backoff=8.0,
+                 hedge=False, hedge_quantile=0.95, hedge_min_delay=2.0, failure_threshold=5, reset_timeout=30.0):
+        """
+        參數:
+            attempts: int - 每層模型最多嘗試幾次（含第一次）
+            attempt_timeout: float - 每次嘗試的期限（秒）
+            budget: float - 整層（含重試與退避）的總期限（秒）
+            backoff / max_backoff: float - 指數退避的起始值與上限（秒，實際等待為 0 ~ 該值的隨機數）
+            hedge: bool - 是否啟用對沖請求
+            hedge_quantile: float - 等到最近延遲的這個分位數還沒回來才對沖
+            hedge_min_delay: float - 對沖前至少等幾秒（延遲樣本不夠時不對沖）
+            failure_threshold: int - 連續幾次上游故障打開斷路器
+            reset_timeout: float - 斷路器打開後幾秒放出試探請求
+        """
+        self.attempts = max(1, attempts)
+        self.attempt_timeout = attempt_timeout
+        self.budget = budget
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._breakers = {}
+        self._latencies = {}  # 模型 → 最近成功嘗試的延遲（秒）
+        self._counts = {}
+        self._executor = None
+        self._executor_pid = None
+
+    def breaker(self, model_name):
+        with self._lock:
+            breaker = self._breakers.get(model_name)
+            if breaker is None:
+                breaker = self._breakers[model_name] = CircuitBreaker(
+                    model_name, self.failure_threshold, self.reset_timeout
+                )
+            return breaker
+
+    def call(self, model_name, fn, hedge=True, can_retry=None, budget=None):
+        """
+        呼叫 fn，暫時性的錯誤在期限內重試
+
+        參數:
+            model_name: str - 模型名稱（斷路器與延遲統計各自分開）
+            fn: callable(timeout) - 實際的呼叫，timeout 是這次嘗試的期限（秒）
+            hedge: bool - 這個呼叫可以對沖（串流呼叫不行：已經送出的店家不能重來）
+            can_retry: callable() -> bool - 可選；回傳 False 時不再重試（例如串流已經送出第一家店）
+            budget: float - 整層的總期限（None 表示用建構時的 budget）
+
+        回傳:
+            fn 的回傳值
+
+        例外:
+            CircuitOpen: 斷路器打開中
+            其他: 不能重試、次數或期限用完時，最後一次的例外
+        """
+        breaker = self.breaker(model_name)
+        deadline = time.monotonic() + (budget or self.budget)
+        for attempt in range(self.attempts):
+            breaker.allow()
+            timeout = max(min(self.attempt_timeout, deadline - time.monotonic()), 0.1)
+            start = time.perf_counter()
+            try:
+                if hedge and self.hedge:
+                    result = self._hedged(model_name, fn, timeout)
+                else:
+                    result = fn(timeout)
+            except Exception as e:
+                breaker.record(e)
+                delay = self._retry_delay(breaker, e, attempt, deadline, can_retry)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            breaker.record()
+            self._observe(model_name, time.perf_counter() - start)
+            return result
+
+    async def call_async(self, model_name, fn, hedge=True, budget=None):
+        """
+        call() 的 asyncio 版本（ASGI 模式用）
+
+        參數:
+            fn: callable(timeout) -> awaitable - 實際的呼叫
+            其他同 call()
+
+        回傳 / 例外:
+            同 call()；取消（asyncio.CancelledError）直接往外傳，不算失敗
+        """
+        breaker = self.breaker(model_name)
+        deadline = time.monotonic() + (budget or self.budget)
+        for attempt in range(self.attempts):
+            breaker.allow()
+            timeout = max(min(self.attempt_timeout, deadline - time.monotonic()), 0.1)
+            start = time.perf_counter()
+            try:
+                if hedge and self.hedge:
+                    result = await self._hedged_async(model_name, fn, timeout)
+                else:
+                    result = await fn(timeout)
+            except Exception as e:
+                breaker.record(e)
+                delay = self._retry_delay(breaker, e, attempt, deadline, None)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except asyncio.CancelledError:
+                # 取消不是上游故障，但 half_open 的試探名額要還回去
+                breaker.record(asyncio.CancelledError())
+                raise
+            breaker.record()
+            self._observe(model_name, time.perf_counter() - start)
+            return result
+
+    def _retry_delay(self, breaker, error, attempt, deadline, can_retry):
+        """
+        決定要不要重試
+
+        回傳:
+            float 或 None: 重試前等幾秒；None 表示不重試（斷路器剛打開時也不重試）
+        """
+        model_name = breaker.model_name
+        reason = classify(error)
+        if reason is None or attempt + 1 >= self.attempts or breaker.state == OPEN:
+            return None
+        if can_retry is not None and not can_retry():
+            return None
+        # full jitter：0 ~ min(max_backoff, backoff × 2^attempt)
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            # key 池全部用完：恢復時間太久就不等了（模型分層會改用下一層）
+            if retry_after > self.max_backoff:
+                return None
+            delay = max(delay, retry_after)
+        # 等完之後至少還要留一點時間給下一次嘗試
+        if time.monotonic() + delay + 0.5 > deadline:
+            return None
+        RETRIES.inc(model=model_name, reason=reason)
+        self._count(model_name, 'retries')
+        if reason == TIMEOUT:
+            self._count(model_name, 'timeouts')
+        log.info('gemini_retry', model=model_name, attempt=attempt + 1, reason=reason,
+                 error=type(error).__name__, delay_ms=round(delay * 1000))
+        return delay
+
+    def hedge_delay(self, model_name):
+        """
+        對沖前要等多久：這個模型最近成功嘗試延遲的 hedge_quantile 分位數（至少 hedge_min_delay）
+
+        回傳:
+            float 或 None: 秒數；延遲樣本少於 20 個時不對沖（None）
+        """
+        with self._lock:
+            samples = sorted(self._latencies.get(model_name, ()))
+        if len(samples) < 20:
+            return None
+        return max(samples[min(int(len(samples) * self.hedge_quantile), len(samples) - 1)], self.hedge_min_delay)
+
+    def _hedged(self, model_name, fn, timeout):
+        delay = self.hedge_delay(model_name)
+        if delay is None or delay >= timeout or self.breaker(model_name).state != CLOSED:
+            return fn(timeout)
+        executor = self._hedge_executor()
+        end = time.monotonic() + timeout
+        # 帶著目前的 trace()，gemini 階段的耗時也記到這批圖片的 stages
+        futures = [executor.submit(contextvars.copy_context().run, fn, timeout)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            HEDGES.inc(model=model_name, outcome='launched')
+            self._count(model_name, 'hedges')
+            futures.append(executor.submit(contextvars.copy_context().run, fn, max(end - time.monotonic(), 0.1)))
+        pending, error = set(futures), None
+        while pending:
+            done, pending = wait(pending, timeout=max(end - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                # SDK 沒有照 request_options 的期限結束：放棄等待（呼叫在執行緒裡跑完後丟掉）
+                raise TimeoutError(f'{model_name} 超過 {timeout:.1f} 秒沒有回應')
+            for future in done:
+                if future.exception() is None:
+                    self._hedge_won(model_name, futures, future)
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _hedged_async(self, model_name, fn, timeout):
+        delay = self.hedge_delay(model_name)
+        if delay is None or delay >= timeout or self.breaker(model_name).state != CLOSED:
+            return await fn(timeout)
+        start = time.monotonic()
+        tasks = [asyncio.ensure_future(fn(timeout))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                HEDGES.inc(model=model_name, outcome='launched')
+                self._count(model_name, 'hedges')
+                tasks.append(asyncio.ensure_future(fn(max(timeout - (time.monotonic() - start), 0.1))))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._hedge_won(model_name, tasks, task)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # 輸的那個直接取消（grpc_asyncio 會連同 RPC 一起取消）
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _hedge_won(self, model_name, attempts, winner):
+        if len(attempts) > 1 and winner is attempts[1]:
+            HEDGES.inc(model=model_name, outcome='won')
+            self._count(model_name, 'hedges_won')
+
+    def _hedge_executor(self):
+        pid = os.getpid()
+        if self._executor_pid != pid:
+            with self._lock:
+                if self._executor_pid != pid:
+                    # gunicorn fork 後的 worker 不沿用父行程的執行緒
+                    self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='hedge')
+                    self._executor_pid = pid
+        return self._executor
+
+    def _observe(self, model_name, elapsed):
+        with self._lock:
+            samples = self._latencies.get(model_name)
+            if samples is None:
+                samples = self._latencies[model_name] = collections.deque(maxlen=200)
+            samples.append(elapsed)
+
+    def _count(self, model_name, key):
+        with self._lock:
+            counts = self._counts.setdefault(model_name, {'retries': 0, 'timeouts': 0, 'hedges': 0, 'hedges_won': 0})
+            counts[key] += 1
+
+    def stats(self):
+        """各模型的斷路器狀態、打開次數、重試 / 逾時 / 對沖次數與最近的 p95 延遲（以本行程為準）"""
+        with self._lock:
+            models = set(self._breakers) | set(self._counts)
+            breakers = dict(self._breakers)
+            counts = {name: dict(values) for name, values in self._counts.items()}
+        result = {}
+        for name in sorted(models):
+            breaker = breakers.get(name)
+            delay = self.hedge_delay(name)
+            result[name] = dict(
+                counts.get(name, {'retries': 0, 'timeouts': 0, 'hedges': 0, 'hedges_won': 0}),
+                state=breaker.state if breaker else CLOSED,
+                failures=breaker.failures if breaker else 0,
+                trips=breaker.trips if breaker else 0,
+                rejected=breaker.rejected if breaker else 0,
+                hedge_delay_ms=round(delay * 1000) if delay is not None else None,
+            )
+        return {'hedge': self.hedge, 'models': result}
@@ -0,0 +1,269 @@
+import difflib
+import sqlite3
+import threading
+import time
+from utils.db import ThreadLocalSqlite
+from utils.maps import extract_area, is_generic_name
+from utils.merge import normalize_key
+from utils.log import get_logger
+from utils import metrics
+
+# 已知店家索引
+#
+# 每次成功辨識都會得到店名、original_handle 與地址，以前推完卡片就丟掉了。
+# 這裡把它們記在 SQLite：以正規化後的帳號 / 店名當 key，存下看過的行政區與 Google Maps 查詢字串。
+#   - 產生地圖連結時：同一個帳號在別的貼文出現過行政區（或帳號），直接補進查詢
+#   - 模型分層：flash 辨識出的店家都是看過好幾次的已知店家時，不必再升級到 Pro
+# 精確查詢走 B-tree 索引；差一個字的店名 / 帳號用 FTS5 trigram 索引找候選，數十萬筆仍在毫秒內。
+
+FUZZY_MIN_LENGTH = 8       # key 至少幾個字才做模糊比對（太短的店名差一個字常常就是另一家店）
+FUZZY_MIN_RATIO = 0.9      # 模糊比對的相似度門檻（difflib ratio）
+FUZZY_CANDIDATES = 200     # 最多取回幾個候選再算相似度
+
+log = get_logger('shops')
+
+LOOKUPS = metrics.counter('maps_known_shop_lookups_total', '已知店家查詢次數（exact / fuzzy / miss）', ['result'])
+
+_COLUMNS = 'id, name, handle, area, address, query, seen'
+_FUZZY_COLUMNS = 's.id, s.name, s.handle, s.area, s.address, s.query, s.seen, s.name_key, s.handle_key'
+
+
+def _phrase(text):
+    # FTS5 片語（trigram tokenizer 下就是子字串比對）
+    return '"{}"'.format(text.replace('"', '""'))
+
+
+def _row_to_shop(row):
+    return {
+        'name': row[1],
+        'handle': row[2],
+        'area': row[3],
+        'address': row[4],
+        'query': row[5],
+        'seen': row[6],
+    }
+
+
+class ShopIndex:
+    """辨識過的店家（SQLite + FTS5 trigram）"""
+
+    def __init__(self, db_path, min_seen=2):
+        """
+        參數:
+            db_path: str - SQLite 檔案路徑
+            min_seen: int - 被辨識過幾次才算「已知店家」（模型分層可以不升級）
+        """
+        self.min_seen = min_seen
+        self._lock = threading.Lock()
+        self._counts = {'recorded': 0, 'exact': 0, 'fuzzy': 0, 'miss': 0, 'trusted': 0}
+        self._db = ThreadLocalSqlite(db_path, [
+            'CREATE TABLE IF NOT EXISTS shops ('
+            ' id INTEGER PRIMARY KEY,'
+            ' name_key TEXT NOT NULL,'
+            ' handle_key TEXT NOT NULL,'
+            ' name TEXT NOT NULL,'
+            ' handle TEXT NOT NULL,'
+            ' area TEXT NOT NULL,'
+            ' address TEXT NOT NULL,'
+            ' query TEXT NOT NULL,'
+            ' seen INTEGER NOT NULL,'
+            ' updated_at REAL NOT NULL)',
+            'CREATE INDEX IF NOT EXISTS shops_name_key ON shops (name_key)',
+            'CREATE INDEX IF NOT EXISTS shops_handle_key ON shops (handle_key)',
+            # 外部內容的 FTS 表：只索引 key，內容留在 shops，由 trigger 同步
+            "CREATE VIRTUAL TABLE IF NOT EXISTS shops_fts USING fts5("
+            " name_key, handle_key, content='shops', content_rowid='id', tokenize='trigram')",
+            'CREATE TRIGGER IF NOT EXISTS shops_ai AFTER INSERT ON shops BEGIN'
+            ' INSERT INTO shops_fts (rowid, name_key, handle_key) VALUES (new.id, new.name_key, new.handle_key);'
+            ' END',
+            'CREATE TRIGGER IF NOT EXISTS shops_au AFTER UPDATE OF name_key, handle_key ON shops BEGIN'
+            " INSERT INTO shops_fts (shops_fts, rowid, name_key, handle_key)"
+            " VALUES ('delete', old.id, old.name_key, old.handle_key);"
+            ' INSERT INTO shops_fts (rowid, name_key, handle_key) VALUES (new.id, new.name_key, new.handle_key);'
+            ' END',
+        ])
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counts[key] += value
+
+    def _find(self, conn, name_key, handle_key):
+        # 帳號全世界唯一，先比帳號；店名也可能等於別筆的帳號（No.5 Cafe ↔ no5ca_fe）
+        if handle_key:
+            row = conn.execute(
+                f'SELECT {_COLUMNS} FROM shops WHERE handle_key = ? OR name_key = ? ORDER BY seen DESC LIMIT 1',
+                (handle_key, handle_key)
+            ).fetchone()
+            if row:
+                return row
+        if name_key:
+            return conn.execute(
+                f'SELECT {_COLUMNS} FROM shops WHERE name_key = ? OR handle_key = ? ORDER BY seen DESC LIMIT 1',
+                (name_key, name_key)
+            ).fetchone()
+        return None
+
+    def _fuzzy(self, conn, key):
+        # 差一個字（多 / 少 / 錯）時，把 key 切成三段，至少有兩段完全沒變：
+        # 用 FTS5 trigram 找「包含其中任兩段」的候選（子字串查詢走索引），再逐一算相似度。
+        # 只要求一段的話，常見字（cafe、咖啡）組成的那段候選太多，正確的店家會被 LIMIT 擠掉
+        if len(key) < FUZZY_MIN_LENGTH:
+            return None
+        if len(key) >= 9:
+            step = len(key) // 3
+            first, second, third = _phrase(key[:step]), _phrase(key[step:2 * step]), _phrase(key[2 * step:])
+            match = f'({first} AND {second}) OR ({first} AND {third}) OR ({second} AND {third})'
+        else:
+            # 切三段會短於一個 trigram，改成前後兩段（至少一段沒變）
+            middle = len(key) // 2
+            match = f'{_phrase(key[:middle])} OR {_phrase(key[middle:])}'
+        rows = conn.execute(
+            f'SELECT {_FUZZY_COLUMNS} FROM shops_fts JOIN shops s ON s.id = shops_fts.rowid'
+            ' WHERE shops_fts MATCH ? LIMIT ?',
+            (match, FUZZY_CANDIDATES)
+        ).fetchall()
+
+        best, best_ratio = None, FUZZY_MIN_RATIO
+        matcher = difflib.SequenceMatcher(None, b=key)
+        for row in rows:
+            for candidate in row[7:]:
+                if not candidate:
+                    continue
+                matcher.set_seq1(candidate)
+                if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio:
+                    continue
+                ratio = matcher.ratio()
+                if ratio >= best_ratio:
+                    best, best_ratio = row, ratio
+        return best
+
+    def lookup(self, name, handle=''):
+        """
+        查詢已知店家（先精確比對帳號 / 店名，找不到再做模糊比對）
+
+        參數:
+            name: str - 店名
+            handle: str - 社群帳號（可選）
+
+        回傳:
+            dict 或 None: {"name", "handle", "area", "address", "query", "seen"}
+        """
+        name_key, handle_key = normalize_key(name), normalize_key(handle)
+        if not name_key and not handle_key:
+            return None
+        try:
+            conn = self._db.conn()
+            row = self._find(conn, name_key, handle_key)
+            result = 'exact'
+            if row is None:
+                row = self._fuzzy(conn, handle_key or name_key)
+                result = 'fuzzy' if row else 'miss'
+        except sqlite3.Error:
+            # 查不到只是少了補充資訊，不影響產生卡片
+            log.exception('shop_lookup_failed')
+            return None
+        self._count(result)
+        LOOKUPS.inc(result=result)
+        return _row_to_shop(row) if row else None
+
+    def is_known(self, restaurant):
+        """
+        店家是否已被辨識過至少 min_seen 次（只看精確比對，不用模糊比對）
+
+        參數:
+            restaurant: dict - 辨識結果中的單一店家
+        """
+        name = restaurant.get('name') or ''
+        if is_generic_name(name):
+            return False
+        row = self._find(self._db.conn(), normalize_key(name), normalize_key(restaurant.get('original_handle')))
+        return row is not None and row[6] >= self.min_seen
+
+    def trusts(self, result):
+        """
+        結果中的店家是否都是已知店家（模型分層用來略過升級）
+
+        參數:
+            result: dict - 整理過的辨識結果
+
+        回傳:
+            bool
+        """
+        restaurants = result.get('restaurants') or []
+        try:
+            trusted = bool(restaurants) and all(self.is_known(restaurant) for restaurant in restaurants)
+        except sqlite3.Error:
+            log.exception('shop_lookup_failed')
+            return False
+        if trusted:
+            self._count('trusted')
+        return trusted
+
+    def record(self, restaurants):
+        """
+        記下辨識到的店家（已有的話合併：帳號、行政區、地址取有值的那一份，並累計次數）
+
+        參數:
+            restaurants: list[dict] - 辨識結果的 restaurants
+
+        回傳:
+            int: 實際記錄的店家數（菜市場名不記）
+        """
+        now = time.time()
+        recorded = 0
+        conn = self._db.conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for restaurant in restaurants:
+                name = (restaurant.get('name') or '').strip()
+                if not name or name == 'unknown' or is_generic_name(name):
+                    continue
+                handle = (restaurant.get('original_handle') or '').strip()
+                address = (restaurant.get('address') or '').strip()
+                if address == 'unknown':
+                    address = ''
+                name_key, handle_key = normalize_key(name), normalize_key(handle)
+
+                row = self._find(conn, name_key, handle_key)
+                if row:
+                    name = row[1]
+                    handle = handle or row[2]
+                    address = address or row[4]
+                    area = extract_area(address) or row[3]
+                else:
+                    area = extract_area(address)
+                query = ' '.join(part for part in (name, handle, area or address) if part)
+
+                if row and handle == row[2]:
+                    conn.execute(
+                        'UPDATE shops SET area = ?, address = ?, query = ?, seen = seen + 1, updated_at = ? WHERE id = ?',
+                        (area, address, query, now, row[0])
+                    )
+                elif row:
+                    # 第一次看到這家店的帳號（FTS 索引由 trigger 更新）
+                    conn.execute(
+                        'UPDATE shops SET handle_key = ?, handle = ?, area = ?, address = ?, query = ?,'
+                        ' seen = seen + 1, updated_at = ? WHERE id = ?',
+                        (normalize_key(handle), handle, area, address, query, now, row[0])
+                    )
+                else:
+                    conn.execute(
+                        'INSERT INTO shops (name_key, handle_key, name, handle, area, address, query, seen, updated_at)'
+                        ' VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?)',
+                        (name_key, handle_key, name, handle, area, address, query, now)
+                    )
+                recorded += 1
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        self._count('recorded', recorded)
+        return recorded
+
+    def stats(self):
+        """店家數與查詢結果（查詢次數以本行程為準）"""
+        with self._lock:
+            counts = dict(self._counts)
+        counts['shops'] = self._db.execute('SELECT COUNT(*) FROM shops').fetchone()[0]
+        counts['min_seen'] = self.min_seen
+        return counts
@@ -0,0 +1,130 @@
+import asyncio
+import copy
+import threading
+from utils import metrics
+
+# 相同請求合併（single-flight）
+#
+# 群組裡好幾個人同時轉傳同一張截圖，或同一個人連按兩次傳送時，
+# 辨識快取還沒寫入，每個事件都會各自呼叫一次 Gemini。
+# 這裡用圖片雜湊當 key：同一個 key 已經有人在辨識，後到的呼叫就等它的結果，
+# 不再重複呼叫。只在本行程內合併；跨 worker 的重複由辨識快取（SQLite）處理。
+# AsyncSingleFlight 是 ASGI 模式（asyncio）用的版本，等待時不佔用執行緒。
+
+SHARED = metrics.counter('maps_singleflight_shared_total', '等待進行中的相同辨識、沒有另外呼叫 Gemini 的次數')
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """同一個 key 同時只執行一次，其他呼叫者共用結果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._executed = 0
+        self._shared = 0
+
+    def do(self, key, fn):
+        """
+        執行 fn()；同一個 key 已在執行中時等待並共用它的結果
+
+        參數:
+            key: str - 合併用的 key（例如圖片 SHA-256）
+            fn: callable() - 實際的工作
+
+        回傳:
+            tuple(結果, bool): (fn 的回傳值, 是否共用別人的結果)；
+            共用時回傳深複製，呼叫端可以各自修改
+
+        例外:
+            fn 丟出的例外（等待中的呼叫者也會收到同一個例外）
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._shared += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self._executed += 1
+                leader = True
+
+        if not leader:
+            SHARED.inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result), True
+
+        try:
+            result = fn()
+            # 另存一份給等待者，leader 的呼叫端修改回傳值也不會影響它們
+            call.result = copy.deepcopy(result)
+            return result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """實際執行 / 共用結果的次數與目前進行中的數量（以本行程為準）"""
+        with self._lock:
+            return {
+                'executed': self._executed,
+                'shared': self._shared,
+                'in_flight': len(self._calls),
+            }
+
+
+class AsyncSingleFlight(SingleFlight):
+    """SingleFlight 的 asyncio 版本（同一個 event loop 內合併）"""
+
+    async def do(self, key, fn):
+        """
+        執行 await fn()；同一個 key 已在執行中時等待並共用它的結果
+
+        參數:
+            key: str - 合併用的 key
+            fn: async callable() - 實際的工作
+
+        回傳 / 例外:
+            同 SingleFlight.do()；leader 被取消（逾時 / 關機）時等待者收到 TimeoutError，
+            走一般的失敗流程，不會被當成自己被取消
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            self._shared += 1
+            SHARED.inc()
+            # shield：等待者自己被取消不會連帶取消 leader 的工作
+            result = await asyncio.shield(future)
+            return copy.deepcopy(result), True
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        self._executed += 1
+        try:
+            result = await fn()
+            future.set_result(copy.deepcopy(result))
+            return result, False
+        except asyncio.CancelledError:
+            # 不用 future.cancel()：等待者收到 CancelledError 會以為是自己被取消（例如關機）
+            future.set_exception(TimeoutError(f'singleflight leader for {key!r} was cancelled'))
+            future.exception()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 沒有等待者時避免「exception was never retrieved」警告
+            future.exception()
+            raise
+        finally:
+            del self._calls[key]
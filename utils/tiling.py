@@ -0,0 +1,166 @@
+import difflib
+import math
+from utils.merge import merge_results, normalize_key
+from utils import metrics
+
+# 長截圖切塊
+#
+# 推薦清單常是一路往下捲的長截圖（寬 1080、高一萬像素以上，8 ~ 10 家店）。整張送出時，
+# 前處理要把長邊縮到 PREPROCESS_MAX_EDGE，寬度只剩一兩百像素，小字根本讀不出來，
+# 而且是一次又長又慢的模型呼叫。這裡把太長的圖切成幾段約一個手機畫面高的區塊：
+#   - 切點挑在列與列之間的留白（每一列的邊緣量最少的地方），盡量不切過文字
+#   - 相鄰區塊重疊一小段，切在一家店中間時兩邊都看得到
+#   - 區塊數有上限，超過就把每塊切高一點；區塊在辨識時才裁切，記憶體裡同時只有幾塊
+# 各區塊辨識完依順序合併：重疊處重複的店家只留一筆（店名差幾個字也算同一家），保留清單順序。
+
+PROFILE_WIDTH = 256          # 找切點時把圖縮到這個寬度再算每一列的邊緣量
+SEARCH_RATIO = 0.15          # 理想切點上下多少比例的區塊高度內找留白
+EDGE_LEVEL = 40              # FIND_EDGES 後超過這個亮度才算邊緣像素
+DUPLICATE_RATIO = 0.85       # 相鄰區塊的店名相似度達到這個值視為同一家店
+BOUNDARY_ENTRIES = 3         # 只比對相鄰區塊交界處（前一塊最後 / 下一塊最前）的幾家店
+
+TILED_IMAGES = metrics.counter('maps_tiled_images_total', '切成多個區塊辨識的長截圖數')
+TILES = metrics.counter('maps_tiles_total', '長截圖切出的區塊辨識結果（ok / empty / error）', ['outcome'])
+OVERLAP_DUPLICATES = metrics.counter('maps_tile_duplicates_total', '相鄰區塊重疊處重複、合併掉的店家數')
+DECODE_REDUCED = metrics.counter('maps_decode_reduced_total', '超過解碼像素上限、以縮小倍率解碼的圖片數')
+
+
+def limit_decode(image, max_pixels):
+    """
+    在 load() 之前限制解碼的像素數（只對 JPEG 有效：直接以 1/2、1/4、1/8 解碼，不先解出整張原圖）
+
+    參數:
+        image: PIL.Image - Image.open() 後、還沒 load() 的圖片
+        max_pixels: int - 像素上限（0 = 不限）
+
+    回傳:
+        bool: 是否縮小解碼
+    """
+    width, height = image.size
+    if not max_pixels or width * height <= max_pixels or image.format != 'JPEG':
+        return False
+    scale = math.sqrt(max_pixels / (width * height))
+    image.draft('RGB', (max(1, int(width * scale)), max(1, int(height * scale))))
+    if image.size == (width, height):
+        return False
+    DECODE_REDUCED.inc()
+    return True
+
+
+def row_profile(image, width=PROFILE_WIDTH):
+    """
+    每一列的邊緣量（0 ~ 255，越小越接近留白）
+
+    參數:
+        image: PIL.Image - 圖片
+        width: int - 先縮到這個寬度再計算
+
+    回傳:
+        tuple(list[int], float): (由上到下每一列的值, 原圖每像素對應幾列)
+    """
+    from PIL import Image, ImageFilter
+
+    scale = min(1.0, width / image.width)
+    small = image.convert('L')
+    if scale < 1.0:
+        # reduce 先整數倍縮小（快），剩下的交給 resize
+        factor = max(1, int(1 / scale))
+        if factor > 1:
+            small = small.reduce(factor)
+        small = small.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))))
+    edges = small.filter(ImageFilter.FIND_EDGES).point(lambda value: 255 if value > EDGE_LEVEL else 0)
+    # 縮成一欄：每一列的平均值 = 這一列的邊緣像素比例
+    column = edges.resize((1, edges.height), Image.BOX)
+    return list(column.getdata()), small.height / image.height
+
+
+def plan_tiles(image, min_aspect=3.0, tile_aspect=2.0, overlap=0.1, max_tiles=6):
+    """
+    規劃長截圖的切塊位置（不裁切）
+
+    參數:
+        image: PIL.Image - 圖片
+        min_aspect: float - 高 / 寬超過這個值才切
+        tile_aspect: float - 每塊的高約為寬的幾倍
+        overlap: float - 相鄰區塊重疊的高度（區塊高度的比例）
+        max_tiles: int - 最多切幾塊（超過就把每塊切高一點）
+
+    回傳:
+        list[tuple(int, int, int, int)]: 每塊的 (left, top, right, bottom)；不需要切時回傳空 list
+    """
+    width, height = image.size
+    if not width or height <= width * min_aspect or max_tiles < 2:
+        return []
+
+    count = min(max_tiles, math.ceil(height / (width * tile_aspect)))
+    if count < 2:
+        return []
+    tile_height = height / count
+    margin = int(tile_height * overlap / 2)
+
+    profile, scale = row_profile(image)
+    search = max(1, int(tile_height * SEARCH_RATIO * scale))
+    cuts = [0]
+    for index in range(1, count):
+        # 理想切點附近邊緣量最少的一列（一樣少時取離理想切點最近的）
+        target = int(index * tile_height * scale)
+        low, high = max(int(cuts[-1] * scale) + 1, target - search), min(len(profile) - 1, target + search)
+        best = min(range(low, high + 1), key=lambda row: (profile[row], abs(row - target)), default=target)
+        cuts.append(min(height, int(best / scale)))
+    cuts.append(height)
+
+    return [
+        (0, max(0, top - margin), width, min(height, bottom + margin))
+        for top, bottom in zip(cuts, cuts[1:])
+    ]
+
+
+def _similar(a, b):
+    if not a or not b:
+        return False
+    if min(len(a), len(b)) >= 4 and (a in b or b in a):
+        return True
+    return difflib.SequenceMatcher(None, a, b).ratio() >= DUPLICATE_RATIO
+
+
+def merge_tiles(results, max_restaurants=10):
+    """
+    依區塊順序合併辨識結果
+
+    相鄰區塊交界處的店家，店名 / 帳號幾乎相同（切在店名中間、少讀一兩個字）就當成同一家，
+    統一成比較完整的店名後交給 merge_results 去重（後出現的資料可以補上地址與帳號）。
+
+    參數:
+        results: list[dict 或 None] - 由上到下每一塊的辨識結果（失敗的區塊為 None）
+        max_restaurants: int - 最多保留幾家
+
+    回傳:
+        dict: {"restaurants": [...], "count": int, "food_keywords": str}
+    """
+    normalized = []
+    previous = []
+    for result in results:
+        if not result:
+            previous = []
+            continue
+        restaurants = [dict(restaurant) for restaurant in result.get('restaurants', [])]
+        for restaurant in restaurants[:BOUNDARY_ENTRIES]:
+            name_key = normalize_key(restaurant.get('name'))
+            handle_key = normalize_key(restaurant.get('original_handle'))
+            for earlier in previous[-BOUNDARY_ENTRIES:]:
+                earlier_name = normalize_key(earlier.get('name'))
+                earlier_handle = normalize_key(earlier.get('original_handle'))
+                if name_key == earlier_name or (handle_key and handle_key == earlier_handle):
+                    # 完全相同的交給 merge_results
+                    OVERLAP_DUPLICATES.inc()
+                    break
+                if _similar(name_key, earlier_name) or (handle_key and _similar(handle_key, earlier_handle)):
+                    # 交界處的店名常被切掉一截：兩邊都改用比較完整（較長）的那個
+                    OVERLAP_DUPLICATES.inc()
+                    if len(name_key) > len(earlier_name):
+                        earlier['name'] = restaurant['name']
+                    restaurant['name'] = earlier['name']
+                    break
+        normalized.append(dict(result, restaurants=restaurants))
+        previous = restaurants
+    return merge_results(normalized, max_restaurants)
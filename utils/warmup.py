@@ -0,0 +1,144 @@
+import importlib
+import os
+import threading
+import time
+from utils.log import get_logger
+
+# 冷啟動預熱
+#
+# 重量級模組（google.generativeai、linebot.v3 的 model、PIL）都改成用到才 import，
+# app 本身幾百毫秒內就能開始接 webhook（驗簽名 + 排入佇列不需要它們）。
+# 每個 worker 行程啟動後在背景執行緒依序跑預熱步驟：import 模組、建立 Gemini client、
+# 打開 LINE 連線池……，第一則訊息進來時通常都已經準備好。
+# /warmup 會同步跑完尚未完成（或失敗）的步驟，/healthz 只回報目前狀態。
+
+log = get_logger('warmup')
+
+HEAVY_MODULES = (
+    'google.generativeai',
+    'linebot.v3.messaging',
+    'linebot.v3.webhooks',
+    'PIL.Image',
+)
+
+
+def preload_modules(modules=HEAVY_MODULES):
+    """
+    import 重量級模組
+
+    gunicorn 設定 preload 時由 master 在 fork 前呼叫，worker 直接共用已載入的模組。
+
+    參數:
+        modules: iterable[str] - 模組名稱
+
+    回傳:
+        dict: 模組名稱 → import 耗時（ms）
+    """
+    timings = {}
+    for name in modules:
+        start = time.perf_counter()
+        importlib.import_module(name)
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+    return timings
+
+
+class Warmup:
+    """
+    每個行程各跑一次的預熱步驟
+
+    步驟失敗只記錄錯誤，不影響服務；下次 run() 會重試失敗的步驟。
+    狀態以 pid 區分，gunicorn fork 出來的 worker 會重新預熱。
+    """
+
+    def __init__(self):
+        self._steps = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        # 呼叫端需持有 self._lock（或在 __init__ 中）
+        self._pid = os.getpid()
+        self._run_lock = threading.Lock()
+        self._thread = None
+        self._started = False
+        self._done = {}       # 步驟名稱 → 耗時（ms）
+        self._errors = {}     # 步驟名稱 → 錯誤訊息
+
+    def _current(self):
+        # 呼叫端需持有 self._lock
+        if self._pid != os.getpid():
+            self._reset()
+
+    def add(self, name, fn):
+        """
+        加入預熱步驟（依加入順序執行）
+
+        參數:
+            name: str - 步驟名稱（顯示在 /healthz、/warmup）
+            fn: callable() - 預熱動作
+        """
+        self._steps.append((name, fn))
+
+    def start(self):
+        """在背景執行緒開始預熱（同一個行程只會啟動一次）"""
+        with self._lock:
+            self._current()
+            if self._thread is not None:
+                return
+            self._started = True
+            self._thread = threading.Thread(target=self.run, name='warmup', daemon=True)
+            self._thread.start()
+
+    def run(self):
+        """
+        同步執行尚未完成的步驟（背景預熱進行中時會等它跑完）
+
+        回傳:
+            dict: 同 status()
+        """
+        with self._lock:
+            self._current()
+            run_lock = self._run_lock
+            self._started = True
+
+        with run_lock:
+            for name, fn in self._steps:
+                with self._lock:
+                    if name in self._done:
+                        continue
+                start = time.perf_counter()
+                try:
+                    fn()
+                except Exception as e:
+                    log.warning('warmup_step_failed', step=name, error=str(e))
+                    with self._lock:
+                        self._errors[name] = str(e)
+                    continue
+                elapsed = round((time.perf_counter() - start) * 1000, 1)
+                with self._lock:
+                    self._done[name] = elapsed
+                    self._errors.pop(name, None)
+
+        status = self.status()
+        log.info('warmup_finished', steps=status['steps'], failed=list(status['errors']))
+        return status
+
+    def status(self):
+        """目前的預熱狀態與各步驟耗時（以本行程為準）"""
+        with self._lock:
+            self._current()
+            if not self._started:
+                state = 'cold'
+            elif len(self._done) == len(self._steps):
+                state = 'warm'
+            elif self._run_lock.locked() or (self._thread is not None and self._thread.is_alive()):
+                state = 'warming'
+            else:
+                state = 'partial'
+            return {
+                'state': state,
+                'pid': self._pid,
+                'steps': dict(self._done),
+                'errors': dict(self._errors),
+            }